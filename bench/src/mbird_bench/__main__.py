@@ -0,0 +1,101 @@
+"""
+Run the benchmark suite, or compare two runs.
+
+    python -m mbird_bench run --output results.json
+    python -m mbird_bench compare baseline.json results.json
+
+`compare` exits with status 1 if any benchmark regressed.
+"""
+
+import argparse
+from pathlib import Path
+import sys
+
+from mbird_bench import trees
+from mbird_bench.results import (
+    NOISE_SECONDS,
+    REGRESSION_THRESHOLD,
+    compare,
+    read_results,
+    write_results,
+)
+from mbird_bench.suite import REPEAT, SIZES, all_benchmarks, run
+
+
+def _run(args: argparse.Namespace) -> int:
+    benchmarks = [
+        benchmark
+        for benchmark in all_benchmarks()
+        if not args.filter or any(f in benchmark.name for f in args.filter)
+    ]
+    results = run(benchmarks, args.shapes, args.sizes, repeat=args.repeat)
+    write_results(args.output, results)
+    print(f"Wrote {len(results)} results to {args.output}")
+    return 0
+
+
+def _compare(args: argparse.Namespace) -> int:
+    baseline = read_results(args.baseline)
+    current = read_results(args.current)
+    changes = compare(
+        baseline, current, threshold=args.threshold, noise_seconds=args.noise
+    )
+    for change in changes:
+        marker = "REGRESSED" if change.regressed else ""
+        print(
+            f"{change.key:<44} {change.baseline:>9.4f}s -> {change.current:>9.4f}s"
+            f" {change.ratio:>6.2f}x {marker}"
+        )
+
+    missing = len(baseline) - len(changes)
+    if missing:
+        print(f"{missing} baseline benchmarks weren't run in {args.current}")
+
+    regressions = [change for change in changes if change.regressed]
+    print(f"{len(regressions)} of {len(changes)} benchmarks regressed")
+    return 1 if regressions else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m mbird_bench")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "--output", type=Path, default=Path("bench_results.json"), help="JSON file"
+    )
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    run_parser.add_argument(
+        "--shapes", nargs="+", choices=list(trees.SHAPES), default=list(trees.SHAPES)
+    )
+    run_parser.add_argument(
+        "--filter", nargs="+", help="Only run benchmarks whose names contain these"
+    )
+    run_parser.add_argument("--repeat", type=int, default=REPEAT)
+    run_parser.set_defaults(handler=_run)
+
+    compare_parser = commands.add_parser(
+        "compare", help="Flag regressions against a baseline run"
+    )
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("current", type=Path)
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="Slowdown (as a fraction of the baseline) that counts as a regression",
+    )
+    compare_parser.add_argument(
+        "--noise",
+        type=float,
+        default=NOISE_SECONDS,
+        help="Slowdowns below this many seconds are ignored",
+    )
+    compare_parser.set_defaults(handler=_compare)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
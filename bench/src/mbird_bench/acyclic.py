@@ -0,0 +1,70 @@
+"""
+Benchmark tree construction and cycle validation across tree sizes.
+
+Run with `python -m mbird_bench.acyclic`. Time per node should stay roughly flat
+as the node count grows if validation is linear.
+"""
+
+from collections.abc import Callable
+from functools import partial
+import json
+from pathlib import Path
+import tempfile
+import time
+
+from mbird_data import MbirdData, MbirdNode
+
+from mbird_bench import trees
+
+SIZES = [1_000, 10_000, 100_000]
+SHAPES: dict[str, Callable[[int], trees.TreeDict]] = {
+    "chain": trees.chain,
+    "fan": trees.fan,
+    "balanced": trees.balanced,
+}
+
+
+def time_call(fn: Callable[[], object], repeat: int = 3) -> float:
+    """Best-of-`repeat` wall time in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(label: str, num_nodes: int, seconds: float) -> None:
+    per_node_us = seconds / num_nodes * 1e6
+    print(
+        f"{label:<28} {num_nodes:>9} nodes {seconds:>9.4f}s {per_node_us:>7.2f}us/node"
+    )
+
+
+def bench_from_dict() -> None:
+    for shape, make_tree in SHAPES.items():
+        for num_nodes in SIZES:
+            data = make_tree(num_nodes)
+            seconds = time_call(partial(MbirdNode.from_dict, data))
+            report(f"from_dict[{shape}]", num_nodes, seconds)
+
+
+def bench_load() -> None:
+    # json.loads itself recurses, so deep chains are left to from_dict above
+    with tempfile.TemporaryDirectory() as tmp:
+        for shape in ["fan", "balanced"]:
+            for num_nodes in SIZES:
+                project = Path(tmp) / f"{shape}_{num_nodes}.mbird"
+                project.mkdir()
+                (project / "tree.json").write_text(json.dumps(SHAPES[shape](num_nodes)))
+                seconds = time_call(partial(MbirdData.load, project))
+                report(f"MbirdData.load[{shape}]", num_nodes, seconds)
+
+
+def main() -> None:
+    bench_from_dict()
+    bench_load()
+
+
+if __name__ == "__main__":
+    main()
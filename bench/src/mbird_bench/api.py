@@ -0,0 +1,122 @@
+"""
+Benchmarks of the console API's main routes, through the FastAPI test client.
+
+Needs mbird_console (and httpx, for the test client).
+"""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from mbird_console.api import routes
+from mbird_console.catalog import CatalogScanner, ProjectCatalog
+from mbird_console.main import app
+from mbird_console.sessions import SessionRegistry
+from mbird_data import MbirdData, MbirdNode
+
+from mbird_bench import trees
+from mbird_bench.suite import Benchmark, Case
+
+# Every node is stored under its id, so ids must be unique; deep chains are
+# left out as projects are saved as indented JSON
+API_SHAPES = ("fan", "balanced")
+
+
+@contextmanager
+def _project(tree: trees.TreeDict, workdir: Path) -> Iterator[tuple[TestClient, str]]:
+    """Start the app with a saved project, and its path."""
+    project = str(workdir / "project.mbird")
+    MbirdData(root=MbirdNode.from_dict(tree)).save(project, binary=True)
+
+    # Leave the user's catalog alone
+    routes.registry = SessionRegistry(routes.generate)
+    routes.catalog = ProjectCatalog(workdir / "catalog.sqlite3")
+    routes.catalog_scanner = CatalogScanner(routes.catalog)
+    with TestClient(app) as client:
+        yield client, project
+
+
+def _open(client: TestClient, project: str, depth: int | None = None) -> str:
+    request: dict[str, object] = {"path": project}
+    if depth is not None:
+        request["depth"] = depth
+    response = client.post("/api/project/load", json=request)
+    response.raise_for_status()
+    return response.json()["project_id"]
+
+
+def _close_all(client: TestClient) -> None:
+    for project in client.get("/api/projects").json()["projects"]:
+        client.delete(f"/api/projects/{project['project_id']}").raise_for_status()
+
+
+@contextmanager
+def _load(
+    tree: trees.TreeDict, workdir: Path, depth: int | None = None
+) -> Iterator[Case]:
+    with _project(tree, workdir) as (client, project):
+        yield Case(
+            lambda: _open(client, project, depth), before=lambda: _close_all(client)
+        )
+
+
+@contextmanager
+def _load_lazy(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    with _load(tree, workdir, depth=1) as case:
+        yield case
+
+
+@contextmanager
+def _get_tree(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    with _project(tree, workdir) as (client, project):
+        project_id = _open(client, project)
+        yield Case(
+            lambda: client.get(f"/api/projects/{project_id}/tree").raise_for_status()
+        )
+
+
+@contextmanager
+def _patch(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    with _project(tree, workdir) as (client, project):
+        project_id = _open(client, project)
+        root_id = tree["id"]
+        # Leaves the tree as it was, apart from stale flags
+        ops = [
+            {"op": "add", "parent_id": root_id, "node": {"id": "bench"}},
+            {"op": "remove", "node_id": "bench"},
+        ]
+        yield Case(
+            lambda: client.patch(
+                f"/api/projects/{project_id}/tree", json={"ops": ops}
+            ).raise_for_status()
+        )
+
+
+@contextmanager
+def _regenerate(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    with _project(tree, workdir) as (client, project):
+        project_ids: list[str] = []
+
+        def before() -> None:
+            # Closing saves the fresh flags, so every run starts from a stale
+            # copy and a new session that hasn't generated anything yet
+            _close_all(client)
+            MbirdData(root=MbirdNode.from_dict(tree)).save(project, binary=True)
+            project_ids[:] = [_open(client, project)]
+
+        yield Case(
+            lambda: client.post(
+                f"/api/projects/{project_ids[0]}/regenerate"
+            ).raise_for_status(),
+            before=before,
+        )
+
+
+API_BENCHMARKS = [
+    Benchmark("api.load", _load, API_SHAPES),
+    Benchmark("api.load_lazy", _load_lazy, API_SHAPES),
+    Benchmark("api.get_tree", _get_tree, API_SHAPES),
+    Benchmark("api.patch", _patch, API_SHAPES),
+    Benchmark("api.regenerate", _regenerate, API_SHAPES),
+]
@@ -0,0 +1,113 @@
+"""Benchmark results files, and comparing them against a baseline."""
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import platform
+
+RESULTS_VERSION = 1
+# Slowdowns above this fraction of the baseline time count as regressions
+REGRESSION_THRESHOLD = 0.1
+# Differences below this many seconds are treated as noise
+NOISE_SECONDS = 0.001
+
+
+@dataclass(frozen=True)
+class Result:
+    name: str
+    shape: str
+    num_nodes: int
+    # Best time over the repeats
+    seconds: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}[{self.shape}/{self.num_nodes}]"
+
+
+@dataclass(frozen=True)
+class Change:
+    key: str
+    baseline: float
+    current: float
+    regressed: bool
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline if self.baseline else float("inf")
+
+
+def write_results(path: Path, results: list[Result]) -> None:
+    """Write results as JSON, along with where and when they were measured."""
+    document = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [
+            {
+                "name": result.name,
+                "shape": result.shape,
+                "num_nodes": result.num_nodes,
+                "seconds": result.seconds,
+                "us_per_node": result.seconds / result.num_nodes * 1e6,
+            }
+            for result in results
+        ],
+    }
+    path.write_text(json.dumps(document, indent=2) + "\n")
+
+
+def read_results(path: Path) -> list[Result]:
+    """
+    Read results written by write_results().
+
+    Raises:
+        ValueError: If the file isn't a results file of a supported version
+    """
+    document = json.loads(path.read_text())
+    if not isinstance(document, dict) or document.get("version") != RESULTS_VERSION:
+        raise ValueError(f"Not a version {RESULTS_VERSION} results file: {path}")
+    return [
+        Result(
+            name=item["name"],
+            shape=item["shape"],
+            num_nodes=item["num_nodes"],
+            seconds=item["seconds"],
+        )
+        for item in document["results"]
+    ]
+
+
+def compare(
+    baseline: list[Result],
+    current: list[Result],
+    threshold: float = REGRESSION_THRESHOLD,
+    noise_seconds: float = NOISE_SECONDS,
+) -> list[Change]:
+    """
+    Compare the benchmarks measured in both runs.
+
+    A benchmark regressed if it got more than `threshold` (a fraction) slower,
+    by more than `noise_seconds`.
+
+    Returns:
+        Changes in the order of the current run
+    """
+    baseline_seconds = {result.key: result.seconds for result in baseline}
+    changes = []
+    for result in current:
+        before = baseline_seconds.get(result.key)
+        if before is None:
+            continue
+        slowdown = result.seconds - before
+        changes.append(
+            Change(
+                key=result.key,
+                baseline=before,
+                current=result.seconds,
+                regressed=slowdown > before * threshold and slowdown > noise_seconds,
+            )
+        )
+    return changes
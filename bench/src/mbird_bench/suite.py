@@ -0,0 +1,267 @@
+"""
+Benchmarks of mbird_data operations across tree shapes and sizes.
+
+Each benchmark prepares a case from a generated tree in a scratch directory,
+and the case's `run` is timed (best of a few repeats).
+"""
+
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+import tempfile
+import time
+
+from mbird_data import MbirdData, MbirdNode
+from mbird_data.diff import diff_trees
+from mbird_data.history import History
+from mbird_data.index import TreeIndex
+from mbird_data.merge import merge_trees
+from mbird_data.patch import AddChild, TreePatch
+from mbird_data.scheduler import RegenerationScheduler
+from mbird_data.search import NodeSearch
+from mbird_data.staleness import StalenessEngine
+from mbird_data.streaming import encode_json, iter_json
+
+from mbird_bench import trees
+from mbird_bench.results import Result
+
+SIZES = [1_000, 10_000, 100_000]
+REPEAT = 3
+
+ALL_SHAPES = tuple(trees.SHAPES)
+# Pydantic validates and dumps recursively, and indented JSON (as saved) grows
+# quadratically with depth, so deep chains are left out of those benchmarks
+SHALLOW_SHAPES = ("fan", "balanced", "shared")
+# Shapes that can be indexed (the shared shape's repeated ids are shared nodes)
+INDEXED_SHAPES = ("chain", "fan", "balanced", "shared")
+# Edits after a snapshot copy the path to the root, which is the whole tree for
+# deep chains
+SHALLOW_INDEXED_SHAPES = ("fan", "balanced", "shared")
+
+
+@dataclass
+class Case:
+    """A prepared benchmark: `run` is timed, after `before` (untimed) if given."""
+
+    run: Callable[[], object]
+    before: Callable[[], object] | None = None
+
+
+CaseSetup = Callable[[trees.TreeDict, Path], AbstractContextManager[Case]]
+
+
+@dataclass(frozen=True)
+class Benchmark:
+    name: str
+    # Prepares a case from a tree, in a scratch directory
+    setup: CaseSetup
+    shapes: tuple[str, ...]
+
+
+def time_call(
+    fn: Callable[[], object],
+    repeat: int = REPEAT,
+    before: Callable[[], object] | None = None,
+) -> float:
+    """Best-of-`repeat` wall time in seconds, calling `before` untimed each time."""
+    best = float("inf")
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(result: Result) -> None:
+    per_node_us = result.seconds / result.num_nodes * 1e6
+    print(
+        f"{result.name:<20} {result.shape:<9} {result.num_nodes:>9} nodes"
+        f" {result.seconds:>9.4f}s {per_node_us:>7.2f}us/node",
+        flush=True,
+    )
+
+
+@contextmanager
+def _from_dict(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    yield Case(lambda: MbirdNode.from_dict(tree))
+
+
+@contextmanager
+def _from_dict_trusted(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    yield Case(lambda: MbirdNode.from_dict(tree, validate=False))
+
+
+@contextmanager
+def _model_validate(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    yield Case(lambda: MbirdNode.model_validate(tree))
+
+
+@contextmanager
+def _model_dump(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    root = MbirdNode.from_dict(tree)
+    yield Case(root.model_dump)
+
+
+@contextmanager
+def _iter_json(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    root = MbirdNode.from_dict(tree)
+    yield Case(lambda: sum(len(chunk) for chunk in iter_json(root)))
+
+
+@contextmanager
+def _encode_json(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    root = MbirdNode.from_dict(tree)
+    yield Case(lambda: encode_json(root))
+
+
+@contextmanager
+def _save(tree: trees.TreeDict, workdir: Path, binary: bool = False) -> Iterator[Case]:
+    data = MbirdData(root=MbirdNode.from_dict(tree))
+    yield Case(lambda: data.save(workdir / "project.mbird", binary=binary))
+
+
+@contextmanager
+def _load(
+    tree: trees.TreeDict, workdir: Path, binary: bool = False, lazy: bool = False
+) -> Iterator[Case]:
+    project = workdir / "project.mbird"
+    MbirdData(root=MbirdNode.from_dict(tree)).save(project, binary=binary)
+    if lazy:
+        yield Case(lambda: MbirdData.load(project, lazy=True).subtree(depth=1))
+    else:
+        yield Case(lambda: MbirdData.load(project))
+
+
+@contextmanager
+def _index(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    root = MbirdNode.from_dict(tree)
+    yield Case(lambda: TreeIndex(root))
+
+
+@contextmanager
+def _search_index(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    index = TreeIndex(MbirdNode.from_dict(tree))
+    yield Case(lambda: NodeSearch(index))
+
+
+@contextmanager
+def _search(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    search = NodeSearch(TreeIndex(MbirdNode.from_dict(tree)))
+    yield Case(lambda: search.search("node12", is_stale=True))
+
+
+@contextmanager
+def _generate(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    engine = StalenessEngine(TreeIndex(MbirdNode.from_dict(tree)))
+    node_ids = [node.id for node in engine.index]
+    # A new scheduler each time, so nothing is skipped as unchanged
+    schedulers: list[RegenerationScheduler] = []
+
+    def before() -> None:
+        engine.reset_stale(node_ids, True)
+        schedulers[:] = [RegenerationScheduler(lambda node: None)]
+
+    yield Case(lambda: schedulers[0].run(engine), before=before)
+
+
+@contextmanager
+def _edit_undo(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    engine = StalenessEngine(TreeIndex(MbirdNode.from_dict(tree)))
+    history = History()
+    patch = TreePatch(ops=[AddChild(parent_id=tree["id"], node={"id": "bench"})])
+
+    def run() -> None:
+        # As when a reader took a snapshot between edits
+        engine.index.snapshot()
+        history.apply(engine, patch)
+        history.undo(engine)
+
+    yield Case(run)
+
+
+@contextmanager
+def _diff(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    old = MbirdNode.from_dict(tree)
+    new = MbirdNode.from_dict(tree)
+    new.children.reverse()
+    yield Case(lambda: diff_trees(old, new))
+
+
+@contextmanager
+def _merge(tree: trees.TreeDict, workdir: Path) -> Iterator[Case]:
+    base = MbirdNode.from_dict(tree)
+    ours = MbirdNode.from_dict(tree)
+    ours.children.reverse()
+    theirs = MbirdNode.from_dict(tree)
+    theirs.is_stale = not theirs.is_stale
+    yield Case(lambda: merge_trees(base, ours, theirs))
+
+
+def _variant(setup: Callable[..., AbstractContextManager[Case]], **kwargs) -> CaseSetup:
+    return lambda tree, workdir: setup(tree, workdir, **kwargs)
+
+
+BENCHMARKS = [
+    Benchmark("from_dict", _from_dict, ALL_SHAPES),
+    Benchmark("from_dict_trusted", _from_dict_trusted, ALL_SHAPES),
+    Benchmark("model_validate", _model_validate, SHALLOW_SHAPES),
+    Benchmark("model_dump", _model_dump, SHALLOW_SHAPES),
+    Benchmark("iter_json", _iter_json, ALL_SHAPES),
+    Benchmark("encode_json", _encode_json, ALL_SHAPES),
+    Benchmark("save_json", _save, SHALLOW_SHAPES),
+    Benchmark("save_binary", _variant(_save, binary=True), SHALLOW_SHAPES),
+    Benchmark("load_json", _load, SHALLOW_SHAPES),
+    Benchmark("load_binary", _variant(_load, binary=True), SHALLOW_SHAPES),
+    Benchmark("load_lazy", _variant(_load, binary=True, lazy=True), SHALLOW_SHAPES),
+    Benchmark("index", _index, INDEXED_SHAPES),
+    Benchmark("search_index", _search_index, INDEXED_SHAPES),
+    Benchmark("search", _search, INDEXED_SHAPES),
+    Benchmark("generate", _generate, INDEXED_SHAPES),
+    Benchmark("edit_undo", _edit_undo, SHALLOW_INDEXED_SHAPES),
+    Benchmark("diff", _diff, INDEXED_SHAPES),
+    Benchmark("merge", _merge, INDEXED_SHAPES),
+]
+
+
+def all_benchmarks() -> list[Benchmark]:
+    """The mbird_data benchmarks, and the console API's if it's installed."""
+    try:
+        from mbird_bench.api import API_BENCHMARKS
+    except ImportError as e:
+        print(f"Skipping the console API benchmarks: {e}")
+        return list(BENCHMARKS)
+    return BENCHMARKS + API_BENCHMARKS
+
+
+def run(
+    benchmarks: list[Benchmark],
+    shapes: list[str],
+    sizes: list[int],
+    repeat: int = REPEAT,
+    on_result: Callable[[Result], None] = report,
+) -> list[Result]:
+    """
+    Time every benchmark on every shape it supports, smallest trees first.
+
+    Returns:
+        One result per benchmark, shape and size
+    """
+    results = []
+    for num_nodes in sizes:
+        for shape in shapes:
+            tree = trees.SHAPES[shape](num_nodes)
+            for benchmark in benchmarks:
+                if shape not in benchmark.shapes:
+                    continue
+                with (
+                    tempfile.TemporaryDirectory() as tmp,
+                    benchmark.setup(tree, Path(tmp)) as case,
+                ):
+                    seconds = time_call(case.run, repeat, case.before)
+                result = Result(benchmark.name, shape, num_nodes, seconds)
+                results.append(result)
+                on_result(result)
+    return results
@@ -0,0 +1,59 @@
+from collections.abc import Callable
+from typing import Any
+
+TreeDict = dict[str, Any]
+
+
+def _node(index: int) -> TreeDict:
+    return {"id": f"node{index}", "children": [], "is_stale": True}
+
+
+def chain(num_nodes: int) -> TreeDict:
+    """Single path of num_nodes nodes (maximum depth)."""
+    root = _node(0)
+    node = root
+    for i in range(1, num_nodes):
+        child = _node(i)
+        node["children"].append(child)
+        node = child
+    return root
+
+
+def fan(num_nodes: int) -> TreeDict:
+    """Root with num_nodes - 1 leaf children (maximum width)."""
+    root = _node(0)
+    root["children"] = [_node(i) for i in range(1, num_nodes)]
+    return root
+
+
+def balanced(num_nodes: int, branching: int = 4) -> TreeDict:
+    """Tree of num_nodes nodes where every inner node has `branching` children."""
+    nodes = [_node(i) for i in range(num_nodes)]
+    for i in range(1, num_nodes):
+        nodes[(i - 1) // branching]["children"].append(nodes[i])
+    return nodes[0]
+
+
+def shared(num_nodes: int, copies: int = 4) -> TreeDict:
+    """
+    Root with `copies` branches that each hold one balanced subtree (about
+    num_nodes nodes).
+
+    Ids repeat across branches but never along a path, like a DAG flattened into
+    a tree. MbirdNode.from_dict() builds the branches' subtrees as one shared
+    subtree.
+    """
+    subtree = balanced(max(1, (num_nodes - 1 - copies) // copies))
+    branches = [
+        {"id": f"branch{i}", "children": [subtree], "is_stale": True}
+        for i in range(copies)
+    ]
+    return {"id": "shared", "children": branches, "is_stale": True}
+
+
+SHAPES: dict[str, Callable[[int], TreeDict]] = {
+    "chain": chain,
+    "fan": fan,
+    "balanced": balanced,
+    "shared": shared,
+}
@@ -1,38 +1,118 @@
-import { useState } from 'react'
+import { useCallback, useEffect, useState } from 'react'
+import NodeSearch from './components/NodeSearch'
 import ProjectDialog from './components/ProjectDialog'
 import TreeView from './components/TreeView'
+import { applyEvent, applyStale, decodeTree } from './treeEvents'
+
+// Identifies this tab, so the server doesn't echo its own edits back to it
+const clientId = crypto.randomUUID()
 
 function App() {
   const [projectLoaded, setProjectLoaded] = useState(false)
   const [projectPath, setProjectPath] = useState(null)
+  const [projectId, setProjectId] = useState(null)
   const [treeData, setTreeData] = useState(null)
   const [lastSaved, setLastSaved] = useState(null)
   const [saving, setSaving] = useState(false)
   const [regenerating, setRegenerating] = useState(false)
+  const [progress, setProgress] = useState(null)
+  const [canUndo, setCanUndo] = useState(false)
+  const [canRedo, setCanRedo] = useState(false)
+
+  // The server pushes changes made elsewhere, regeneration progress and
+  // background saves as they happen
+  useEffect(() => {
+    if (!projectId) return undefined
+    const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
+    const socket = new WebSocket(
+      `${protocol}//${window.location.host}/api/projects/${projectId}/events?client_id=${clientId}`
+    )
+    socket.onmessage = message => {
+      const { events } = JSON.parse(message.data)
+      for (const event of events) {
+        if (event.type === 'save_status' && event.last_saved) {
+          setLastSaved(new Date(event.last_saved))
+        } else if (event.type === 'progress') {
+          setProgress(event.running ? event : null)
+        }
+      }
+      setTreeData(tree => events.reduce(applyEvent, tree))
+    }
+    return () => socket.close()
+  }, [projectId])
 
-  const handleProjectLoaded = (path, tree) => {
+  const handleProjectLoaded = (path, id, tree) => {
     setProjectPath(path)
-    setTreeData(tree)
+    setProjectId(id)
+    setTreeData(tree && decodeTree(tree))
     setProjectLoaded(true)
   }
 
-  const handleTreeChange = async (newTreeData) => {
+  const handleTreeChange = async (newTreeData, ops) => {
     setTreeData(newTreeData)
 
-    await fetch('/api/tree', {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(newTreeData),
-    }).catch(err => console.error('Failed to update tree:', err))
+    try {
+      const response = await fetch(`/api/projects/${projectId}/tree`, {
+        method: 'PATCH',
+        headers: { 'Content-Type': 'application/json', 'X-Mbird-Client': clientId },
+        body: JSON.stringify({ ops }),
+      })
+      if (response.ok) {
+        // The server marks nodes that depend on the change stale
+        const data = await response.json()
+        setTreeData(tree => applyStale(tree, data.diff.stale))
+        setCanUndo(data.can_undo)
+        setCanRedo(data.can_redo)
+      } else {
+        console.error('Failed to update tree:', await response.text())
+      }
+    } catch (err) {
+      console.error('Failed to update tree:', err)
+    }
   }
 
+  // The changes come back over the events socket, like other clients' edits
+  const handleHistory = useCallback(
+    async step => {
+      try {
+        const response = await fetch(`/api/projects/${projectId}/${step}`, { method: 'POST' })
+        if (response.ok) {
+          const data = await response.json()
+          setCanUndo(data.can_undo)
+          setCanRedo(data.can_redo)
+        } else if (response.status !== 409) {
+          console.error(`Failed to ${step}:`, await response.text())
+        }
+      } catch (err) {
+        console.error(`Failed to ${step}:`, err)
+      }
+    },
+    [projectId]
+  )
+
+  useEffect(() => {
+    if (!projectId) return undefined
+    const onKeyDown = event => {
+      if (!(event.ctrlKey || event.metaKey)) return
+      // Text fields keep their own undo
+      if (event.target.closest?.('input, textarea, [contenteditable="true"]')) return
+      const key = event.key.toLowerCase()
+      if (key === 'z' || key === 'y') {
+        event.preventDefault()
+        handleHistory(key === 'y' || event.shiftKey ? 'redo' : 'undo')
+      }
+    }
+    window.addEventListener('keydown', onKeyDown)
+    return () => window.removeEventListener('keydown', onKeyDown)
+  }, [projectId, handleHistory])
+
   const handleSave = async () => {
     setSaving(true)
     try {
-      const response = await fetch('/api/save', { method: 'POST' })
+      const response = await fetch(`/api/projects/${projectId}/save`, { method: 'POST' })
       if (response.ok) {
         const data = await response.json()
-        setLastSaved(new Date(data.timestamp))
+        if (data.timestamp) setLastSaved(new Date(data.timestamp))
       } else {
         console.error('Save failed:', await response.text())
       }
@@ -46,10 +126,11 @@ function App() {
   const handleRegenerate = async () => {
     setRegenerating(true)
     try {
-      const response = await fetch('/api/regenerate', { method: 'POST' })
+      const response = await fetch(`/api/projects/${projectId}/regenerate`, { method: 'POST' })
       if (response.ok) {
         const data = await response.json()
-        setTreeData(data.tree)
+        const fresh = Object.fromEntries(data.regenerated.map(id => [id, false]))
+        setTreeData(tree => applyStale(tree, fresh))
       } else {
         console.error('Regenerate failed:', await response.text())
       }
@@ -60,6 +141,14 @@ function App() {
     }
   }
 
+  const handleNodeSelected = node => {
+    const element = document.querySelector(`[data-node-id="${CSS.escape(node.id)}"]`)
+    if (!element) return
+    element.scrollIntoView({ behavior: 'smooth', block: 'center' })
+    element.classList.add('tree-node-found')
+    setTimeout(() => element.classList.remove('tree-node-found'), 1500)
+  }
+
   if (!projectLoaded) {
     return <ProjectDialog onProjectLoaded={handleProjectLoaded} />
   }
@@ -75,11 +164,30 @@ function App() {
             disabled={regenerating}
             className="app-regenerate-btn"
           >
-            {regenerating ? 'Regenerating...' : 'Regenerate'}
+            {regenerating
+              ? `Regenerating...${progress ? ` ${progress.done}/${progress.total}` : ''}`
+              : 'Regenerate'}
+          </button>
+          <button
+            onClick={() => handleHistory('undo')}
+            disabled={!canUndo}
+            className="app-history-btn"
+            title="Undo (Ctrl+Z)"
+          >
+            Undo
+          </button>
+          <button
+            onClick={() => handleHistory('redo')}
+            disabled={!canRedo}
+            className="app-history-btn"
+            title="Redo (Ctrl+Shift+Z)"
+          >
+            Redo
           </button>
           <h2 className="app-title">{basename}</h2>
         </div>
         <div className="app-header-actions">
+          <NodeSearch projectId={projectId} onSelect={handleNodeSelected} />
           {lastSaved && (
             <span className="app-last-saved">
               Last saved: {lastSaved.toLocaleString()}
@@ -7,6 +7,8 @@ function DirectoryBrowser({ mode, onSelect }) {
   const [loading, setLoading] = useState(true)
   const [error, setError] = useState(null)
   const [newDirName, setNewDirName] = useState('')
+  const [filter, setFilter] = useState('')
+  const [total, setTotal] = useState(0)
 
   useEffect(() => {
     // Load default directory on mount (last used or home)
@@ -21,18 +23,26 @@ function DirectoryBrowser({ mode, onSelect }) {
       })
   }, [])
 
+  // Large directories are listed a page at a time
+  const fetchPage = async (path, prefix, offset) => {
+    const params = new URLSearchParams({ path, prefix, offset })
+    const response = await fetch(`/api/filesystem/browse?${params}`)
+    if (!response.ok) {
+      throw new Error('Failed to load directory')
+    }
+    return response.json()
+  }
+
   const loadDirectory = async (path) => {
     setLoading(true)
     setError(null)
     try {
-      const response = await fetch(`/api/filesystem/browse?path=${encodeURIComponent(path)}`)
-      if (!response.ok) {
-        throw new Error('Failed to load directory')
-      }
-      const data = await response.json()
+      const data = await fetchPage(path, '', 0)
       setCurrentPath(data.current)
       setDirectories(data.directories)
       setParentPath(data.parent)
+      setTotal(data.total)
+      setFilter('')
     } catch (err) {
       setError(err.message)
     } finally {
@@ -40,6 +50,27 @@ function DirectoryBrowser({ mode, onSelect }) {
     }
   }
 
+  const handleFilterChange = async (prefix) => {
+    setFilter(prefix)
+    try {
+      const data = await fetchPage(currentPath, prefix, 0)
+      setDirectories(data.directories)
+      setTotal(data.total)
+    } catch (err) {
+      setError(err.message)
+    }
+  }
+
+  const loadMore = async () => {
+    try {
+      const data = await fetchPage(currentPath, filter, directories.length)
+      setDirectories(dirs => [...dirs, ...data.directories])
+      setTotal(data.total)
+    } catch (err) {
+      setError(err.message)
+    }
+  }
+
   const handleSelectCurrent = () => {
     if (mode === 'create' && newDirName) {
       const fullPath = `${currentPath}/${newDirName}`
@@ -82,6 +113,14 @@ function DirectoryBrowser({ mode, onSelect }) {
         </button>
       )}
 
+      <input
+        type="text"
+        value={filter}
+        onChange={(e) => handleFilterChange(e.target.value)}
+        placeholder="Filter"
+        className="directory-create-input"
+      />
+
       <div className="directory-list">
         {directories.length === 0 ? (
           <div className="directory-empty">No directories</div>
@@ -92,10 +131,15 @@ function DirectoryBrowser({ mode, onSelect }) {
               onClick={() => handleSelectDirectory(dir.path)}
               className="directory-item"
             >
-              📁 {dir.name}
+              {dir.is_project ? '🐦' : '📁'} {dir.name}
             </button>
           ))
         )}
+        {directories.length < total && (
+          <button onClick={loadMore} className="directory-item">
+            Load more ({total - directories.length} remaining)
+          </button>
+        )}
       </div>
 
       {mode === 'create' && (
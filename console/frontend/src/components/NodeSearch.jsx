@@ -0,0 +1,66 @@
+import { useEffect, useState } from 'react'
+
+// Finds nodes by id on the server, so the tree doesn't need to be walked here
+function NodeSearch({ projectId, onSelect }) {
+  const [query, setQuery] = useState('')
+  const [results, setResults] = useState(null)
+
+  useEffect(() => {
+    if (!query) {
+      setResults(null)
+      return undefined
+    }
+    const controller = new AbortController()
+    const params = new URLSearchParams({ q: query, limit: 20 })
+    fetch(`/api/projects/${projectId}/tree/search?${params}`, { signal: controller.signal })
+      .then(res => res.json())
+      .then(data => setResults(data))
+      .catch(err => {
+        if (err.name !== 'AbortError') console.error('Search failed:', err)
+      })
+    return () => controller.abort()
+  }, [projectId, query])
+
+  const handleSelect = node => {
+    setQuery('')
+    onSelect(node)
+  }
+
+  return (
+    <div className="node-search">
+      <input
+        type="text"
+        value={query}
+        onChange={e => setQuery(e.target.value)}
+        placeholder="Find node"
+        className="node-search-input"
+      />
+      {results && (
+        <div className="node-search-results">
+          {results.nodes.length === 0 ? (
+            <div className="node-search-empty">No matching nodes</div>
+          ) : (
+            results.nodes.map(node => (
+              <button
+                key={node.id}
+                onClick={() => handleSelect(node)}
+                className="node-search-result"
+                title={node.path.join(' / ')}
+              >
+                {node.id}
+                <span className="node-search-path"> {node.path.slice(0, -1).join(' / ')}</span>
+              </button>
+            ))
+          )}
+          {results.total > results.nodes.length && (
+            <div className="node-search-empty">
+              {results.total - results.nodes.length} more
+            </div>
+          )}
+        </div>
+      )}
+    </div>
+  )
+}
+
+export default NodeSearch
@@ -1,30 +1,32 @@
 import { useState } from 'react'
 import DirectoryBrowser from './DirectoryBrowser'
+import RecentProjects from './RecentProjects'
+import { COLUMNAR_MEDIA_TYPE } from '../treeEvents'
 
 function ProjectDialog({ onProjectLoaded }) {
   const [error, setError] = useState(null)
   const [loading, setLoading] = useState(false)
   const [mode, setMode] = useState(null)
 
-  const handleSelectPath = async (selectedPath) => {
+  const handleSelectPath = async (selectedPath, action = mode) => {
     setError(null)
     setLoading(true)
 
     try {
-      const endpoint = mode === 'create' ? '/api/project/create' : '/api/project/load'
+      const endpoint = action === 'create' ? '/api/project/create' : '/api/project/load'
       const response = await fetch(endpoint, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', Accept: COLUMNAR_MEDIA_TYPE },
         body: JSON.stringify({ path: selectedPath }),
       })
 
       if (!response.ok) {
         const text = await response.text()
-        throw new Error(`Failed to ${mode} project: ${response.status} ${text}`)
+        throw new Error(`Failed to ${action} project: ${response.status} ${text}`)
       }
 
       const data = await response.json()
-      onProjectLoaded(selectedPath, data.tree)
+      onProjectLoaded(selectedPath, data.project_id, data.tree)
     } catch (err) {
       setError(err.message)
       setLoading(false)
@@ -53,6 +55,19 @@ function ProjectDialog({ onProjectLoaded }) {
               Load Existing Project
             </button>
           </div>
+
+          {error && (
+            <div className="dialog-error">
+              {error}
+            </div>
+          )}
+
+          <h3>Recent Projects</h3>
+          {loading ? (
+            <div className="dialog-loading">Loading...</div>
+          ) : (
+            <RecentProjects onSelect={path => handleSelectPath(path, 'load')} />
+          )}
         </div>
       </div>
     )
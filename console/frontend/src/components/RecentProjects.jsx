@@ -0,0 +1,55 @@
+import { useState, useEffect } from 'react'
+
+function RecentProjects({ onSelect }) {
+  const [projects, setProjects] = useState([])
+  const [query, setQuery] = useState('')
+  const [error, setError] = useState(null)
+
+  useEffect(() => {
+    const params = new URLSearchParams({ q: query })
+    fetch(`/api/catalog?${params}`)
+      .then(res => res.json())
+      .then(data => setProjects(data.projects))
+      .catch(err => setError(err.message))
+  }, [query])
+
+  if (error) {
+    return <div className="directory-browser-error">Error: {error}</div>
+  }
+
+  return (
+    <div className="recent-projects">
+      <input
+        type="text"
+        value={query}
+        onChange={(e) => setQuery(e.target.value)}
+        placeholder="Search projects"
+        className="directory-create-input"
+      />
+
+      <div className="directory-list">
+        {projects.length === 0 ? (
+          <div className="directory-empty">No known projects</div>
+        ) : (
+          projects.map(project => (
+            <button
+              key={project.path}
+              onClick={() => onSelect(project.path)}
+              className="directory-item"
+              title={project.path}
+            >
+              🐦 {project.name}
+              {project.node_count !== null && (
+                <span className="recent-project-info">
+                  {' '}{project.node_count} nodes
+                </span>
+              )}
+            </button>
+          ))
+        )}
+      </div>
+    </div>
+  )
+}
+
+export default RecentProjects
@@ -6,7 +6,10 @@ function TreeNode({ node, onAddChild, level = 0 }) {
 
   return (
     <div className="tree-node-container" style={{ marginLeft: `${level * 30}px` }}>
-      <div className={`tree-node ${node.is_stale ? 'tree-node-stale' : ''}`}>
+      <div
+        className={`tree-node ${node.is_stale ? 'tree-node-stale' : ''}`}
+        data-node-id={node.id}
+      >
         <span className="tree-node-id">
           {node.id}
         </span>
@@ -9,7 +9,7 @@ function TreeView({ treeData, onTreeChange }) {
     }
 
     const updatedTree = addChildRecursive(treeData, parentId, newChild)
-    onTreeChange(updatedTree)
+    onTreeChange(updatedTree, [{ op: 'add', parent_id: parentId, node: newChild }])
   }
 
   const addChildRecursive = (node, parentId, newChild) => {
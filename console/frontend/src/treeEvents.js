@@ -0,0 +1,114 @@
+// Applies the events pushed by /api/projects/{id}/events to a tree, without
+// mutating it
+
+// Shared nodes (with several parents) are sent in full the first time and as
+// {"ref": id} after that. The tree kept here has them at every occurrence.
+export const expandRefs = tree => {
+  const seen = new Map()
+  const expand = node => {
+    if (node.id === undefined && node.ref !== undefined) return seen.get(node.ref)
+    const expanded = { is_stale: true, ...node, children: [] }
+    seen.set(node.id, expanded)
+    expanded.children = (node.children ?? []).map(expand)
+    return expanded
+  }
+  return expand(tree)
+}
+
+// Media type that asks for trees as flat columns (see mbird_data.columnar),
+// which are smaller and quicker to parse than nested JSON
+export const COLUMNAR_MEDIA_TYPE = 'application/vnd.mbird.columnar+json'
+
+// Builds the nested tree from its columns, with shared nodes at every
+// occurrence like expandRefs()
+export const fromColumnar = ({ ids, parents, stale, links }) => {
+  const bits = atob(stale)
+  const nodes = ids.map((id, i) => ({
+    id,
+    is_stale: ((bits.charCodeAt(i >> 3) >> (i & 7)) & 1) === 1,
+    children: [],
+  }))
+  for (let i = 1; i < nodes.length; i++) {
+    nodes[parents[i]].children.push(nodes[i])
+  }
+  // In order of position, so that each lands where it belongs
+  const sorted = [...links].sort((a, b) => a[1] - b[1] || a[2] - b[2])
+  for (const [node, parent, position] of sorted) {
+    nodes[parent].children.splice(position, 0, nodes[node])
+  }
+  return nodes[0]
+}
+
+// Tree sent in either encoding
+export const decodeTree = tree =>
+  tree.format === 'columnar' ? fromColumnar(tree) : expandRefs(tree)
+
+const insertAt = (children, node, position) => {
+  const index = position ?? children.length
+  return [...children.slice(0, index), node, ...children.slice(index)]
+}
+
+const findNode = (node, id) => {
+  if (node.id === id) return node
+  for (const child of node.children) {
+    const found = findNode(child, id)
+    if (found) return found
+  }
+  return null
+}
+
+const mapNodes = (node, update) => {
+  const updated = update(node)
+  return {
+    ...updated,
+    children: updated.children.map(child => mapNodes(child, update)),
+  }
+}
+
+// Only from the given parent, if there is one (for shared nodes)
+const removeNode = (tree, id, parentId) =>
+  mapNodes(tree, node =>
+    parentId == null || node.id === parentId
+      ? { ...node, children: node.children.filter(child => child.id !== id) }
+      : node
+  )
+
+const addNode = (tree, parentId, node, position) =>
+  mapNodes(tree, current =>
+    current.id === parentId
+      ? { ...current, children: insertAt(current.children, node, position) }
+      : current
+  )
+
+export const applyStale = (tree, staleById) =>
+  mapNodes(tree, node => ({ ...node, is_stale: staleById[node.id] ?? node.is_stale }))
+
+export const applyEvent = (tree, event) => {
+  switch (event.type) {
+    case 'reset':
+      return event.tree && expandRefs(event.tree)
+    case 'added':
+      return addNode(tree, event.parent_id, expandRefs(event.node), event.position)
+    case 'linked': {
+      const node = findNode(tree, event.node_id)
+      if (!node) return tree
+      return addNode(tree, event.parent_id, node, event.position)
+    }
+    case 'removed':
+      return removeNode(tree, event.node_id, event.parent_id)
+    case 'moved': {
+      const node = findNode(tree, event.node_id)
+      if (!node) return tree
+      const removed = removeNode(tree, event.node_id, event.from_parent_id)
+      return addNode(removed, event.parent_id, node, event.position)
+    }
+    case 'renamed':
+      return mapNodes(tree, node =>
+        node.id === event.node_id ? { ...node, id: event.new_id } : node
+      )
+    case 'stale':
+      return applyStale(tree, event.changes)
+    default:
+      return tree
+  }
+}
@@ -1,131 +1,924 @@
-from datetime import datetime, timezone
+import asyncio
+from collections.abc import AsyncIterator, Callable
+from dataclasses import asdict
+import json
+import logging
 from pathlib import Path
+import time
 from typing import Any
 
-from fastapi import APIRouter, HTTPException
+from fastapi import (
+    APIRouter,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+    WebSocket,
+)
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from mbird_data import MbirdData, MbirdNode
-
+from mbird_data.columnar import encode_columnar
+from mbird_data.diff import diff_trees, tree_patch
+from mbird_data.lazy import TreeSlice
+from mbird_data.merge import merge_trees
+from mbird_data.patch import PatchDiff, SetFlags, TreePatch, apply_patch
+from mbird_data.staleness import StalenessEngine
+from mbird_data.streaming import dumps_json, encode_json, iter_json
+
+from mbird_console.catalog import CatalogScanner, ProjectCatalog
 from mbird_console.config import get_last_directory, save_last_directory
+from mbird_console.events import Event, Subscriber, patch_events
+from mbird_console.filesystem import ListingCache
+from mbird_console.metrics import CONTENT_TYPE, OPERATION_SECONDS
+from mbird_console.metrics import registry as metrics
+from mbird_console.sessions import ChangeWatcher, ProjectSession, SessionRegistry
+from mbird_console.shared import VersionConflict, state_from_env
+
+logger = logging.getLogger(__name__)
+
+# Directories listed per page by /api/filesystem/browse, by default and at most
+BROWSE_PAGE_SIZE = 200
+BROWSE_MAX_PAGE_SIZE = 1000
+# Catalog entries returned by /api/catalog, by default and at most
+CATALOG_PAGE_SIZE = 50
+CATALOG_MAX_PAGE_SIZE = 500
+# Nodes returned by /api/projects/{id}/tree/search, by default and at most
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 500
+# Media type of trees in the flat, columnar encoding (see mbird_data.columnar),
+# sent instead of nested JSON to clients that list it in their Accept header
+COLUMNAR_MEDIA_TYPE = "application/vnd.mbird.columnar+json"
+# Recently opened projects opened lazily at startup, so loading them is quick
+PREWARM_PROJECTS = 1
 
 router = APIRouter()
 
-current_data: MbirdData | None = None
-current_path: str | None = None
-last_saved: datetime | None = None
+
+def generate(node: MbirdNode) -> None:
+    """Regenerate a single node's output (nodes don't have any output yet)."""
+
+
+# Shared with the other workers when there are several (see mbird_console.main)
+registry = SessionRegistry(generate, state=state_from_env())
+change_watcher = ChangeWatcher(registry)
+listing_cache = ListingCache()
+catalog = ProjectCatalog()
+catalog_scanner = CatalogScanner(catalog)
+
+
+async def get_session(project_id: str) -> ProjectSession:
+    """Get an open project's session, or raise a 404 if there isn't one."""
+    try:
+        return await registry.get(project_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0]) from e
+
+
+async def _iter_tree_json(
+    root: MbirdNode, envelope: bool, extra: dict[str, Any]
+) -> AsyncIterator[str]:
+    # Encoded chunk by chunk on the event loop, so edits can't land mid-chunk
+    if envelope:
+        yield '{"status":"success",'
+        for key, value in extra.items():
+            yield f"{json.dumps(key)}:{json.dumps(value)},"
+        yield '"tree":'
+    # Time spent encoding, leaving out the time spent sending chunks
+    seconds = 0.0
+    chunks = iter_json(root)
+    try:
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            seconds += time.perf_counter() - start
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        OPERATION_SECONDS.observe(seconds, operation="encode")
+    if envelope:
+        yield "}"
+
+
+def tree_response(
+    root: MbirdNode, envelope: bool = True, columnar: bool = False, **extra: Any
+) -> Response:
+    """
+    Stream a tree as JSON without building the whole payload in memory.
+
+    With envelope=True the tree is wrapped as {"status": "success", "tree": ...},
+    along with any extra fields. With columnar=True the tree is encoded in
+    columns instead, all at once.
+    """
+    if columnar:
+        return Response(
+            _encode_tree(root, envelope, columnar=True, **extra),
+            media_type=COLUMNAR_MEDIA_TYPE,
+        )
+    return StreamingResponse(
+        _iter_tree_json(root, envelope, extra), media_type="application/json"
+    )
+
+
+def _wants_columnar(accept: str | None) -> bool:
+    """Whether an Accept header asks for trees in the columnar encoding."""
+    if accept is None:
+        return False
+    media_types = (item.split(";")[0].strip().lower() for item in accept.split(","))
+    return COLUMNAR_MEDIA_TYPE in media_types
+
+
+def _encode_tree(
+    root: MbirdNode,
+    envelope: bool = False,
+    shared: bool = False,
+    columnar: bool = False,
+    **extra: Any,
+) -> bytes:
+    """
+    Encode a tree all at once, optionally in an envelope like tree_response().
+
+    Shared nodes are written once (see encode_json()) if `shared` is set, and
+    always in the columnar encoding.
+    """
+    with OPERATION_SECONDS.time(operation="encode"):
+        if columnar:
+            tree = encode_columnar(root)
+        else:
+            tree = encode_json(root, shared=shared)
+    if not envelope:
+        return tree
+    fields = "".join(
+        f"{json.dumps(key)}:{json.dumps(value)}," for key, value in extra.items()
+    )
+    return b'{"status":"success",' + fields.encode() + b'"tree":' + tree + b"}"
+
+
+async def _cached_tree_response(
+    session: ProjectSession,
+    node_id: str | None,
+    depth: int | None,
+    variant: list[object],
+    if_none_match: str | None,
+    envelope: bool = False,
+    columnar: bool = False,
+) -> Response:
+    """
+    Respond with a subtree that's only encoded again once its ETag changes.
+
+    Unlike tree_response(), the whole body is built in memory, but repeated
+    requests for an unchanged tree (e.g. from several clients) cost nothing.
+    An If-None-Match request with the current ETag gets an empty 304 response.
+    Otherwise the subtree is read (see ProjectSession.read_subtree()) and
+    encoded off the event loop, unless it's cached.
+
+    Args:
+        variant: What else the encoding depends on, for the ETag
+        envelope: Whether to wrap the tree like tree_response(), along with
+            the nodes that were "truncated"
+
+    Raises:
+        KeyError: If there's no node with the given id
+        ValueError: If there's no tree
+    """
+    while True:
+        etag = _etag(session.digest(node_id), *variant)
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        body = session.responses.lookup(etag)
+        if body is None:
+            read = session.read_subtree(node_id, depth)
+            shared = session.has_shared_nodes()
+            body = await asyncio.to_thread(
+                _encode_subtree, read, envelope, shared, columnar
+            )
+            if body is None:
+                # The lazily loaded tree was built meanwhile, so the ETag may
+                # have changed
+                continue
+            session.responses.put(etag, body)
+        return Response(
+            content=body,
+            media_type=COLUMNAR_MEDIA_TYPE if columnar else "application/json",
+            # The encoding depends on the Accept header
+            headers={"ETag": etag, "Vary": "Accept"},
+        )
+
+
+def _encode_subtree(
+    read: Callable[[], TreeSlice | None],
+    envelope: bool,
+    shared: bool,
+    columnar: bool,
+) -> bytes | None:
+    """Encode the subtree that `read` returns (None if it returns None)."""
+    tree_slice = read()
+    if tree_slice is None:
+        return None
+    extra = {"truncated": tree_slice.truncated} if envelope else {}
+    return _encode_tree(
+        tree_slice.root, envelope, shared=shared, columnar=columnar, **extra
+    )
+
+
+def _etag(digest: bytes, *variant: object) -> str:
+    """ETag for a response built from the subtree with the given digest."""
+    return '"' + "-".join([digest.hex(), *map(str, variant)]) + '"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header lists the ETag (weak comparison)."""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _parse_depth(value: Any) -> int | None:
+    if value is None:
+        return None
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise HTTPException(status_code=400, detail="'depth' must be an integer >= 0")
+    return value
 
 
 @router.post("/api/project/create")
-async def create_project(request: dict[str, Any]) -> dict[str, Any]:
-    """Create new project with single root node."""
-    global current_data, current_path
+async def create_project(
+    request: dict[str, Any], accept: str | None = Header(default=None)
+) -> Response:
+    """
+    Create new project with single root node.
 
+    Like every route that returns a tree, the tree is sent in the columnar
+    encoding if the Accept header lists COLUMNAR_MEDIA_TYPE.
+    """
     dir_path = request.get("path")
     if not dir_path:
         raise HTTPException(status_code=400, detail="Missing 'path' in request")
 
-    root = MbirdNode(id="root")
-    current_data = MbirdData(root=root)
-    current_path = dir_path
+    data = MbirdData(root=MbirdNode(id="root"))
+    session = await registry.open(dir_path, data=data)
+    session.autosaver.mark_dirty()
     save_last_directory(dir_path)
+    await _record_opened(dir_path)
 
-    if current_data.root is None:
+    if data.root is None:
         raise HTTPException(status_code=500, detail="Failed to create project")
-    return {"status": "success", "tree": current_data.root.model_dump()}
+    return tree_response(
+        session.snapshot().root,
+        columnar=_wants_columnar(accept),
+        project_id=session.id,
+    )
 
 
 @router.post("/api/project/load")
-async def load_project(request: dict[str, Any]) -> dict[str, Any]:
-    """Load project from directory path."""
-    global current_data, current_path
+async def load_project(
+    request: dict[str, Any], accept: str | None = Header(default=None)
+) -> Response:
+    """
+    Load project from directory path.
 
+    The response has the "project_id" to use in the project's other routes.
+    If the request has a "depth", the tree is loaded lazily and only that many
+    levels below the root are returned, with the ids of the nodes whose
+    children were left out in "truncated".
+    """
     dir_path = request.get("path")
     if not dir_path:
         raise HTTPException(status_code=400, detail="Missing 'path' in request")
+    depth = _parse_depth(request.get("depth"))
 
     try:
-        current_data = MbirdData.load(dir_path)
-        current_path = dir_path
+        session = await registry.open(dir_path, lazy=depth is not None)
         save_last_directory(dir_path)
-        if current_data.root is None:
+        await _record_opened(dir_path)
+        if depth is not None:
+            tree_slice = session.data.subtree(depth=depth)
+            return tree_response(
+                tree_slice.root,
+                columnar=_wants_columnar(accept),
+                project_id=session.id,
+                truncated=tree_slice.truncated,
+            )
+        if session.data.root is None:
             raise HTTPException(status_code=500, detail="Failed to load project")
-        return {"status": "success", "tree": current_data.root.model_dump()}
+        return tree_response(
+            session.snapshot().root,
+            columnar=_wants_columnar(accept),
+            project_id=session.id,
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
 
-@router.get("/api/tree")
-async def get_tree() -> dict[str, Any]:
-    """Get current tree data."""
-    if current_data is None or current_data.root is None:
+async def _record_opened(dir_path: str) -> None:
+    # The catalog is only a convenience, so failing to update it isn't an error
+    try:
+        await asyncio.to_thread(catalog.record_opened, dir_path)
+    except Exception:
+        logger.exception("Failed to add %s to the project catalog", dir_path)
+    else:
+        catalog_scanner.request()
+
+
+async def prewarm() -> None:
+    """Open the most recently opened projects lazily, ready to be loaded."""
+    try:
+        paths = await asyncio.to_thread(catalog.recent, PREWARM_PROJECTS)
+    except Exception:
+        logger.exception("Failed to read the project catalog")
+        return
+    for path in paths:
+        if not Path(path).is_dir():
+            continue
+        try:
+            await registry.open(path, lazy=True)
+        except Exception:
+            logger.exception("Failed to pre-warm project %s", path)
+
+
+@router.get("/api/catalog")
+async def search_catalog(
+    q: str = "",
+    limit: int = Query(default=CATALOG_PAGE_SIZE, ge=1, le=CATALOG_MAX_PAGE_SIZE),
+) -> dict[str, Any]:
+    """
+    List known projects, most recently opened first.
+
+    Only those whose name or path contains `q` (ignoring case) are listed. Each
+    has its "path", "name", "node_count", "size_bytes", "last_opened" time and
+    a summary of its "root", as of the last background scan.
+    """
+    return {"projects": await asyncio.to_thread(catalog.search, q, limit)}
+
+
+@router.post("/api/catalog/scan")
+async def scan_catalog() -> dict[str, Any]:
+    """Look for new, changed and deleted projects now."""
+    try:
+        updated = await asyncio.to_thread(catalog.scan)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    return {"status": "success", "updated": updated}
+
+
+@router.get("/api/projects")
+async def list_projects() -> dict[str, Any]:
+    """List the projects held in memory, least recently used first."""
+    return {
+        "projects": [
+            {
+                "project_id": session.id,
+                "path": session.path,
+                **session.autosaver.status(),
+            }
+            for session in registry.sessions()
+        ]
+    }
+
+
+@router.delete("/api/projects/{project_id}")
+async def close_project(project_id: str) -> dict[str, Any]:
+    """Save a project's changes and drop it from memory."""
+    try:
+        await registry.close(project_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+    return {"status": "success"}
+
+
+@router.get("/api/projects/{project_id}/tree")
+async def get_tree(
+    project_id: str,
+    if_none_match: str | None = Header(default=None),
+    accept: str | None = Header(default=None),
+) -> Response:
+    """
+    Get current tree data.
+
+    The response has an ETag that changes whenever the tree does, and an
+    If-None-Match request with the current ETag gets an empty 304 response.
+    """
+    session = await get_session(project_id)
+    if not session.has_tree():
         raise HTTPException(status_code=404, detail="No project loaded")
-    return current_data.root.model_dump()
+
+    columnar = _wants_columnar(accept)
+    try:
+        return await _cached_tree_response(
+            session,
+            None,
+            None,
+            ["columnar"] if columnar else [],
+            if_none_match,
+            columnar=columnar,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail="No project loaded") from e
+
+
+# Registered before the subtree route, which would take "search" as a node id
+@router.get("/api/projects/{project_id}/tree/search")
+async def search_tree(
+    project_id: str,
+    q: str = "",
+    prefix: bool = False,
+    stale: bool | None = None,
+    min_depth: int | None = Query(default=None, ge=0),
+    max_depth: int | None = Query(default=None, ge=0),
+    under: str | None = None,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+) -> dict[str, Any]:
+    """
+    Find nodes by id, without fetching the tree.
+
+    Returns a page of the nodes (ordered by id) whose id contains `q`, or
+    starts with it if `prefix` is set, ignoring case: up to `limit` of them
+    from `offset`, out of `total`. Each has its "id", its "path" of ids from
+    the root and its "is_stale" flag. Nodes can also be filtered by stale flag,
+    depth, and whether they're `under` (or are) a given node.
+    """
+    session = await get_session(project_id)
+    if not session.has_tree():
+        raise HTTPException(status_code=404, detail="No project loaded")
+
+    try:
+        search = session.search()
+        with OPERATION_SECONDS.time(operation="search"):
+            page = search.search(
+                q,
+                prefix=prefix,
+                is_stale=stale,
+                min_depth=min_depth,
+                max_depth=max_depth,
+                under=under,
+                offset=offset,
+                limit=limit,
+            )
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0]) from e
+    return {"nodes": [asdict(hit) for hit in page.hits], "total": page.total}
+
+
+@router.get("/api/projects/{project_id}/tree/{node_id}")
+async def get_subtree(
+    project_id: str,
+    node_id: str,
+    depth: int | None = Query(default=None, ge=0),
+    if_none_match: str | None = Header(default=None),
+    accept: str | None = Header(default=None),
+) -> Response:
+    """
+    Get a node and its descendants down to depth levels below it.
+
+    Nodes whose children were left out are listed in "truncated", so the
+    client knows which ones to fetch when they're expanded. ETags work as for
+    the whole tree.
+    """
+    session = await get_session(project_id)
+    if not session.has_tree():
+        raise HTTPException(status_code=404, detail="No project loaded")
+
+    columnar = _wants_columnar(accept)
+    try:
+        return await _cached_tree_response(
+            session,
+            node_id,
+            depth,
+            ["all" if depth is None else depth, *(["columnar"] if columnar else [])],
+            if_none_match,
+            envelope=True,
+            columnar=columnar,
+        )
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0]) from e
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
 
 
-@router.post("/api/tree")
-async def update_tree(tree_data: dict[str, Any]) -> dict[str, Any]:
+@router.post("/api/projects/{project_id}/tree")
+async def update_tree(
+    project_id: str,
+    tree_data: dict[str, Any],
+    accept: str | None = Header(default=None),
+) -> Response:
     """Update entire tree."""
-    global current_data
+    session = await get_session(project_id)
     try:
-        root = MbirdNode(**tree_data)
-        current_data = MbirdData(root=root)
-        if current_data.root is None:
+        with OPERATION_SECONDS.time(operation="validate"):
+            data = MbirdData(root=MbirdNode.from_dict(tree_data))
+        async with session.lock:
+            await session.replace(data)
+        session.autosaver.mark_dirty()
+        session.events.publish({"type": "reset"})
+        if data.root is None:
             raise HTTPException(status_code=500, detail="Failed to update tree")
-        return {"status": "success", "tree": current_data.root.model_dump()}
+        return tree_response(session.snapshot().root, columnar=_wants_columnar(accept))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
 
-def generate(node: MbirdNode) -> None:
-    """Recursively set is_stale=False for all nodes in tree."""
-    node.is_stale = False
-    for child in node.children:
-        generate(child)
+@router.patch("/api/projects/{project_id}/tree")
+async def patch_tree(
+    project_id: str,
+    patch: TreePatch,
+    x_mbird_client: str | None = Header(default=None),
+) -> dict[str, Any]:
+    """
+    Apply edit operations to the tree and return what changed.
+
+    Subscribers to the project's events are sent the changes, except the one
+    whose client id is in the X-Mbird-Client header. The patch can be undone,
+    and "can_undo" and "can_redo" tell whether there is anything to undo or
+    redo.
+    """
+    session = await get_session(project_id)
+    if session.get_engine() is None:
+        raise HTTPException(status_code=404, detail="No project loaded")
+
+    async with session.lock:
+        try:
+            with OPERATION_SECONDS.time(operation="apply_patch"):
+                _, diff = await session.commit(
+                    lambda engine: (patch, session.history.apply(engine, patch)),
+                    session.history.revert,
+                )
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e)) from e
+        except (KeyError, ValueError) as e:
+            detail = e.args[0] if isinstance(e, KeyError) else str(e)
+            raise HTTPException(status_code=400, detail=detail) from e
+    session.autosaver.mark_dirty()
+    for event in patch_events(patch, diff):
+        session.events.publish(event, source=x_mbird_client)
+
+    return {"status": "success", "diff": asdict(diff), **_history_status(session)}
+
+
+@router.post("/api/projects/{project_id}/undo")
+async def undo(project_id: str) -> Response:
+    """
+    Revert the last edit (or redo) and return the patch that reverted it.
+
+    Every subscriber to the project's events is sent the changes, as for a
+    patch. Responds with 409 if there's nothing to undo.
+    """
+    return await _step_history(project_id, redo=False)
+
 
+@router.post("/api/projects/{project_id}/redo")
+async def redo(project_id: str) -> Response:
+    """Reapply the last undone edit, like undo()."""
+    return await _step_history(project_id, redo=True)
 
-@router.post("/api/regenerate")
-async def regenerate() -> dict[str, Any]:
-    """Run generate() to set is_stale=False for all nodes."""
-    global current_data
 
-    if current_data is None or current_data.root is None:
+async def _step_history(project_id: str, redo: bool) -> Response:
+    session = await get_session(project_id)
+    if session.get_engine() is None:
         raise HTTPException(status_code=404, detail="No project loaded")
 
-    generate(current_data.root)
+    history = session.history
+    async with session.lock:
+        try:
+            with OPERATION_SECONDS.time(operation="apply_patch"):
+                patch, diff = await session.commit(
+                    history.redo if redo else history.undo,
+                    # Each reverts the other
+                    history.undo if redo else history.redo,
+                )
+        except (KeyError, ValueError, VersionConflict) as e:
+            detail = e.args[0] if isinstance(e, KeyError) else str(e)
+            raise HTTPException(status_code=409, detail=detail) from e
+    session.autosaver.mark_dirty()
+    # The client that asked doesn't know what changed either
+    for event in patch_events(patch, diff):
+        session.events.publish(event)
+
+    # Undoing a removal adds back the removed subtree, which may be too deep for
+    # pydantic's (recursive) serializer
+    content = dumps_json(
+        {
+            "status": "success",
+            "patch": patch,
+            "diff": asdict(diff),
+            **_history_status(session),
+        }
+    )
+    return Response(content, media_type="application/json")
+
 
-    return {"status": "success", "tree": current_data.root.model_dump()}
+def _history_status(session: ProjectSession) -> dict[str, bool]:
+    return {
+        "can_undo": session.history.can_undo,
+        "can_redo": session.history.can_redo,
+    }
 
 
-@router.post("/api/save")
-async def save_project() -> dict[str, Any]:
-    """Save project to disk using MbirdData.save()."""
-    global current_data, current_path, last_saved
+@router.post("/api/tree/diff")
+async def diff_tree(request: dict[str, Any]) -> dict[str, Any]:
+    """
+    Compare two trees, matching nodes by id.
 
-    if current_data is None or current_data.root is None:
+    The request has the "old" and "new" trees, each given as {"tree": ...} (a
+    tree sent as is), {"project_id": ...} (an open project's tree) or
+    {"path": ...} (a saved project).
+    """
+    old = await _tree_source(request, "old")
+    new = await _tree_source(request, "new")
+    with OPERATION_SECONDS.time(operation="diff"):
+        diff = await asyncio.to_thread(diff_trees, old, new)
+    return {"status": "success", "diff": asdict(diff)}
+
+
+@router.post("/api/projects/{project_id}/tree/merge")
+async def merge_tree(
+    project_id: str,
+    request: dict[str, Any],
+    x_mbird_client: str | None = Header(default=None),
+) -> dict[str, Any]:
+    """
+    Merge another version of the project's tree into it.
+
+    The request has the "base" the two versions were edited from and "theirs",
+    given as in diff_tree(). Responds with 409 and the "conflicts" if the
+    versions conflict, unless "resolve" says which to take where they do
+    ("ours" or "theirs"). The merge is applied as a patch, so it can be undone
+    and subscribers are sent the changes, as for patch_tree().
+    """
+    resolve = request.get("resolve")
+    if resolve not in (None, "ours", "theirs"):
+        raise HTTPException(
+            status_code=400, detail="'resolve' must be 'ours' or 'theirs'"
+        )
+    base = await _tree_source(request, "base")
+    theirs = await _tree_source(request, "theirs")
+    session = await get_session(project_id)
+    if session.get_engine() is None:
         raise HTTPException(status_code=404, detail="No project loaded")
 
-    if current_path is None:
-        raise HTTPException(status_code=400, detail="No project path set")
+    conflicts: list[dict[str, str]] = []
+
+    def apply(engine: StalenessEngine) -> tuple[TreePatch, PatchDiff]:
+        # Merged into the latest version, which changes if the commit is retried
+        with OPERATION_SECONDS.time(operation="merge"):
+            ours = engine.index.root
+            result = merge_trees(base, ours, theirs, prefer=resolve or "ours")
+            conflicts[:] = [asdict(conflict) for conflict in result.conflicts]
+            if conflicts and resolve is None:
+                raise HTTPException(
+                    status_code=409,
+                    detail={"message": "Trees conflict", "conflicts": conflicts},
+                )
+            patch = tree_patch(ours, result.tree)
+        return patch, session.history.apply(engine, patch)
+
+    async with session.lock:
+        try:
+            with OPERATION_SECONDS.time(operation="apply_patch"):
+                patch, diff = await session.commit(apply, session.history.revert)
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e)) from e
+        except (KeyError, ValueError) as e:
+            detail = e.args[0] if isinstance(e, KeyError) else str(e)
+            raise HTTPException(status_code=400, detail=detail) from e
+    session.autosaver.mark_dirty()
+    for event in patch_events(patch, diff):
+        session.events.publish(event, source=x_mbird_client)
+
+    return {
+        "status": "success",
+        "diff": asdict(diff),
+        "conflicts": conflicts,
+        **_history_status(session),
+    }
+
 
+async def _tree_source(request: dict[str, Any], name: str) -> MbirdNode:
+    """Get a tree named in a diff or merge request (see diff_tree())."""
+    source = request.get(name)
+    if not isinstance(source, dict):
+        raise HTTPException(status_code=400, detail=f"Missing '{name}' in request")
     try:
-        current_data.save(current_path)
-        last_saved = datetime.now(timezone.utc)
+        if "tree" in source:
+            with OPERATION_SECONDS.time(operation="validate"):
+                return MbirdNode.from_dict(source["tree"])
+        if "project_id" in source:
+            session = await get_session(source["project_id"])
+            return session.snapshot().root
+        if "path" in source:
+            with OPERATION_SECONDS.time(operation="load"):
+                data = await asyncio.to_thread(MbirdData.load, source["path"])
+            if data.root is None:
+                raise ValueError(f"No tree in {source['path']}")
+            return data.root
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=f"'{name}': {e}") from e
+    raise HTTPException(
+        status_code=400, detail=f"'{name}' needs a 'tree', 'project_id' or 'path'"
+    )
+
+
+@router.post("/api/projects/{project_id}/regenerate")
+async def regenerate(project_id: str) -> dict[str, Any]:
+    """
+    Regenerate the stale nodes and return the ids that were regenerated.
 
-        return {
-            "status": "success",
-            "timestamp": last_saved.isoformat(),
-        }
+    Subscribers to the project's events are sent each node's new flag and the
+    progress of the run as nodes finish.
+    """
+    session = await get_session(project_id)
+    engine = session.get_engine()
+    if engine is None:
+        raise HTTPException(status_code=404, detail="No project loaded")
+
+    loop = asyncio.get_running_loop()
+    done = total = 0
+
+    def progress(node_id: str) -> None:
+        nonlocal done
+        done += 1
+        loop.call_soon_threadsafe(_publish_progress, session, node_id, done, total)
+
+    try:
+        async with session.lock:
+            total = len(engine.stale_ids)
+            with OPERATION_SECONDS.time(operation="regenerate"):
+                result = await session.scheduler.run_async(engine, progress)
+            for seconds in result.timings.values():
+                OPERATION_SECONDS.observe(seconds, operation="generate")
+            if result.regenerated:
+                # Nodes finish after their dependencies, so replaying these in
+                # order marks them fresh the same way
+                patch = TreePatch(
+                    ops=[
+                        SetFlags(node_id=node_id, is_stale=False)
+                        for node_id in result.regenerated
+                    ]
+                )
+                # Already applied, but applied again in case other workers'
+                # changes are replayed first
+                await session.commit(
+                    lambda engine: (patch, apply_patch(engine, patch)),
+                    lambda engine: None,
+                )
+                session.autosaver.mark_dirty()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
+    finally:
+        session.events.publish(
+            {"type": "progress", "done": done, "total": total, "running": False}
+        )
+
+    return {
+        "status": "success",
+        "regenerated": result.regenerated,
+        "skipped": result.skipped,
+        "timings": result.timings,
+        "cancelled": result.cancelled,
+    }
+
+
+def _publish_progress(
+    session: ProjectSession, node_id: str, done: int, total: int
+) -> None:
+    session.events.publish({"type": "stale", "changes": {node_id: False}})
+    session.events.publish(
+        {"type": "progress", "done": done, "total": total, "running": True}
+    )
+
 
+@router.post("/api/projects/{project_id}/regenerate/cancel")
+async def cancel_regenerate(project_id: str) -> dict[str, Any]:
+    """Stop the running regeneration after the nodes currently in progress."""
+    session = await get_session(project_id)
+    session.scheduler.cancel()
+    return {"status": "success"}
 
-@router.get("/api/save/status")
-async def get_save_status() -> dict[str, Any]:
-    """Get last saved timestamp."""
+
+@router.post("/api/projects/{project_id}/save")
+async def save_project(project_id: str) -> dict[str, Any]:
+    """
+    Save the project's unsaved changes now.
+
+    Waits for a background save that is already in progress instead of
+    starting another one.
+    """
+    session = await get_session(project_id)
+
+    try:
+        await session.autosaver.flush()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    last_saved = session.autosaver.last_saved
     return {
-        "last_saved": last_saved.isoformat() if last_saved else None,
+        "status": "success",
+        "timestamp": last_saved.isoformat() if last_saved else None,
     }
 
 
+@router.get("/api/projects/{project_id}/save/status")
+async def get_save_status(project_id: str) -> dict[str, Any]:
+    """Get the last saved timestamp and the state of background saving."""
+    session = await get_session(project_id)
+    return session.autosaver.status()
+
+
+@router.websocket("/api/projects/{project_id}/events")
+async def project_events(
+    websocket: WebSocket, project_id: str, client_id: str | None = None
+) -> None:
+    """
+    Push the project's changes to the client as they happen.
+
+    Each message is {"events": [...]}, where every event has a "type":
+    "added", "removed", "moved" and "renamed" replay tree edits; "stale" has
+    the new flags of changed nodes; "progress" reports a regeneration run;
+    "save_status" is sent after each save; "reset" carries the whole "tree",
+    when it was replaced or the client fell too far behind; "closed" is the
+    last event when the project is closed. Edits made with the same client_id
+    in the X-Mbird-Client header aren't sent back.
+    """
+    try:
+        session = await registry.get(project_id)
+    except KeyError:
+        await websocket.close(code=4404, reason="Project not found")
+        return
+    await websocket.accept()
+
+    with session.events.subscribe(client_id) as subscriber:
+        sender = asyncio.create_task(_send_events(websocket, session, subscriber))
+        receiver = asyncio.create_task(_wait_for_disconnect(websocket))
+        done, pending = await asyncio.wait(
+            {sender, receiver}, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+    if sender in done and sender.exception() is None:
+        # The project was closed
+        await websocket.close()
+
+
+async def _send_events(
+    websocket: WebSocket, session: ProjectSession, subscriber: Subscriber
+) -> None:
+    while True:
+        events = await subscriber.get()
+        tree = None
+        if any(event["type"] == "reset" for event in events):
+            # The tree as of now, so later events apply on top of it, encoded
+            # off the event loop
+            tree = "null"
+            if session.has_tree():
+                read = session.read_subtree()
+                tree = await asyncio.to_thread(_encode_reset_tree, read)
+            if tree is None:
+                # The lazily loaded tree was built, and may have been edited,
+                # while it was read
+                subscriber.reset()
+                continue
+        # Waits while the client is slow to read, as events pile up and merge
+        await websocket.send_text(_encode_events(events, tree))
+        if any(event["type"] == "closed" for event in events):
+            return
+
+
+async def _wait_for_disconnect(websocket: WebSocket) -> None:
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+def _encode_events(events: list[Event], tree: str | None = None) -> str:
+    """Encode events as a message, with the JSON `tree` in reset events."""
+    parts = []
+    for event in events:
+        if event["type"] == "reset":
+            parts.append(f'{{"type":"reset","tree":{tree}}}')
+        else:
+            parts.append(dumps_json(event))
+    return '{"events":[' + ",".join(parts) + "]}"
+
+
+def _encode_reset_tree(read: Callable[[], TreeSlice | None]) -> str | None:
+    """Encode the tree that `read` returns as JSON (None if it returns None)."""
+    tree_slice = read()
+    if tree_slice is None:
+        return None
+    with OPERATION_SECONDS.time(operation="encode"):
+        return "".join(iter_json(tree_slice.root))
+
+
+@router.get("/api/metrics")
+async def get_metrics() -> PlainTextResponse:
+    """
+    Request latencies and sizes by route, and time spent in the hot paths.
+
+    In the Prometheus text format, so it can be scraped as it is.
+    """
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
+
+
 @router.get("/api/filesystem/home")
 async def get_home_directory() -> dict[str, Any]:
     """Get user's home directory."""
@@ -139,12 +932,25 @@ async def get_default_directory() -> dict[str, Any]:
 
 
 @router.get("/api/filesystem/browse")
-async def browse_directory(path: str = "/") -> dict[str, Any]:
+async def browse_directory(
+    path: str = "/",
+    prefix: str = "",
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=BROWSE_PAGE_SIZE, ge=1, le=BROWSE_MAX_PAGE_SIZE),
+) -> dict[str, Any]:
     """
     List directories in the given path.
 
-    Returns list of directories (not files) that user can navigate to.
+    Returns list of directories (not files) that user can navigate to, a page
+    at a time: up to `limit` of them from `offset`, out of `total` whose names
+    start with `prefix` (ignoring case). Project directories are marked with
+    "is_project".
     """
+    # A slow (e.g. network) filesystem only holds up this request
+    return await asyncio.to_thread(_browse, path, prefix, offset, limit)
+
+
+def _browse(path: str, prefix: str, offset: int, limit: int) -> dict[str, Any]:
     dir_path = Path(path).expanduser().resolve()
 
     if not dir_path.exists():
@@ -152,15 +958,18 @@ async def browse_directory(path: str = "/") -> dict[str, Any]:
     if not dir_path.is_dir():
         raise HTTPException(status_code=400, detail="Not a directory")
 
-    # List only directories, sorted alphabetically
-    directories = []
     try:
-        for entry in sorted(dir_path.iterdir()):
-            if entry.is_dir() and not entry.name.startswith("."):
-                directories.append({"name": entry.name, "path": str(entry)})
-    except PermissionError:
-        pass  # Skip directories we can't read
+        listing = listing_cache.get(dir_path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail="Directory not found") from e
+    start, end = listing.matching(prefix)
+    page = listing.entries[start + offset : min(end, start + offset + limit)]
 
     parent = str(dir_path.parent) if dir_path.parent != dir_path else None
 
-    return {"current": str(dir_path), "parent": parent, "directories": directories}
+    return {
+        "current": str(dir_path),
+        "parent": parent,
+        "directories": [asdict(entry) for entry in page],
+        "total": end - start,
+    }
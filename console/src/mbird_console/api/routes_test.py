@@ -1,32 +1,53 @@
+import asyncio
+from collections.abc import Iterator
 from pathlib import Path
 from typing import Any
 
 from fastapi.testclient import TestClient
+from fastapi.websockets import WebSocketDisconnect
+from mbird_data import MbirdData, MbirdNode
+from mbird_data.columnar import from_columnar
 from mbird_data.constants import TREE_FNAME
 import pytest
 
+from mbird_console import metrics
 from mbird_console.api import routes
+from mbird_console.catalog import CatalogScanner, ProjectCatalog
 from mbird_console.main import app
+from mbird_console.sessions import SessionRegistry
 
 client = TestClient(app)
 
 
 @pytest.fixture(autouse=True)
-def reset_state():
-    """Reset global state before each test."""
-    routes.current_data = None
-    routes.current_path = None
-    routes.last_saved = None
-    yield
+def reset_state(tmp_path: Path) -> Iterator[None]:
+    """Start each test with no open projects, an empty catalog and a running app."""
+    routes.registry = SessionRegistry(routes.generate)
+    routes.catalog = ProjectCatalog(tmp_path / "catalog.sqlite3")
+    routes.catalog_scanner = CatalogScanner(routes.catalog)
+    with client:
+        yield
 
 
-def test_save_writes_to_disk_using_mbird_data_save(tmp_path: Path):
-    project_path = str(tmp_path / "test_project.mbird")
+@pytest.fixture
+def project_path(tmp_path: Path) -> str:
+    return str(tmp_path / "test_project.mbird")
+
+
+def create_project(path: str) -> str:
+    response = client.post("/api/project/create", json={"path": path})
+    assert response.status_code == 200
+    return response.json()["project_id"]
 
-    create_response = client.post("/api/project/create", json={"path": project_path})
-    assert create_response.status_code == 200
 
-    save_response = client.post("/api/save")
+def url(project_id: str, route: str) -> str:
+    return f"/api/projects/{project_id}/{route}"
+
+
+def test_save_writes_to_disk_using_mbird_data_save(project_path: str):
+    project_id = create_project(project_path)
+
+    save_response = client.post(url(project_id, "save"))
     assert save_response.status_code == 200
 
     data = save_response.json()
@@ -37,13 +58,11 @@ def test_save_writes_to_disk_using_mbird_data_save(tmp_path: Path):
     assert saved_file.exists()
 
 
-def test_save_status_returns_timestamp_after_save(tmp_path: Path):
-    project_path = str(tmp_path / "test_project.mbird")
-
-    client.post("/api/project/create", json={"path": project_path})
-    client.post("/api/save")
+def test_save_status_returns_timestamp_after_save(project_path: str):
+    project_id = create_project(project_path)
+    client.post(url(project_id, "save"))
 
-    status_response = client.get("/api/save/status")
+    status_response = client.get(url(project_id, "save/status"))
     assert status_response.status_code == 200
 
     data = status_response.json()
@@ -51,33 +70,32 @@ def test_save_status_returns_timestamp_after_save(tmp_path: Path):
 
 
 def test_save_without_project_raises_error():
-    save_response = client.post("/api/save")
+    save_response = client.post(url("missing", "save"))
     assert save_response.status_code == 404
-    assert "No project loaded" in save_response.json()["detail"]
+    assert "Project not found" in save_response.json()["detail"]
 
 
-def test_load_reads_from_disk_using_mbird_data_load(tmp_path: Path):
-    project_path = str(tmp_path / "existing.mbird")
-
-    client.post("/api/project/create", json={"path": project_path})
-    client.post("/api/save")
+def test_load_reads_from_disk_using_mbird_data_load(project_path: str):
+    project_id = create_project(project_path)
+    client.post(url(project_id, "save"))
+    client.delete(f"/api/projects/{project_id}")
 
     load_response = client.post("/api/project/load", json={"path": project_path})
     assert load_response.status_code == 200
 
     data = load_response.json()
     assert data["status"] == "success"
+    assert data["project_id"] == project_id
     assert data["tree"]["id"] == "root"
 
 
-def test_create_project_returns_root_node():
-    create_response = client.post(
-        "/api/project/create", json={"path": "/tmp/test.mbird"}
-    )
+def test_create_project_returns_root_node(project_path: str):
+    create_response = client.post("/api/project/create", json={"path": project_path})
     assert create_response.status_code == 200
 
     data = create_response.json()
     assert data["status"] == "success"
+    assert data["project_id"]
     assert data["tree"]["id"] == "root"
     assert data["tree"]["children"] == []
 
@@ -88,33 +106,42 @@ def test_create_project_without_path_raises_error():
     assert "Missing 'path'" in create_response.json()["detail"]
 
 
-def test_create_project_sets_current_path():
-    client.post("/api/project/create", json={"path": "/tmp/test.mbird"})
+def test_projects_are_kept_apart(tmp_path: Path):
+    first = create_project(str(tmp_path / "first.mbird"))
+    second = create_project(str(tmp_path / "second.mbird"))
+    assert first != second
 
-    tree_response = client.get("/api/tree")
-    assert tree_response.status_code == 200
-    assert tree_response.json()["id"] == "root"
+    client.patch(
+        url(first, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "root", "node": {"id": "a"}}]},
+    )
+
+    assert len(client.get(url(first, "tree")).json()["children"]) == 1
+    assert client.get(url(second, "tree")).json()["children"] == []
+    projects = client.get("/api/projects").json()["projects"]
+    assert [project["project_id"] for project in projects] == [first, second]
 
 
 def test_get_tree_when_no_project_loaded_raises_error():
-    tree_response = client.get("/api/tree")
+    tree_response = client.get(url("missing", "tree"))
     assert tree_response.status_code == 404
-    assert "No project loaded" in tree_response.json()["detail"]
+    assert "Project not found" in tree_response.json()["detail"]
 
 
-def test_get_tree_returns_current_tree():
-    client.post("/api/project/create", json={"path": "/tmp/test.mbird"})
+def test_get_tree_returns_current_tree(project_path: str):
+    project_id = create_project(project_path)
 
-    tree_response = client.get("/api/tree")
+    tree_response = client.get(url(project_id, "tree"))
     assert tree_response.status_code == 200
 
+    assert tree_response.headers["content-type"] == "application/json"
     data = tree_response.json()
     assert data["id"] == "root"
     assert data["children"] == []
 
 
-def test_update_tree_with_valid_data_succeeds():
-    client.post("/api/project/create", json={"path": "/tmp/test.mbird"})
+def test_update_tree_with_valid_data_succeeds(project_path: str):
+    project_id = create_project(project_path)
 
     new_tree = {
         "id": "root",
@@ -124,7 +151,7 @@ def test_update_tree_with_valid_data_succeeds():
         ],
     }
 
-    update_response = client.post("/api/tree", json=new_tree)
+    update_response = client.post(url(project_id, "tree"), json=new_tree)
     assert update_response.status_code == 200
 
     data = update_response.json()
@@ -132,11 +159,12 @@ def test_update_tree_with_valid_data_succeeds():
     assert len(data["tree"]["children"]) == 2
     assert data["tree"]["children"][0]["id"] == "child1"
 
-    tree_response = client.get("/api/tree")
+    tree_response = client.get(url(project_id, "tree"))
     assert len(tree_response.json()["children"]) == 2
 
 
-def test_update_tree_with_cyclic_data_raises_error():
+def test_update_tree_with_cyclic_data_raises_error(project_path: str):
+    project_id = create_project(project_path)
     cyclic_tree = {
         "id": "node1",
         "children": [
@@ -147,36 +175,875 @@ def test_update_tree_with_cyclic_data_raises_error():
         ],
     }
 
-    update_response = client.post("/api/tree", json=cyclic_tree)
+    update_response = client.post(url(project_id, "tree"), json=cyclic_tree)
     assert update_response.status_code == 400
     assert "Cycle detected" in update_response.json()["detail"]
 
 
-def test_update_tree_with_invalid_structure_raises_error():
+def test_update_tree_with_invalid_structure_raises_error(project_path: str):
+    project_id = create_project(project_path)
     invalid_tree: dict[str, Any] = {"children": []}
 
-    update_response = client.post("/api/tree", json=invalid_tree)
+    update_response = client.post(url(project_id, "tree"), json=invalid_tree)
     assert update_response.status_code == 400
 
 
-def test_regenerate_sets_is_stale_false_for_all_nodes(tmp_path: Path):
-    project_path = str(tmp_path / "test_project.mbird")
+def test_regenerate_sets_is_stale_false_for_all_nodes(project_path: str):
+    project_id = create_project(project_path)
 
-    client.post("/api/project/create", json={"path": project_path})
-
-    tree_response = client.get("/api/tree")
+    tree_response = client.get(url(project_id, "tree"))
     tree_data = tree_response.json()
     assert tree_data["is_stale"] is True
 
-    regenerate_response = client.post("/api/regenerate")
+    regenerate_response = client.post(url(project_id, "regenerate"))
     assert regenerate_response.status_code == 200
 
     data = regenerate_response.json()
     assert data["status"] == "success"
-    assert data["tree"]["is_stale"] is False
+    assert data["regenerated"] == ["root"]
+
+    tree_response = client.get(url(project_id, "tree"))
+    assert tree_response.json()["is_stale"] is False
+
+
+def test_regenerate_only_visits_stale_nodes(project_path: str):
+    project_id = create_project(project_path)
+    client.post(
+        url(project_id, "tree"),
+        json={
+            "id": "root",
+            "is_stale": False,
+            "children": [
+                {"id": "fresh", "is_stale": False},
+                {
+                    "id": "parent",
+                    "is_stale": False,
+                    "children": [{"id": "new_child", "is_stale": True}],
+                },
+            ],
+        },
+    )
+
+    regenerate_response = client.post(url(project_id, "regenerate"))
+    assert regenerate_response.json()["regenerated"] == [
+        "new_child",
+        "parent",
+        "root",
+    ]
+
+    second_response = client.post(url(project_id, "regenerate"))
+    assert second_response.json()["regenerated"] == []
+
+
+def test_regenerate_reports_per_node_timings(project_path: str):
+    project_id = create_project(project_path)
+
+    regenerate_response = client.post(url(project_id, "regenerate"))
+
+    data = regenerate_response.json()
+    assert set(data["timings"]) == {"root"}
+    assert data["cancelled"] is False
+
+
+def test_cancel_regenerate_succeeds_when_idle(project_path: str):
+    project_id = create_project(project_path)
+
+    cancel_response = client.post(url(project_id, "regenerate/cancel"))
+    assert cancel_response.status_code == 200
+
+
+def test_update_tree_marks_ancestors_of_stale_nodes_stale(project_path: str):
+    project_id = create_project(project_path)
+
+    update_response = client.post(
+        url(project_id, "tree"),
+        json={
+            "id": "root",
+            "is_stale": False,
+            "children": [{"id": "child", "is_stale": True}],
+        },
+    )
+
+    assert update_response.json()["tree"]["is_stale"] is True
+
+
+def test_update_tree_with_duplicate_ids_raises_error(project_path: str):
+    project_id = create_project(project_path)
+
+    update_response = client.post(
+        url(project_id, "tree"),
+        json={"id": "root", "children": [{"id": "dup"}, {"id": "dup"}]},
+    )
+
+    assert update_response.status_code == 400
+    assert "Duplicate node id" in update_response.json()["detail"]
+    assert client.get(url(project_id, "tree")).json()["children"] == []
 
 
 def test_regenerate_without_project_raises_error():
-    regenerate_response = client.post("/api/regenerate")
+    regenerate_response = client.post(url("missing", "regenerate"))
     assert regenerate_response.status_code == 404
-    assert "No project loaded" in regenerate_response.json()["detail"]
+    assert "Project not found" in regenerate_response.json()["detail"]
+
+
+def test_patch_tree_applies_operations_and_returns_diff(project_path: str):
+    project_id = create_project(project_path)
+    client.post(url(project_id, "regenerate"))
+
+    patch_response = client.patch(
+        url(project_id, "tree"),
+        json={
+            "ops": [
+                {"op": "add", "parent_id": "root", "node": {"id": "child"}},
+                {"op": "rename", "node_id": "child", "new_id": "renamed"},
+            ]
+        },
+    )
+    assert patch_response.status_code == 200
+
+    diff = patch_response.json()["diff"]
+    assert diff["added"] == ["child"]
+    assert diff["renamed"] == {"child": "renamed"}
+    assert diff["stale"] == {"renamed": True, "root": True}
+
+    tree_response = client.get(url(project_id, "tree"))
+    assert tree_response.json()["children"][0]["id"] == "renamed"
+
+
+def test_patch_tree_with_invalid_operation_raises_error(project_path: str):
+    project_id = create_project(project_path)
+
+    patch_response = client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "remove", "node_id": "missing"}]},
+    )
+    assert patch_response.status_code == 400
+    assert "Node not found: missing" in patch_response.json()["detail"]
+
+
+def test_patch_tree_without_project_raises_error():
+    patch_response = client.patch(url("missing", "tree"), json={"ops": []})
+    assert patch_response.status_code == 404
+
+
+def test_undo_and_redo_a_patch(project_path: str):
+    project_id = create_project(project_path)
+    client.post(url(project_id, "regenerate"))
+    patch_response = client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "root", "node": {"id": "child"}}]},
+    )
+    assert patch_response.json()["can_undo"] is True
+
+    undo_response = client.post(url(project_id, "undo"))
+    assert undo_response.status_code == 200
+    assert undo_response.json()["diff"]["removed"] == ["child"]
+    assert undo_response.json()["can_redo"] is True
+    tree = client.get(url(project_id, "tree")).json()
+    assert tree["children"] == []
+    assert tree["is_stale"] is False
+
+    redo_response = client.post(url(project_id, "redo"))
+    assert redo_response.status_code == 200
+    assert redo_response.json()["can_redo"] is False
+    tree = client.get(url(project_id, "tree")).json()
+    assert [child["id"] for child in tree["children"]] == ["child"]
+
+    # Undone and redone edits are saved like any other
+    client.post(url(project_id, "save"))
+    loaded = MbirdData.load(project_path)
+    assert [child.id for child in loaded.root.children] == ["child"]  # type: ignore[union-attr]
+
+
+def test_shared_nodes_are_sent_and_saved_once(project_path: str):
+    project_id = create_project(project_path)
+    client.patch(
+        url(project_id, "tree"),
+        json={
+            "ops": [
+                {"op": "add", "parent_id": "root", "node": {"id": "a"}},
+                {"op": "add", "parent_id": "root", "node": {"id": "b"}},
+                {"op": "add", "parent_id": "a", "node": {"id": "s"}},
+                {"op": "link", "parent_id": "b", "node_id": "s"},
+            ]
+        },
+    )
+
+    tree = client.get(url(project_id, "tree")).json()
+    assert tree["children"][1]["children"] == [{"ref": "s"}]
+    subtree = client.get(url(project_id, "tree/b")).json()
+    assert subtree["tree"]["children"][0]["id"] == "s"
+
+    client.post(url(project_id, "save"))
+    loaded = MbirdData.load(project_path)
+    a, b = loaded.root.children  # type: ignore[union-attr]
+    assert b.children[0] is a.children[0]
+
+
+def test_undo_puts_back_a_deep_subtree(project_path: str):
+    project_id = create_project(project_path)
+    chain: dict[str, Any] = {"id": "n299"}
+    for i in range(298, -1, -1):
+        chain = {"id": f"n{i}", "children": [chain]}
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "root", "node": chain}]},
+    )
+    client.patch(
+        url(project_id, "tree"), json={"ops": [{"op": "remove", "node_id": "n0"}]}
+    )
+
+    undo_response = client.post(url(project_id, "undo"))
+    assert undo_response.status_code == 200
+    node = undo_response.json()["patch"]["ops"][0]["node"]
+    for _ in range(299):
+        node = node["children"][0]
+    assert node["id"] == "n299"
+
+    assert client.post(url(project_id, "redo")).status_code == 200
+    assert client.post(url(project_id, "undo")).status_code == 200
+    assert client.post(url(project_id, "save")).status_code == 200
+
+
+def test_undone_removal_of_a_shared_node_is_saved_and_reloaded(project_path: str):
+    project_id = create_project(project_path)
+    client.patch(
+        url(project_id, "tree"),
+        json={
+            "ops": [
+                {
+                    "op": "add",
+                    "parent_id": "root",
+                    "node": {"id": "x", "children": [{"id": "s"}]},
+                },
+                {"op": "add", "parent_id": "root", "node": {"id": "y"}},
+            ]
+        },
+    )
+    client.post(url(project_id, "save"))
+    for op in (
+        {"op": "link", "parent_id": "y", "node_id": "s"},
+        {"op": "remove", "node_id": "x"},
+    ):
+        client.patch(url(project_id, "tree"), json={"ops": [op]})
+    assert client.post(url(project_id, "undo")).status_code == 200
+    assert client.post(url(project_id, "save")).status_code == 200
+
+    client.delete(f"/api/projects/{project_id}")
+    response = client.post("/api/project/load", json={"path": project_path})
+    assert response.status_code == 200
+    x, y = response.json()["tree"]["children"]
+    assert [child["id"] for child in x["children"]] == ["s"]
+    assert y["children"] == [{"ref": "s"}]
+
+
+def test_undo_with_nothing_to_undo_conflicts(project_path: str):
+    project_id = create_project(project_path)
+
+    response = client.post(url(project_id, "undo"))
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Nothing to undo"
+
+
+def create_saved_project(project_path: str) -> str:
+    project_id = create_project(project_path)
+    client.post(
+        url(project_id, "tree"),
+        json={
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "a1", "children": [{"id": "a1x"}]}]},
+                {"id": "b"},
+            ],
+        },
+    )
+    assert client.post(url(project_id, "save")).status_code == 200
+    return project_id
+
+
+def test_diff_tree_compares_saved_and_open_trees(project_path: str):
+    project_id = create_project(project_path)
+    client.post(url(project_id, "save"))
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "root", "node": {"id": "child"}}]},
+    )
+
+    response = client.post(
+        "/api/tree/diff",
+        json={"old": {"path": project_path}, "new": {"project_id": project_id}},
+    )
+
+    assert response.status_code == 200
+    diff = response.json()["diff"]
+    assert diff["added"] == ["child"]
+    assert diff["removed"] == []
+
+
+def test_diff_tree_with_missing_tree_raises_error():
+    response = client.post("/api/tree/diff", json={"old": {"tree": {"id": "root"}}})
+    assert response.status_code == 400
+    assert "Missing 'new'" in response.json()["detail"]
+
+
+def test_merge_tree_applies_the_other_versions_changes(project_path: str):
+    project_id = create_project(project_path)
+    base = {"id": "root", "children": [{"id": "a"}, {"id": "b"}]}
+    client.post(url(project_id, "tree"), json=base)
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "a", "node": {"id": "ours"}}]},
+    )
+    theirs = {"id": "root", "children": [{"id": "b", "children": [{"id": "a"}]}]}
+
+    response = client.post(
+        url(project_id, "tree/merge"),
+        json={"base": {"tree": base}, "theirs": {"tree": theirs}},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["conflicts"] == []
+    tree = client.get(url(project_id, "tree")).json()
+    assert [child["id"] for child in tree["children"]] == ["b"]
+    assert tree["children"][0]["children"][0]["children"][0]["id"] == "ours"
+
+    client.post(url(project_id, "undo"))
+    tree = client.get(url(project_id, "tree")).json()
+    assert [child["id"] for child in tree["children"]] == ["a", "b"]
+
+
+def test_merge_tree_adds_deep_subtrees(project_path: str):
+    project_id = create_project(project_path)
+    base = {"id": "root", "children": [{"id": "a"}]}
+    client.post(url(project_id, "tree"), json=base)
+    chain: dict[str, Any] = {"id": "n299"}
+    for i in range(298, -1, -1):
+        chain = {"id": f"n{i}", "children": [chain]}
+    theirs = {"id": "root", "children": [{"id": "a", "children": [chain]}]}
+
+    response = client.post(
+        url(project_id, "tree/merge"),
+        json={"base": {"tree": base}, "theirs": {"tree": theirs}},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["diff"]["added"] == ["n0"]
+    assert client.post(url(project_id, "undo")).status_code == 200
+    assert client.post(url(project_id, "redo")).status_code == 200
+    assert client.post(url(project_id, "save")).status_code == 200
+
+
+def test_merge_tree_conflicts_unless_resolved(project_path: str):
+    project_id = create_project(project_path)
+    base = {"id": "root", "children": [{"id": "a"}, {"id": "b"}, {"id": "c"}]}
+    client.post(url(project_id, "tree"), json=base)
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "move", "node_id": "c", "new_parent_id": "a"}]},
+    )
+    theirs = {
+        "id": "root",
+        "children": [{"id": "a"}, {"id": "b", "children": [{"id": "c"}]}],
+    }
+    request = {"base": {"tree": base}, "theirs": {"tree": theirs}}
+
+    response = client.post(url(project_id, "tree/merge"), json=request)
+    assert response.status_code == 409
+    assert response.json()["detail"]["conflicts"] == [
+        {
+            "node_id": "c",
+            "kind": "moved",
+            "detail": "moved differently in ours and theirs",
+        }
+    ]
+
+    response = client.post(
+        url(project_id, "tree/merge"), json={**request, "resolve": "theirs"}
+    )
+    assert response.status_code == 200
+    tree = client.get(url(project_id, "tree")).json()
+    assert tree["children"][1]["children"][0]["id"] == "c"
+
+
+def test_get_subtree_returns_bounded_slice(project_path: str):
+    project_id = create_saved_project(project_path)
+
+    response = client.get(url(project_id, "tree/a"), params={"depth": 1})
+    assert response.status_code == 200
+
+    data = response.json()
+    assert data["tree"]["id"] == "a"
+    assert [child["id"] for child in data["tree"]["children"]] == ["a1"]
+    assert data["tree"]["children"][0]["children"] == []
+    assert data["truncated"] == ["a1"]
+
+
+def test_get_subtree_of_missing_node_raises_error(project_path: str):
+    project_id = create_saved_project(project_path)
+
+    response = client.get(url(project_id, "tree/missing"))
+    assert response.status_code == 404
+    assert "Node not found" in response.json()["detail"]
+
+
+def test_get_subtree_without_project_raises_error():
+    response = client.get(url("missing", "tree/root"))
+    assert response.status_code == 404
+
+
+def test_search_tree_finds_nodes_and_their_paths(project_path: str):
+    project_id = create_saved_project(project_path)
+
+    response = client.get(url(project_id, "tree/search"), params={"q": "A1"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "nodes": [
+            {"id": "a1", "path": ["root", "a", "a1"], "is_stale": True},
+            {"id": "a1x", "path": ["root", "a", "a1", "a1x"], "is_stale": True},
+        ],
+        "total": 2,
+    }
+
+    response = client.get(
+        url(project_id, "tree/search"),
+        params={"q": "a", "prefix": True, "min_depth": 2, "limit": 1},
+    )
+    data = response.json()
+    assert [node["id"] for node in data["nodes"]] == ["a1"]
+    assert data["total"] == 2
+
+
+def test_search_tree_follows_edits(project_path: str):
+    project_id = create_saved_project(project_path)
+    client.get(url(project_id, "tree/search"))
+
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "rename", "node_id": "a1", "new_id": "chorus"}]},
+    )
+    response = client.get(url(project_id, "tree/search"), params={"q": "chor"})
+    assert [node["id"] for node in response.json()["nodes"]] == ["chorus"]
+
+    client.post(url(project_id, "undo"))
+    response = client.get(url(project_id, "tree/search"), params={"under": "a"})
+    assert [node["id"] for node in response.json()["nodes"]] == ["a", "a1", "a1x"]
+
+
+def test_search_tree_under_missing_node_raises_error(project_path: str):
+    project_id = create_saved_project(project_path)
+
+    response = client.get(url(project_id, "tree/search"), params={"under": "nope"})
+    assert response.status_code == 404
+    assert "Node not found" in response.json()["detail"]
+
+
+def test_trees_are_sent_in_columns_when_accepted(project_path: str):
+    project_id = create_saved_project(project_path)
+    accept = {"Accept": routes.COLUMNAR_MEDIA_TYPE}
+
+    response = client.get(url(project_id, "tree"), headers=accept)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == routes.COLUMNAR_MEDIA_TYPE
+    assert "Accept" in response.headers["Vary"]
+    columns = response.json()
+    assert columns["ids"] == ["root", "a", "a1", "a1x", "b"]
+    assert columns["parents"] == [-1, 0, 1, 2, 0]
+    assert from_columnar(columns) == MbirdNode.from_dict(
+        client.get(url(project_id, "tree")).json()
+    )
+
+    # Each encoding has its own ETag
+    etag = response.headers["ETag"]
+    assert etag != client.get(url(project_id, "tree")).headers["ETag"]
+    cached = client.get(
+        url(project_id, "tree"), headers={**accept, "If-None-Match": etag}
+    )
+    assert cached.status_code == 304
+
+    response = client.get(
+        url(project_id, "tree/a"), params={"depth": 1}, headers=accept
+    )
+    data = response.json()
+    assert data["tree"]["ids"] == ["a", "a1"]
+    assert data["truncated"] == ["a1"]
+
+
+def test_created_and_loaded_trees_are_sent_in_columns_when_accepted(
+    project_path: str,
+):
+    accept = {"Accept": f"{routes.COLUMNAR_MEDIA_TYPE}, application/json;q=0.9"}
+    response = client.post(
+        "/api/project/create", json={"path": project_path}, headers=accept
+    )
+    assert response.json()["tree"]["ids"] == ["root"]
+
+    response = client.post(
+        "/api/project/load", json={"path": project_path}, headers=accept
+    )
+    assert response.headers["Content-Type"] == routes.COLUMNAR_MEDIA_TYPE
+    assert response.json()["tree"]["ids"] == ["root"]
+
+
+def test_large_trees_are_compressed(project_path: str):
+    project_id = create_project(project_path)
+    children = [{"id": f"node{i}"} for i in range(1000)]
+    client.post(url(project_id, "tree"), json={"id": "root", "children": children})
+
+    response = client.get(url(project_id, "tree"), headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert int(response.headers["Content-Length"]) < len(response.content) / 4
+    assert len(response.json()["children"]) == 1000
+
+
+def test_load_with_depth_returns_top_levels_lazily(project_path: str):
+    project_id = create_saved_project(project_path)
+    client.delete(f"/api/projects/{project_id}")
+
+    response = client.post("/api/project/load", json={"path": project_path, "depth": 1})
+    assert response.status_code == 200
+
+    data = response.json()
+    assert [child["id"] for child in data["tree"]["children"]] == ["a", "b"]
+    assert data["truncated"] == ["a"]
+    session = routes.registry.sessions()[0]
+    assert not session.data.is_materialized
+
+    subtree = client.get(url(project_id, "tree/a1"), params={"depth": 0}).json()
+    assert subtree["truncated"] == ["a1"]
+    assert not session.data.is_materialized
+
+    # Editing builds the tree in memory
+    patch_response = client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "b", "node": {"id": "new"}}]},
+    )
+    assert patch_response.status_code == 200
+    assert session.data.is_materialized
+
+
+def test_load_with_invalid_depth_raises_error(project_path: str):
+    create_saved_project(project_path)
+
+    response = client.post(
+        "/api/project/load", json={"path": project_path, "depth": -1}
+    )
+    assert response.status_code == 400
+
+
+def test_save_after_patch_and_regenerate_only_appends_to_journal(project_path: str):
+    project_id = create_saved_project(project_path)
+    snapshot = (Path(project_path) / TREE_FNAME).read_text()
+
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "b", "node": {"id": "new"}}]},
+    )
+    client.post(url(project_id, "regenerate"))
+    assert client.post(url(project_id, "save")).status_code == 200
+
+    assert (Path(project_path) / TREE_FNAME).read_text() == snapshot
+    client.delete(f"/api/projects/{project_id}")
+    response = client.post("/api/project/load", json={"path": project_path})
+    tree = response.json()["tree"]
+    assert [child["id"] for child in tree["children"][1]["children"]] == ["new"]
+    assert tree["is_stale"] is False
+
+
+def test_save_status_reports_unsaved_changes(project_path: str):
+    project_id = create_project(project_path)
+
+    status = client.get(url(project_id, "save/status")).json()
+    assert status["dirty"] is True
+    assert status["last_saved"] is None
+
+    client.post(url(project_id, "save"))
+
+    status = client.get(url(project_id, "save/status")).json()
+    assert status["dirty"] is False
+    assert status["error"] is None
+    assert status["last_saved"] is not None
+
+
+def test_evicted_project_is_saved_and_reloaded(tmp_path: Path):
+    routes.registry.memory_budget = 0
+    first = create_project(str(tmp_path / "first.mbird"))
+    client.patch(
+        url(first, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "root", "node": {"id": "a"}}]},
+    )
+    second = create_project(str(tmp_path / "second.mbird"))
+    client.get(url(second, "tree"))
+
+    assert first not in routes.registry
+    assert (tmp_path / "first.mbird" / TREE_FNAME).exists()
+
+    tree = client.get(url(first, "tree")).json()
+    assert [child["id"] for child in tree["children"]] == ["a"]
+
+
+def test_get_tree_is_not_sent_again_while_unchanged(project_path: str):
+    project_id = create_project(project_path)
+
+    first = client.get(url(project_id, "tree"))
+    etag = first.headers["etag"]
+    cached = client.get(url(project_id, "tree"), headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == etag
+
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "root", "node": {"id": "a"}}]},
+    )
+
+    changed = client.get(url(project_id, "tree"), headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert changed.json()["children"][0]["id"] == "a"
+
+
+def test_unchanged_tree_is_encoded_once(project_path: str):
+    project_id = create_saved_project(project_path)
+    encoded = metrics.OPERATION_SECONDS.count(operation="encode")
+
+    first = client.get(url(project_id, "tree"))
+    subtree = client.get(url(project_id, "tree/a"), params={"depth": 1})
+    assert client.get(url(project_id, "tree")).content == first.content
+    assert (
+        client.get(url(project_id, "tree/a"), params={"depth": 1}).content
+        == subtree.content
+    )
+    assert metrics.OPERATION_SECONDS.count(operation="encode") == encoded + 2
+    assert subtree.json()["status"] == "success"
+    assert subtree.json()["tree"]["id"] == "a"
+
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "a", "node": {"id": "new"}}]},
+    )
+    changed = client.get(url(project_id, "tree")).json()
+    assert "new" in [child["id"] for child in changed["children"][0]["children"]]
+
+
+def test_subtree_etag_depends_on_subtree_and_depth(project_path: str):
+    project_id = create_saved_project(project_path)
+    etag = client.get(url(project_id, "tree/a"), params={"depth": 1}).headers["etag"]
+
+    assert client.get(url(project_id, "tree/a")).headers["etag"] != etag
+
+    # Changes outside the subtree keep its ETag
+    client.patch(
+        url(project_id, "tree"),
+        json={"ops": [{"op": "add", "parent_id": "b", "node": {"id": "new"}}]},
+    )
+    cached = client.get(
+        url(project_id, "tree/a"),
+        params={"depth": 1},
+        headers={"If-None-Match": etag},
+    )
+    assert cached.status_code == 304
+
+
+def test_lazily_loaded_tree_etag_matches_once_loaded(project_path: str):
+    project_id = create_saved_project(project_path)
+    etag = client.get(url(project_id, "tree/a")).headers["etag"]
+    client.delete(f"/api/projects/{project_id}")
+
+    client.post("/api/project/load", json={"path": project_path, "depth": 0})
+    lazy_etag = client.get(url(project_id, "tree/a")).headers["etag"]
+    session = routes.registry.sessions()[0]
+    assert not session.data.is_materialized
+    assert lazy_etag == etag
+
+
+def test_trees_are_encoded_off_the_event_loop(
+    project_path: str, monkeypatch: pytest.MonkeyPatch
+):
+    project_id = create_saved_project(project_path)
+    encode_tree = routes._encode_tree
+    on_loop: list[bool] = []
+
+    def encode(*args: Any, **kwargs: Any) -> bytes:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            on_loop.append(False)
+        else:
+            on_loop.append(True)
+        return encode_tree(*args, **kwargs)
+
+    monkeypatch.setattr(routes, "_encode_tree", encode)
+    client.get(url(project_id, "tree"))
+    client.get(url(project_id, "tree/a"), params={"depth": 1})
+    assert on_loop == [False, False]
+
+
+def test_lazily_loaded_tree_is_sent_without_building_it(project_path: str):
+    project_id = create_saved_project(project_path)
+    expected = client.get(url(project_id, "tree")).json()
+    client.delete(f"/api/projects/{project_id}")
+
+    client.post("/api/project/load", json={"path": project_path, "depth": 0})
+    assert client.get(url(project_id, "tree")).json() == expected
+    session = routes.registry.sessions()[0]
+    assert not session.data.is_materialized
+
+
+def test_regenerate_skips_unchanged_subtrees(project_path: str):
+    project_id = create_saved_project(project_path)
+    client.post(url(project_id, "regenerate"))
+
+    client.patch(
+        url(project_id, "tree"),
+        json={
+            "ops": [
+                {"op": "add", "parent_id": "a", "node": {"id": "tmp"}},
+                {"op": "remove", "node_id": "tmp"},
+            ]
+        },
+    )
+    regenerate_response = client.post(url(project_id, "regenerate"))
+
+    data = regenerate_response.json()
+    assert data["regenerated"] == ["a", "root"]
+    assert data["skipped"] == ["a", "root"]
+    assert data["timings"] == {}
+    assert client.get(url(project_id, "tree")).json()["is_stale"] is False
+
+
+def test_events_push_other_clients_changes(project_path: str):
+    project_id = create_project(project_path)
+
+    with client.websocket_connect(
+        url(project_id, "events") + "?client_id=watcher"
+    ) as websocket:
+        client.patch(
+            url(project_id, "tree"),
+            json={"ops": [{"op": "add", "parent_id": "root", "node": {"id": "a"}}]},
+            headers={"X-Mbird-Client": "editor"},
+        )
+        events = websocket.receive_json()["events"]
+        assert events[0] == {
+            "type": "added",
+            "parent_id": "root",
+            "position": None,
+            "node": {"id": "a"},
+        }
+
+        # The author's own edits aren't echoed back
+        client.patch(
+            url(project_id, "tree"),
+            json={"ops": [{"op": "remove", "node_id": "a"}]},
+            headers={"X-Mbird-Client": "watcher"},
+        )
+        client.post(url(project_id, "regenerate"))
+        events = websocket.receive_json()["events"]
+        assert events[0] == {"type": "stale", "changes": {"root": False}}
+        assert events[-1]["type"] == "progress"
+
+
+def test_events_send_the_whole_tree_when_it_is_replaced(project_path: str):
+    project_id = create_project(project_path)
+
+    with client.websocket_connect(url(project_id, "events")) as websocket:
+        client.post(url(project_id, "tree"), json={"id": "new"})
+        events = websocket.receive_json()["events"]
+
+    assert events == [
+        {"type": "reset", "tree": {"id": "new", "children": [], "is_stale": True}}
+    ]
+
+
+def test_events_end_when_project_is_closed(project_path: str):
+    project_id = create_project(project_path)
+
+    with client.websocket_connect(url(project_id, "events")) as websocket:
+        client.delete(f"/api/projects/{project_id}")
+        events = websocket.receive_json()["events"]
+
+    assert events[-1] == {"type": "closed"}
+
+
+def test_events_for_unknown_project_are_refused():
+    with (
+        pytest.raises(WebSocketDisconnect),
+        client.websocket_connect(url("missing", "events")),
+    ):
+        pass
+
+
+def test_browse_pages_through_matching_directories(tmp_path: Path):
+    for name in ["a1", "a2", "a3.mbird", "b1"]:
+        (tmp_path / name).mkdir()
+
+    response = client.get(
+        "/api/filesystem/browse",
+        params={"path": str(tmp_path), "prefix": "a", "offset": 1, "limit": 1},
+    )
+    assert response.status_code == 200
+
+    data = response.json()
+    assert data["current"] == str(tmp_path.resolve())
+    assert data["total"] == 3
+    assert data["directories"] == [
+        {"name": "a2", "path": str(tmp_path.resolve() / "a2"), "is_project": False}
+    ]
+
+    last = client.get(
+        "/api/filesystem/browse",
+        params={"path": str(tmp_path), "prefix": "a", "offset": 2},
+    ).json()
+    assert last["directories"][0]["is_project"] is True
+
+
+def test_browse_missing_directory_raises_error(tmp_path: Path):
+    response = client.get(
+        "/api/filesystem/browse", params={"path": str(tmp_path / "missing")}
+    )
+    assert response.status_code == 404
+
+
+def test_catalog_lists_opened_projects(project_path: str):
+    create_saved_project(project_path)
+    assert client.post("/api/catalog/scan").status_code == 200
+
+    response = client.get("/api/catalog")
+    assert response.status_code == 200
+    (project,) = response.json()["projects"]
+    assert project["path"] == str(Path(project_path).resolve())
+    assert project["node_count"] == 5
+    assert project["root"]["children"] == ["a", "b"]
+    assert project["last_opened"] is not None
+
+    assert client.get("/api/catalog", params={"q": "TEST_proj"}).json()["projects"]
+    assert client.get("/api/catalog", params={"q": "other"}).json()["projects"] == []
+
+
+def test_prewarm_opens_most_recent_project(project_path: str):
+    project_id = create_saved_project(project_path)
+    assert client.delete(f"/api/projects/{project_id}").status_code == 200
+    assert client.get("/api/projects").json()["projects"] == []
+
+    assert client.portal is not None
+    client.portal.call(routes.prewarm)
+
+    (project,) = client.get("/api/projects").json()["projects"]
+    assert project["project_id"] == project_id
+
+
+def test_metrics_report_routes_and_hot_paths(project_path: str):
+    project_id = create_saved_project(project_path)
+    client.post(url(project_id, "regenerate"))
+
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert (
+        "mbird_http_request_duration_seconds_count"
+        '{method="POST",route="/api/projects/{project_id}/regenerate",status="200"}'
+    ) in text
+    assert 'mbird_http_response_size_bytes_count{method="POST"' in text
+    for operation in ("validate", "encode", "save", "generate", "regenerate"):
+        series = f'mbird_operation_duration_seconds_count{{operation="{operation}"}}'
+        assert series in text
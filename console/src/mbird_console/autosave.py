@@ -0,0 +1,149 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from contextlib import suppress
+from datetime import datetime, timezone
+import logging
+import time
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Seconds without a new change before the project is saved
+AUTOSAVE_DELAY = 2.0
+# Longest a change stays unsaved while edits keep arriving
+AUTOSAVE_MAX_DELAY = 30.0
+
+
+class Autosaver:
+    """
+    Saves the project in the background once edits settle down.
+
+    Changes are reported with mark_dirty(), and the project is saved after
+    `delay` seconds without a new change (or `max_delay` seconds after the first
+    unsaved one). The save function is awaited, and is responsible for keeping
+    the event loop free (e.g. writing from a worker thread) and for saving a
+    consistent version of the tree while edits continue. `on_status` is called
+    after every save, successful or not.
+    """
+
+    def __init__(
+        self,
+        save: Callable[[], Awaitable[None]],
+        delay: float = AUTOSAVE_DELAY,
+        max_delay: float = AUTOSAVE_MAX_DELAY,
+        on_status: Callable[[], None] | None = None,
+    ):
+        self._save = save
+        self.delay = delay
+        self.max_delay = max_delay
+        self.on_status = on_status
+
+        self.last_saved: datetime | None = None
+        self.error: str | None = None
+        self.saving = False
+        self.dirty = False
+        self._first_change_at = 0.0
+        self._last_change_at = 0.0
+
+        self._changed = asyncio.Event()
+        # Held for the whole of a save, so flushes never overlap
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def mark_dirty(self) -> None:
+        """Report a change that should be saved."""
+        now = time.monotonic()
+        if not self.dirty:
+            self._first_change_at = now
+        self._last_change_at = now
+        self.dirty = True
+        self._changed.set()
+
+    def reset(self) -> None:
+        """Forget the save state, e.g. after switching to another project."""
+        self.dirty = False
+        self.error = None
+        self.last_saved = None
+        self._changed.clear()
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "last_saved": self.last_saved.isoformat() if self.last_saved else None,
+            "saving": self.saving,
+            "dirty": self.dirty,
+            "error": self.error,
+        }
+
+    def start(self) -> None:
+        """Start saving in the background (must be called from the event loop)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop saving in the background, then save any remaining changes."""
+        if self._task is not None:
+            # Wait for a save in progress rather than abandoning its thread
+            async with self._flush_lock:
+                self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Save now if there are unsaved changes, after any save in progress.
+
+        Raises:
+            Exception: Whatever the save function raised (also kept in `error`)
+        """
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.saving = True
+            try:
+                await self._save()
+            except Exception as e:
+                self.dirty = True
+                self.error = str(e)
+                raise
+            else:
+                self.error = None
+                self.last_saved = datetime.now(timezone.utc)
+            finally:
+                self.saving = False
+                self._report_status()
+
+    def _report_status(self) -> None:
+        if self.on_status is not None:
+            try:
+                self.on_status()
+            except Exception:
+                logger.exception("Autosave status callback failed")
+
+    async def _run(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            if not self.dirty:
+                continue
+
+            # Debounce: keep waiting while changes arrive, up to max_delay
+            while True:
+                now = time.monotonic()
+                due = min(
+                    self._last_change_at + self.delay,
+                    self._first_change_at + self.max_delay,
+                )
+                if now >= due:
+                    break
+                await asyncio.sleep(due - now)
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Autosave failed")
+                # Still dirty; try again later even if nothing else changes
+                await asyncio.sleep(self.max_delay)
+                self._changed.set()
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+
+import pytest
+
+from mbird_console.autosave import Autosaver
+
+
+class FakeSave:
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+        self.release = threading.Event()
+        self.release.set()
+
+    async def __call__(self) -> None:
+        await asyncio.to_thread(self.release.wait, 5)
+        self.calls += 1
+        if self.fail:
+            raise OSError("disk full")
+
+
+def test_changes_are_saved_once_after_they_settle():
+    save = FakeSave()
+
+    async def scenario() -> None:
+        autosaver = Autosaver(save, delay=0.05)
+        autosaver.start()
+        for _ in range(5):
+            autosaver.mark_dirty()
+            await asyncio.sleep(0.01)
+        assert save.calls == 0
+
+        await asyncio.sleep(0.2)
+        assert save.calls == 1
+        assert not autosaver.dirty
+        assert autosaver.last_saved is not None
+        await autosaver.stop()
+
+    asyncio.run(scenario())
+
+
+def test_continuous_changes_are_saved_after_max_delay():
+    save = FakeSave()
+
+    async def scenario() -> None:
+        autosaver = Autosaver(save, delay=0.05, max_delay=0.1)
+        autosaver.start()
+        for _ in range(20):
+            autosaver.mark_dirty()
+            await asyncio.sleep(0.02)
+        assert save.calls >= 2
+        await autosaver.stop()
+
+    asyncio.run(scenario())
+
+
+def test_flush_waits_for_save_in_progress():
+    save = FakeSave()
+    save.release.clear()
+
+    async def scenario() -> None:
+        autosaver = Autosaver(save)
+        autosaver.mark_dirty()
+        in_flight = asyncio.create_task(autosaver.flush())
+        await asyncio.sleep(0.01)
+        assert autosaver.saving
+
+        # Nothing changed since the save started, so this doesn't save again
+        waiting = asyncio.create_task(autosaver.flush())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+
+        save.release.set()
+        await asyncio.gather(in_flight, waiting)
+        assert save.calls == 1
+        assert not autosaver.saving
+
+    asyncio.run(scenario())
+
+
+def test_failed_save_is_reported_and_kept_dirty():
+    save = FakeSave()
+    save.fail = True
+
+    async def scenario() -> None:
+        autosaver = Autosaver(save)
+        autosaver.mark_dirty()
+        with pytest.raises(OSError):
+            await autosaver.flush()
+        assert autosaver.status()["error"] == "disk full"
+        assert autosaver.dirty
+
+        save.fail = False
+        await autosaver.flush()
+        assert autosaver.status()["error"] is None
+        assert not autosaver.dirty
+
+    asyncio.run(scenario())
+
+
+def test_stop_saves_remaining_changes():
+    save = FakeSave()
+
+    async def scenario() -> None:
+        autosaver = Autosaver(save, delay=60)
+        autosaver.start()
+        autosaver.mark_dirty()
+        await autosaver.stop()
+        assert save.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_status_is_reported_after_each_save():
+    save = FakeSave()
+    statuses: list[dict] = []
+
+    async def scenario() -> None:
+        autosaver: Autosaver
+
+        def report() -> None:
+            statuses.append(autosaver.status())
+
+        autosaver = Autosaver(save, on_status=report)
+        autosaver.mark_dirty()
+        await autosaver.flush()
+        save.fail = True
+        autosaver.mark_dirty()
+        with pytest.raises(OSError):
+            await autosaver.flush()
+
+    asyncio.run(scenario())
+
+    assert [status["error"] for status in statuses] == [None, "disk full"]
+    assert statuses[0]["last_saved"] is not None
+    assert not any(status["saving"] for status in statuses)
@@ -0,0 +1,391 @@
+import asyncio
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any
+
+from mbird_data.constants import (
+    BINARY_TREE_FNAME,
+    JOURNAL_FNAME,
+    MBIRD_EXT,
+    TREE_FNAME,
+)
+from mbird_data.lazy import MappedTree
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FNAME = "catalog.sqlite3"
+# How many directory levels below each scan root are searched for projects
+SCAN_DEPTH = 3
+# Seconds between background scans
+SCAN_INTERVAL = 300.0
+# Child ids kept in a project's root summary
+SUMMARY_CHILDREN = 20
+
+_SCHEMA_VERSION = 1
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    -- Modification times and sizes of the project's files when last read
+    fingerprint TEXT,
+    node_count INTEGER,
+    size_bytes INTEGER,
+    root_summary TEXT,
+    last_opened REAL
+);
+CREATE INDEX IF NOT EXISTS projects_last_opened ON projects (last_opened);
+-- Subdirectories of each scanned directory, reused while its mtime is unchanged
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scan_roots (
+    path TEXT PRIMARY KEY
+);
+"""
+
+
+def default_catalog_path() -> Path:
+    return Path.home() / ".mbird" / CATALOG_FNAME
+
+
+class ProjectCatalog:
+    """
+    Persistent catalog of known projects, with a summary of each.
+
+    Projects are added when they're opened, and by scanning the directories
+    that projects were opened from. Scans are incremental: a directory's
+    listing is reused while its modification time is unchanged, and a project
+    is only read again once its files change. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, db_path: Path | None = None):
+        self.db_path = default_catalog_path() if db_path is None else db_path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        """Use the database in a transaction, opening it on first use."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            with self._conn:
+                yield self._conn
+
+    def _connect(self) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > _SCHEMA_VERSION:
+            conn.close()
+            raise ValueError(f"Unsupported catalog version: {version}")
+        conn.executescript(_SCHEMA)
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        return conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def record_opened(self, path: str | Path) -> None:
+        """
+        Note that a project was opened, and scan its directory from now on.
+
+        Its summary is filled in by the next scan.
+        """
+        project_path = _project_path(path)
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO projects (path, name, last_opened) VALUES (?, ?, ?)"
+                " ON CONFLICT (path) DO UPDATE SET last_opened = excluded.last_opened",
+                (str(project_path), project_path.name, time.time()),
+            )
+            db.execute(
+                "INSERT OR IGNORE INTO scan_roots (path) VALUES (?)",
+                (str(project_path.parent),),
+            )
+
+    def search(self, query: str = "", limit: int = 50) -> list[dict[str, Any]]:
+        """
+        Find projects whose name or path contains query (ignoring case).
+
+        Returns:
+            Projects, most recently opened first, then by name
+        """
+        pattern = "%" + _escape_like(query) + "%"
+        with self._db() as db:
+            rows = db.execute(
+                "SELECT * FROM projects"
+                " WHERE name LIKE ? ESCAPE '\\' OR path LIKE ? ESCAPE '\\'"
+                " ORDER BY last_opened IS NULL, last_opened DESC, name"
+                " LIMIT ?",
+                (pattern, pattern, limit),
+            ).fetchall()
+        return [_project_info(row) for row in rows]
+
+    def recent(self, limit: int) -> list[str]:
+        """Paths of the most recently opened projects."""
+        with self._db() as db:
+            rows = db.execute(
+                "SELECT path FROM projects WHERE last_opened IS NOT NULL"
+                " ORDER BY last_opened DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [row["path"] for row in rows]
+
+    def refresh(self, path: str | Path) -> bool:
+        """
+        Read a project's summary again if its files changed since last time.
+
+        A project that was deleted is dropped from the catalog. One that was
+        opened but hasn't been saved yet is kept as it is.
+
+        Returns:
+            Whether the catalog changed
+        """
+        project_path = _project_path(path)
+        if not project_path.is_dir():
+            with self._db() as db:
+                row = db.execute(
+                    "SELECT fingerprint FROM projects WHERE path = ?",
+                    (str(project_path),),
+                ).fetchone()
+            # Projects that were opened but never saved have no files yet
+            if row is not None and row["fingerprint"] is not None:
+                return self._forget(project_path)
+            return False
+
+        fingerprint, size = _fingerprint(project_path)
+        with self._db() as db:
+            row = db.execute(
+                "SELECT fingerprint FROM projects WHERE path = ?",
+                (str(project_path),),
+            ).fetchone()
+        if row is not None and row["fingerprint"] == fingerprint:
+            return False
+
+        try:
+            node_count, summary = _summarize(project_path)
+        except (OSError, ValueError) as e:
+            logger.warning("Couldn't read project %s: %s", project_path, e)
+            return False
+
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO projects"
+                " (path, name, fingerprint, node_count, size_bytes, root_summary)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (path) DO UPDATE SET"
+                " fingerprint = excluded.fingerprint,"
+                " node_count = excluded.node_count,"
+                " size_bytes = excluded.size_bytes,"
+                " root_summary = excluded.root_summary",
+                (
+                    str(project_path),
+                    project_path.name,
+                    fingerprint,
+                    node_count,
+                    size,
+                    None if summary is None else json.dumps(summary),
+                ),
+            )
+        return True
+
+    def scan(self, depth: int = SCAN_DEPTH) -> int:
+        """
+        Look for new, changed and deleted projects.
+
+        Known projects are checked, and the scan roots are searched down to
+        depth levels below them.
+
+        Returns:
+            Number of projects added, updated or dropped
+        """
+        with self._db() as db:
+            known = [row["path"] for row in db.execute("SELECT path FROM projects")]
+            roots = [row["path"] for row in db.execute("SELECT path FROM scan_roots")]
+
+        found: set[str] = set()
+        for root in roots:
+            self._walk(Path(root), depth, found)
+        return sum(self.refresh(path) for path in found.union(known))
+
+    def _walk(self, dir_path: Path, depth: int, found: set[str]) -> None:
+        stack = [(dir_path, depth)]
+        while stack:
+            current, levels = stack.pop()
+            for subdir in self._subdirs(current):
+                if subdir.endswith(MBIRD_EXT):
+                    found.add(subdir)
+                elif levels > 0:
+                    stack.append((Path(subdir), levels - 1))
+
+    def _subdirs(self, dir_path: Path) -> list[str]:
+        """Visible subdirectories of a directory, from the catalog if unchanged."""
+        try:
+            mtime_ns = dir_path.stat().st_mtime_ns
+        except OSError:
+            return []
+        with self._db() as db:
+            row = db.execute(
+                "SELECT mtime_ns, subdirs FROM directories WHERE path = ?",
+                (str(dir_path),),
+            ).fetchone()
+        if row is not None and row["mtime_ns"] == mtime_ns:
+            return json.loads(row["subdirs"])
+
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    try:
+                        if not entry.name.startswith(".") and entry.is_dir():
+                            subdirs.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            return []
+        with self._db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs)"
+                " VALUES (?, ?, ?)",
+                (str(dir_path), mtime_ns, json.dumps(subdirs)),
+            )
+        return subdirs
+
+    def _forget(self, project_path: Path) -> bool:
+        with self._db() as db:
+            cursor = db.execute(
+                "DELETE FROM projects WHERE path = ?", (str(project_path),)
+            )
+        return cursor.rowcount > 0
+
+
+class CatalogScanner:
+    """Scans for project changes in the background, periodically or on request."""
+
+    def __init__(self, catalog: ProjectCatalog, interval: float = SCAN_INTERVAL):
+        self.catalog = catalog
+        self.interval = interval
+        self._requested = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start scanning (must be called from the event loop)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def request(self) -> None:
+        """Scan as soon as possible, e.g. after a project was opened."""
+        self._requested.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.catalog.scan)
+            except Exception:
+                logger.exception("Project catalog scan failed")
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._requested.wait(), self.interval)
+            self._requested.clear()
+
+
+def _project_path(path: str | Path) -> Path:
+    project_path = Path(path).expanduser().resolve()
+    if not project_path.name.endswith(MBIRD_EXT):
+        # Saving adds the extension
+        project_path = project_path.with_name(project_path.name + MBIRD_EXT)
+    return project_path
+
+
+def _fingerprint(project_path: Path) -> tuple[str, int]:
+    """Fingerprint of a project's files, and their total size."""
+    parts = []
+    size = 0
+    for fname in (TREE_FNAME, BINARY_TREE_FNAME, JOURNAL_FNAME):
+        try:
+            stat = (project_path / fname).stat()
+        except FileNotFoundError:
+            continue
+        parts.append(f"{fname}:{stat.st_mtime_ns}:{stat.st_size}")
+        size += stat.st_size
+    return ",".join(parts), size
+
+
+def _summarize(project_path: Path) -> tuple[int | None, dict[str, Any] | None]:
+    """
+    Count a project's nodes and summarize its root, from its binary tree file.
+
+    Only the file's header and the root's children are read, and changes
+    journaled since the file was written aren't included. Projects without an
+    up to date binary file (e.g. only saved as JSON) aren't read at all, since
+    parsing tree.json costs as much as opening the project: they're summarized
+    once they're saved with one.
+
+    Returns:
+        The node count and root summary (both None if they weren't read)
+
+    Raises:
+        OSError: If the file can't be read
+        ValueError: If it isn't a valid binary tree file
+    """
+    binary_file = project_path / BINARY_TREE_FNAME
+    try:
+        binary_mtime = binary_file.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None, None
+    with suppress(FileNotFoundError):
+        # Older than tree.json, so MbirdData.load() wouldn't use it either
+        if (project_path / TREE_FNAME).stat().st_mtime_ns > binary_mtime:
+            return None, None
+
+    tree = MappedTree(binary_file)
+    try:
+        root = tree.slice(0, depth=1).root
+        node_count = tree.num_nodes()
+    finally:
+        tree.close()
+    summary = {
+        "id": root.id,
+        "is_stale": root.is_stale,
+        "num_children": len(root.children),
+        "children": [child.id for child in root.children[:SUMMARY_CHILDREN]],
+    }
+    return node_count, summary
+
+
+def _project_info(row: sqlite3.Row) -> dict[str, Any]:
+    summary = row["root_summary"]
+    return {
+        "path": row["path"],
+        "name": row["name"],
+        "node_count": row["node_count"],
+        "size_bytes": row["size_bytes"],
+        "last_opened": row["last_opened"],
+        "root": None if summary is None else json.loads(summary),
+    }
+
+
+def _escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
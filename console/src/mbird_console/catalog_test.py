@@ -0,0 +1,120 @@
+from pathlib import Path
+
+from mbird_data import MbirdData, MbirdNode
+import pytest
+
+from mbird_console.catalog import ProjectCatalog
+
+
+@pytest.fixture
+def catalog(tmp_path: Path) -> ProjectCatalog:
+    return ProjectCatalog(tmp_path / "catalog.sqlite3")
+
+
+def save_project(path: Path, num_children: int = 2, binary: bool = True) -> None:
+    root = MbirdNode(
+        id="root", children=[MbirdNode(id=f"c{i}") for i in range(num_children)]
+    )
+    MbirdData(root=root).save(path, binary=binary)
+
+
+def test_opened_project_is_summarized_by_scan(catalog: ProjectCatalog, tmp_path: Path):
+    save_project(tmp_path / "first.mbird")
+    catalog.record_opened(tmp_path / "first.mbird")
+
+    assert catalog.scan() == 1
+
+    (project,) = catalog.search()
+    assert project["name"] == "first.mbird"
+    assert project["node_count"] == 3
+    assert project["size_bytes"] > 0
+    assert project["root"] == {
+        "id": "root",
+        "is_stale": True,
+        "num_children": 2,
+        "children": ["c0", "c1"],
+    }
+
+
+def test_scan_finds_projects_near_opened_ones(catalog: ProjectCatalog, tmp_path: Path):
+    save_project(tmp_path / "first.mbird")
+    catalog.record_opened(tmp_path / "first.mbird")
+    catalog.scan()
+
+    save_project(tmp_path / "nested" / "deeper" / "second.mbird")
+    (tmp_path / "nested" / "not_a_project").mkdir()
+    assert catalog.scan() == 1
+
+    names = [project["name"] for project in catalog.search()]
+    # Opened projects come first
+    assert names == ["first.mbird", "second.mbird"]
+
+
+def test_scan_only_rereads_changed_projects(catalog: ProjectCatalog, tmp_path: Path):
+    save_project(tmp_path / "first.mbird")
+    catalog.record_opened(tmp_path / "first.mbird")
+    catalog.scan()
+    assert catalog.scan() == 0
+
+    save_project(tmp_path / "first.mbird", num_children=5)
+    assert catalog.scan() == 1
+    assert catalog.search()[0]["node_count"] == 6
+
+
+def test_json_only_projects_are_summarized_once_saved_with_a_binary_file(
+    catalog: ProjectCatalog, tmp_path: Path
+):
+    save_project(tmp_path / "first.mbird", binary=False)
+    catalog.record_opened(tmp_path / "first.mbird")
+
+    assert catalog.scan() == 1
+    (project,) = catalog.search()
+    assert project["node_count"] is None
+    assert project["root"] is None
+    assert catalog.scan() == 0
+
+    save_project(tmp_path / "first.mbird")
+    assert catalog.scan() == 1
+    assert catalog.search()[0]["node_count"] == 3
+
+
+def test_scan_drops_deleted_projects(catalog: ProjectCatalog, tmp_path: Path):
+    save_project(tmp_path / "first.mbird")
+    catalog.record_opened(tmp_path / "first.mbird")
+    catalog.scan()
+
+    for path in (tmp_path / "first.mbird").iterdir():
+        path.unlink()
+    (tmp_path / "first.mbird").rmdir()
+
+    assert catalog.scan() == 1
+    assert catalog.search() == []
+
+
+def test_unsaved_projects_are_kept(catalog: ProjectCatalog, tmp_path: Path):
+    catalog.record_opened(tmp_path / "new")
+
+    assert catalog.scan() == 0
+    (project,) = catalog.search()
+    assert project["name"] == "new.mbird"
+    assert project["node_count"] is None
+
+
+def test_search_matches_wildcards_literally(catalog: ProjectCatalog, tmp_path: Path):
+    catalog.record_opened(tmp_path / "100%_done.mbird")
+    catalog.record_opened(tmp_path / "other.mbird")
+
+    assert [p["name"] for p in catalog.search("0%_")] == ["100%_done.mbird"]
+    assert [p["name"] for p in catalog.search("%")] == ["100%_done.mbird"]
+    assert len(catalog.search()) == 2
+
+
+def test_recent_lists_last_opened_first(catalog: ProjectCatalog, tmp_path: Path):
+    for name in ("a", "b", "c"):
+        catalog.record_opened(tmp_path / name)
+    catalog.record_opened(tmp_path / "a")
+
+    assert catalog.recent(2) == [
+        str(tmp_path.resolve() / "a.mbird"),
+        str(tmp_path.resolve() / "c.mbird"),
+    ]
@@ -0,0 +1,228 @@
+"""
+Response compression, negotiated with each client's Accept-Encoding header.
+
+gzip is always available. Brotli ("br") and Zstandard ("zstd") are used when
+the optional `brotli` and `zstandard` packages are installed (the console's
+"compression" extra).
+"""
+
+from collections.abc import Callable
+from typing import Protocol
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Smaller responses are sent as is, since compressing them saves less than it
+# costs
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+class _BrotliCompressor:
+    def __init__(self) -> None:
+        import brotli  # type: ignore[import-not-found]
+
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def _gzip() -> Compressor:
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _zstd() -> Compressor:
+    import zstandard  # type: ignore[import-not-found]
+
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def available_encodings() -> dict[str, Callable[[], Compressor]]:
+    """Compressor factories by content coding, most preferred first."""
+    encodings: dict[str, Callable[[], Compressor]] = {}
+    try:
+        import zstandard  # type: ignore[import-not-found]  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        encodings["zstd"] = _zstd
+    try:
+        import brotli  # type: ignore[import-not-found]  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        encodings["br"] = _BrotliCompressor
+    encodings["gzip"] = _gzip
+    return encodings
+
+
+def negotiate(accept_encoding: str, supported: list[str]) -> str | None:
+    """
+    Pick the content coding to respond with.
+
+    Args:
+        accept_encoding: The request's Accept-Encoding header
+        supported: Codings that can be used, most preferred first
+
+    Returns:
+        The accepted coding with the highest q-value (ties going to the most
+        preferred), or None if none are accepted
+    """
+    weights: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+
+    default = weights.get("*", 0.0)
+    best: str | None = None
+    best_weight = 0.0
+    for coding in supported:
+        weight = weights.get(coding, default)
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+class CompressionMiddleware:
+    """
+    Compresses HTTP responses of at least `minimum_size` bytes.
+
+    Streamed responses are compressed as they're sent, once enough of the body
+    has been buffered to tell that it's worth it. Responses that are already
+    encoded are left alone. ETags of compressed responses are made weak, since
+    the bytes differ from the uncompressed response's.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = COMPRESS_MIN_BYTES,
+        encodings: dict[str, Callable[[], Compressor]] | None = None,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = available_encodings() if encodings is None else encodings
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        encoding = negotiate(accept_encoding, list(self.encodings))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressingSender(
+            send, encoding, self.encodings[encoding], self.minimum_size
+        )
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressingSender:
+    def __init__(
+        self,
+        send: Send,
+        encoding: str,
+        new_compressor: Callable[[], Compressor],
+        minimum_size: int,
+    ):
+        self._send = send
+        self.encoding = encoding
+        self.new_compressor = new_compressor
+        self.minimum_size = minimum_size
+        self._start: Message | None = None
+        self._buffer: list[bytes] = []
+        self._buffered = 0
+        # Decided once enough of the body was seen: None until then
+        self._compressor: Compressor | None = None
+        self._passthrough = False
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            self._passthrough = "content-encoding" in headers
+            if self._passthrough:
+                await self._send(message)
+            else:
+                self._start = message
+            return
+        if message["type"] != "http.response.body" or self._passthrough:
+            await self._send(message)
+            return
+
+        body: bytes = message.get("body", b"")
+        more_body: bool = message.get("more_body", False)
+        if self._compressor is not None:
+            await self._send_compressed(body, more_body)
+            return
+
+        self._buffer.append(body)
+        self._buffered += len(body)
+        if self._buffered < self.minimum_size:
+            if more_body:
+                return
+            # The whole body is too small to be worth compressing
+            assert self._start is not None
+            await self._send(self._start)
+            await self._send(
+                {"type": "http.response.body", "body": b"".join(self._buffer)}
+            )
+            return
+
+        self._compressor = self.new_compressor()
+        buffered = b"".join(self._buffer)
+        self._buffer = []
+        await self._send_compressed(buffered, more_body, start=True)
+
+    async def _send_compressed(
+        self, body: bytes, more_body: bool, start: bool = False
+    ) -> None:
+        assert self._compressor is not None
+        data = self._compressor.compress(body)
+        if not more_body:
+            data += self._compressor.flush()
+
+        if start:
+            message = self._start
+            assert message is not None
+            self._start = None
+            headers = MutableHeaders(raw=message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag is not None and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag
+            if more_body:
+                # Not known until the whole body is compressed
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(data))
+            await self._send(message)
+
+        if data or not more_body:
+            await self._send(
+                {"type": "http.response.body", "body": data, "more_body": more_body}
+            )
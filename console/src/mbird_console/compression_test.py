@@ -0,0 +1,136 @@
+from collections.abc import Iterator
+
+from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+import pytest
+
+from mbird_console.compression import (
+    CompressionMiddleware,
+    _gzip,
+    available_encodings,
+    negotiate,
+)
+
+BIG = b"x" * 4096
+
+
+class _Reversed:
+    """A fake coding, so tests can tell which coding was picked."""
+
+    def __init__(self) -> None:
+        self._data = b""
+
+    def compress(self, data: bytes) -> bytes:
+        self._data += data
+        return b""
+
+    def flush(self) -> bytes:
+        return self._data[::-1]
+
+
+def make_client(**kwargs) -> TestClient:
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=1024, **kwargs)
+
+    @app.get("/big")
+    async def big() -> Response:
+        return Response(BIG, headers={"ETag": '"abc"'})
+
+    @app.get("/small")
+    async def small() -> Response:
+        return Response(b"small")
+
+    @app.get("/stream")
+    async def stream() -> StreamingResponse:
+        def chunks() -> Iterator[bytes]:
+            for _ in range(8):
+                yield b"y" * 512
+
+        return StreamingResponse(chunks())
+
+    @app.get("/small-stream")
+    async def small_stream() -> StreamingResponse:
+        return StreamingResponse(iter([b"a", b"b"]))
+
+    @app.get("/encoded")
+    async def encoded() -> Response:
+        return Response(BIG, headers={"Content-Encoding": "identity"})
+
+    return TestClient(app)
+
+
+@pytest.mark.parametrize(
+    ("accept_encoding", "expected"),
+    [
+        ("gzip", "gzip"),
+        ("gzip, br", "br"),
+        ("gzip;q=1.0, br;q=0.5", "gzip"),
+        ("zstd, br, gzip", "zstd"),
+        ("*", "zstd"),
+        ("*, zstd;q=0", "br"),
+        ("identity", None),
+        ("gzip;q=0", None),
+        ("", None),
+    ],
+)
+def test_negotiate_picks_the_best_accepted_coding(
+    accept_encoding: str, expected: str | None
+):
+    assert negotiate(accept_encoding, ["zstd", "br", "gzip"]) == expected
+
+
+def test_gzip_is_always_available():
+    assert "gzip" in available_encodings()
+
+
+def test_large_responses_are_compressed():
+    client = make_client()
+
+    response = client.get("/big", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == 'W/"abc"'
+    assert int(response.headers["Content-Length"]) < len(BIG)
+    # Decompressed by the client
+    assert response.content == BIG
+
+
+def test_streamed_responses_are_compressed():
+    client = make_client()
+
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    assert response.content == b"y" * 4096
+
+
+@pytest.mark.parametrize("path", ["/small", "/small-stream", "/encoded"])
+def test_small_and_encoded_responses_are_sent_as_is(path: str):
+    client = make_client()
+
+    response = client.get(path, headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers or (
+        response.headers["Content-Encoding"] == "identity"
+    )
+
+
+def test_uncompressed_without_accept_encoding():
+    client = make_client()
+
+    response = client.get("/big", headers={"Accept-Encoding": "identity"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["ETag"] == '"abc"'
+
+
+def test_prefers_the_first_encoding():
+    client = make_client(encodings={"reversed": _Reversed, "gzip": _gzip})
+
+    response = client.get("/big", headers={"Accept-Encoding": "gzip, reversed"})
+
+    assert response.headers["Content-Encoding"] == "reversed"
+    assert response.content == BIG[::-1]
@@ -0,0 +1,200 @@
+import asyncio
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from mbird_data import MbirdNode
+from mbird_data.patch import (
+    AddChild,
+    LinkNode,
+    MoveSubtree,
+    PatchDiff,
+    RemoveSubtree,
+    RenameNode,
+    TreePatch,
+)
+from mbird_data.streaming import encode_json, loads_json
+
+# Events a subscriber can fall behind by before they're replaced with a reset
+MAX_PENDING_EVENTS = 1000
+
+# Events that only set values, so a later one of the same type can be merged
+# into an earlier one as long as no structural change came in between
+_MERGEABLE = ("stale", "progress", "save_status")
+
+Event = dict[str, Any]
+
+
+def patch_events(patch: TreePatch, diff: PatchDiff) -> list[Event]:
+    """
+    Describe an applied patch as events, in the order it was applied.
+
+    Adds, links, removes, moves and renames are replayed by clients as they
+    were requested, followed by the stale flags that changed as a result.
+    Removes and moves of a shared node name the parent they apply to, as
+    "parent_id" and "from_parent_id" respectively.
+    """
+    events: list[Event] = []
+    for op in patch.ops:
+        if isinstance(op, AddChild):
+            # Undoing a removal adds back the removed nodes themselves
+            node = op.node
+            if isinstance(node, MbirdNode):
+                node = loads_json(encode_json(node))
+            events.append(
+                {
+                    "type": "added",
+                    "parent_id": op.parent_id,
+                    "position": op.position,
+                    "node": node,
+                }
+            )
+        elif isinstance(op, LinkNode):
+            events.append(
+                {
+                    "type": "linked",
+                    "node_id": op.node_id,
+                    "parent_id": op.parent_id,
+                    "position": op.position,
+                }
+            )
+        elif isinstance(op, RemoveSubtree):
+            event: Event = {"type": "removed", "node_id": op.node_id}
+            if op.parent_id is not None:
+                event["parent_id"] = op.parent_id
+            events.append(event)
+        elif isinstance(op, MoveSubtree):
+            event = {
+                "type": "moved",
+                "node_id": op.node_id,
+                "parent_id": op.new_parent_id,
+                "position": op.position,
+            }
+            if op.parent_id is not None:
+                event["from_parent_id"] = op.parent_id
+            events.append(event)
+        elif isinstance(op, RenameNode):
+            events.append(
+                {"type": "renamed", "node_id": op.node_id, "new_id": op.new_id}
+            )
+    if diff.stale:
+        events.append({"type": "stale", "changes": diff.stale})
+    return events
+
+
+class Subscriber:
+    """
+    Events waiting to be sent to one client.
+
+    Consecutive flag changes and progress updates are merged while they wait,
+    so a client that reads slowly gets fewer, larger updates. One that falls
+    more than max_pending events behind gets a single reset event instead,
+    after which it should take the whole tree again.
+    """
+
+    def __init__(self, client_id: str | None, max_pending: int = MAX_PENDING_EVENTS):
+        self.client_id = client_id
+        self.max_pending = max_pending
+        self.closed = False
+        self._events: deque[Event] = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, event: Event) -> None:
+        if self.closed:
+            return
+        if self._events and self._events[0]["type"] == "reset":
+            # The reset already covers it
+            pass
+        elif not self._merge(event):
+            self._events.append(event)
+            if len(self._events) > self.max_pending:
+                self.reset()
+        self._ready.set()
+
+    def reset(self) -> None:
+        """Replace the waiting events with a reset (and "closed" if closed)."""
+        self._events.clear()
+        self._events.append({"type": "reset"})
+        if self.closed:
+            self._events.append({"type": "closed"})
+        self._ready.set()
+
+    def close(self) -> None:
+        """Stop after the events already waiting."""
+        self._events.append({"type": "closed"})
+        self.closed = True
+        self._ready.set()
+
+    async def get(self) -> list[Event]:
+        """Wait for events and take every one waiting."""
+        await self._ready.wait()
+        self._ready.clear()
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+    def _merge(self, event: Event) -> bool:
+        if event["type"] not in _MERGEABLE:
+            return False
+        for pending in reversed(self._events):
+            if pending["type"] not in _MERGEABLE:
+                return False
+            if pending["type"] == event["type"]:
+                if event["type"] == "stale":
+                    pending["changes"].update(event["changes"])
+                else:
+                    pending.update(event)
+                return True
+        return False
+
+
+class EventHub:
+    """Fans out a project's events to every subscribed client."""
+
+    def __init__(self) -> None:
+        self._subscribers: set[Subscriber] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    @contextmanager
+    def subscribe(self, client_id: str | None = None) -> Iterator[Subscriber]:
+        """
+        Receive events until the block exits.
+
+        Args:
+            client_id: Identifies the client, so it can be left out of events
+                about its own changes
+        """
+        subscriber = Subscriber(client_id)
+        self._subscribers.add(subscriber)
+        try:
+            yield subscriber
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event: Event, source: str | None = None) -> None:
+        """
+        Send an event to every subscriber (must be called from the event loop).
+
+        Args:
+            event: JSON-serializable event with a "type"
+            source: Client id of the change's author, which already knows
+                about it and doesn't get the event
+        """
+        for subscriber in self._subscribers:
+            if source is None or subscriber.client_id != source:
+                # Each subscriber may merge into its copy
+                subscriber.put(_copy_event(event))
+
+    def close(self) -> None:
+        """Tell every subscriber that the project was closed."""
+        for subscriber in self._subscribers:
+            subscriber.close()
+
+
+def _copy_event(event: Event) -> Event:
+    if event["type"] == "stale":
+        return {**event, "changes": dict(event["changes"])}
+    return dict(event)
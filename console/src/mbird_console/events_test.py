@@ -0,0 +1,118 @@
+import asyncio
+
+from mbird_data.patch import PatchDiff, TreePatch
+
+from mbird_console.events import EventHub, Subscriber, patch_events
+
+
+def test_patch_events_replay_operations_then_flags():
+    patch = TreePatch.model_validate(
+        {
+            "ops": [
+                {"op": "add", "parent_id": "root", "node": {"id": "a"}},
+                {"op": "move", "node_id": "a", "new_parent_id": "b", "position": 0},
+                {"op": "rename", "node_id": "a", "new_id": "c"},
+                {"op": "remove", "node_id": "c"},
+                {"op": "set_flags", "node_id": "b", "is_stale": True},
+            ]
+        }
+    )
+
+    events = patch_events(patch, PatchDiff(stale={"b": True}))
+
+    assert [event["type"] for event in events] == [
+        "added",
+        "moved",
+        "renamed",
+        "removed",
+        "stale",
+    ]
+    assert events[1] == {
+        "type": "moved",
+        "node_id": "a",
+        "parent_id": "b",
+        "position": 0,
+    }
+    assert events[-1]["changes"] == {"b": True}
+
+
+def test_flag_changes_and_progress_are_merged_while_waiting():
+    async def scenario() -> list[dict]:
+        subscriber = Subscriber(None)
+        subscriber.put({"type": "stale", "changes": {"a": True}})
+        subscriber.put({"type": "progress", "done": 1, "total": 3})
+        subscriber.put({"type": "stale", "changes": {"a": False, "b": False}})
+        subscriber.put({"type": "progress", "done": 2, "total": 3})
+        # Structural changes aren't merged across
+        subscriber.put({"type": "removed", "node_id": "b"})
+        subscriber.put({"type": "stale", "changes": {"root": True}})
+        return await subscriber.get()
+
+    assert asyncio.run(scenario()) == [
+        {"type": "stale", "changes": {"a": False, "b": False}},
+        {"type": "progress", "done": 2, "total": 3},
+        {"type": "removed", "node_id": "b"},
+        {"type": "stale", "changes": {"root": True}},
+    ]
+
+
+def test_subscriber_that_falls_behind_gets_a_reset():
+    async def scenario() -> list[dict]:
+        subscriber = Subscriber(None, max_pending=3)
+        for i in range(5):
+            subscriber.put({"type": "removed", "node_id": f"n{i}"})
+        return await subscriber.get()
+
+    assert asyncio.run(scenario()) == [{"type": "reset"}]
+
+
+def test_reset_replaces_waiting_events_but_keeps_closed():
+    async def scenario() -> list[dict]:
+        subscriber = Subscriber(None)
+        subscriber.put({"type": "removed", "node_id": "a"})
+        subscriber.close()
+        subscriber.reset()
+        return await subscriber.get()
+
+    assert asyncio.run(scenario()) == [{"type": "reset"}, {"type": "closed"}]
+
+
+def test_hub_skips_the_author_of_a_change():
+    async def scenario() -> tuple[list[dict], list[dict]]:
+        hub = EventHub()
+        with hub.subscribe("author") as author, hub.subscribe("other") as other:
+            hub.publish({"type": "removed", "node_id": "a"}, source="author")
+            hub.publish({"type": "stale", "changes": {"root": True}})
+            hub.close()
+            return await author.get(), await other.get()
+
+    author_events, other_events = asyncio.run(scenario())
+
+    assert [event["type"] for event in author_events] == ["stale", "closed"]
+    assert [event["type"] for event in other_events] == ["removed", "stale", "closed"]
+
+
+def test_patch_events_name_the_parent_of_shared_nodes():
+    patch = TreePatch.model_validate(
+        {
+            "ops": [
+                {"op": "link", "parent_id": "b", "node_id": "a", "position": 0},
+                {"op": "move", "node_id": "a", "new_parent_id": "c", "parent_id": "b"},
+                {"op": "remove", "node_id": "a", "parent_id": "root"},
+            ]
+        }
+    )
+
+    events = patch_events(patch, PatchDiff())
+
+    assert events == [
+        {"type": "linked", "node_id": "a", "parent_id": "b", "position": 0},
+        {
+            "type": "moved",
+            "node_id": "a",
+            "parent_id": "c",
+            "position": None,
+            "from_parent_id": "b",
+        },
+        {"type": "removed", "node_id": "a", "parent_id": "root"},
+    ]
@@ -0,0 +1,115 @@
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+
+from mbird_data.constants import MBIRD_EXT
+
+# Directory listings kept in memory, most recently used first
+LISTING_CACHE_SIZE = 64
+
+
+@dataclass(frozen=True)
+class DirectoryEntry:
+    name: str
+    path: str
+    # Whether it's an mbird project directory
+    is_project: bool
+
+
+@dataclass
+class Listing:
+    """The subdirectories of a directory, sorted case-insensitively by name."""
+
+    # Modification time of the directory when it was listed
+    mtime_ns: int
+    entries: list[DirectoryEntry]
+    # Sort key of each entry, for prefix searches
+    keys: list[str]
+
+    def matching(self, prefix: str = "") -> tuple[int, int]:
+        """
+        Find the entries whose names start with prefix (ignoring case).
+
+        Returns:
+            Start and end of the matching entries
+        """
+        folded = prefix.casefold()
+        start = bisect_left(self.keys, folded)
+        end = start
+        while end < len(self.keys) and self.keys[end].startswith(folded):
+            end += 1
+        return start, end
+
+
+class ListingCache:
+    """
+    Listings of recently browsed directories.
+
+    A cached listing is reused as long as the directory's modification time is
+    unchanged, which it isn't once entries are added, removed or renamed. Safe
+    to use from several threads.
+    """
+
+    def __init__(self, max_listings: int = LISTING_CACHE_SIZE):
+        self.max_listings = max_listings
+        self._listings: OrderedDict[Path, Listing] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dir_path: Path) -> Listing:
+        """
+        List a directory's subdirectories, skipping hidden ones.
+
+        Raises:
+            FileNotFoundError: If the directory doesn't exist
+            NotADirectoryError: If the path isn't a directory
+        """
+        mtime_ns = dir_path.stat().st_mtime_ns
+        with self._lock:
+            listing = self._listings.get(dir_path)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self._listings.move_to_end(dir_path)
+                return listing
+
+        # Listed without holding the lock, so a slow directory doesn't block
+        # the others
+        listing = _scan(dir_path, mtime_ns)
+        with self._lock:
+            self._listings[dir_path] = listing
+            self._listings.move_to_end(dir_path)
+            while len(self._listings) > self.max_listings:
+                self._listings.popitem(last=False)
+        return listing
+
+
+def _scan(dir_path: Path, mtime_ns: int) -> Listing:
+    entries = []
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    # Answered from the directory entry itself on most systems
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir:
+                    entries.append(
+                        DirectoryEntry(
+                            name=entry.name,
+                            path=entry.path,
+                            is_project=entry.name.endswith(MBIRD_EXT),
+                        )
+                    )
+    except PermissionError:
+        pass  # Skip directories we can't read
+
+    entries.sort(key=lambda e: (e.name.casefold(), e.name))
+    return Listing(
+        mtime_ns=mtime_ns,
+        entries=entries,
+        keys=[entry.name.casefold() for entry in entries],
+    )
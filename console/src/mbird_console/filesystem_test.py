@@ -0,0 +1,56 @@
+import os
+from pathlib import Path
+
+from mbird_console.filesystem import ListingCache
+
+
+def make_dirs(root: Path, *names: str) -> None:
+    for name in names:
+        (root / name).mkdir()
+
+
+def test_listing_has_sorted_visible_directories(tmp_path: Path):
+    make_dirs(tmp_path, "beta", "Alpha", ".hidden", "gamma.mbird")
+    (tmp_path / "file.txt").write_text("")
+
+    listing = ListingCache().get(tmp_path)
+
+    assert [entry.name for entry in listing.entries] == ["Alpha", "beta", "gamma.mbird"]
+    assert [entry.is_project for entry in listing.entries] == [False, False, True]
+    assert listing.entries[0].path == str(tmp_path / "Alpha")
+
+
+def test_matching_finds_entries_by_prefix_ignoring_case(tmp_path: Path):
+    make_dirs(tmp_path, "apple", "Apricot", "banana", "application")
+    listing = ListingCache().get(tmp_path)
+
+    start, end = listing.matching("AP")
+    assert [entry.name for entry in listing.entries[start:end]] == [
+        "apple",
+        "application",
+        "Apricot",
+    ]
+    assert listing.matching("cherry")[0] == listing.matching("cherry")[1]
+
+
+def test_listing_is_reused_until_directory_changes(tmp_path: Path):
+    make_dirs(tmp_path, "a")
+    cache = ListingCache()
+    listing = cache.get(tmp_path)
+    assert cache.get(tmp_path) is listing
+
+    make_dirs(tmp_path, "b")
+    # Make sure the change is visible even on coarse-grained timestamps
+    os.utime(tmp_path, ns=(listing.mtime_ns + 10**9, listing.mtime_ns + 10**9))
+
+    assert [entry.name for entry in cache.get(tmp_path).entries] == ["a", "b"]
+
+
+def test_least_recently_used_listings_are_dropped(tmp_path: Path):
+    make_dirs(tmp_path, "one", "two", "three")
+    cache = ListingCache(max_listings=2)
+    first = cache.get(tmp_path / "one")
+    cache.get(tmp_path / "two")
+    cache.get(tmp_path / "three")
+
+    assert cache.get(tmp_path / "one") is not first
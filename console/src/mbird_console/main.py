@@ -1,9 +1,59 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager, suppress
+import os
+from pathlib import Path
+import tempfile
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from mbird_console.api import routes
+from mbird_console.compression import CompressionMiddleware
+from mbird_console.metrics import MetricsMiddleware, SlowRequestProfiler
+from mbird_console.shared import STATE_DB_ENV
+
+# Opt-in profiling: requests taking at least this many milliseconds have their
+# profiles written to the profile directory
+PROFILE_SLOW_MS_ENV = "MBIRD_PROFILE_SLOW_MS"
+PROFILE_DIR_ENV = "MBIRD_PROFILE_DIR"
+# Number of worker processes serving the API. With more than one, they share
+# the projects' changes through a database at MBIRD_STATE_DB (a temporary one
+# for the server's lifetime if it's unset).
+WORKERS_ENV = "MBIRD_WORKERS"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    routes.catalog_scanner.start()
+    if routes.registry.state.shared:
+        routes.change_watcher.start()
+    prewarm = asyncio.create_task(routes.prewarm())
+    yield
+    prewarm.cancel()
+    with suppress(asyncio.CancelledError):
+        await prewarm
+    await routes.catalog_scanner.stop()
+    await routes.change_watcher.stop()
+    # Saves whatever changed since the last autosave
+    await routes.registry.close_all()
+    routes.registry.state.close()
+    routes.catalog.close()
+
+
+def slow_request_profiler() -> SlowRequestProfiler | None:
+    """Profiler configured by the environment, if profiling is turned on."""
+    threshold_ms = os.environ.get(PROFILE_SLOW_MS_ENV)
+    if not threshold_ms:
+        return None
+    output_dir = os.environ.get(PROFILE_DIR_ENV)
+    return SlowRequestProfiler(
+        float(threshold_ms) / 1000,
+        Path(output_dir) if output_dir else Path.home() / ".mbird" / "profiles",
+    )
+
 
-app = FastAPI(title="mbird Console API")
+app = FastAPI(title="mbird Console API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -12,6 +62,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+# Outermost, so it times everything else (and sees compressed sizes)
+app.add_middleware(MetricsMiddleware, profiler=slow_request_profiler())
 
 app.include_router(routes.router)
 
@@ -24,4 +77,16 @@ async def root():
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    workers = int(os.environ.get(WORKERS_ENV, "1"))
+    if workers == 1:
+        uvicorn.run(app, host="127.0.0.1", port=8000)
+    else:
+        with tempfile.TemporaryDirectory(prefix="mbird-state-") as state_dir:
+            # Inherited by the workers, which import the app themselves
+            os.environ.setdefault(STATE_DB_ENV, str(Path(state_dir) / "state.db"))
+            uvicorn.run(
+                "mbird_console.main:app",
+                host="127.0.0.1",
+                port=8000,
+                workers=workers,
+            )
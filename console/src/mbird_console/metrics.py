@@ -0,0 +1,329 @@
+from bisect import bisect_left
+from collections.abc import Awaitable, Callable, Iterator, MutableMapping
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import logging
+from pathlib import Path
+import pstats
+import re
+import threading
+import time
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+# Functions listed in the text summary of a slow request's profile
+PROFILE_SUMMARY_LINES = 40
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+class Histogram:
+    """
+    Distribution of observed values, per combination of label values.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        label_names: tuple[str, ...],
+        buckets: tuple[float, ...],
+    ):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label values: count in each bucket (the last one is +Inf), and sum
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Record a value.
+
+        Raises:
+            ValueError: If the labels aren't exactly this histogram's
+        """
+        if labels.keys() != set(self.label_names):
+            raise ValueError(
+                f"{self.name} takes labels {self.label_names}, got {tuple(labels)}"
+            )
+        key = tuple(labels[name] for name in self.label_names)
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts[bucket] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Record how long the block takes, in seconds (even if it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """Number of values recorded with the given labels."""
+        key = tuple(labels[name] for name in self.label_names)
+        with self._lock:
+            return sum(self._counts.get(key, ()))
+
+    def render(self) -> list[str]:
+        """Lines describing the histogram in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = sorted(
+                (key, list(counts), self._sums[key])
+                for key, counts in self._counts.items()
+            )
+        bounds = [_format_number(bound) for bound in self.buckets] + ["+Inf"]
+        for key, counts, total in series:
+            labels = [
+                f'{name}="{_escape(value)}"'
+                for name, value in zip(self.label_names, key, strict=True)
+            ]
+            cumulative = 0
+            for bound, count in zip(bounds, counts, strict=True):
+                cumulative += count
+                bucket_labels = ",".join([*labels, f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            joined = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{joined} {_format_number(total)}")
+            lines.append(f"{self.name}_count{joined} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics exposed by /api/metrics."""
+
+    def __init__(self) -> None:
+        self._histograms: dict[str, Histogram] = {}
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        """
+        Create and register a histogram.
+
+        Raises:
+            ValueError: If a metric with this name is already registered
+        """
+        if name in self._histograms:
+            raise ValueError(f"Metric already registered: {name}")
+        histogram = Histogram(name, description, label_names, buckets)
+        self._histograms[name] = histogram
+        return histogram
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format."""
+        lines = []
+        for histogram in self._histograms.values():
+            lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    "mbird_http_request_duration_seconds",
+    "Time taken to handle HTTP requests, until the response was sent.",
+    ("method", "route", "status"),
+)
+REQUEST_BYTES = registry.histogram(
+    "mbird_http_request_size_bytes",
+    "Size of HTTP request bodies.",
+    ("method", "route"),
+    SIZE_BUCKETS,
+)
+RESPONSE_BYTES = registry.histogram(
+    "mbird_http_response_size_bytes",
+    "Size of HTTP response bodies.",
+    ("method", "route"),
+    SIZE_BUCKETS,
+)
+# Operations: "load" and "save" (disk I/O and decoding/encoding), "materialize"
+# (building a lazily loaded tree), "validate" (building a tree sent by a
+# client), "apply_patch", "encode" (JSON encoding of trees sent to clients),
+# "generate" (each node), "regenerate" (a whole run, including scheduling),
+# "index_search" (building a tree's search index), "search", and "diff" and
+# "merge" (comparing and merging trees)
+OPERATION_SECONDS = registry.histogram(
+    "mbird_operation_duration_seconds",
+    "Time spent in the backend's hot paths.",
+    ("operation",),
+)
+
+
+class SlowRequestProfiler:
+    """
+    Profiles requests, and writes the profiles of slow ones to disk.
+
+    Each slow request gets a .prof file (readable with pstats or snakeviz) and
+    a .txt summary of the functions with the most cumulative time. Requests are
+    profiled one at a time on the event loop's thread, so a profile may include
+    other requests' work on the loop, while work handed to other threads (e.g.
+    loading, saving, regenerating) only shows up as waiting; the operation
+    timings break that down.
+    """
+
+    def __init__(self, threshold: float, output_dir: Path):
+        """
+        Args:
+            threshold: Requests that take at least this many seconds are slow
+            output_dir: Directory the profiles are written to
+        """
+        self.threshold = threshold
+        self.output_dir = output_dir
+        self._active = threading.Lock()
+
+    def start(self) -> cProfile.Profile | None:
+        """Start profiling a request, unless another one is being profiled."""
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is running in this thread
+            self._active.release()
+            return None
+        return profile
+
+    def finish(
+        self, profile: cProfile.Profile, seconds: float, method: str, route: str
+    ) -> Path | None:
+        """
+        Stop profiling a request, and write the profile if the request was slow.
+
+        Returns:
+            Path of the written profile, if any
+        """
+        profile.disable()
+        self._active.release()
+        if seconds < self.threshold:
+            return None
+
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = self.output_dir / f"{timestamp}-{method}-{slug}.prof"
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(path)
+            with path.with_suffix(".txt").open("w") as f:
+                f.write(f"{method} {route} took {seconds:.3f}s\n\n")
+                stats = pstats.Stats(profile, stream=f)
+                stats.sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+        except OSError:
+            logger.exception("Failed to write profile to %s", path)
+            return None
+        logger.warning(
+            "Slow request: %s %s took %.3fs, profile written to %s",
+            method,
+            route,
+            seconds,
+            path,
+        )
+        return path
+
+
+class MetricsMiddleware:
+    """
+    Records each HTTP request's latency and body sizes, by route.
+
+    Requests are labeled with their route's path template (e.g.
+    /api/projects/{project_id}/tree), so the number of series stays bounded.
+    """
+
+    def __init__(self, app: ASGIApp, profiler: SlowRequestProfiler | None = None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_bytes = 0
+        response_bytes = 0
+        status = 500
+
+        async def counting_receive() -> Message:
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message) -> None:
+            nonlocal response_bytes, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        profile = self.profiler.start() if self.profiler is not None else None
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            seconds = time.perf_counter() - start
+            method = scope["method"]
+            # Set by the router once the request matched a route
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(
+                seconds, method=method, route=route, status=str(status)
+            )
+            REQUEST_BYTES.observe(request_bytes, method=method, route=route)
+            RESPONSE_BYTES.observe(response_bytes, method=method, route=route)
+            if profile is not None and self.profiler is not None:
+                self.profiler.finish(profile, seconds, method, route)
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,92 @@
+from pathlib import Path
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import pytest
+
+from mbird_console.metrics import (
+    Histogram,
+    MetricsMiddleware,
+    MetricsRegistry,
+    SlowRequestProfiler,
+)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram(
+        "test_seconds", "Test durations.", ("route",), buckets=(0.1, 1.0)
+    )
+    histogram.observe(0.05, route="/a")
+    histogram.observe(0.5, route="/a")
+    histogram.observe(5.0, route="/a")
+    histogram.observe(1.0, route='/b"')
+
+    assert registry.render().splitlines() == [
+        "# HELP test_seconds Test durations.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+        'test_seconds_count{route="/a"} 3',
+        'test_seconds_bucket{route="/b\\"",le="0.1"} 0',
+        'test_seconds_bucket{route="/b\\"",le="1.0"} 1',
+        'test_seconds_bucket{route="/b\\"",le="+Inf"} 1',
+        'test_seconds_sum{route="/b\\""} 1.0',
+        'test_seconds_count{route="/b\\""} 1',
+    ]
+
+
+def test_histogram_times_blocks_that_raise():
+    histogram = Histogram("test_seconds", "Test durations.", ("op",), (1.0,))
+
+    with pytest.raises(RuntimeError), histogram.time(op="failing"):
+        raise RuntimeError("failed")
+
+    assert histogram.count(op="failing") == 1
+
+
+def test_histogram_rejects_wrong_labels():
+    histogram = Histogram("test_seconds", "Test durations.", ("op",), (1.0,))
+
+    with pytest.raises(ValueError, match="takes labels"):
+        histogram.observe(1.0, route="/a")
+
+
+def test_registry_rejects_duplicate_names():
+    registry = MetricsRegistry()
+    registry.histogram("test_seconds", "Test durations.")
+
+    with pytest.raises(ValueError, match="already registered"):
+        registry.histogram("test_seconds", "Test durations.")
+
+
+def profiled_app(profiler: SlowRequestProfiler) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: str) -> dict[str, str]:
+        return {"id": item_id}
+
+    app.add_middleware(MetricsMiddleware, profiler=profiler)
+    return TestClient(app)
+
+
+def test_slow_requests_are_profiled(tmp_path: Path):
+    client = profiled_app(SlowRequestProfiler(0.0, tmp_path))
+
+    assert client.get("/items/1").status_code == 200
+
+    (profile,) = tmp_path.glob("*.prof")
+    assert "-GET-items_item_id" in profile.name
+    summary = profile.with_suffix(".txt").read_text()
+    assert summary.startswith("GET /items/{item_id} took")
+
+
+def test_fast_requests_are_not_profiled(tmp_path: Path):
+    client = profiled_app(SlowRequestProfiler(60.0, tmp_path))
+
+    assert client.get("/items/1").status_code == 200
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,689 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager, suppress
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, TypeVar
+
+from mbird_data import MbirdData, MbirdNode
+from mbird_data.history import HISTORY_MAX_NODES, History
+from mbird_data.index import TreeSnapshot
+from mbird_data.lazy import TreeSlice, slice_tree
+from mbird_data.patch import PatchDiff, TreePatch, apply_patch
+from mbird_data.scheduler import RegenerationScheduler
+from mbird_data.search import NodeSearch
+from mbird_data.staleness import StalenessEngine
+
+from mbird_console.autosave import Autosaver
+from mbird_console.events import EventHub, patch_events
+from mbird_console.metrics import OPERATION_SECONDS
+from mbird_console.shared import (
+    Change,
+    LocalState,
+    MissingChanges,
+    SharedState,
+    VersionConflict,
+)
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
+
+# Rough heap cost of one loaded node, including its index and engine entries
+NODE_MEMORY_ESTIMATE = 700
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024
+# Encoded tree responses kept per project, in bytes
+ENCODED_CACHE_BYTES = 32 * 1024 * 1024
+# Times an edit is tried while other workers keep changing the project first
+COMMIT_ATTEMPTS = 10
+# Seconds between checks for a project's files, while another worker uses them
+FILES_POLL_SECONDS = 0.05
+# Seconds between checks for other workers' changes to the open projects
+SYNC_INTERVAL = 0.5
+
+
+def project_id_for(path: str | Path) -> str:
+    """Stable id for the project at a path, so reopening it finds the session."""
+    resolved = str(Path(path).expanduser().resolve())
+    return hashlib.sha256(resolved.encode()).hexdigest()[:16]
+
+
+def _load(path: str, lazy: bool) -> MbirdData:
+    with OPERATION_SECONDS.time(operation="load"):
+        return MbirdData.load(path, lazy=lazy)
+
+
+async def _shared(state: SharedState, call: Callable[..., _T], *args: Any) -> _T:
+    """
+    Call one of state's methods without blocking the event loop.
+
+    Shared state waits on other workers (SqliteState for as long as its busy
+    timeout), so its calls run in a thread. LocalState's don't wait.
+    """
+    if not state.shared:
+        return call(*args)
+    return await asyncio.to_thread(call, *args)
+
+
+@asynccontextmanager
+async def project_files(state: SharedState, project_id: str) -> AsyncIterator[int]:
+    """
+    Hold a project's files, waiting while another worker saves or loads them.
+
+    Yields the version of the tree in the files.
+    """
+    while (saved_version := await _shared(state, state.lock_files, project_id)) is None:
+        await asyncio.sleep(FILES_POLL_SECONDS)
+    try:
+        yield saved_version
+    finally:
+        await _shared(state, state.unlock_files, project_id)
+
+
+async def restore(
+    state: SharedState, project_id: str, path: str, lazy: bool
+) -> tuple[MbirdData, int, int | None]:
+    """
+    Get the latest version of a project that doesn't need changes replayed.
+
+    That's the last tree that replaced the whole tree, if it was replaced since
+    the project was last saved, or else the project's files.
+
+    Returns:
+        The data, its version, and the same version if it was loaded from the
+        files (or None)
+    """
+    async with project_files(state, project_id) as saved_version:
+        change = await _shared(state, state.last_tree, project_id, saved_version)
+        if change is not None:
+            return MbirdData(root=change.tree), change.version, None
+        data = await asyncio.to_thread(_load, path, lazy)
+        return data, saved_version, saved_version
+
+
+class ResponseCache:
+    """
+    Encoded responses by key, dropped least recently used first past a budget.
+
+    Keys must identify the content, e.g. ETags derived from subtree digests,
+    so entries never need to be invalidated: responses for a tree that changed
+    just stop being asked for and age out.
+    """
+
+    def __init__(self, max_bytes: int = ENCODED_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._bodies: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, key: str, encode: Callable[[], bytes]) -> bytes:
+        """Get the response for a key, encoding (and caching) it if needed."""
+        body = self.lookup(key)
+        if body is None:
+            body = encode()
+            self.put(key, body)
+        return body
+
+    def lookup(self, key: str) -> bytes | None:
+        """Get the cached response for a key, if there is one."""
+        body = self._bodies.get(key)
+        if body is not None:
+            self._bodies.move_to_end(key)
+        return body
+
+    def put(self, key: str, body: bytes) -> None:
+        """Cache the response for a key, unless it's over budget by itself."""
+        if key in self._bodies:
+            return
+        if len(body) <= self.max_bytes:
+            self._bodies[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, dropped = self._bodies.popitem(last=False)
+                self.size -= len(dropped)
+
+
+class ProjectSession:
+    """
+    An open project: its data, engine, lock, history, autosaver and events.
+
+    Its tree is shared with other workers through `state` (see
+    mbird_console.shared): edits go through commit() or replace(), and other
+    workers' changes are replayed by sync().
+    """
+
+    def __init__(
+        self,
+        project_id: str,
+        path: str,
+        data: MbirdData,
+        generate: Callable[[MbirdNode], object],
+        encoded_cache_bytes: int = ENCODED_CACHE_BYTES,
+        history_max_nodes: int = HISTORY_MAX_NODES,
+        state: SharedState | None = None,
+        version: int = 0,
+        files_version: int | None = 0,
+    ):
+        """
+        Args:
+            state: Changes shared with other workers (just this process's by
+                default)
+            version: Version of the data (see SharedState.version())
+            files_version: Version of the data when it was loaded from the
+                project's files, if it was
+        """
+        self.id = project_id
+        self.path = path
+        self.state = LocalState() if state is None else state
+        self.version = version
+        # Version in the project's files when this worker last saved (or
+        # loaded) them: otherwise the data's journal doesn't match them
+        self._files_version = files_version
+        # Held while the tree is being edited or regenerated, and while a save
+        # takes its snapshot (but not while it's written)
+        self.lock = asyncio.Lock()
+        self.events = EventHub()
+        self.responses = ResponseCache(encoded_cache_bytes)
+        self.autosaver = Autosaver(self._save, on_status=self._saved)
+        self.scheduler = RegenerationScheduler(generate)
+        self.history = History(history_max_nodes)
+        self.data = data
+        self.engine: StalenessEngine | None = None
+        # Built on the first search, then kept up to date as the tree changes
+        self._search: NodeSearch | None = None
+        self.set_data(data)
+
+    def set_data(self, data: MbirdData) -> None:
+        """
+        Replace the project's data and start tracking its stale nodes.
+
+        Lazily loaded data is tracked from the first time get_engine() is
+        called, so that the whole tree isn't built just to open the project.
+        """
+        if data.is_materialized and data.root is not None:
+            engine = StalenessEngine(data.index)
+        else:
+            engine = None
+        self.data = data
+        self.engine = engine
+        self._search = None
+        # The old tree's edits can't be undone on this one
+        self.history.clear()
+
+    def get_engine(self) -> StalenessEngine | None:
+        """Get the staleness engine, building the tree first if it's lazy."""
+        if self.engine is None:
+            with OPERATION_SECONDS.time(operation="materialize"):
+                root = self.data.root
+            if root is not None:
+                self.engine = StalenessEngine(self.data.index)
+        return self.engine
+
+    def has_tree(self) -> bool:
+        """Whether there's a tree (without building a lazily loaded one)."""
+        return not self.data.is_materialized or self.data.root is not None
+
+    def digest(self, node_id: str | None = None) -> bytes:
+        """
+        Get the digest of a subtree (the whole tree if node_id is None).
+
+        Digests of loaded trees are kept up to date as the tree changes, and
+        lazily loaded trees stay on disk.
+
+        Raises:
+            KeyError: If there's no node with the given id
+        """
+        if not self.data.is_materialized:
+            return self.data.digest(node_id)
+        if self.get_engine() is None:
+            raise ValueError("No root node loaded")
+        return self.data.digest(node_id)
+
+    def has_shared_nodes(self) -> bool:
+        """Whether a node in the loaded tree has more than one parent."""
+        return self.engine is not None and self.engine.index.num_shared > 0
+
+    def search(self) -> NodeSearch:
+        """
+        Get the index for searching the tree's nodes, building it if needed.
+
+        Raises:
+            ValueError: If there's no tree
+        """
+        if self._search is None:
+            engine = self.get_engine()
+            if engine is None:
+                raise ValueError("No root node loaded")
+            with OPERATION_SECONDS.time(operation="index_search"):
+                self._search = NodeSearch(engine.index)
+        return self._search
+
+    def patched(self, diff: PatchDiff) -> None:
+        """Catch up with a patch that was applied to the tree."""
+        if self._search is not None:
+            self._search.update(diff)
+
+    async def sync(self) -> None:
+        """Replay the changes other workers made to the project since."""
+        if await _shared(self.state, self.state.version, self.id) > self.version:
+            async with self.lock:
+                await self._catch_up()
+
+    async def commit(
+        self,
+        apply: Callable[[StalenessEngine], tuple[TreePatch, PatchDiff]],
+        revert: Callable[[StalenessEngine], object],
+    ) -> tuple[TreePatch, PatchDiff]:
+        """
+        Edit the tree and share the edit with other workers, holding the lock.
+
+        The edit is applied to the latest version of the tree, and kept if no
+        other worker added a change with the next version first. Otherwise it's
+        reverted, the other worker's changes are replayed, and it's tried again.
+
+        Args:
+            apply: Applies the edit, returning the patch that was applied and
+                what it changed
+            revert: Reverts the patch apply() applied
+
+        Raises:
+            KeyError: If the edit refers to a node that doesn't exist
+            ValueError: If the edit can't be applied, or there's no tree
+            VersionConflict: If other workers kept changing the project first
+        """
+        for _ in range(COMMIT_ATTEMPTS):
+            await self._catch_up()
+            engine = self.get_engine()
+            if engine is None:
+                raise ValueError("No root node loaded")
+            patch, diff = apply(engine)
+            change = Change(self.version + 1, patch=patch)
+            try:
+                # Readers may see the edit before it's kept (or reverted)
+                await _shared(self.state, self.state.append, self.id, change)
+            except VersionConflict:
+                revert(engine)
+                continue
+            self.version += 1
+            self.data.record(patch)
+            self.patched(diff)
+            return patch, diff
+        raise VersionConflict(f"Project {self.id} kept changing, try again")
+
+    async def replace(self, data: MbirdData) -> None:
+        """
+        Replace the project's data (see set_data()) and share the new tree with
+        other workers, holding the lock.
+
+        Raises:
+            ValueError: If the tree is invalid
+            VersionConflict: If other workers kept changing the project first
+        """
+        old_data = self.data
+        # Raises for an invalid tree, before it's shared
+        self.set_data(data)
+        for _ in range(COMMIT_ATTEMPTS):
+            # Changes to the old tree don't need to be replayed
+            version = await _shared(self.state, self.state.version, self.id) + 1
+            change = Change(version, tree=data.root)
+            try:
+                await _shared(self.state, self.state.append, self.id, change)
+            except VersionConflict:
+                continue
+            self.version = version
+            return
+        self.set_data(old_data)
+        raise VersionConflict(f"Project {self.id} kept changing, try again")
+
+    async def _catch_up(self) -> None:
+        # Called holding the lock
+        state = self.state
+        if await _shared(state, state.version, self.id) <= self.version:
+            return
+        try:
+            changes = await _shared(state, state.changes, self.id, self.version)
+        except MissingChanges:
+            # Too far behind to replay the changes
+            data, version, self._files_version = await restore(
+                self.state, self.id, self.path, lazy=True
+            )
+            self.set_data(data)
+            self.version = version
+            self.events.publish({"type": "reset"})
+            changes = await _shared(state, state.changes, self.id, self.version)
+        for change in changes:
+            self._replay(change)
+        # Whichever worker saves first saves them for every worker
+        self.autosaver.mark_dirty()
+
+    def _replay(self, change: Change) -> None:
+        if change.tree is not None:
+            self.set_data(MbirdData(root=change.tree))
+            self.events.publish({"type": "reset"})
+        else:
+            assert change.patch is not None
+            engine = self.get_engine()
+            if engine is None:
+                raise ValueError("No root node loaded")
+            with OPERATION_SECONDS.time(operation="apply_patch"):
+                diff = apply_patch(engine, change.patch)
+            self.data.record(change.patch)
+            self.patched(diff)
+            for event in patch_events(change.patch, diff):
+                self.events.publish(event)
+        self.version = change.version
+
+    def read_subtree(
+        self, node_id: str | None = None, depth: int | None = None
+    ) -> Callable[[], TreeSlice | None]:
+        """
+        Get a function that reads a subtree (see MbirdData.subtree()) as it is
+        now, from any thread, e.g. to encode it off the event loop.
+
+        Loaded trees are read from a snapshot. Lazily loaded trees are read
+        from disk without building them; if the tree is built before the
+        function is called, it may have been edited since, so the function
+        returns None instead.
+
+        Raises:
+            KeyError: If there's no node with the given id
+            ValueError: If there's no tree
+        """
+        data = self.data
+        if not data.is_materialized:
+            return lambda: data.lazy_subtree(node_id, depth)
+        snapshot = self.snapshot(node_id)
+        if depth is None:
+            # Nothing is left out, and the snapshot doesn't change
+            return lambda: TreeSlice(snapshot.root)
+        return lambda: slice_tree(snapshot.root, depth)
+
+    def snapshot(self, node_id: str | None = None) -> TreeSnapshot:
+        """
+        Get a version of the tree (or a subtree) that later edits don't change.
+
+        Unlike the nodes under `data.root`, it can be read from any thread, or
+        across awaits, while the tree is being edited.
+
+        Raises:
+            KeyError: If there's no node with the given id
+            ValueError: If there's no tree
+        """
+        if self.get_engine() is None:
+            raise ValueError("No root node loaded")
+        return self.data.index.snapshot(node_id)
+
+    def memory_estimate(self) -> int:
+        """
+        Approximate bytes held in memory by the project's tree (and the nodes
+        its undo history holds on to).
+        """
+        if self.engine is None:
+            # Lazily loaded trees stay on disk until they're used
+            return self.responses.size
+        num_nodes = len(self.engine.index) + self.history.size
+        return num_nodes * NODE_MEMORY_ESTIMATE + self.responses.size
+
+    def _saved(self) -> None:
+        self.events.publish({"type": "save_status", **self.autosaver.status()})
+
+    async def _save(self) -> None:
+        await self.sync()
+        # Only taking the snapshot waits for edits, which can go on while it's
+        # written
+        async with self.lock:
+            version = self.version
+            data = self.data
+            index = self.engine.index if self.engine is not None else None
+            snapshot = index.snapshot() if index is not None else None
+            checkpoint = data.checkpoint(snapshot.root if snapshot else None)
+
+        async with project_files(self.state, self.id) as saved_version:
+            # The journal only continues this worker's last save
+            incremental = saved_version == self._files_version
+            # Otherwise another worker already saved this version (or a later
+            # one)
+            if saved_version < version or incremental:
+
+                def write() -> None:
+                    # Lets the save be skipped when the changes cancelled out,
+                    # unless the tree changed again since the snapshot
+                    digest = None
+                    if incremental and index is not None and snapshot is not None:
+                        digest = index.snapshot_digest(snapshot)
+                    with OPERATION_SECONDS.time(operation="save"):
+                        checkpoint.save(
+                            self.path,
+                            binary=True,
+                            incremental=incremental,
+                            digest=digest,
+                        )
+
+                await asyncio.to_thread(write)
+                await _shared(self.state, self.state.saved, self.id, version)
+                self._files_version = version
+        data.saved(checkpoint)
+
+
+class SessionRegistry:
+    """
+    Open projects keyed by project id, kept in memory up to a budget.
+
+    Projects are evicted least recently used first once their estimated
+    memory use exceeds the budget, after saving their changes. Projects with
+    clients subscribed to their events stay. An evicted project is loaded from
+    disk again the next time its id is used.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[MbirdNode], object],
+        memory_budget: int = DEFAULT_MEMORY_BUDGET,
+        encoded_cache_bytes: int = ENCODED_CACHE_BYTES,
+        history_max_nodes: int = HISTORY_MAX_NODES,
+        state: SharedState | None = None,
+    ):
+        """
+        Args:
+            generate: Regenerates a single node's output
+            memory_budget: Approximate bytes of trees (and cached responses)
+                to keep in memory
+            encoded_cache_bytes: Bytes of encoded responses cached per
+                project, or 0 to encode each response anew
+            history_max_nodes: Nodes each project's undo history may hold on
+                to (see History)
+            state: Projects' changes, shared with other workers (just this
+                process's by default)
+        """
+        self.generate = generate
+        self.state = LocalState() if state is None else state
+        self.memory_budget = memory_budget
+        self.encoded_cache_bytes = encoded_cache_bytes
+        self.history_max_nodes = history_max_nodes
+        self._sessions: OrderedDict[str, ProjectSession] = OrderedDict()
+        # Every project opened so far, including evicted ones
+        self._paths: dict[str, str] = {}
+        # Held while sessions are opened or closed
+        self._lock = asyncio.Lock()
+
+    def __contains__(self, project_id: object) -> bool:
+        return project_id in self._sessions
+
+    def sessions(self) -> list[ProjectSession]:
+        """The sessions in memory, least recently used first."""
+        return list(self._sessions.values())
+
+    async def open(
+        self, path: str, data: MbirdData | None = None, lazy: bool = False
+    ) -> ProjectSession:
+        """
+        Get the session for the project at path, opening it if needed.
+
+        Args:
+            path: Project directory
+            data: Data for a new project, replacing any open session's data.
+                If None, an open session is reused or the project is loaded.
+            lazy: Load the project lazily (see MbirdData.load)
+        """
+        project_id = project_id_for(path)
+        session = self._sessions.get(project_id)
+        if session is None:
+            async with self._lock:
+                # Another request may have opened it while this one waited
+                session = self._sessions.get(project_id)
+                if session is None:
+                    session = await self._restore(project_id, path, lazy, data)
+        else:
+            self._sessions.move_to_end(project_id)
+
+        if data is not None:
+            async with session.lock:
+                await session.replace(data)
+            # The old tree is being replaced, so it's not worth saving
+            session.autosaver.reset()
+        else:
+            await session.sync()
+        await self.evict()
+        return session
+
+    async def get(self, project_id: str) -> ProjectSession:
+        """
+        Get an open project's session, reloading it if it was evicted.
+
+        Raises:
+            KeyError: If no project with this id was opened
+        """
+        session = self._sessions.get(project_id)
+        if session is not None:
+            self._sessions.move_to_end(project_id)
+            await session.sync()
+            return session
+        # Projects opened by other workers are known to the shared state
+        path = self._paths.get(project_id) or await _shared(
+            self.state, self.state.path, project_id
+        )
+        if path is None:
+            raise KeyError(f"Project not found: {project_id}")
+
+        # Only loading waits for the registry lock, so open projects stay fast
+        async with self._lock:
+            session = self._sessions.get(project_id)
+            if session is None:
+                session = await self._restore(project_id, path, True)
+        await session.sync()
+        await self.evict()
+        return session
+
+    async def close(self, project_id: str) -> None:
+        """Save a project's changes and drop it from memory."""
+        async with self._lock:
+            session = self._sessions.get(project_id)
+            if session is None:
+                return
+            await session.autosaver.stop()
+            del self._sessions[project_id]
+            session.events.close()
+            # Waits for nodes that are being regenerated
+            await asyncio.to_thread(session.scheduler.close)
+
+    async def close_all(self) -> None:
+        """Save every project's changes and drop them from memory."""
+        for project_id in list(self._sessions):
+            try:
+                await self.close(project_id)
+            except Exception:
+                logger.exception("Failed to save project %s", project_id)
+
+    async def evict(self) -> None:
+        """Drop least recently used projects until the rest fit in the budget."""
+        async with self._lock:
+            total = sum(s.memory_estimate() for s in self._sessions.values())
+            # The most recently used project stays even if it's over budget
+            for session in list(self._sessions.values())[:-1]:
+                if total <= self.memory_budget:
+                    break
+                if session.events:
+                    # Clients are following its changes
+                    continue
+                try:
+                    await session.autosaver.stop()
+                except Exception:
+                    # Keep it rather than lose its changes
+                    logger.exception("Failed to save evicted project %s", session.id)
+                    session.autosaver.start()
+                    continue
+                total -= session.memory_estimate()
+                del self._sessions[session.id]
+                await asyncio.to_thread(session.scheduler.close)
+
+    async def sync_all(self) -> None:
+        """Replay other workers' changes to the projects in memory."""
+        versions = await _shared(self.state, self.state.versions)
+        for session in self.sessions():
+            if versions.get(session.id, 0) > session.version:
+                await session.sync()
+
+    async def _restore(
+        self, project_id: str, path: str, lazy: bool, data: MbirdData | None = None
+    ) -> ProjectSession:
+        """Open a project that isn't in memory (with its registry lock held)."""
+        await _shared(self.state, self.state.register, project_id, path)
+        if data is None:
+            data, version, files_version = await restore(
+                self.state, project_id, path, lazy
+            )
+        else:
+            # It's about to be replaced by `data`
+            version = await _shared(self.state, self.state.version, project_id)
+            files_version = None
+
+        session = ProjectSession(
+            project_id,
+            path,
+            data,
+            self.generate,
+            self.encoded_cache_bytes,
+            self.history_max_nodes,
+            self.state,
+            version,
+            files_version,
+        )
+        session.autosaver.start()
+        self._sessions[project_id] = session
+        self._paths[project_id] = path
+        return session
+
+
+class ChangeWatcher:
+    """
+    Replays other workers' changes to the open projects in the background.
+
+    Requests replay them anyway, but this way clients following a project's
+    events see them as they happen, and they get saved.
+    """
+
+    def __init__(self, registry: SessionRegistry, interval: float = SYNC_INTERVAL):
+        self.registry = registry
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Start watching (must be called from the event loop)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.registry.sync_all()
+            except Exception:
+                logger.exception("Failed to replay other workers' changes")
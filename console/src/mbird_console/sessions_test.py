@@ -0,0 +1,351 @@
+import asyncio
+from pathlib import Path
+import threading
+
+from mbird_data import MbirdData, MbirdNode
+from mbird_data.constants import TREE_FNAME
+from mbird_data.patch import AddChild, TreePatch
+from mbird_data.staleness import StalenessEngine
+import pytest
+
+from mbird_console import shared
+from mbird_console.sessions import (
+    ProjectSession,
+    ResponseCache,
+    SessionRegistry,
+    project_id_for,
+)
+from mbird_console.shared import Change, SqliteState
+
+
+def generate(node: MbirdNode) -> None:
+    pass
+
+
+def new_data(*child_ids: str) -> MbirdData:
+    children = [MbirdNode(id=child_id) for child_id in child_ids]
+    return MbirdData(root=MbirdNode(id="root", children=children))
+
+
+def add(parent_id: str, node_id: str) -> TreePatch:
+    return TreePatch(ops=[AddChild(parent_id=parent_id, node={"id": node_id})])
+
+
+async def commit(session: ProjectSession, patch: TreePatch) -> None:
+    async with session.lock:
+        await session.commit(
+            lambda engine: (patch, session.history.apply(engine, patch)),
+            session.history.revert,
+        )
+    session.autosaver.mark_dirty()
+
+
+def child_ids(session: ProjectSession) -> list[str]:
+    engine = session.get_engine()
+    assert engine is not None
+    return [child.id for child in engine.index.root.children]
+
+
+def workers(tmp_path: Path, count: int = 2) -> list[SessionRegistry]:
+    """Registries sharing their state, like those of separate workers."""
+    db_path = tmp_path / "state.db"
+    return [SessionRegistry(generate, state=SqliteState(db_path)) for _ in range(count)]
+
+
+def test_project_id_is_stable_for_equivalent_paths(tmp_path: Path):
+    path = tmp_path / "project.mbird"
+
+    assert project_id_for(path) == project_id_for(tmp_path / "." / "project.mbird")
+    assert project_id_for(path) != project_id_for(tmp_path / "other.mbird")
+
+
+def test_open_reuses_session_for_same_path(tmp_path: Path):
+    path = str(tmp_path / "project.mbird")
+
+    async def scenario() -> None:
+        registry = SessionRegistry(generate)
+        first = await registry.open(path, new_data())
+        second = await registry.open(path)
+        assert first is second
+        assert await registry.get(first.id) is first
+        await registry.close_all()
+
+    asyncio.run(scenario())
+
+
+def test_get_unknown_project_raises_error():
+    async def scenario() -> None:
+        registry = SessionRegistry(generate)
+        with pytest.raises(KeyError, match="Project not found"):
+            await registry.get("missing")
+
+    asyncio.run(scenario())
+
+
+def test_least_recently_used_project_is_saved_and_evicted(tmp_path: Path):
+    paths = [str(tmp_path / f"project{i}.mbird") for i in range(3)]
+
+    async def scenario() -> None:
+        # Room for two of the three-node trees but not three
+        registry = SessionRegistry(generate, memory_budget=3 * 700 * 2)
+        sessions = [await registry.open(path, new_data("a", "b")) for path in paths[:2]]
+        for session in sessions:
+            session.autosaver.mark_dirty()
+
+        # Using the first project makes the second the least recently used
+        await registry.get(sessions[0].id)
+        await registry.open(paths[2], new_data("c", "d"))
+
+        assert sessions[0].id in registry
+        assert sessions[1].id not in registry
+        assert (Path(paths[1]) / TREE_FNAME).exists()
+        assert not (Path(paths[0]) / TREE_FNAME).exists()
+
+        reloaded = await registry.get(sessions[1].id)
+        assert reloaded is not sessions[1]
+        engine = reloaded.get_engine()
+        assert engine is not None
+        assert [child.id for child in engine.index.root.children] == ["a", "b"]
+        await registry.close_all()
+
+    asyncio.run(scenario())
+
+
+def test_project_that_fails_to_save_is_not_evicted(tmp_path: Path):
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+
+    async def scenario() -> None:
+        registry = SessionRegistry(generate, memory_budget=0)
+        # Saving fails since the project directory's parent is a file
+        stuck = await registry.open(str(blocker / "project.mbird"), new_data())
+        stuck.autosaver.mark_dirty()
+        await registry.open(str(tmp_path / "other.mbird"), new_data())
+
+        assert stuck.id in registry
+        assert stuck.autosaver.error is not None
+        stuck.autosaver.reset()
+        await registry.close_all()
+
+    asyncio.run(scenario())
+
+
+def test_response_cache_reuses_bodies_and_drops_least_recently_used():
+    cache = ResponseCache(max_bytes=8)
+    encoded: list[str] = []
+
+    def encoder(key: str):
+        def encode() -> bytes:
+            encoded.append(key)
+            return key.encode() * 4
+
+        return encode
+
+    assert cache.get("a", encoder("a")) == b"aaaa"
+    assert cache.get("b", encoder("b")) == b"bbbb"
+    assert cache.get("a", encoder("a")) == b"aaaa"
+    assert encoded == ["a", "b"]
+
+    # Over budget: "b" was used least recently
+    cache.get("c", encoder("c"))
+    assert cache.size == 8
+    cache.get("a", encoder("a"))
+    cache.get("b", encoder("b"))
+    assert encoded == ["a", "b", "c", "b"]
+
+
+def test_response_cache_skips_bodies_over_budget():
+    cache = ResponseCache(max_bytes=2)
+    assert cache.get("a", lambda: b"abc") == b"abc"
+    assert cache.size == 0
+
+
+def test_edits_go_on_while_a_save_is_written(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    path = str(tmp_path / "project.mbird")
+    writing = threading.Event()
+    release = threading.Event()
+    save = MbirdData.save
+
+    def slow_save(data: MbirdData, *args, **kwargs) -> None:
+        writing.set()
+        release.wait(5)
+        save(data, *args, **kwargs)
+
+    monkeypatch.setattr(MbirdData, "save", slow_save)
+
+    async def scenario() -> None:
+        registry = SessionRegistry(generate)
+        session = await registry.open(path, new_data("a"))
+        session.autosaver.mark_dirty()
+        flush = asyncio.create_task(session.autosaver.flush())
+        await asyncio.to_thread(writing.wait, 5)
+
+        async with session.lock:
+            engine = session.get_engine()
+            assert engine is not None
+            patch = TreePatch(ops=[AddChild(parent_id="root", node={"id": "b"})])
+            session.history.apply(engine, patch)
+            session.data.record(patch)
+        session.autosaver.mark_dirty()
+        release.set()
+        await flush
+
+        loaded = MbirdData.load(path)
+        assert [child.id for child in loaded.root.children] == ["a"]  # type: ignore[union-attr]
+
+        await registry.close_all()
+        loaded = MbirdData.load(path)
+        assert [child.id for child in loaded.root.children] == ["a", "b"]  # type: ignore[union-attr]
+
+    asyncio.run(scenario())
+
+
+def test_workers_replay_each_others_edits(tmp_path: Path):
+    path = str(tmp_path / "project.mbird")
+
+    async def scenario() -> None:
+        first, second = workers(tmp_path)
+        session = await first.open(path, new_data("a"))
+        # Not saved yet, so it's built from the shared tree
+        other = await second.get(session.id)
+        assert child_ids(other) == ["a"]
+
+        await commit(session, add("root", "b"))
+        with other.events.subscribe() as subscriber:
+            assert await second.get(session.id) is other
+            assert child_ids(other) == ["a", "b"]
+            events = await subscriber.get()
+        assert events[0]["type"] == "added"
+
+        await commit(other, add("a", "c"))
+        await first.sync_all()
+        assert session.version == other.version == 3
+        assert session.data.index.parent_id("c") == "a"
+        await first.close_all()
+        await second.close_all()
+
+    asyncio.run(scenario())
+
+
+def test_shared_state_is_used_off_the_event_loop(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    path = str(tmp_path / "project.mbird")
+    # Threads each of the state's methods was called from
+    callers: dict[str, set[int]] = {}
+    originals = {}
+    for name in ["register", "version", "append", "lock_files", "saved"]:
+        originals[name] = getattr(SqliteState, name)
+
+        def recording(self: SqliteState, *args: object, _name: str = name) -> object:
+            callers.setdefault(_name, set()).add(threading.get_ident())
+            return originals[_name](self, *args)
+
+        monkeypatch.setattr(SqliteState, name, recording)
+
+    async def scenario() -> None:
+        (registry,) = workers(tmp_path, count=1)
+        session = await registry.open(path, new_data("a"))
+        await commit(session, add("root", "b"))
+        await registry.close_all()
+
+    asyncio.run(scenario())
+
+    assert sorted(callers) == [
+        "append",
+        "lock_files",
+        "register",
+        "saved",
+        "version",
+    ]
+    assert all(threading.get_ident() not in threads for threads in callers.values())
+
+
+def test_edit_is_retried_after_another_workers_edit(tmp_path: Path):
+    path = str(tmp_path / "project.mbird")
+
+    async def scenario() -> None:
+        first, second = workers(tmp_path)
+        session = await first.open(path, new_data())
+        racing = True
+
+        def apply(engine: StalenessEngine) -> tuple[TreePatch, object]:
+            nonlocal racing
+            if racing:
+                # Another worker adds the next version meanwhile
+                second.state.append(session.id, Change(2, patch=add("root", "x")))
+                racing = False
+            patch = add("root", "y")
+            return patch, session.history.apply(engine, patch)
+
+        async with session.lock:
+            await session.commit(apply, session.history.revert)  # type: ignore[arg-type]
+
+        assert session.version == 3
+        assert child_ids(session) == ["x", "y"]
+        assert session.history.can_undo
+        await first.close_all()
+
+    asyncio.run(scenario())
+
+
+def test_workers_save_each_version_once(tmp_path: Path):
+    path = str(tmp_path / "project.mbird")
+
+    def saved_ids() -> list[str]:
+        root = MbirdData.load(path).root
+        assert root is not None
+        return [child.id for child in root.children]
+
+    async def scenario() -> None:
+        first, second = workers(tmp_path)
+        session = await first.open(path, new_data("a"))
+        other = await second.get(session.id)
+
+        session.autosaver.mark_dirty()
+        await session.autosaver.flush()
+        # Already saved by the first worker
+        mtime = (Path(path) / TREE_FNAME).stat().st_mtime_ns
+        other.autosaver.mark_dirty()
+        await other.autosaver.flush()
+        assert (Path(path) / TREE_FNAME).stat().st_mtime_ns == mtime
+
+        # Each worker continues the other's save
+        await commit(other, add("root", "b"))
+        await other.autosaver.flush()
+        assert saved_ids() == ["a", "b"]
+        await commit(session, add("root", "c"))
+        await session.autosaver.flush()
+        assert saved_ids() == ["a", "b", "c"]
+
+        await first.close_all()
+        await second.close_all()
+
+    asyncio.run(scenario())
+
+
+def test_worker_too_far_behind_loads_the_saved_project(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(shared, "SAVED_CHANGES_KEPT", 0)
+    path = str(tmp_path / "project.mbird")
+
+    async def scenario() -> None:
+        first, second = workers(tmp_path)
+        session = await first.open(path, new_data())
+        other = await second.get(session.id)
+        for node_id in ["a", "b"]:
+            await commit(session, add("root", node_id))
+        session.autosaver.mark_dirty()
+        await session.autosaver.flush()
+
+        await other.sync()
+
+        assert other.version == session.version
+        assert child_ids(other) == ["a", "b"]
+        await first.close_all()
+        await second.close_all()
+
+    asyncio.run(scenario())
@@ -0,0 +1,364 @@
+"""
+Project state shared between the console's worker processes.
+
+Every worker keeps its own copy of each open project's tree. To keep the copies
+the same, each change to a tree is added to a log of the project's changes,
+numbered by version, and workers replay the changes they haven't seen before
+reading or changing the tree (see ProjectSession.sync()). Changes are added
+optimistically: a worker applies its edit to its copy, and only keeps it if
+no other worker added the same version first.
+
+A single worker (the default) uses LocalState, which doesn't need to keep the
+changes. Several workers share a SqliteState database, set by the
+MBIRD_STATE_DB environment variable.
+"""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Protocol
+import uuid
+
+from mbird_data import MbirdNode
+from mbird_data.columnar import encode_columnar, from_columnar
+from mbird_data.patch import TreePatch, decode_patch, encode_patch
+
+STATE_DB_ENV = "MBIRD_STATE_DB"
+# Seconds a worker may hold a project's files (to save or load them) before
+# another worker can take them over, e.g. if it crashed
+FILES_LEASE_SECONDS = 60.0
+# Changes kept once they're saved, so workers that are only a little behind
+# can still replay them instead of loading the project's files again
+SAVED_CHANGES_KEPT = 1000
+
+_SCHEMA_VERSION = 1
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    project_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    -- Version of the latest change
+    version INTEGER NOT NULL DEFAULT 0,
+    -- Version of the tree in the project's files
+    saved_version INTEGER NOT NULL DEFAULT 0,
+    -- Worker saving or loading the project's files, until files_expires
+    files_holder TEXT,
+    files_expires REAL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    project_id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    -- The TreePatch that was applied, as JSON
+    patch TEXT,
+    -- Or the tree that replaced the whole tree, in the columnar encoding
+    tree BLOB,
+    PRIMARY KEY (project_id, version)
+);
+"""
+
+
+class VersionConflict(Exception):
+    """Another worker added a change with the same version first."""
+
+
+class MissingChanges(LookupError):
+    """The changes after a version are no longer kept."""
+
+
+@dataclass
+class Change:
+    version: int
+    # Either the patch that was applied or the tree that replaced the tree
+    patch: TreePatch | None = None
+    tree: MbirdNode | None = None
+
+
+class SharedState(Protocol):
+    # Whether other workers may change the projects
+    shared: bool
+
+    def register(self, project_id: str, path: str) -> None:
+        """Note a project that was opened, if it isn't known yet."""
+        ...
+
+    def path(self, project_id: str) -> str | None:
+        """Directory of a known project."""
+        ...
+
+    def version(self, project_id: str) -> int:
+        """Version of a project's latest change (0 if it hasn't changed)."""
+        ...
+
+    def versions(self) -> dict[str, int]:
+        """Version of every known project's latest change."""
+        ...
+
+    def changes(self, project_id: str, since: int) -> list[Change]:
+        """
+        Get a project's changes after a version, in order.
+
+        Raises:
+            MissingChanges: If some of them are no longer kept
+        """
+        ...
+
+    def last_tree(self, project_id: str, since: int) -> Change | None:
+        """The last change after a version that replaced the whole tree."""
+        ...
+
+    def append(self, project_id: str, change: Change) -> None:
+        """
+        Add the next change to a project.
+
+        Raises:
+            VersionConflict: If the change's version isn't the next version
+        """
+        ...
+
+    def lock_files(self, project_id: str) -> int | None:
+        """
+        Start saving or loading a project's files, unless another worker is.
+
+        Returns:
+            The version of the tree in the files, or None if they're in use
+        """
+        ...
+
+    def saved(self, project_id: str, version: int) -> None:
+        """Record that a version was saved to a project's (locked) files."""
+        ...
+
+    def unlock_files(self, project_id: str) -> None: ...
+
+    def close(self) -> None: ...
+
+
+class LocalState:
+    """State of projects that only this process changes."""
+
+    shared = False
+
+    def __init__(self) -> None:
+        self._paths: dict[str, str] = {}
+        self._versions: dict[str, int] = {}
+        self._saved: dict[str, int] = {}
+
+    def register(self, project_id: str, path: str) -> None:
+        self._paths.setdefault(project_id, path)
+
+    def path(self, project_id: str) -> str | None:
+        return self._paths.get(project_id)
+
+    def version(self, project_id: str) -> int:
+        return self._versions.get(project_id, 0)
+
+    def versions(self) -> dict[str, int]:
+        return dict(self._versions)
+
+    def changes(self, project_id: str, since: int) -> list[Change]:
+        # The changes were made here, so only the version needs to be kept
+        if since < self.version(project_id):
+            raise MissingChanges(f"Changes after version {since} aren't kept")
+        return []
+
+    def last_tree(self, project_id: str, since: int) -> Change | None:
+        return None
+
+    def append(self, project_id: str, change: Change) -> None:
+        if change.version != self.version(project_id) + 1:
+            raise VersionConflict(f"Version {change.version} was already added")
+        self._versions[project_id] = change.version
+
+    def lock_files(self, project_id: str) -> int | None:
+        # Saves are already one at a time (see Autosaver)
+        return self._saved.get(project_id, 0)
+
+    def saved(self, project_id: str, version: int) -> None:
+        self._saved[project_id] = max(version, self._saved.get(project_id, 0))
+
+    def unlock_files(self, project_id: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteState:
+    """
+    State shared through a SQLite database, by workers on the same machine.
+
+    The database is in WAL mode, so reading versions (which every request
+    does) doesn't wait for writers. Saved changes are dropped, except for the
+    last SAVED_CHANGES_KEPT: a worker further behind loads the project's files
+    again. Safe to use from several threads. Calls may wait on other workers'
+    transactions, so async code calls them in a thread.
+    """
+
+    shared = True
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        # Identifies this worker as the holder of files it locked
+        self.holder = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _db(self) -> Iterator[sqlite3.Connection]:
+        """Use the database in a transaction, opening it on first use."""
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            with self._conn:
+                yield self._conn
+
+    def _connect(self) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > _SCHEMA_VERSION:
+            conn.close()
+            raise ValueError(f"Unsupported state database version: {version}")
+        conn.executescript(_SCHEMA)
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        return conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def register(self, project_id: str, path: str) -> None:
+        with self._db() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO projects (project_id, path) VALUES (?, ?)",
+                (project_id, path),
+            )
+
+    def path(self, project_id: str) -> str | None:
+        with self._db() as db:
+            row = db.execute(
+                "SELECT path FROM projects WHERE project_id = ?", (project_id,)
+            ).fetchone()
+        return None if row is None else row["path"]
+
+    def version(self, project_id: str) -> int:
+        with self._db() as db:
+            return _version(db, project_id) or 0
+
+    def versions(self) -> dict[str, int]:
+        with self._db() as db:
+            rows = db.execute("SELECT project_id, version FROM projects").fetchall()
+        return {row["project_id"]: row["version"] for row in rows}
+
+    def changes(self, project_id: str, since: int) -> list[Change]:
+        with self._db() as db:
+            # Read first, since more changes may be added before they're read
+            version = _version(db, project_id) or 0
+            rows = db.execute(
+                "SELECT version, patch, tree FROM changes"
+                " WHERE project_id = ? AND version > ? ORDER BY version",
+                (project_id, since),
+            ).fetchall()
+        # Only the oldest changes are dropped, so the rest follow on
+        if version > since and (not rows or rows[0]["version"] != since + 1):
+            raise MissingChanges(f"Changes after version {since} aren't kept")
+        return [_change(row) for row in rows]
+
+    def last_tree(self, project_id: str, since: int) -> Change | None:
+        with self._db() as db:
+            row = db.execute(
+                "SELECT version, patch, tree FROM changes"
+                " WHERE project_id = ? AND version > ? AND tree IS NOT NULL"
+                " ORDER BY version DESC LIMIT 1",
+                (project_id, since),
+            ).fetchone()
+        return None if row is None else _change(row)
+
+    def append(self, project_id: str, change: Change) -> None:
+        patch = None if change.patch is None else encode_patch(change.patch).decode()
+        tree = None if change.tree is None else encode_columnar(change.tree)
+        with self._db() as db:
+            updated = db.execute(
+                "UPDATE projects SET version = ? WHERE project_id = ? AND version = ?",
+                (change.version, project_id, change.version - 1),
+            ).rowcount
+            if not updated:
+                raise VersionConflict(f"Version {change.version} was already added")
+            db.execute(
+                "INSERT INTO changes (project_id, version, patch, tree)"
+                " VALUES (?, ?, ?, ?)",
+                (project_id, change.version, patch, tree),
+            )
+
+    def lock_files(self, project_id: str) -> int | None:
+        now = time.time()
+        with self._db() as db:
+            locked = db.execute(
+                "UPDATE projects SET files_holder = ?, files_expires = ?"
+                " WHERE project_id = ? AND (files_holder IS NULL"
+                " OR files_holder = ? OR files_expires < ?)",
+                (
+                    self.holder,
+                    now + FILES_LEASE_SECONDS,
+                    project_id,
+                    self.holder,
+                    now,
+                ),
+            ).rowcount
+            row = db.execute(
+                "SELECT saved_version FROM projects WHERE project_id = ?",
+                (project_id,),
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"Project not found: {project_id}")
+        return row["saved_version"] if locked else None
+
+    def saved(self, project_id: str, version: int) -> None:
+        with self._db() as db:
+            db.execute(
+                "UPDATE projects SET saved_version = MAX(saved_version, ?)"
+                " WHERE project_id = ?",
+                (version, project_id),
+            )
+            db.execute(
+                "DELETE FROM changes WHERE project_id = ? AND version <= ?",
+                (project_id, version - SAVED_CHANGES_KEPT),
+            )
+
+    def unlock_files(self, project_id: str) -> None:
+        with self._db() as db:
+            db.execute(
+                "UPDATE projects SET files_holder = NULL, files_expires = NULL"
+                " WHERE project_id = ? AND files_holder = ?",
+                (project_id, self.holder),
+            )
+
+
+def _version(db: sqlite3.Connection, project_id: str) -> int | None:
+    row = db.execute(
+        "SELECT version FROM projects WHERE project_id = ?", (project_id,)
+    ).fetchone()
+    return None if row is None else row["version"]
+
+
+def _change(row: sqlite3.Row) -> Change:
+    if row["tree"] is not None:
+        return Change(row["version"], tree=from_columnar(json.loads(row["tree"])))
+    return Change(row["version"], patch=decode_patch(row["patch"]))
+
+
+def state_from_env() -> SharedState:
+    """Shared state database set by MBIRD_STATE_DB, or LocalState if unset."""
+    db_path = os.environ.get(STATE_DB_ENV)
+    if not db_path:
+        return LocalState()
+    return SqliteState(Path(db_path))
@@ -0,0 +1,122 @@
+from pathlib import Path
+
+from mbird_data import MbirdNode
+from mbird_data.patch import AddChild, TreePatch, encode_patch
+import pytest
+
+from mbird_console.shared import (
+    SAVED_CHANGES_KEPT,
+    Change,
+    LocalState,
+    MissingChanges,
+    SharedState,
+    SqliteState,
+    VersionConflict,
+)
+
+PATCH = TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})])
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def state(request: pytest.FixtureRequest, tmp_path: Path) -> SharedState:
+    if request.param == "local":
+        return LocalState()
+    return SqliteState(tmp_path / "state.db")
+
+
+def test_versions_are_added_in_order(state: SharedState):
+    state.register("p", "/projects/p.mbird")
+    assert state.version("p") == 0
+
+    state.append("p", Change(1, patch=PATCH))
+    state.append("p", Change(2, tree=MbirdNode(id="root")))
+
+    assert state.version("p") == 2
+    assert state.versions() == {"p": 2}
+    assert state.path("p") == "/projects/p.mbird"
+    with pytest.raises(VersionConflict):
+        state.append("p", Change(2, patch=PATCH))
+    with pytest.raises(VersionConflict):
+        state.append("p", Change(4, patch=PATCH))
+
+
+def test_files_record_the_saved_version(state: SharedState):
+    state.register("p", "/projects/p.mbird")
+    state.append("p", Change(1, patch=PATCH))
+
+    assert state.lock_files("p") == 0
+    state.saved("p", 1)
+    state.unlock_files("p")
+
+    assert state.lock_files("p") == 1
+
+
+def test_sqlite_state_keeps_the_changes(tmp_path: Path):
+    state = SqliteState(tmp_path / "state.db")
+    state.register("p", "/projects/p.mbird")
+    tree = MbirdNode.from_dict({"id": "root", "children": [{"id": "b"}]})
+    state.append("p", Change(1, patch=PATCH))
+    state.append("p", Change(2, tree=tree))
+    state.append("p", Change(3, patch=PATCH))
+
+    # As another worker sees them
+    other = SqliteState(tmp_path / "state.db")
+    changes = other.changes("p", 0)
+    assert [change.version for change in changes] == [1, 2, 3]
+    assert changes[0].patch == PATCH
+    assert changes[1].tree == tree
+    assert other.changes("p", 3) == []
+    last_tree = other.last_tree("p", 0)
+    assert last_tree is not None and last_tree.version == 2
+    assert other.last_tree("p", 2) is None
+
+
+def test_sqlite_state_keeps_patches_of_deep_subtrees(tmp_path: Path):
+    state = SqliteState(tmp_path / "state.db")
+    state.register("p", "/projects/p.mbird")
+    chain = MbirdNode(id="n999")
+    for i in range(998, -1, -1):
+        chain = MbirdNode(id=f"n{i}", children=[chain])
+    patch = TreePatch(ops=[AddChild(parent_id="root", node=chain)])
+
+    state.append("p", Change(1, patch=patch))
+
+    (change,) = state.changes("p", 0)
+    assert change.patch is not None
+    assert encode_patch(change.patch) == encode_patch(patch)
+
+
+def test_saved_changes_are_dropped(tmp_path: Path):
+    state = SqliteState(tmp_path / "state.db")
+    state.register("p", "/projects/p.mbird")
+    count = SAVED_CHANGES_KEPT + 10
+    for version in range(1, count + 1):
+        state.append("p", Change(version, patch=PATCH))
+
+    state.saved("p", count)
+
+    assert len(state.changes("p", 10)) == SAVED_CHANGES_KEPT
+    with pytest.raises(MissingChanges):
+        state.changes("p", 0)
+
+
+def test_local_state_only_keeps_versions():
+    state = LocalState()
+    state.append("p", Change(1, patch=PATCH))
+
+    assert state.changes("p", 1) == []
+    with pytest.raises(MissingChanges):
+        state.changes("p", 0)
+
+
+def test_only_one_worker_holds_the_files(tmp_path: Path):
+    first = SqliteState(tmp_path / "state.db")
+    second = SqliteState(tmp_path / "state.db")
+    first.register("p", "/projects/p.mbird")
+
+    assert first.lock_files("p") == 0
+    assert second.lock_files("p") is None
+    first.unlock_files("p")
+    assert second.lock_files("p") == 0
+    with pytest.raises(KeyError, match="Project not found"):
+        second.lock_files("missing")
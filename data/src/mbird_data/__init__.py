@@ -1,4 +1,5 @@
 from mbird_data.data import MbirdData
 from mbird_data.models import MbirdNode
+from mbird_data.store import TreeStore
 
-__all__ = ["MbirdData", "MbirdNode"]
+__all__ = ["MbirdData", "MbirdNode", "TreeStore"]
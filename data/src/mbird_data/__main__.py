@@ -0,0 +1,108 @@
+"""
+Process many projects from the command line.
+
+    python -m mbird_data batch 'projects/**/*.mbird' --validate
+    python -m mbird_data batch projects/ --regenerate --format binary --workers 8
+
+`batch` writes a JSON line per project as it finishes, and exits with status 1
+if any project failed.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import sys
+from typing import TextIO
+
+from mbird_data.batch import BatchOptions, expand_paths, load_generator, run_batch
+
+
+def _batch(args: argparse.Namespace) -> int:
+    options = BatchOptions(
+        validate=args.validate,
+        regenerate=args.regenerate,
+        generator=args.generator,
+        format=args.format,
+        save=args.save,
+        memory_limit=(
+            None if args.memory_limit is None else args.memory_limit * 1024 * 1024
+        ),
+    )
+    if options.regenerate:
+        # Fail once here rather than in every project
+        try:
+            load_generator(options.generator)
+        except (ValueError, ImportError, AttributeError) as e:
+            print(f"Invalid generator: {e}", file=sys.stderr)
+            return 2
+
+    paths = expand_paths(args.paths)
+    output: TextIO = sys.stdout
+    if args.output is not None:
+        output = args.output.open("w", encoding="utf-8")
+    failed = 0
+    try:
+        for result in run_batch(paths, options, max_workers=args.workers):
+            failed += not result.ok
+            output.write(json.dumps(result.to_json()) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"{len(paths) - failed} of {len(paths)} projects succeeded", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m mbird_data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = commands.add_parser(
+        "batch", help="Validate, regenerate or convert many projects in parallel"
+    )
+    batch_parser.add_argument(
+        "paths",
+        nargs="+",
+        help="Project directories, directories of projects, or glob patterns",
+    )
+    batch_parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Validate tree.json even if the journal vouches for it",
+    )
+    batch_parser.add_argument(
+        "--regenerate", action="store_true", help="Regenerate stale nodes and save"
+    )
+    batch_parser.add_argument(
+        "--generator",
+        help="Regenerates a node, as module:function (nodes are just marked fresh"
+        " if not given)",
+    )
+    batch_parser.add_argument(
+        "--format",
+        choices=["json", "binary"],
+        help="Convert projects saved in the other format",
+    )
+    batch_parser.add_argument(
+        "--save",
+        action="store_true",
+        help="Save every project, even unchanged ones (compacting their journals)",
+    )
+    batch_parser.add_argument(
+        "--workers", type=int, help="Worker processes (default: one per CPU)"
+    )
+    batch_parser.add_argument(
+        "--memory-limit", type=int, help="Megabytes of memory per worker"
+    )
+    batch_parser.add_argument(
+        "--output", type=Path, help="JSON lines file (default: standard output)"
+    )
+    batch_parser.set_defaults(handler=_batch)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import secrets
+from typing import BinaryIO, TextIO
+
+
+@contextmanager
+def atomic_write(path: Path) -> Iterator[TextIO]:
+    """
+    Open a temporary text file that replaces path when the block exits cleanly.
+
+    The new contents are fsynced before the rename, so after a crash path holds
+    either the old or the new contents, never a mix. If the block raises, path
+    is left untouched.
+    """
+    with _replace_on_exit(path) as tmp_path, tmp_path.open("x", encoding="utf-8") as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@contextmanager
+def atomic_write_bytes(path: Path) -> Iterator[BinaryIO]:
+    """Binary counterpart of atomic_write."""
+    with _replace_on_exit(path) as tmp_path, tmp_path.open("xb") as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@contextmanager
+def _replace_on_exit(path: Path) -> Iterator[Path]:
+    # In the same directory, since renames are only atomic within a filesystem
+    tmp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    fsync_dir(path.parent)
+
+
+def fsync_dir(dir_path: Path) -> None:
+    """Make renames and new files in a directory durable (no-op off POSIX)."""
+    if os.name != "posix":
+        return
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pytest
+
+from mbird_data.atomic import atomic_write, atomic_write_bytes
+
+
+def test_atomic_write_replaces_file(tmp_path: Path):
+    path = tmp_path / "file.txt"
+    path.write_text("old")
+
+    with atomic_write(path) as f:
+        f.write("new")
+        assert path.read_text() == "old"
+
+    assert path.read_text() == "new"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_failed_atomic_write_keeps_old_contents(tmp_path: Path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"old")
+
+    with pytest.raises(RuntimeError), atomic_write_bytes(path) as f:
+        f.write(b"partial")
+        raise RuntimeError("crash")
+
+    assert path.read_bytes() == b"old"
+    assert list(tmp_path.iterdir()) == [path]
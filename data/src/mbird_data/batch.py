@@ -0,0 +1,253 @@
+"""
+Load, validate, regenerate, convert and re-save many projects in parallel.
+
+Each project is processed in a worker process, so a project that fails (or
+runs out of memory) only fails its own result. Results are yielded as projects
+finish, to be streamed as a report.
+
+    python -m mbird_data batch 'projects/**/*.mbird' --regenerate --format binary
+"""
+
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+import functools
+import glob
+import importlib
+import os
+from pathlib import Path
+import time
+from typing import Any, Literal
+
+from mbird_data.constants import BINARY_TREE_FNAME, MBIRD_EXT
+from mbird_data.data import MbirdData
+from mbird_data.models import MbirdNode
+from mbird_data.staleness import StalenessEngine
+
+Format = Literal["json", "binary"]
+
+# Projects queued per worker beyond the ones running, so workers never wait for
+# the next project but thousands of paths aren't all queued up front
+QUEUED_PER_WORKER = 2
+
+
+@dataclass(frozen=True)
+class BatchOptions:
+    # Validate the nodes read from tree.json, even if the journal vouches for it
+    validate: bool = False
+    # Regenerate every stale node (and save the now fresh tree)
+    regenerate: bool = False
+    # Regenerates a single node, as "module:function" (see load_generator)
+    generator: str | None = None
+    # Save in this format, if the project isn't saved in it already
+    format: Format | None = None
+    # Save a new snapshot even if nothing changed, e.g. to compact the journal
+    save: bool = False
+    # Bytes of memory each worker may use (unlimited if None)
+    memory_limit: int | None = None
+
+
+@dataclass
+class ProjectResult:
+    path: str
+    ok: bool = True
+    # "ExceptionType: message" if processing the project failed
+    error: str | None = None
+    num_nodes: int | None = None
+    # Number of stale nodes when the project was loaded
+    num_stale: int | None = None
+    num_regenerated: int | None = None
+    # Format the project is saved in (once processed, if it got that far)
+    format: Format | None = None
+    saved: bool = False
+    seconds: float = 0.0
+
+    def to_json(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+def expand_paths(patterns: Iterable[str]) -> list[Path]:
+    """
+    Find the project directories matching paths or glob patterns.
+
+    Patterns match recursively with "**". A directory that isn't a project is
+    searched (not recursively) for projects. Paths that match nothing are kept,
+    so that they're reported as missing rather than silently skipped.
+
+    Returns:
+        Project paths in order, without repeats
+    """
+    paths: dict[Path, None] = {}
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        is_glob = any(c in pattern for c in "*?[")
+        matches = sorted(glob.glob(pattern, recursive=True)) if is_glob else [pattern]
+        for match in matches:
+            path = Path(match)
+            if path.is_dir() and not path.name.endswith(MBIRD_EXT):
+                for project in sorted(path.glob(f"*{MBIRD_EXT}")):
+                    if project.is_dir():
+                        paths[project] = None
+            elif path.name.endswith(MBIRD_EXT) or not is_glob:
+                paths[path] = None
+    return list(paths)
+
+
+def _no_output(node: MbirdNode) -> None:
+    """The default generator: nodes don't have any output yet."""
+
+
+@functools.cache
+def load_generator(spec: str | None) -> Callable[[MbirdNode], Any]:
+    """
+    Import a node generator.
+
+    Args:
+        spec: "module:function", e.g. "mypackage.render:generate". If None,
+            nodes are just marked fresh.
+
+    Raises:
+        ValueError: If spec isn't of the form "module:function"
+        ImportError: If the module can't be imported
+        AttributeError: If the module has no such function
+    """
+    if spec is None:
+        return _no_output
+    module_name, sep, attr = spec.partition(":")
+    if not sep or not module_name or not attr:
+        raise ValueError(f"Generator must be given as module:function: {spec}")
+    generate = importlib.import_module(module_name)
+    for name in attr.split("."):
+        generate = getattr(generate, name)
+    if not callable(generate):
+        raise ValueError(f"Generator is not callable: {spec}")
+    return generate
+
+
+def process_project(path: str | Path, options: BatchOptions) -> ProjectResult:
+    """
+    Load a project and validate, regenerate and save it as the options say.
+
+    Errors are reported in the result rather than raised.
+    """
+    result = ProjectResult(path=str(path))
+    start = time.perf_counter()
+    try:
+        _process(Path(path), options, result)
+    except Exception as e:
+        # Including MemoryError, past the worker's memory limit
+        result.ok = False
+        result.error = f"{type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def _process(path: Path, options: BatchOptions, result: ProjectResult) -> None:
+    data = MbirdData.load(path, validate=True if options.validate else None)
+    binary = (path / BINARY_TREE_FNAME).exists()
+    result.format = "binary" if binary else "json"
+
+    # Indexing checks the ids, and regeneration needs the index anyway
+    index = data.index
+    result.num_nodes = len(index)
+    engine = StalenessEngine(index)
+    result.num_stale = len(engine.stale_ids)
+
+    changed = False
+    if options.regenerate:
+        # Projects already run in parallel, so each one's nodes run in order
+        regenerated = engine.regenerate(load_generator(options.generator))
+        result.num_regenerated = len(regenerated)
+        changed = bool(regenerated)
+
+    if options.format is not None and options.format != result.format:
+        binary = options.format == "binary"
+        changed = True
+
+    if changed or options.save:
+        data.save(path, binary=binary)
+        result.format = "binary" if binary else "json"
+        result.saved = True
+
+
+def _init_worker(memory_limit: int | None) -> None:
+    if memory_limit is None or os.name != "posix":
+        return
+    import resource
+
+    # Allocations past the limit raise MemoryError, which fails the project
+    # being processed but leaves the worker running
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        memory_limit = min(memory_limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+
+
+def run_batch(
+    paths: Iterable[str | Path],
+    options: BatchOptions,
+    max_workers: int | None = None,
+) -> Iterator[ProjectResult]:
+    """
+    Process projects on a pool of worker processes.
+
+    If a worker dies (e.g. killed for using too much memory), the projects it
+    was running fail and a new pool takes over the rest.
+
+    Args:
+        paths: Project directories
+        options: What to do with each project
+        max_workers: Worker processes (the number of CPUs if None)
+
+    Returns:
+        A result per project, in the order they finish
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    pending = iter(paths)
+    max_running = max_workers * (1 + QUEUED_PER_WORKER)
+
+    def new_pool() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(options.memory_limit,),
+        )
+
+    executor = new_pool()
+    running: dict[Future[ProjectResult], str] = {}
+    try:
+        while True:
+            for path in pending:
+                future = executor.submit(process_project, path, options)
+                running[future] = str(path)
+                if len(running) >= max_running:
+                    break
+            if not running:
+                return
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                path = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    yield ProjectResult(
+                        path=path, ok=False, error=f"{type(e).__name__}: {e}"
+                    )
+            if broken:
+                # Every other running project failed along with the pool
+                for path in running.values():
+                    yield ProjectResult(
+                        path=path,
+                        ok=False,
+                        error="BrokenProcessPool: A worker process died",
+                    )
+                running.clear()
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = new_pool()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
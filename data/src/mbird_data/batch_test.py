@@ -0,0 +1,202 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from mbird_data import MbirdData, MbirdNode
+from mbird_data.__main__ import main
+from mbird_data.batch import (
+    BatchOptions,
+    expand_paths,
+    load_generator,
+    process_project,
+    run_batch,
+)
+from mbird_data.constants import BINARY_TREE_FNAME, TREE_FNAME
+
+
+def make_project(path: Path, binary: bool = False, stale: bool = True) -> Path:
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": stale,
+                    "children": [{"id": "a1", "is_stale": False}],
+                },
+                {"id": "b", "is_stale": False},
+            ],
+            "is_stale": False,
+        }
+    )
+    MbirdData(root=root).save(path, binary=binary)
+    return path
+
+
+def generate_upper(node: MbirdNode) -> None:
+    if node.id == "b":
+        raise RuntimeError("Can't generate b")
+
+
+def test_expand_paths_finds_projects(tmp_path: Path):
+    first = make_project(tmp_path / "one.mbird")
+    second = make_project(tmp_path / "nested" / "two.mbird")
+    (tmp_path / "notes.txt").write_text("not a project")
+
+    assert expand_paths([str(tmp_path / "**" / "*.mbird")]) == [second, first]
+    # Directories of projects are searched, and repeats dropped
+    assert expand_paths([str(tmp_path), str(first)]) == [first]
+    # Including the directories a glob matches
+    assert expand_paths([str(tmp_path / "*")]) == [second, first]
+
+
+def test_expand_paths_keeps_missing_paths(tmp_path: Path):
+    missing = tmp_path / "missing.mbird"
+    assert expand_paths([str(missing)]) == [missing]
+    # Globs that match nothing have nothing to report
+    assert expand_paths([str(tmp_path / "*.mbird")]) == []
+
+
+def test_process_project_reports_the_tree(tmp_path: Path):
+    project = make_project(tmp_path / "project.mbird")
+
+    result = process_project(project, BatchOptions(validate=True))
+
+    assert result.ok
+    assert result.num_nodes == 4
+    # a and the root it was generated into
+    assert result.num_stale == 2
+    assert result.format == "json"
+    assert not result.saved
+
+
+def test_process_project_regenerates_and_saves(tmp_path: Path):
+    project = make_project(tmp_path / "project.mbird")
+
+    result = process_project(project, BatchOptions(regenerate=True))
+
+    assert result.ok
+    assert result.num_regenerated == 2
+    assert result.saved
+    loaded = MbirdData.load(project)
+    assert not any(node.is_stale for node in loaded.index)
+
+
+def test_process_project_converts_formats(tmp_path: Path):
+    project = make_project(tmp_path / "project.mbird")
+
+    result = process_project(project, BatchOptions(format="binary"))
+    assert result.saved
+    assert result.format == "binary"
+    assert (project / BINARY_TREE_FNAME).exists()
+
+    # Already converted
+    assert not process_project(project, BatchOptions(format="binary")).saved
+
+    result = process_project(project, BatchOptions(format="json"))
+    assert result.format == "json"
+    assert not (project / BINARY_TREE_FNAME).exists()
+
+
+def test_process_project_reports_errors(tmp_path: Path):
+    project = tmp_path / "project.mbird"
+    project.mkdir()
+    (project / TREE_FNAME).write_text(
+        json.dumps({"id": "root", "children": [{"id": "root"}]})
+    )
+
+    result = process_project(project, BatchOptions(validate=True))
+
+    assert not result.ok
+    assert result.error is not None
+    assert result.error.startswith("ValueError: ")
+    assert "root" in result.error
+
+    missing = process_project(tmp_path / "missing.mbird", BatchOptions())
+    assert not missing.ok
+    assert missing.error is not None
+    assert missing.error.startswith("FileNotFoundError: ")
+
+
+def test_process_project_reports_generator_errors(tmp_path: Path):
+    project = make_project(tmp_path / "project.mbird", stale=False)
+    data = MbirdData.load(project)
+    data.index.set_stale("b", True)
+    data.save(project)
+
+    options = BatchOptions(regenerate=True, generator=f"{__name__}:generate_upper")
+    result = process_project(project, options)
+
+    assert not result.ok
+    assert result.error == "RuntimeError: Can't generate b"
+    # Nothing was saved
+    assert MbirdData.load(project).index.get("b").is_stale
+
+
+def test_load_generator_rejects_bad_specs():
+    with pytest.raises(ValueError, match="module:function"):
+        load_generator("mbird_data.batch")
+    with pytest.raises(AttributeError):
+        load_generator("mbird_data.batch:missing")
+    assert load_generator(f"{__name__}:generate_upper") is generate_upper
+
+
+def test_run_batch_processes_every_project(tmp_path: Path):
+    projects = [
+        make_project(tmp_path / f"project{i}.mbird", binary=i % 2 == 0)
+        for i in range(6)
+    ]
+    paths = [*projects, tmp_path / "missing.mbird"]
+
+    results = list(run_batch(paths, BatchOptions(regenerate=True), max_workers=2))
+
+    assert sorted(result.path for result in results) == sorted(map(str, paths))
+    by_path = {result.path: result for result in results}
+    assert not by_path[str(tmp_path / "missing.mbird")].ok
+    for project in projects:
+        assert by_path[str(project)].ok
+        assert by_path[str(project)].num_regenerated == 2
+
+
+def test_run_batch_limits_worker_memory(tmp_path: Path):
+    project = make_project(tmp_path / "project.mbird")
+    options = BatchOptions(memory_limit=4 * 1024 * 1024 * 1024)
+
+    [result] = run_batch([project], options, max_workers=1)
+
+    assert result.ok
+
+
+def test_main_writes_a_json_line_per_project(tmp_path: Path, capsys):
+    make_project(tmp_path / "one.mbird")
+    make_project(tmp_path / "two.mbird")
+    output = tmp_path / "report.jsonl"
+
+    status = main(
+        ["batch", str(tmp_path), "--format", "binary", "--output", str(output)]
+    )
+
+    assert status == 0
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted(Path(line["path"]).name for line in lines) == [
+        "one.mbird",
+        "two.mbird",
+    ]
+    assert all(line["saved"] and line["format"] == "binary" for line in lines)
+    assert "2 of 2 projects succeeded" in capsys.readouterr().err
+
+
+def test_main_fails_if_a_project_fails(tmp_path: Path, capsys):
+    status = main(["batch", str(tmp_path / "missing.mbird")])
+
+    assert status == 1
+    [line] = capsys.readouterr().out.splitlines()
+    assert not json.loads(line)["ok"]
+
+
+def test_main_rejects_bad_generators(tmp_path: Path, capsys):
+    status = main(["batch", str(tmp_path), "--regenerate", "--generator", "nope"])
+
+    assert status == 2
+    assert "Invalid generator" in capsys.readouterr().err
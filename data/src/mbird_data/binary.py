@@ -0,0 +1,183 @@
+from array import array
+from collections.abc import Sequence
+import struct
+import sys
+from typing import BinaryIO, Literal, NamedTuple
+
+from mbird_data.models import MbirdNode
+from mbird_data.store import TreeStore
+
+MAGIC = b"MBTR"
+FORMAT_VERSION = 2
+# Versions that can still be read. Version 1 files have no links bitmap, and
+# store shared nodes at every occurrence.
+READABLE_VERSIONS = (1, FORMAT_VERSION)
+
+# Magic, format version, flags (reserved), node count, string count
+HEADER = struct.Struct("<4sHHQQ")
+
+# File layout, all little-endian and with every section padded to 8 bytes:
+#
+#   header
+#   string offsets  u64 * (string count + 1), into the string blob
+#   id refs         u32 * node count, index of each node's id in the string table
+#   parents         i64 * node count, preorder index of the parent (-1 for root)
+#   subtree ends    i64 * node count, one past the last node of each subtree
+#   stale bitmap    1 bit per node
+#   links bitmap    1 bit per node, set for links (see TreeStore)
+#   string blob     UTF-8 ids, each stored once
+#
+# Subtree ends are redundant with the parents, but let readers skip over a
+# subtree without walking it. A shared node's subtree is stored once, and its
+# other occurrences are links: leaves whose node is the first one with their id.
+
+
+def write_binary(root: MbirdNode, fp: BinaryIO) -> None:
+    """Write a tree to an open binary file in the compact binary format."""
+    store = TreeStore.from_node(root)
+    num_nodes = len(store)
+
+    strings: dict[str, int] = {}
+    refs = array("I")
+    parents = array("q")
+    subtree_ends = array("q")
+    stale = bytearray((num_nodes + 7) // 8)
+    links = bytearray(len(stale))
+    for i in range(num_nodes):
+        refs.append(strings.setdefault(store.node_id(i), len(strings)))
+        parent = store.parent(i)
+        parents.append(-1 if parent is None else parent)
+        subtree_ends.append(store.subtree_end(i))
+        if store.is_stale(i):
+            stale[i >> 3] |= 1 << (i & 7)
+        if store.is_link(i):
+            links[i >> 3] |= 1 << (i & 7)
+
+    encoded = [node_id.encode() for node_id in strings]
+    offsets = array("Q", [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+
+    fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, num_nodes, len(strings)))
+    for section in (offsets, refs, parents, subtree_ends):
+        if sys.byteorder == "big":
+            section.byteswap()
+        _write_padded(fp, section.tobytes())
+    _write_padded(fp, bytes(stale))
+    _write_padded(fp, bytes(links))
+    fp.write(b"".join(encoded))
+
+
+def read_binary(fp: BinaryIO) -> MbirdNode:
+    """
+    Read a tree from an open binary file written by write_binary.
+
+    The nodes are built without re-running validation, since the layout can only
+    describe a well-formed tree.
+
+    Raises:
+        ValueError: If the file isn't a supported binary tree file
+    """
+    data = fp.read()
+    store = _parse(memoryview(data))
+    return store.to_node()
+
+
+class _Sections(NamedTuple):
+    num_nodes: int
+    num_strings: int
+    offsets: Sequence[int]
+    refs: Sequence[int]
+    parents: Sequence[int]
+    subtree_ends: Sequence[int]
+    stale: Sequence[int]
+    links: Sequence[int]
+    blob: memoryview
+
+
+def _read_sections(data: memoryview, copy: bool = True) -> _Sections:
+    """
+    Split a binary tree file into its sections.
+
+    With copy=False the sections are views into data where the host byte order
+    allows it, so nothing is read until it's used.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated binary tree file")
+    magic, version, _flags, num_nodes, num_strings = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary tree file")
+    if version not in READABLE_VERSIONS:
+        raise ValueError(f"Unsupported binary tree format version: {version}")
+
+    pos = HEADER.size
+
+    def section(typecode: Literal["B", "I", "q", "Q"], count: int) -> Sequence[int]:
+        nonlocal pos
+        values = array(typecode)
+        size = values.itemsize * count
+        if pos + size > len(data):
+            raise ValueError("Truncated binary tree file")
+        view = data[pos : pos + size]
+        pos += _padded(size)
+        if not copy and sys.byteorder == "little":
+            return view.cast(typecode)
+        values.frombytes(view)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    offsets = section("Q", num_strings + 1)
+    refs = section("I", num_nodes)
+    parents = section("q", num_nodes)
+    subtree_ends = section("q", num_nodes)
+    stale = section("B", (num_nodes + 7) // 8)
+    if version == 1:
+        links: Sequence[int] = bytes(len(stale))
+    else:
+        links = section("B", (num_nodes + 7) // 8)
+
+    blob = data[pos:]
+    if offsets[0] != 0 or offsets[-1] != len(blob):
+        raise ValueError("Corrupt string table in binary tree file")
+    return _Sections(
+        num_nodes,
+        num_strings,
+        offsets,
+        refs,
+        parents,
+        subtree_ends,
+        stale,
+        links,
+        blob,
+    )
+
+
+def _parse(data: memoryview) -> TreeStore:
+    """Decode a binary tree file into a store."""
+    sections = _read_sections(data)
+    offsets = sections.offsets
+    blob = bytes(sections.blob)
+    strings = [
+        blob[offsets[k] : offsets[k + 1]].decode() for k in range(sections.num_strings)
+    ]
+    refs = sections.refs
+    if refs and max(refs) >= sections.num_strings:
+        raise ValueError("Corrupt id table in binary tree file")
+
+    # Subtree ends are recomputed by the store
+    return TreeStore(
+        [strings[ref] for ref in refs],
+        array("q", sections.parents),
+        bytearray(sections.stale),
+        bytearray(sections.links),
+    )
+
+
+def _padded(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _write_padded(fp: BinaryIO, data: bytes) -> None:
+    fp.write(data)
+    fp.write(bytes(_padded(len(data)) - len(data)))
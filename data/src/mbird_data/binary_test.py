@@ -0,0 +1,117 @@
+import io
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.binary import FORMAT_VERSION, HEADER, read_binary, write_binary
+from mbird_data.diff import TreeShape
+from mbird_data.hashing import subtree_digest
+from mbird_data.streaming import iter_json
+
+
+@pytest.fixture
+def tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "is_stale": False, "children": [{"id": "a1"}]},
+                {"id": "b", "is_stale": False},
+                {"id": "ünïcode"},
+            ],
+        }
+    )
+
+
+def round_trip(root: MbirdNode) -> MbirdNode:
+    buf = io.BytesIO()
+    write_binary(root, buf)
+    buf.seek(0)
+    return read_binary(buf)
+
+
+def test_round_trip_preserves_tree(tree: MbirdNode):
+    assert round_trip(tree).model_dump() == tree.model_dump()
+
+
+def test_round_trip_preserves_deep_tree():
+    data: dict = {"id": "node4999", "is_stale": False}
+    for i in range(4998, -1, -1):
+        data = {"id": f"node{i}", "children": [data]}
+    root = MbirdNode.from_dict(data)
+
+    assert "".join(iter_json(round_trip(root))) == "".join(iter_json(root))
+
+
+def test_repeated_ids_are_stored_once():
+    root = MbirdNode.model_construct(
+        id="root",
+        children=[MbirdNode(id="shared" * 100), MbirdNode(id="shared" * 100)],
+    )
+    buf = io.BytesIO()
+    write_binary(root, buf)
+
+    assert buf.getvalue().count(b"shared" * 100) == 1
+    buf.seek(0)
+    assert read_binary(buf).model_dump() == root.model_dump()
+
+
+def make_diamonds(count: int) -> MbirdNode:
+    """Stacked diamonds, so the number of paths doubles with each one."""
+    node = MbirdNode(id="bottom")
+    for i in range(count):
+        sides = [MbirdNode(id=f"{i}-{side}", children=[node]) for side in "lr"]
+        node = MbirdNode(id=f"{i}-top", children=sides)
+    return node
+
+
+def test_shared_nodes_are_written_once():
+    root = make_diamonds(20)
+    buf = io.BytesIO()
+    write_binary(root, buf)
+
+    assert len(buf.getvalue()) < 10_000
+    buf.seek(0)
+    read = read_binary(buf)
+    assert read.children[0].children[0] is read.children[1].children[0]
+    assert subtree_digest(read) == subtree_digest(root)
+
+
+def test_version_1_files_are_read(tree: MbirdNode):
+    buf = io.BytesIO()
+    write_binary(tree, buf)
+    data = bytearray(buf.getvalue())
+    magic, _, flags, nodes, strings = HEADER.unpack_from(data)
+    HEADER.pack_into(data, 0, magic, 1, flags, nodes, strings)
+    # Version 1 has no links bitmap, which is the section before the strings
+    blob_start = len(data) - sum(len(i.encode()) for i in TreeShape(tree).nodes)
+    del data[blob_start - 8 : blob_start]
+
+    assert read_binary(io.BytesIO(bytes(data))).model_dump() == tree.model_dump()
+
+
+def test_unsupported_version_is_rejected(tree: MbirdNode):
+    buf = io.BytesIO()
+    write_binary(tree, buf)
+    data = bytearray(buf.getvalue())
+    magic, _, flags, nodes, strings = HEADER.unpack_from(data)
+    HEADER.pack_into(data, 0, magic, FORMAT_VERSION + 1, flags, nodes, strings)
+
+    with pytest.raises(ValueError, match="Unsupported binary tree format version"):
+        read_binary(io.BytesIO(bytes(data)))
+
+
+@pytest.mark.parametrize(
+    "data", [b"", b"not a tree file at all, really", b"MBTR\x01\x00"]
+)
+def test_invalid_file_is_rejected(data: bytes):
+    with pytest.raises(ValueError):
+        read_binary(io.BytesIO(data))
+
+
+def test_truncated_file_is_rejected(tree: MbirdNode):
+    buf = io.BytesIO()
+    write_binary(tree, buf)
+
+    with pytest.raises(ValueError):
+        read_binary(io.BytesIO(buf.getvalue()[:-3]))
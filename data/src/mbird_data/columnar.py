@@ -0,0 +1,153 @@
+"""
+Flat, columnar encoding of trees, for sending them compactly.
+
+Instead of nesting, a tree is a JSON object of parallel columns, with the nodes
+in preorder:
+
+    {
+        "format": "columnar",
+        "ids": ["root", "a", "a1", "b"],
+        "parents": [-1, 0, 1, 0],
+        "stale": "BQ==",
+        "links": []
+    }
+
+- ids: each node's id, once per node (shared nodes too)
+- parents: index of each node's first parent (-1 for the root). A parent's
+  children come in index order, which is preorder.
+- stale: base64 bitmap of the stale flags, node i being bit i % 8 of byte i // 8
+- links: [node, parent, position] for every other parent of a shared node, by
+  index, position being the node's position among the parent's children
+
+Inserting each link's node at its position, in order of position, after adding
+the other children, gives each parent its children in order.
+"""
+
+import base64
+from collections.abc import Mapping
+import json
+from typing import Any
+
+from mbird_data.models import MbirdNode, check_acyclic, construct_node
+
+COLUMNAR_FORMAT = "columnar"
+
+
+def to_columnar(root: MbirdNode) -> dict[str, Any]:
+    """Get the columns of a tree (see the module docstring)."""
+    ids: list[str] = []
+    parents: list[int] = []
+    flags: list[bool] = []
+    links: list[list[int]] = []
+    # Index of each node written so far, by identity
+    indices: dict[int, int] = {}
+
+    # Bound once, since this runs for every node
+    add_id = ids.append
+    add_parent = parents.append
+    add_flag = flags.append
+    stack: list[tuple[MbirdNode, int, int]] = [(root, -1, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, parent, position = pop()
+        key = id(node)
+        index = indices.get(key)
+        if index is not None:
+            links.append([index, parent, position])
+            continue
+
+        index = len(ids)
+        indices[key] = index
+        add_id(node.id)
+        add_parent(parent)
+        add_flag(node.is_stale)
+        children = node.children
+        if children:
+            position = len(children)
+            for child in reversed(children):
+                position -= 1
+                push((child, index, position))
+
+    stale = bytearray((len(flags) + 7) // 8)
+    for index, is_stale in enumerate(flags):
+        if is_stale:
+            stale[index >> 3] |= 1 << (index & 7)
+    return {
+        "format": COLUMNAR_FORMAT,
+        "ids": ids,
+        "parents": parents,
+        "stale": base64.b64encode(stale).decode("ascii"),
+        "links": links,
+    }
+
+
+def encode_columnar(root: MbirdNode) -> bytes:
+    """Encode a tree as compact columnar JSON."""
+    return json.dumps(
+        to_columnar(root), ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+def from_columnar(columns: Mapping[str, Any]) -> MbirdNode:
+    """
+    Build a tree from its columns (see the module docstring).
+
+    Raises:
+        ValueError: If the columns don't describe a valid tree
+    """
+    if columns.get("format") != COLUMNAR_FORMAT:
+        raise ValueError(f"Not a {COLUMNAR_FORMAT} tree: {columns.get('format')}")
+    try:
+        ids = columns["ids"]
+        parents = columns["parents"]
+        stale = base64.b64decode(columns["stale"], validate=True)
+        links = columns.get("links", [])
+    except (KeyError, ValueError) as e:
+        raise ValueError(f"Invalid {COLUMNAR_FORMAT} tree: {e}") from e
+
+    num_nodes = len(ids)
+    if num_nodes == 0:
+        raise ValueError("Tree has no nodes")
+    if len(parents) != num_nodes or len(stale) != (num_nodes + 7) // 8:
+        raise ValueError("Tree columns have different lengths")
+    if not all(isinstance(node_id, str) for node_id in ids):
+        raise ValueError("Node ids must be strings")
+    if len(set(ids)) != num_nodes:
+        raise ValueError("Duplicate node ids")
+
+    nodes = [
+        construct_node(node_id, [], bool(stale[i >> 3] >> (i & 7) & 1))
+        for i, node_id in enumerate(ids)
+    ]
+    if parents[0] != -1:
+        raise ValueError("The first node must be the root")
+    for i in range(1, num_nodes):
+        parent = parents[i]
+        # Parents come first in preorder, so this can't make a cycle
+        if not isinstance(parent, int) or not 0 <= parent < i:
+            raise ValueError(f"Invalid parent of node {ids[i]}: {parent}")
+        nodes[parent].children.append(nodes[i])
+
+    for link in links:
+        if (
+            not isinstance(link, list)
+            or len(link) != 3
+            or not all(isinstance(i, int) for i in link)
+            or not (0 < link[0] < num_nodes and 0 <= link[1] < num_nodes)
+        ):
+            raise ValueError(f"Invalid link: {link}")
+    for node, parent, position in sorted(links, key=lambda link: link[1:]):
+        children = nodes[parent].children
+        if not 0 <= position <= len(children):
+            raise ValueError(f"Invalid link: {[node, parent, position]}")
+        if any(child is nodes[node] for child in children):
+            raise ValueError(
+                f"Duplicate node id: {ids[node]} (twice under {ids[parent]})"
+            )
+        children.insert(position, nodes[node])
+
+    root = nodes[0]
+    if links:
+        check_acyclic(root)
+    return root
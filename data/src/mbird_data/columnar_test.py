@@ -0,0 +1,126 @@
+import base64
+import json
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.columnar import encode_columnar, from_columnar, to_columnar
+from mbird_data.streaming import encode_json
+
+
+def make_tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "is_stale": True,
+            "children": [
+                {"id": "a", "is_stale": False, "children": [{"id": "a1"}]},
+                {"id": "b", "is_stale": False},
+            ],
+        }
+    )
+
+
+def test_to_columnar_lists_nodes_in_preorder():
+    columns = to_columnar(make_tree())
+
+    assert columns["ids"] == ["root", "a", "a1", "b"]
+    assert columns["parents"] == [-1, 0, 1, 0]
+    # root and a1
+    assert base64.b64decode(columns["stale"]) == bytes([0b0101])
+    assert columns["links"] == []
+
+
+def test_columnar_round_trips():
+    root = make_tree()
+
+    decoded = from_columnar(json.loads(encode_columnar(root)))
+
+    assert decoded == root
+
+
+def test_columnar_round_trips_stale_flags_past_a_byte():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [{"id": f"n{i}", "is_stale": i % 3 == 0} for i in range(20)],
+        }
+    )
+
+    assert from_columnar(to_columnar(root)) == root
+
+
+def test_columnar_writes_shared_nodes_once():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "x", "children": [{"id": "y"}]}]},
+                {"id": "b", "children": [{"id": "c"}, {"ref": "x"}, {"id": "d"}]},
+            ],
+        }
+    )
+
+    columns = to_columnar(root)
+    assert columns["ids"] == ["root", "a", "x", "y", "b", "c", "d"]
+    assert columns["links"] == [[2, 4, 1]]
+
+    decoded = from_columnar(columns)
+    assert encode_json(decoded, shared=True) == encode_json(root, shared=True)
+    a, b = decoded.children
+    assert b.children[1] is a.children[0]
+    assert [child.id for child in b.children] == ["c", "x", "d"]
+
+
+@pytest.mark.parametrize(
+    ("columns", "error"),
+    [
+        ({"format": "nested"}, "Not a columnar tree"),
+        ({"format": "columnar", "ids": []}, "Invalid columnar tree"),
+        (
+            {"format": "columnar", "ids": ["a", "b"], "parents": [-1], "stale": "AA=="},
+            "different lengths",
+        ),
+        (
+            {
+                "format": "columnar",
+                "ids": ["a", "a"],
+                "parents": [-1, 0],
+                "stale": "AA==",
+            },
+            "Duplicate node ids",
+        ),
+        (
+            {
+                "format": "columnar",
+                "ids": ["a", "b"],
+                "parents": [-1, 1],
+                "stale": "AA==",
+            },
+            "Invalid parent of node b",
+        ),
+        (
+            {
+                "format": "columnar",
+                "ids": ["a", "b"],
+                "parents": [-1, 0],
+                "stale": "AA==",
+                "links": [[1, 0, 0]],
+            },
+            "twice under a",
+        ),
+        (
+            {
+                "format": "columnar",
+                "ids": ["a", "b", "c"],
+                "parents": [-1, 0, 1],
+                "stale": "AA==",
+                "links": [[1, 2, 0]],
+            },
+            "Cycle detected",
+        ),
+    ],
+)
+def test_from_columnar_rejects_invalid_trees(columns: dict, error: str):
+    with pytest.raises(ValueError, match=error):
+        from_columnar(columns)
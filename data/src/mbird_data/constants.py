@@ -1,2 +1,4 @@
 TREE_FNAME = "tree.json"
+BINARY_TREE_FNAME = "tree.bin"
+JOURNAL_FNAME = "journal.jsonl"
 MBIRD_EXT = ".mbird"
@@ -1,21 +1,287 @@
-import json
 from pathlib import Path
+import threading
 
-from mbird_data.constants import MBIRD_EXT, TREE_FNAME
-from mbird_data.models import MbirdNode
+from mbird_data.atomic import atomic_write, atomic_write_bytes
+from mbird_data.binary import read_binary, write_binary
+from mbird_data.constants import (
+    BINARY_TREE_FNAME,
+    JOURNAL_FNAME,
+    MBIRD_EXT,
+    TREE_FNAME,
+)
+from mbird_data.hashing import subtree_digest
+from mbird_data.index import TreeIndex
+from mbird_data.journal import (
+    append_journal,
+    file_digest,
+    read_journal,
+    replay_journal,
+    start_journal,
+)
+from mbird_data.lazy import MappedTree, TreeSlice, slice_tree
+from mbird_data.models import MbirdNode, paused_gc
+from mbird_data.patch import TreePatch, encode_patch
+from mbird_data.store import TreeStore
+from mbird_data.streaming import read_json, write_json
+
+# Incremental saves compact the journal into a new snapshot once it grows past
+# half the snapshot's size (and at least this many bytes), so that replaying it
+# never costs more than loading the snapshot
+JOURNAL_COMPACT_MIN_BYTES = 1024 * 1024
 
 
 class MbirdData:
     def __init__(self, root: MbirdNode | None = None):
-        self.root = root
+        self._root = root
+        # Built on first use; once there is one, the tree is edited through it
+        self._index: TreeIndex | None = None
+        # Bumped whenever the tree is replaced, so checkpoints of an older tree
+        # aren't mistaken for checkpoints of this one
+        self._generation = 0
+        # Patches included in this checkpoint (see checkpoint())
+        self._checkpointed = 0
+        # Set for lazily loaded data until the tree is first materialized
+        self._mapped: MappedTree | None = None
+        # Held while the lazily loaded tree is read or materialized, which
+        # several threads can do at once
+        self._mapped_lock = threading.Lock()
+        # Directory whose journal ends at the last saved state of this tree
+        self._journal_dir: Path | None = None
+        # Patches applied since the last save, for the next incremental save,
+        # encoded when they were recorded
+        self._pending: list[bytes] = []
+        # Digest of the tree as last saved to _journal_dir, if it was given
+        self._saved_digest: bytes | None = None
+
+    @property
+    def root(self) -> MbirdNode | None:
+        """The root node, materializing the whole tree if it was loaded lazily."""
+        if self._mapped is not None:
+            with self._mapped_lock:
+                if self._mapped is not None:
+                    self._root = self._mapped.to_node()
+                    self._mapped.close()
+                    self._mapped = None
+        if self._index is not None:
+            # Copy-on-write edits replace the root
+            return self._index.root
+        return self._root
+
+    @root.setter
+    def root(self, root: MbirdNode | None) -> None:
+        with self._mapped_lock:
+            if self._mapped is not None:
+                self._mapped.close()
+                self._mapped = None
+        self._root = root
+        self._index = None
+        self._generation += 1
+        # The journal can't describe a replaced tree
+        self._journal_dir = None
+        self._pending.clear()
+        self._saved_digest = None
+
+    @property
+    def index(self) -> TreeIndex:
+        """
+        Index of the tree, which edits and snapshots go through.
+
+        Builds a lazily loaded tree. Once the index exists, `root` follows its
+        copy-on-write edits.
+
+        Raises:
+            ValueError: If there's no tree
+        """
+        if self._index is None:
+            root = self.root
+            if root is None:
+                raise ValueError("No root node loaded")
+            self._index = TreeIndex(root)
+        return self._index
+
+    def checkpoint(self, root: MbirdNode | None = None) -> "MbirdData":
+        """
+        Copy the tree's save state, to save it while the tree keeps changing.
+
+        The copy shares the tree, so it must be a version that no longer
+        changes, e.g. from TreeIndex.snapshot(). Once the copy is saved, saved()
+        carries the result back.
+
+        Args:
+            root: Root of the version to save (the current root if None)
+        """
+        checkpoint = MbirdData(root=self.root if root is None else root)
+        checkpoint._journal_dir = self._journal_dir
+        checkpoint._pending = list(self._pending)
+        checkpoint._saved_digest = self._saved_digest
+        checkpoint._generation = self._generation
+        checkpoint._checkpointed = len(self._pending)
+        return checkpoint
+
+    def saved(self, checkpoint: "MbirdData") -> None:
+        """
+        Record that a checkpoint of this tree was saved.
+
+        Only the patches recorded since the checkpoint are left for the next
+        incremental save. Checkpoints of a tree that was replaced since are
+        ignored.
+        """
+        if checkpoint._generation != self._generation:
+            return
+        del self._pending[: checkpoint._checkpointed]
+        self._journal_dir = checkpoint._journal_dir
+        self._saved_digest = checkpoint._saved_digest
+
+    def record(self, patch: TreePatch) -> None:
+        """
+        Note a patch that was applied to the tree, for the next incremental save.
+
+        Changes made to the tree without recording them are only saved by a full
+        (non-incremental) save. The patch is encoded right away: the nodes of
+        an applied patch can be part of the tree, which may change before the
+        next save.
+        """
+        self._pending.append(encode_patch(patch))
+
+    def num_nodes(self) -> int:
+        """
+        Number of nodes in the tree, without building a lazily loaded one.
+
+        Shared nodes are counted once.
+        """
+        with self._mapped_lock:
+            if self._mapped is not None:
+                return self._mapped.num_nodes()
+        if self._index is not None:
+            return len(self._index)
+        seen: set[str] = set()
+        stack = [] if self._root is None else [self._root]
+        while stack:
+            node = stack.pop()
+            if node.id not in seen:
+                seen.add(node.id)
+                stack.extend(node.children)
+        return len(seen)
+
+    @property
+    def is_materialized(self) -> bool:
+        """Whether the tree has been built in memory (always true unless lazy)."""
+        return self._mapped is None
+
+    def subtree(
+        self, node_id: str | None = None, depth: int | None = None
+    ) -> TreeSlice:
+        """
+        Get a copy of a subtree, cut off depth levels below its root.
+
+        Lazily loaded trees stay on disk; only the nodes in the slice are built.
+        Indexed trees are sliced from a snapshot, so they can keep changing
+        while the slice is copied.
+
+        Args:
+            node_id: Id of the slice's root (the tree's root if None)
+            depth: How many levels of descendants to include (all if None)
+
+        Raises:
+            KeyError: If there's no node with the given id
+        """
+        tree_slice = self.lazy_subtree(node_id, depth)
+        if tree_slice is not None:
+            return tree_slice
+        if self._index is not None:
+            return slice_tree(self._index.snapshot(node_id).root, depth)
+        return slice_tree(self._find(node_id), depth)
+
+    def lazy_subtree(
+        self, node_id: str | None = None, depth: int | None = None
+    ) -> TreeSlice | None:
+        """
+        Get a copy of a subtree (see subtree()) while the tree is still on disk.
+
+        Can be called from any thread: the tree isn't materialized, and so
+        can't be edited, while it's being read.
+
+        Returns:
+            The slice, or None if the tree was materialized (or isn't lazy)
+
+        Raises:
+            KeyError: If there's no node with the given id
+        """
+        with self._mapped_lock:
+            if self._mapped is None:
+                return None
+            return self._mapped.slice(self._mapped_index(node_id), depth)
+
+    def digest(self, node_id: str | None = None) -> bytes:
+        """
+        Get the digest of a subtree (see mbird_data.hashing).
+
+        Lazily loaded trees stay on disk. Indexed trees only rehash what changed
+        since the last call, and others hash the whole subtree.
+
+        Args:
+            node_id: Id of the subtree's root (the tree's root if None)
+
+        Raises:
+            KeyError: If there's no node with the given id
+        """
+        with self._mapped_lock:
+            if self._mapped is not None:
+                return self._mapped.digest(self._mapped_index(node_id))
+        if self._index is not None:
+            index = self._index
+            return index.digest(index.root.id if node_id is None else node_id)
+        return subtree_digest(self._find(node_id))
+
+    def _mapped_index(self, node_id: str | None) -> int:
+        assert self._mapped is not None
+        return 0 if node_id is None else self._mapped.find(node_id)
+
+    def _find(self, node_id: str | None) -> MbirdNode:
+        if self._root is None:
+            raise ValueError("No root node loaded")
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node_id is None or node.id == node_id:
+                return node
+            stack.extend(reversed(node.children))
+        raise KeyError(f"Node not found: {node_id}")
+
+    @classmethod
+    def from_store(cls, store: TreeStore) -> "MbirdData":
+        """Create mbird data from a flat tree store, building its nodes."""
+        return cls(root=store.to_node())
+
+    def to_store(self) -> TreeStore:
+        """
+        Flatten the tree into an index-backed store.
+
+        The store is a copy; later changes to either side aren't reflected in the
+        other. The tree itself is never kept in a store (see TreeStore).
+        """
+        if self.root is None:
+            raise ValueError("No root node loaded")
+        return TreeStore.from_node(self.root)
 
     @classmethod
-    def load(cls, dir_path: str | Path) -> "MbirdData":
+    def load(
+        cls, dir_path: str | Path, lazy: bool = False, validate: bool | None = None
+    ) -> "MbirdData":
         """
         Load mbird data from a directory.
 
+        The binary tree file is used when it's present and at least as new as
+        tree.json, since it loads much faster.
+
         Args:
             dir_path: Path to the directory (must end with .mbird)
+            lazy: Memory-map the binary tree file and only build nodes as they're
+                accessed (falls back to a full load if there is no binary file)
+            validate: Validate the nodes read from tree.json. By default they're
+                only validated if the journal doesn't vouch for the file, i.e.
+                if it wasn't written by save() or was changed since. Binary
+                files are never validated: their layout can't describe a cycle.
 
         Returns:
             MbirdData instance with loaded data
@@ -31,29 +297,137 @@ class MbirdData:
             raise NotADirectoryError(f"Not a directory: {dir_path}")
 
         tree_file = dir_path / TREE_FNAME
-        if not tree_file.exists():
+        binary_file = dir_path / BINARY_TREE_FNAME
+        if binary_file.exists() and (
+            not tree_file.exists()
+            or binary_file.stat().st_mtime_ns >= tree_file.stat().st_mtime_ns
+        ):
+            snapshot_file = binary_file
+        elif tree_file.exists():
+            snapshot_file = tree_file
+        else:
             raise FileNotFoundError(f"Tree file not found: {tree_file}")
 
-        data = json.loads(tree_file.read_text())
-        root = MbirdNode(**data)
-        return cls(root=root)
+        # Patches saved since the snapshot was written
+        patches: list[TreePatch] = []
+        journal_matches = False
+        journal_file = dir_path / JOURNAL_FNAME
+        if journal_file.exists():
+            snapshots, patches = read_journal(journal_file)
+            # Lazy loads skip hashing the snapshot when there's nothing to replay
+            if patches or not lazy or snapshot_file == tree_file:
+                journal_matches = snapshots.get(snapshot_file.name) == file_digest(
+                    snapshot_file
+                )
+            if not journal_matches:
+                patches = []
+
+        data = cls()
+        if snapshot_file == binary_file and lazy and not patches:
+            data._mapped = MappedTree(binary_file)
+        elif snapshot_file == binary_file:
+            with binary_file.open("rb") as bf:
+                data._root = read_binary(bf)
+        else:
+            if validate is None:
+                validate = not journal_matches
+            with tree_file.open(encoding="utf-8") as f, paused_gc():
+                data._root = read_json(f, validate=validate)
 
-    def save(self, dir_path: str | Path) -> None:
+        if patches:
+            assert data._root is not None
+            replay_journal(data._root, patches)
+        if journal_matches:
+            data._journal_dir = dir_path
+        return data
+
+    def save(
+        self,
+        dir_path: str | Path,
+        binary: bool = False,
+        incremental: bool = False,
+        digest: bytes | None = None,
+    ) -> None:
         """
         Save mbird data to a directory.
 
+        Every file is written to a temporary file and renamed into place, so a
+        crash mid-save leaves the previous save intact.
+
         Args:
             dir_path: Path to the directory (will append .mbird if missing)
+            binary: Also write the binary tree file, for faster loading
+            incremental: Only append the patches recorded since the last save
+                to the directory's journal, when it holds this tree's last save.
+                Otherwise (and when the journal has grown too big), write a new
+                snapshot of the whole tree.
+            digest: The tree's current digest (e.g. from TreeIndex.digest()).
+                If it matches the digest given when the tree was last saved to
+                this directory, nothing has changed and nothing is written.
         """
         if self.root is None:
             raise ValueError("No root node loaded")
+        root = self.root
 
         dir_path = Path(dir_path)
 
         if not str(dir_path).endswith(MBIRD_EXT):
             dir_path = Path(str(dir_path) + MBIRD_EXT)
 
+        journal_file = dir_path / JOURNAL_FNAME
+        if (
+            digest is not None
+            and digest == self._saved_digest
+            and self._journal_dir == dir_path
+            and journal_file.exists()
+            and (not binary or (dir_path / BINARY_TREE_FNAME).exists())
+        ):
+            # Any pending patches cancel out, e.g. a node added then removed
+            self._pending.clear()
+            return
+
+        if incremental and self._can_append(dir_path):
+            try:
+                if self._pending:
+                    append_journal(journal_file, self._pending)
+            except (OSError, ValueError):
+                # A full snapshot doesn't need the patches, so a journal that
+                # can't be appended to doesn't keep the tree from being saved
+                pass
+            else:
+                self._pending.clear()
+                self._saved_digest = digest
+                return
+
         dir_path.mkdir(parents=True, exist_ok=True)
 
         tree_file = dir_path / TREE_FNAME
-        tree_file.write_text(json.dumps(self.root.model_dump(), indent=2))
+        with atomic_write(tree_file) as f:
+            write_json(root, f)
+        snapshots = {TREE_FNAME: file_digest(tree_file)}
+
+        # Written after tree.json so load() sees it as up to date
+        binary_file = dir_path / BINARY_TREE_FNAME
+        if binary:
+            with atomic_write_bytes(binary_file) as bf:
+                write_binary(root, bf)
+            snapshots[BINARY_TREE_FNAME] = file_digest(binary_file)
+        else:
+            binary_file.unlink(missing_ok=True)
+
+        # Only after the snapshots are in place: until then, the old journal
+        # still matches the old snapshots
+        start_journal(journal_file, snapshots)
+        self._journal_dir = dir_path
+        self._pending.clear()
+        self._saved_digest = digest
+
+    def _can_append(self, dir_path: Path) -> bool:
+        """Whether an incremental save to dir_path can go to its journal."""
+        journal_file = dir_path / JOURNAL_FNAME
+        tree_file = dir_path / TREE_FNAME
+        if self._journal_dir != dir_path or not journal_file.exists():
+            return False
+        journal_size = journal_file.stat().st_size
+        snapshot_size = tree_file.stat().st_size
+        return journal_size <= max(JOURNAL_COMPACT_MIN_BYTES, snapshot_size // 2)
@@ -1,9 +1,22 @@
+import json
+import os
 from pathlib import Path
 
 import pytest
 
 from mbird_data import MbirdData, MbirdNode
-from mbird_data.constants import TREE_FNAME
+from mbird_data import data as data_module
+from mbird_data.constants import BINARY_TREE_FNAME, JOURNAL_FNAME, TREE_FNAME
+from mbird_data.hashing import subtree_digest
+from mbird_data.history import History
+from mbird_data.patch import (
+    AddChild,
+    LinkNode,
+    RemoveSubtree,
+    TreePatch,
+    apply_patch,
+)
+from mbird_data.staleness import StalenessEngine
 
 
 def test_data_preserved_across_save_and_load(tmp_path: Path):
@@ -98,3 +111,330 @@ def test_is_stale_preserved_across_save_and_load(tmp_path: Path):
     assert loaded_data.root is not None
     assert loaded_data.root.is_stale is True
     assert loaded_data.root.children[0].is_stale is False
+
+
+def test_saved_tree_file_is_pretty_printed_json(tmp_path: Path):
+    root = MbirdNode(id="root", children=[MbirdNode(id="child", is_stale=False)])
+    data = MbirdData(root=root)
+
+    mbird_dir = tmp_path / "test_format.mbird"
+    data.save(mbird_dir)
+
+    saved = (mbird_dir / TREE_FNAME).read_text()
+    assert saved == json.dumps(root.model_dump(), indent=2)
+
+
+def test_binary_tree_file_is_preferred_when_up_to_date(tmp_path: Path):
+    root = MbirdNode(id="root", children=[MbirdNode(id="child", is_stale=False)])
+    mbird_dir = tmp_path / "test_binary.mbird"
+    MbirdData(root=root).save(mbird_dir, binary=True)
+
+    assert (mbird_dir / BINARY_TREE_FNAME).exists()
+    # Break the JSON file so only the binary one can be read
+    (mbird_dir / TREE_FNAME).write_text("{}")
+    os.utime(mbird_dir / TREE_FNAME, ns=(0, 0))
+
+    loaded = MbirdData.load(mbird_dir)
+
+    assert loaded.root is not None
+    assert loaded.root.model_dump() == root.model_dump()
+
+
+def test_older_binary_tree_file_is_ignored(tmp_path: Path):
+    mbird_dir = tmp_path / "test_binary.mbird"
+    MbirdData(root=MbirdNode(id="old")).save(mbird_dir, binary=True)
+    (mbird_dir / TREE_FNAME).write_text(json.dumps({"id": "new"}))
+    os.utime(mbird_dir / BINARY_TREE_FNAME, ns=(0, 0))
+
+    loaded = MbirdData.load(mbird_dir)
+
+    assert loaded.root is not None
+    assert loaded.root.id == "new"
+
+
+def test_saving_without_binary_removes_binary_tree_file(tmp_path: Path):
+    mbird_dir = tmp_path / "test_binary.mbird"
+    MbirdData(root=MbirdNode(id="old")).save(mbird_dir, binary=True)
+    MbirdData(root=MbirdNode(id="new")).save(mbird_dir)
+
+    assert not (mbird_dir / BINARY_TREE_FNAME).exists()
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None
+    assert loaded.root.id == "new"
+
+
+def test_incremental_save_appends_to_journal(tmp_path: Path):
+    mbird_dir = tmp_path / "journal.mbird"
+    data = MbirdData(root=MbirdNode(id="root", is_stale=False))
+    data.save(mbird_dir, incremental=True)
+    snapshot = (mbird_dir / TREE_FNAME).read_text()
+
+    root = data.root
+    assert root is not None
+    root.children.append(MbirdNode(id="a"))
+    data.record(
+        TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]),
+    )
+    data.save(mbird_dir, incremental=True)
+
+    # Only the journal was written
+    assert (mbird_dir / TREE_FNAME).read_text() == snapshot
+    assert len((mbird_dir / JOURNAL_FNAME).read_text().splitlines()) == 2
+
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None
+    assert [child.id for child in loaded.root.children] == ["a"]
+    assert loaded.root.is_stale is True
+
+
+def test_full_save_starts_a_new_journal(tmp_path: Path):
+    mbird_dir = tmp_path / "journal.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.save(mbird_dir)
+    data.record(TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]))
+    data.root = MbirdNode(id="root", children=[MbirdNode(id="b")])
+    data.save(mbird_dir, incremental=True)
+
+    assert len((mbird_dir / JOURNAL_FNAME).read_text().splitlines()) == 1
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None
+    assert [child.id for child in loaded.root.children] == ["b"]
+
+
+def test_journal_for_an_older_snapshot_is_ignored(tmp_path: Path):
+    mbird_dir = tmp_path / "journal.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.save(mbird_dir)
+    data.record(TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]))
+    data.root.children.append(MbirdNode(id="a"))  # type: ignore[union-attr]
+    data.save(mbird_dir, incremental=True)
+    journal = (mbird_dir / JOURNAL_FNAME).read_text()
+
+    # A crash after writing a new snapshot but before resetting the journal
+    data.save(mbird_dir)
+    (mbird_dir / JOURNAL_FNAME).write_text(journal)
+
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None
+    assert [child.id for child in loaded.root.children] == ["a"]
+
+
+def test_large_journal_is_compacted(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(data_module, "JOURNAL_COMPACT_MIN_BYTES", 0)
+    mbird_dir = tmp_path / "journal.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.save(mbird_dir)
+
+    for i in range(10):
+        data.root.children.append(MbirdNode(id=f"n{i}"))  # type: ignore[union-attr]
+        data.record(TreePatch(ops=[AddChild(parent_id="root", node={"id": f"n{i}"})]))
+        data.save(mbird_dir, incremental=True)
+
+    assert len((mbird_dir / JOURNAL_FNAME).read_text().splitlines()) < 10
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None
+    assert len(loaded.root.children) == 10
+
+
+def test_failed_journal_append_saves_a_snapshot(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    mbird_dir = tmp_path / "journal.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.save(mbird_dir)
+    data.root.children.append(MbirdNode(id="a"))  # type: ignore[union-attr]
+    data.record(TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]))
+
+    def fail(*args: object) -> None:
+        raise ValueError("Can't encode")
+
+    monkeypatch.setattr(data_module, "append_journal", fail)
+    data.save(mbird_dir, incremental=True)
+
+    assert len((mbird_dir / JOURNAL_FNAME).read_text().splitlines()) == 1
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None
+    assert [child.id for child in loaded.root.children] == ["a"]
+
+
+def test_save_with_unchanged_digest_writes_nothing(tmp_path: Path):
+    mbird_dir = tmp_path / "digest.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.save(mbird_dir, incremental=True, digest=data.digest())
+    journal = (mbird_dir / JOURNAL_FNAME).read_text()
+
+    # Adding then removing a node leaves the tree as it was saved
+    data.record(TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]))
+    data.record(TreePatch(ops=[RemoveSubtree(node_id="a")]))
+    data.save(mbird_dir, incremental=True, digest=data.digest())
+    assert (mbird_dir / JOURNAL_FNAME).read_text() == journal
+
+    data.root.children.append(MbirdNode(id="b"))  # type: ignore[union-attr]
+    data.record(TreePatch(ops=[AddChild(parent_id="root", node={"id": "b"})]))
+    data.save(mbird_dir, incremental=True, digest=data.digest())
+    assert (mbird_dir / JOURNAL_FNAME).read_text() != journal
+
+
+def test_lazy_digest_matches_loaded_tree(tmp_path: Path):
+    mbird_dir = tmp_path / "lazy.mbird"
+    data = MbirdData(root=MbirdNode(id="root", children=[MbirdNode(id="a")]))
+    data.save(mbird_dir, binary=True)
+
+    lazy = MbirdData.load(mbird_dir, lazy=True)
+    assert lazy.digest("a") == data.digest("a")
+    assert lazy.digest() == data.digest()
+    assert not lazy.is_materialized
+
+
+def test_num_nodes_counts_lazily_loaded_tree(tmp_path: Path):
+    mbird_dir = tmp_path / "count.mbird"
+    root = MbirdNode(id="root", children=[MbirdNode(id="a"), MbirdNode(id="b")])
+    MbirdData(root=root).save(mbird_dir, binary=True)
+
+    lazy = MbirdData.load(mbird_dir, lazy=True)
+    assert lazy.num_nodes() == 3
+    assert not lazy.is_materialized
+    assert MbirdData.load(mbird_dir).num_nodes() == 3
+    assert MbirdData().num_nodes() == 0
+
+
+def test_lazy_subtree_is_only_read_from_disk(tmp_path: Path):
+    mbird_dir = tmp_path / "lazy.mbird"
+    MbirdData(root=MbirdNode.from_dict({"id": "root", "children": [{"id": "a"}]})).save(
+        mbird_dir, binary=True
+    )
+
+    data = MbirdData.load(mbird_dir, lazy=True)
+    tree_slice = data.lazy_subtree("a")
+    assert tree_slice is not None
+    assert tree_slice.root.id == "a"
+
+    assert data.root is not None
+    assert data.lazy_subtree("a") is None
+    assert data.subtree("a").root.id == "a"
+
+
+def test_edited_tree_file_is_validated(tmp_path: Path):
+    project = tmp_path / "project.mbird"
+    MbirdData(root=MbirdNode(id="root", children=[MbirdNode(id="a")])).save(project)
+    tree_file = project / TREE_FNAME
+    # Not the file the journal recorded, so it isn't trusted
+    tree_file.write_text(tree_file.read_text().replace('"a"', '"root"'))
+
+    with pytest.raises(ValueError, match="Cycle detected"):
+        MbirdData.load(project)
+    # Both nodes have the same id now, so they count as one
+    assert MbirdData.load(project, validate=False).num_nodes() == 1
+
+
+def test_saved_tree_file_loads_without_validation(tmp_path: Path):
+    project = tmp_path / "project.mbird"
+    root = MbirdNode(id="root", children=[MbirdNode(id="a", is_stale=False)])
+    MbirdData(root=root).save(project)
+
+    assert MbirdData.load(project).root == root
+
+
+def test_checkpoint_is_saved_while_the_tree_keeps_changing(tmp_path: Path):
+    mbird_dir = tmp_path / "checkpoint.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.save(mbird_dir, incremental=True)
+    engine = StalenessEngine(data.index)
+
+    apply_and_record(data, engine, AddChild(parent_id="root", node={"id": "a"}))
+    checkpoint = data.checkpoint(data.index.snapshot().root)
+    # Lands while the checkpoint is being saved
+    apply_and_record(data, engine, AddChild(parent_id="root", node={"id": "b"}))
+    checkpoint.save(mbird_dir, incremental=True)
+    data.saved(checkpoint)
+
+    loaded = MbirdData.load(mbird_dir)
+    assert [child.id for child in loaded.root.children] == ["a"]  # type: ignore[union-attr]
+
+    data.save(mbird_dir, incremental=True)
+    loaded = MbirdData.load(mbird_dir)
+    assert [child.id for child in loaded.root.children] == ["a", "b"]  # type: ignore[union-attr]
+
+
+def test_checkpoint_of_a_replaced_tree_is_ignored(tmp_path: Path):
+    mbird_dir = tmp_path / "checkpoint.mbird"
+    data = MbirdData(root=MbirdNode(id="root"))
+    checkpoint = data.checkpoint()
+    data.root = MbirdNode(id="new")
+    checkpoint.save(mbird_dir)
+    data.saved(checkpoint)
+
+    data.save(mbird_dir, incremental=True)
+    assert MbirdData.load(mbird_dir).root.id == "new"  # type: ignore[union-attr]
+
+
+def test_root_follows_edits_through_the_index():
+    data = MbirdData(root=MbirdNode(id="root"))
+    data.index.snapshot()
+
+    data.index.attach(MbirdNode(id="a"), "root", None)
+
+    assert data.root is data.index.root
+    assert [child.id for child in data.root.children] == ["a"]
+    assert data.num_nodes() == 2
+    assert data.subtree("a").root.id == "a"
+
+
+def test_undone_removal_of_a_shared_node_is_journaled(tmp_path: Path):
+    mbird_dir = tmp_path / "shared.mbird"
+    data = MbirdData(
+        root=MbirdNode.from_dict(
+            {"id": "root", "children": [{"id": "x", "children": [{"id": "s"}]}]}
+        )
+    )
+    data.save(mbird_dir, incremental=True)
+    engine = StalenessEngine(data.index)
+    history = History()
+
+    for op in (
+        AddChild(parent_id="root", node={"id": "y"}),
+        LinkNode(parent_id="y", node_id="s"),
+        RemoveSubtree(node_id="x"),
+    ):
+        patch = TreePatch(ops=[op])
+        history.apply(engine, patch)
+        data.record(patch)
+    data.record(history.undo(engine)[0])
+    data.save(mbird_dir, incremental=True)
+
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None and data.root is not None
+    assert subtree_digest(loaded.root) == subtree_digest(data.root)
+    assert sorted(loaded.index.parent_ids("s")) == ["x", "y"]
+
+
+def test_edits_after_an_undo_are_journaled_once(tmp_path: Path):
+    mbird_dir = tmp_path / "undo.mbird"
+    data = MbirdData(
+        root=MbirdNode.from_dict(
+            {"id": "root", "children": [{"id": "a", "children": [{"id": "a1"}]}]}
+        )
+    )
+    data.save(mbird_dir, incremental=True)
+    engine = StalenessEngine(data.index)
+    history = History()
+
+    patch = TreePatch(ops=[RemoveSubtree(node_id="a")])
+    history.apply(engine, patch)
+    data.record(patch)
+    data.record(history.undo(engine)[0])
+    patch = TreePatch(ops=[AddChild(parent_id="a", node={"id": "z"})])
+    history.apply(engine, patch)
+    data.record(patch)
+    data.save(mbird_dir, incremental=True)
+
+    loaded = MbirdData.load(mbird_dir)
+    assert loaded.root is not None and data.root is not None
+    assert subtree_digest(loaded.root) == subtree_digest(data.root)
+    assert [child.id for child in loaded.index.get("a").children] == ["a1", "z"]
+
+
+def apply_and_record(data: MbirdData, engine: StalenessEngine, op: AddChild) -> None:
+    patch = TreePatch(ops=[op])
+    apply_patch(engine, patch)
+    data.record(patch)
@@ -0,0 +1,317 @@
+"""
+Comparing trees, and finding the patch that turns one tree into another.
+
+Nodes are matched by id, so both take time linear in the size of the trees
+(rather than comparing subtrees against each other). A node whose id changed
+is seen as removed and added.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any
+
+from mbird_data.models import MbirdNode, paused_gc
+from mbird_data.patch import (
+    AddChild,
+    LinkNode,
+    MoveSubtree,
+    PatchOp,
+    RemoveSubtree,
+    SetFlags,
+    TreePatch,
+)
+
+
+@dataclass
+class TreeDiff:
+    # Ids of nodes only in the new tree, in its preorder
+    added: list[str] = field(default_factory=list)
+    # Ids of nodes only in the old tree, in its preorder
+    removed: list[str] = field(default_factory=list)
+    # Ids of nodes in both trees whose parents differ
+    moved: list[str] = field(default_factory=list)
+    # Ids of nodes whose children in both trees are in a different order
+    reordered: list[str] = field(default_factory=list)
+    # New is_stale flag of nodes in both trees whose flag differs
+    stale: dict[str, bool] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.added or self.removed or self.moved or self.reordered or self.stale
+        )
+
+
+class TreeShape:
+    """
+    The nodes of a tree by id, with each node's parents and children by id.
+
+    Shared nodes are listed once, with all their parents.
+    """
+
+    def __init__(self, root: MbirdNode):
+        self.root_id = root.id
+        # In preorder (each shared node where it's first reached)
+        self.nodes: dict[str, MbirdNode] = {}
+        self.children: dict[str, list[str]] = {}
+        self.parents: dict[str, list[str]] = {root.id: []}
+
+        nodes = self.nodes
+        children = self.children
+        parents = self.parents
+        stack = [root]
+        with paused_gc():
+            while stack:
+                node = stack.pop()
+                node_id = node.id
+                if node_id in nodes:
+                    continue
+                nodes[node_id] = node
+                child_ids = [child.id for child in node.children]
+                children[node_id] = child_ids
+                for child_id in child_ids:
+                    if child_id in parents:
+                        parents[child_id].append(node_id)
+                    else:
+                        parents[child_id] = [node_id]
+                stack.extend(reversed(node.children))
+
+    def __contains__(self, node_id: object) -> bool:
+        return node_id in self.nodes
+
+
+def order_changed(old_ids: list[str], new_ids: list[str]) -> bool:
+    """Whether the ids in both lists are in a different order in each."""
+    if old_ids == new_ids:
+        return False
+    old_set = set(old_ids)
+    new_set = set(new_ids)
+    return [i for i in old_ids if i in new_set] != [i for i in new_ids if i in old_set]
+
+
+def diff_trees(old: MbirdNode, new: MbirdNode) -> TreeDiff:
+    """Compare two trees (or two versions of a tree), matching nodes by id."""
+    return diff_shapes(TreeShape(old), TreeShape(new))
+
+
+def diff_shapes(old: TreeShape, new: TreeShape) -> TreeDiff:
+    """Compare two trees' shapes (see diff_trees())."""
+    diff = TreeDiff(
+        added=[node_id for node_id in new.nodes if node_id not in old],
+        removed=[node_id for node_id in old.nodes if node_id not in new],
+    )
+    for node_id, node in new.nodes.items():
+        old_node = old.nodes.get(node_id)
+        if old_node is None:
+            continue
+        if node.is_stale != old_node.is_stale:
+            diff.stale[node_id] = node.is_stale
+        old_parents = old.parents[node_id]
+        new_parents = new.parents[node_id]
+        if old_parents != new_parents and set(old_parents) != set(new_parents):
+            diff.moved.append(node_id)
+        if order_changed(old.children[node_id], new.children[node_id]):
+            diff.reordered.append(node_id)
+    return diff
+
+
+def tree_patch(old: MbirdNode, new: MbirdNode) -> TreePatch:
+    """
+    Find the patch that turns one tree into another (see apply_patch()).
+
+    Nodes that are only in the new tree are added, with their whole subtree at
+    once where it's all new. Nodes that became stale are marked stale, but no
+    node is marked fresh: only regenerating it does that. Other nodes may still
+    be marked stale by the patch's edits, as with any edit.
+
+    Raises:
+        ValueError: If the trees have different roots
+    """
+    return _ShapePatcher(TreeShape(old), TreeShape(new)).patch()
+
+
+class _ShapePatcher:
+    """
+    Builds the patch between two trees' shapes.
+
+    The patch first takes kept nodes away from parents they're no longer under,
+    moving those without any of their new parents under the root for now, then
+    removes the nodes that aren't kept. Every edge left is in the new tree, so
+    placing the nodes under their new parents (from the root down) can't make
+    a cycle.
+    """
+
+    def __init__(self, old: TreeShape, new: TreeShape):
+        if old.root_id != new.root_id:
+            raise ValueError(
+                f"Trees have different roots: {old.root_id} and {new.root_id}"
+            )
+        self.old = old
+        self.new = new
+        self.ops: list[PatchOp] = []
+        # (parent id, child id) of old edges the patch removed
+        self._gone: set[tuple[str, str]] = set()
+        # Kept nodes moved under the root until they're placed, in order
+        self._lifted: dict[str, None] = {}
+
+    def patch(self) -> TreePatch:
+        self._unlink()
+        self._remove()
+        self._place()
+        old_nodes = self.old.nodes
+        for node_id, node in self.new.nodes.items():
+            old_node = old_nodes.get(node_id)
+            if old_node is not None and node.is_stale and not old_node.is_stale:
+                self.ops.append(SetFlags(node_id=node_id, is_stale=True))
+        return TreePatch.model_construct(ops=self.ops)
+
+    def _unlink(self) -> None:
+        old, new = self.old, self.new
+        root_id = old.root_id
+        for node_id in old.nodes:
+            if node_id == root_id or node_id not in new:
+                continue
+            old_parents = old.parents[node_id]
+            new_parents = set(new.parents[node_id])
+            if old_parents == new.parents[node_id]:
+                continue
+            kept_parents = [p for p in old_parents if p in new]
+            if new_parents.intersection(old_parents):
+                carrier = None
+            else:
+                # Under the root until it's placed
+                carrier = root_id if root_id in old_parents else old_parents[0]
+                if carrier != root_id:
+                    self.ops.append(
+                        MoveSubtree(
+                            node_id=node_id, new_parent_id=root_id, parent_id=carrier
+                        )
+                    )
+                    self._gone.add((carrier, node_id))
+                self._lifted[node_id] = None
+            # Parents that are removed take their edges with them
+            for parent_id in kept_parents:
+                if parent_id != carrier and parent_id not in new_parents:
+                    self.ops.append(RemoveSubtree(node_id=node_id, parent_id=parent_id))
+                    self._gone.add((parent_id, node_id))
+
+    def _remove(self) -> None:
+        old, new = self.old, self.new
+        for node_id in old.nodes:
+            if node_id in new:
+                continue
+            for parent_id in old.parents[node_id]:
+                if parent_id in new:
+                    self.ops.append(RemoveSubtree(node_id=node_id, parent_id=parent_id))
+
+    def _place(self) -> None:
+        old, new = self.old, self.new
+        root_id = old.root_id
+        whole = self._new_subtrees()
+        # Nodes added along with an ancestor
+        added_with: set[str] = set()
+        added: set[str] = set()
+        for parent_id, child_ids in new.children.items():
+            if parent_id in added_with:
+                continue
+            current = self._current_children(parent_id)
+            if parent_id == root_id:
+                # Lifted nodes that belong under the root are placed with it
+                for child_id in child_ids:
+                    self._lifted.pop(child_id, None)
+            if current == child_ids:
+                continue
+            in_current = set(current)
+            for position, child_id in enumerate(child_ids):
+                if position < len(current) and current[position] == child_id:
+                    continue
+                if child_id in in_current:
+                    current.pop(current.index(child_id, position))
+                    op: PatchOp = MoveSubtree(
+                        node_id=child_id,
+                        new_parent_id=parent_id,
+                        position=position,
+                        parent_id=parent_id,
+                    )
+                elif child_id in self._lifted:
+                    del self._lifted[child_id]
+                    op = MoveSubtree(
+                        node_id=child_id,
+                        new_parent_id=parent_id,
+                        position=position,
+                        parent_id=root_id,
+                    )
+                elif child_id in old or child_id in added:
+                    op = LinkNode(
+                        parent_id=parent_id, node_id=child_id, position=position
+                    )
+                elif child_id in whole:
+                    op = AddChild(
+                        parent_id=parent_id,
+                        node=self._subtree_dict(child_id),
+                        position=position,
+                    )
+                    added_with.add(child_id)
+                    added_with.update(self._descendants(child_id))
+                else:
+                    node = new.nodes[child_id]
+                    op = AddChild(
+                        parent_id=parent_id,
+                        node={"id": child_id, "is_stale": node.is_stale},
+                        position=position,
+                    )
+                    added.add(child_id)
+                self.ops.append(op)
+                current.insert(position, child_id)
+                in_current.add(child_id)
+
+    def _current_children(self, parent_id: str) -> list[str]:
+        """A parent's children as the patch leaves them before it's placed."""
+        if parent_id not in self.old:
+            return []
+        gone = self._gone
+        children = [
+            child_id
+            for child_id in self.old.children[parent_id]
+            if (parent_id, child_id) not in gone and child_id in self.new
+        ]
+        if parent_id == self.old.root_id:
+            in_children = set(children)
+            children += [i for i in self._lifted if i not in in_children]
+        return children
+
+    def _new_subtrees(self) -> set[str]:
+        """Ids of new nodes whose subtrees are all new and unshared."""
+        old, new = self.old, self.new
+        whole: set[str] = set()
+        # Children come first
+        for node_id in reversed(new.nodes):
+            if (
+                node_id not in old
+                and len(new.parents[node_id]) == 1
+                and all(child_id in whole for child_id in new.children[node_id])
+            ):
+                whole.add(node_id)
+        return whole
+
+    def _subtree_dict(self, node_id: str) -> dict[str, Any]:
+        """A new subtree as a dict, built without recursing (unlike model_dump())."""
+        new = self.new
+        data: dict[str, Any] = {"id": node_id, "is_stale": new.nodes[node_id].is_stale}
+        stack = [(node_id, data)]
+        while stack:
+            parent_id, parent = stack.pop()
+            parent["children"] = []
+            for child_id in new.children[parent_id]:
+                child = {"id": child_id, "is_stale": new.nodes[child_id].is_stale}
+                parent["children"].append(child)
+                stack.append((child_id, child))
+        return data
+
+    def _descendants(self, node_id: str) -> list[str]:
+        children = self.new.children
+        descendants = []
+        stack = list(children[node_id])
+        while stack:
+            child_id = stack.pop()
+            descendants.append(child_id)
+            stack.extend(children[child_id])
+        return descendants
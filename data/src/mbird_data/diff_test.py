@@ -0,0 +1,173 @@
+from contextlib import suppress
+import random
+from typing import Any
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.diff import TreeShape, diff_trees, tree_patch
+from mbird_data.index import TreeIndex
+from mbird_data.patch import TreePatch, apply_patch
+from mbird_data.staleness import StalenessEngine
+
+TREE = {
+    "id": "root",
+    "is_stale": False,
+    "children": [
+        {
+            "id": "a",
+            "is_stale": False,
+            "children": [
+                {"id": "a1", "is_stale": False},
+                {"id": "a2", "is_stale": False},
+            ],
+        },
+        {"id": "b", "is_stale": False, "children": [{"id": "b1", "is_stale": False}]},
+        {"id": "c", "is_stale": False, "children": [{"ref": "a1"}]},
+    ],
+}
+
+
+def tree(**changes: Any) -> MbirdNode:
+    """The test tree, with some nodes' children replaced."""
+
+    def build(data: dict[str, Any]) -> dict[str, Any]:
+        if "ref" in data:
+            return data
+        children = changes.get(data["id"], data.get("children", []))
+        return {**data, "children": [build(child) for child in children]}
+
+    return MbirdNode.from_dict(build(TREE))
+
+
+def apply_between(old: MbirdNode, new: MbirdNode) -> MbirdNode:
+    patch = tree_patch(old, new)
+    engine = StalenessEngine(TreeIndex(old))
+    apply_patch(engine, patch)
+    return engine.index.root
+
+
+def assert_same_shape(result: MbirdNode, expected: MbirdNode) -> None:
+    result_shape = TreeShape(result)
+    expected_shape = TreeShape(expected)
+    assert result_shape.children == expected_shape.children
+    for node_id, node in expected_shape.nodes.items():
+        # Edits mark nodes stale, and nothing is marked fresh
+        assert result_shape.nodes[node_id].is_stale or not node.is_stale
+
+
+def test_diff_reports_each_kind_of_change():
+    old = tree()
+    new = tree(
+        root=[
+            {"id": "b", "is_stale": True, "children": [{"id": "a2"}, {"id": "n"}]},
+            {"id": "a", "is_stale": False, "children": [{"id": "a1"}]},
+            {"id": "c", "is_stale": False},
+        ]
+    )
+
+    diff = diff_trees(old, new)
+
+    assert diff.added == ["n"]
+    assert diff.removed == ["b1"]
+    # a1 is no longer shared
+    assert diff.moved == ["a2", "a1"]
+    assert diff.reordered == ["root"]
+    # Nodes are stale unless they say otherwise
+    assert diff.stale == {"b": True, "a2": True, "a1": True}
+
+
+def test_diff_of_the_same_tree_is_empty():
+    assert not diff_trees(tree(), tree())
+
+
+def test_patch_adds_new_subtrees_at_once():
+    old = tree()
+    new = tree(
+        b=[{"id": "b1", "is_stale": False}, {"id": "n", "children": [{"id": "n1"}]}]
+    )
+
+    patch = tree_patch(old, new)
+
+    assert [op.op for op in patch.ops] == ["add"]
+    assert_same_shape(apply_between(old, new), new)
+
+
+def test_patch_adds_deep_new_subtrees():
+    chain = MbirdNode(id="n1999")
+    for i in range(1998, -1, -1):
+        chain = MbirdNode(id=f"n{i}", children=[chain])
+    old = tree()
+    new = tree(c=[])
+    new.children[2].children = [chain]
+
+    patch = tree_patch(old, new)
+
+    assert [op.op for op in patch.ops] == ["remove", "add"]
+    assert len(TreeShape(apply_between(old, new)).nodes) == 2007
+
+
+def test_patch_does_not_mark_nodes_fresh():
+    old = tree(b=[{"id": "b1", "is_stale": True}])
+    new = tree()
+
+    assert tree_patch(old, new).ops == []
+
+
+def test_patch_requires_the_same_root():
+    with pytest.raises(ValueError, match="different roots"):
+        tree_patch(tree(), MbirdNode(id="other"))
+
+
+@pytest.mark.parametrize(
+    "children",
+    [
+        # Reordered
+        {"root": ["c", "a", "b"]},
+        # Moved into a node that was its sibling
+        {"root": ["b", "c"], "b": ["b1", "a"]},
+        # Swapped with its parent
+        {"root": ["a1", "b", "c"], "a1": ["a"], "a": ["a2"], "c": []},
+        # Kept while its parent is removed
+        {"root": ["b", "c"], "c": ["a2"]},
+        # Shared
+        {"b": ["b1", "a"], "c": ["a2", "b1"]},
+    ],
+)
+def test_patch_turns_one_tree_into_the_other(children: dict[str, list[str]]):
+    new = tree()
+    nodes = TreeShape(new).nodes
+    for node_id, child_ids in children.items():
+        nodes[node_id].children = [nodes[child_id] for child_id in child_ids]
+
+    assert_same_shape(apply_between(tree(), new), new)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_patch_between_randomly_edited_trees(seed: int):
+    rng = random.Random(seed)
+    engine = StalenessEngine(TreeIndex(tree()))
+    for count in range(30):
+        ids = list(TreeShape(engine.index.root).nodes)
+        node_id = rng.choice(ids)
+        parent_id = rng.choice(ids)
+        position = rng.randint(0, 3)
+        op = rng.choice(
+            [
+                {"op": "add", "parent_id": parent_id, "node": {"id": f"n{count}"}},
+                {"op": "link", "parent_id": parent_id, "node_id": node_id},
+                {"op": "remove", "node_id": node_id, "parent_id": parent_id},
+                {
+                    "op": "move",
+                    "node_id": node_id,
+                    "new_parent_id": parent_id,
+                    "position": position,
+                },
+                {"op": "set_flags", "node_id": node_id, "is_stale": True},
+            ]
+        )
+        with suppress(KeyError, ValueError):
+            apply_patch(engine, TreePatch.model_validate({"ops": [op]}))
+    new = engine.index.root
+
+    assert_same_shape(apply_between(tree(), new), new)
@@ -0,0 +1,55 @@
+from collections.abc import Iterable
+import hashlib
+
+from mbird_data.models import MbirdNode
+
+# A subtree's digest covers its root's id and flags and, in order, the digests
+# of its children, so two subtrees have the same digest exactly when they have
+# the same content. Changing a node only changes the digests on its path to the
+# root.
+
+DIGEST_SIZE = 16
+
+
+def node_digest(node_id: str, is_stale: bool, child_digests: Iterable[bytes]) -> bytes:
+    """Digest of a node, given the digests of its children."""
+    encoded_id = node_id.encode()
+    # Length-prefixed, so an id can't run into the fixed-size fields after it
+    content = b"".join(
+        [
+            len(encoded_id).to_bytes(8, "little"),
+            encoded_id,
+            b"\x01" if is_stale else b"\x00",
+            *child_digests,
+        ]
+    )
+    return hashlib.blake2b(content, digest_size=DIGEST_SIZE).digest()
+
+
+def subtree_digest(node: MbirdNode, cache: dict[str, bytes] | None = None) -> bytes:
+    """
+    Digest of a subtree, computed children first.
+
+    Args:
+        node: Root of the subtree
+        cache: Digests of subtrees already known by node id. Digests computed
+            here are added to it, and cached subtrees aren't visited again.
+    """
+    digests = {} if cache is None else cache
+    stack = [node]
+    while stack:
+        current = stack[-1]
+        if current.id in digests:
+            stack.pop()
+            continue
+        missing = [child for child in current.children if child.id not in digests]
+        if missing:
+            stack.extend(missing)
+            continue
+        digests[current.id] = node_digest(
+            current.id,
+            current.is_stale,
+            [digests[child.id] for child in current.children],
+        )
+        stack.pop()
+    return digests[node.id]
@@ -0,0 +1,40 @@
+from typing import Any
+
+from mbird_data import MbirdNode
+from mbird_data.hashing import DIGEST_SIZE, node_digest, subtree_digest
+
+
+def make_tree(**changes: Any) -> MbirdNode:
+    tree: dict[str, Any] = {
+        "id": "root",
+        "children": [{"id": "a", "children": [{"id": "a1"}]}, {"id": "b"}],
+    }
+    tree.update(changes)
+    return MbirdNode.from_dict(tree)
+
+
+def test_equal_trees_have_equal_digests():
+    digest = subtree_digest(make_tree())
+
+    assert len(digest) == DIGEST_SIZE
+    assert subtree_digest(make_tree()) == digest
+
+
+def test_digest_covers_ids_flags_and_child_order():
+    digest = subtree_digest(make_tree())
+
+    assert subtree_digest(make_tree(id="other")) != digest
+    assert subtree_digest(make_tree(is_stale=False)) != digest
+    reordered = make_tree(
+        children=[{"id": "b"}, {"id": "a", "children": [{"id": "a1"}]}]
+    )
+    assert subtree_digest(reordered) != digest
+
+
+def test_digest_is_built_from_child_digests():
+    tree = make_tree()
+    cache: dict[str, bytes] = {}
+    digest = subtree_digest(tree, cache)
+
+    assert set(cache) == {"root", "a", "a1", "b"}
+    assert digest == node_digest("root", True, [cache["a"], cache["b"]])
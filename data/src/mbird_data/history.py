@@ -0,0 +1,151 @@
+from collections import deque
+from dataclasses import dataclass
+
+from mbird_data.models import MbirdNode
+from mbird_data.patch import AddChild, PatchDiff, PatchOp, TreePatch, apply_patch
+from mbird_data.staleness import StalenessEngine
+
+# Nodes that undo and redo steps may hold on to, by default. Each operation
+# counts as one node, plus the nodes of any subtree it adds back.
+HISTORY_MAX_NODES = 100_000
+
+
+@dataclass
+class _Step:
+    # Reverts (for undo) or reapplies (for redo) an applied patch
+    patch: TreePatch
+    cost: int
+
+
+class History:
+    """
+    Undo and redo of the patches applied to a tree.
+
+    Each applied patch is kept as the patch that reverts it, so undoing or
+    redoing a patch costs as much as applying it, rather than as much as the
+    tree. Removed subtrees are held on to as copies, so they can be put back
+    however the tree changes after. The oldest steps are dropped once the steps
+    hold more than max_nodes nodes.
+    """
+
+    def __init__(self, max_nodes: int = HISTORY_MAX_NODES):
+        self.max_nodes = max_nodes
+        # Nodes held by the steps
+        self.size = 0
+        self._undo: deque[_Step] = deque()
+        self._redo: deque[_Step] = deque()
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+    def clear(self) -> None:
+        self._undo.clear()
+        self._redo.clear()
+        self.size = 0
+
+    def apply(self, engine: StalenessEngine, patch: TreePatch) -> PatchDiff:
+        """
+        Apply a patch (see apply_patch()) so that it can be undone.
+
+        Anything that was undone can no longer be redone.
+
+        Raises:
+            KeyError: If an operation refers to a node that doesn't exist
+            ValueError: If an operation would make the tree invalid
+        """
+        inverse: list[PatchOp] = []
+        diff = apply_patch(engine, patch, inverse)
+        for step in self._redo:
+            self.size -= step.cost
+        self._redo.clear()
+        self._push(self._undo, TreePatch.model_construct(ops=inverse))
+        return diff
+
+    def undo(self, engine: StalenessEngine) -> tuple[TreePatch, PatchDiff]:
+        """
+        Revert the last applied (or redone) patch.
+
+        Returns:
+            The patch that was applied to revert it, and what it changed
+
+        Raises:
+            ValueError: If there's nothing to undo, or the patch no longer
+                applies (the step is kept)
+            KeyError: If the patch refers to a node that no longer exists
+        """
+        if not self._undo:
+            raise ValueError("Nothing to undo")
+        return self._step(engine, self._undo, self._redo)
+
+    def redo(self, engine: StalenessEngine) -> tuple[TreePatch, PatchDiff]:
+        """
+        Reapply the last undone patch.
+
+        Returns:
+            The patch that was applied, and what it changed
+
+        Raises:
+            ValueError: If there's nothing to redo, or the patch no longer
+                applies (the step is kept)
+            KeyError: If the patch refers to a node that no longer exists
+        """
+        if not self._redo:
+            raise ValueError("Nothing to redo")
+        return self._step(engine, self._redo, self._undo)
+
+    def revert(self, engine: StalenessEngine) -> PatchDiff:
+        """
+        Revert the last applied patch and forget it, e.g. when it can't be kept.
+
+        Unlike undo(), it can't be redone.
+
+        Raises:
+            ValueError: If there's nothing to revert
+        """
+        if not self._undo:
+            raise ValueError("Nothing to revert")
+        step = self._undo.pop()
+        self.size -= step.cost
+        return apply_patch(engine, step.patch)
+
+    def _step(
+        self, engine: StalenessEngine, source: deque[_Step], target: deque[_Step]
+    ) -> tuple[TreePatch, PatchDiff]:
+        step = source[-1]
+        inverse: list[PatchOp] = []
+        diff = apply_patch(engine, step.patch, inverse)
+        source.pop()
+        self.size -= step.cost
+        self._push(target, TreePatch.model_construct(ops=inverse))
+        return step.patch, diff
+
+    def _push(self, steps: deque[_Step], patch: TreePatch) -> None:
+        cost = len(patch.ops)
+        for op in patch.ops:
+            if isinstance(op, AddChild) and isinstance(op.node, MbirdNode):
+                cost += _count_nodes(op.node)
+        steps.append(_Step(patch, cost))
+        self.size += cost
+
+        # Steps furthest from the current version go first: the oldest undo
+        # steps, then the last redo steps
+        for oldest in (self._undo, self._redo):
+            while self.size > self.max_nodes and oldest:
+                self.size -= oldest.popleft().cost
+
+
+def _count_nodes(root: MbirdNode) -> int:
+    # Shared nodes are only held once
+    seen: set[str] = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node.id not in seen:
+            seen.add(node.id)
+            stack.extend(node.children)
+    return len(seen)
@@ -0,0 +1,213 @@
+from typing import Any
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.hashing import subtree_digest
+from mbird_data.history import History
+from mbird_data.index import TreeIndex
+from mbird_data.patch import TreePatch, apply_patch, decode_patch, encode_patch
+from mbird_data.staleness import Propagation, StalenessEngine
+
+
+def make_engine(propagation: Propagation = Propagation.UP) -> StalenessEngine:
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "is_stale": False,
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": False,
+                    "children": [
+                        {"id": "a1", "is_stale": False},
+                        {"id": "a2", "is_stale": False},
+                    ],
+                },
+                {"id": "b", "is_stale": False, "children": [{"id": "b1"}]},
+                {"id": "c", "is_stale": False},
+            ],
+        }
+    )
+    return StalenessEngine(TreeIndex(root), propagation)
+
+
+def patch(*ops: dict[str, Any]) -> TreePatch:
+    return TreePatch.model_validate({"ops": list(ops)})
+
+
+EDITS = [
+    patch({"op": "add", "parent_id": "a1", "node": {"id": "new"}}),
+    patch({"op": "remove", "node_id": "a"}),
+    patch({"op": "move", "node_id": "a2", "new_parent_id": "c", "position": 0}),
+    patch({"op": "move", "node_id": "c", "new_parent_id": "a1"}),
+    patch({"op": "rename", "node_id": "a1", "new_id": "renamed"}),
+    patch({"op": "set_flags", "node_id": "a2", "is_stale": True}),
+    patch({"op": "set_flags", "node_id": "b1", "is_stale": False}),
+    patch(
+        {"op": "add", "parent_id": "root", "node": {"id": "x", "is_stale": False}},
+        {"op": "move", "node_id": "a", "new_parent_id": "x"},
+        {"op": "remove", "node_id": "c"},
+    ),
+    patch({"op": "link", "parent_id": "c", "node_id": "a"}),
+    patch(
+        {"op": "link", "parent_id": "a", "node_id": "b1", "position": 0},
+        {"op": "remove", "node_id": "b1", "parent_id": "b"},
+        {"op": "remove", "node_id": "a"},
+    ),
+    patch(
+        {"op": "link", "parent_id": "c", "node_id": "a2"},
+        {"op": "move", "node_id": "a2", "new_parent_id": "b", "parent_id": "a"},
+        {"op": "rename", "node_id": "a2", "new_id": "renamed"},
+    ),
+    # Removing a subtree whose nodes are shared, with the rest of the tree and
+    # within the subtree
+    patch(
+        {"op": "link", "parent_id": "b", "node_id": "a2"},
+        {"op": "remove", "node_id": "a"},
+    ),
+    patch(
+        {"op": "link", "parent_id": "a1", "node_id": "a2"},
+        {"op": "remove", "node_id": "a"},
+    ),
+]
+
+
+@pytest.mark.parametrize("propagation", list(Propagation))
+@pytest.mark.parametrize("edit", EDITS)
+def test_undo_and_redo_restore_the_tree_and_flags(
+    edit: TreePatch, propagation: Propagation
+):
+    engine = make_engine(propagation)
+    history = History()
+    before = subtree_digest(engine.index.root)
+    stale_before = engine.stale_ids
+
+    history.apply(engine, edit)
+    after = subtree_digest(engine.index.root)
+    stale_after = engine.stale_ids
+
+    history.undo(engine)
+    assert subtree_digest(engine.index.root) == before
+    assert engine.stale_ids == stale_before
+    assert engine.index.digest("root") == before
+
+    history.redo(engine)
+    assert subtree_digest(engine.index.root) == after
+    assert engine.stale_ids == stale_after
+
+
+@pytest.mark.parametrize("propagation", list(Propagation))
+@pytest.mark.parametrize("edit", EDITS)
+def test_undo_and_redo_can_be_replayed_from_their_encoding(
+    edit: TreePatch, propagation: Propagation
+):
+    engine = make_engine(propagation)
+    replica = make_engine(propagation)
+    history = History()
+
+    history.apply(engine, edit)
+    applied = [encode_patch(edit)]
+    for step in (history.undo, history.redo, history.undo):
+        applied.append(encode_patch(step(engine)[0]))
+    for encoded in applied:
+        apply_patch(replica, decode_patch(encoded))
+
+    assert subtree_digest(replica.index.root) == subtree_digest(engine.index.root)
+    assert replica.stale_ids == engine.stale_ids
+
+
+def test_undo_and_redo_several_steps():
+    engine = make_engine()
+    history = History()
+    edits = [
+        patch({"op": "add", "parent_id": "a1", "node": {"id": "new"}}),
+        patch({"op": "move", "node_id": "a2", "new_parent_id": "c", "position": 0}),
+        patch({"op": "rename", "node_id": "a1", "new_id": "renamed"}),
+        patch({"op": "set_flags", "node_id": "b1", "is_stale": False}),
+        patch({"op": "remove", "node_id": "a"}),
+    ]
+    digests = [subtree_digest(engine.index.root)]
+    for edit in edits:
+        history.apply(engine, edit)
+        digests.append(subtree_digest(engine.index.root))
+
+    for expected in reversed(digests[:-1]):
+        history.undo(engine)
+        assert subtree_digest(engine.index.root) == expected
+    assert not history.can_undo
+
+    for expected in digests[1:]:
+        history.redo(engine)
+        assert subtree_digest(engine.index.root) == expected
+    assert not history.can_redo
+
+
+def test_new_edit_clears_redo():
+    engine = make_engine()
+    history = History()
+    history.apply(engine, EDITS[0])
+    history.undo(engine)
+    assert history.can_redo
+
+    history.apply(engine, EDITS[1])
+
+    assert not history.can_redo
+    # The ops to put back the removed subtree, plus its 3 nodes
+    assert history.size == len(history._undo[0].patch.ops) + 3
+
+
+def test_nothing_to_undo_or_redo_raises_error():
+    engine = make_engine()
+    history = History()
+
+    with pytest.raises(ValueError, match="Nothing to undo"):
+        history.undo(engine)
+    with pytest.raises(ValueError, match="Nothing to redo"):
+        history.redo(engine)
+
+
+def test_revert_forgets_the_last_patch():
+    engine = make_engine()
+    history = History()
+    before = subtree_digest(engine.index.root)
+    history.apply(engine, EDITS[1])
+
+    history.revert(engine)
+
+    assert subtree_digest(engine.index.root) == before
+    assert not history.can_undo
+    assert not history.can_redo
+    assert history.size == 0
+    with pytest.raises(ValueError, match="Nothing to revert"):
+        history.revert(engine)
+
+
+def test_step_that_no_longer_applies_is_kept():
+    engine = make_engine()
+    history = History()
+    history.apply(engine, patch({"op": "add", "parent_id": "c", "node": {"id": "n"}}))
+    # Not recorded, as if the tree were replaced
+    engine.index.detach("n")
+
+    with pytest.raises(KeyError):
+        history.undo(engine)
+    assert history.can_undo
+
+
+def test_oldest_steps_are_dropped_over_budget():
+    engine = make_engine()
+    history = History(max_nodes=6)
+
+    history.apply(engine, patch({"op": "rename", "node_id": "a", "new_id": "a0"}))
+    history.apply(engine, patch({"op": "rename", "node_id": "b", "new_id": "b0"}))
+    # Undoing it takes 2 ops (adding back and restoring a flag) and 3 nodes
+    history.apply(engine, patch({"op": "remove", "node_id": "a0"}))
+
+    assert history.size == 6
+    history.undo(engine)
+    history.undo(engine)
+    with pytest.raises(ValueError, match="Nothing to undo"):
+        history.undo(engine)
+    assert "a0" in engine.index
+    assert "b" in engine.index
@@ -0,0 +1,621 @@
+from collections import deque
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+import threading
+
+from mbird_data.hashing import subtree_digest
+from mbird_data.models import MbirdNode, construct_node
+
+
+@dataclass(frozen=True)
+class TreeSnapshot:
+    """
+    A version of a tree (or of one of its subtrees) that doesn't change.
+
+    Its nodes are shared with the tree, and with other snapshots, wherever they
+    haven't changed between versions, so they must not be modified.
+    """
+
+    version: int
+    root: MbirdNode
+
+
+class TreeIndex:
+    """
+    Id-keyed lookup of the nodes in a tree and their parents.
+
+    Edits go through attach(), link(), detach(), move(), rename() and
+    set_stale(), which keep lookups O(1) without re-walking the whole tree. The
+    tree is edited in place until the first snapshot(), and copy on write from
+    then on: the first edit to a node after a snapshot copies it and its
+    ancestors (so `root` changes), and only the copies are changed in place
+    until the next snapshot. Readers of a snapshot therefore see a consistent
+    tree while edits continue, e.g. from a regeneration thread.
+
+    An id names a single node, but a node can have several parents: a shared
+    node is the same object under each of them, and is indexed (and digested)
+    once. Edits to one occurrence of a shared node name the parent it's under.
+
+    add_subtree(), remove_subtree() and invalidate() only record changes the
+    caller made to the nodes itself, which is only safe while no snapshot
+    shares them.
+
+    Subtree digests are cached once computed. Changes drop the cached digests of
+    the changed node's ancestors.
+    """
+
+    def __init__(self, root: MbirdNode):
+        self.root = root
+        # Bumped by the first change after a snapshot of the current version
+        self.version = 0
+        self._nodes: dict[str, MbirdNode] = {}
+        # First parent of each node, and the other parents of shared nodes
+        self._parents: dict[str, str | None] = {}
+        self._other_parents: dict[str, list[str]] = {}
+        # Whenever a node's digest isn't cached, neither are its ancestors'
+        self._digests: dict[str, bytes] = {}
+        # Whether any snapshot shares the nodes, and if so, ids of the nodes
+        # copied since the last snapshot (which can be changed in place). The
+        # ancestors of a copied node are always copied too.
+        self._shared = False
+        self._owned: set[str] = set()
+        # Whether the current version was handed out by snapshot()
+        self._frozen = False
+        # Position of each child among its parent's children, by parent id, for
+        # the parents whose children were looked up since they last changed
+        self._positions: dict[str, dict[str, int]] = {}
+        # Held while the tree is changed, snapshot or digested, since changes
+        # can come from a regeneration thread
+        self._lock = threading.RLock()
+        self.add_subtree(root, None)
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, node_id: object) -> bool:
+        return node_id in self._nodes
+
+    def __iter__(self) -> Iterator[MbirdNode]:
+        return iter(self._nodes.values())
+
+    @property
+    def num_shared(self) -> int:
+        """Number of nodes with more than one parent."""
+        return len(self._other_parents)
+
+    def get(self, node_id: str) -> MbirdNode:
+        """Get a node by id, raising KeyError if it isn't in the tree."""
+        try:
+            return self._nodes[node_id]
+        except KeyError:
+            raise KeyError(f"Node not found: {node_id}") from None
+
+    def parent_id(self, node_id: str) -> str | None:
+        """Get the id of a node's (first) parent, or None for the root."""
+        self.get(node_id)
+        return self._parents[node_id]
+
+    def parent_ids(self, node_id: str) -> list[str]:
+        """Get the ids of a node's parents, first parent first (none for the root)."""
+        self.get(node_id)
+        return self._parent_list(node_id)
+
+    def ancestor_ids(self, node_id: str) -> Iterator[str]:
+        """Yield the ids of a node's ancestors once each, nearest first."""
+        if not self._other_parents:
+            parent_id = self.parent_id(node_id)
+            while parent_id is not None:
+                yield parent_id
+                parent_id = self._parents[parent_id]
+            return
+
+        seen: set[str] = set()
+        queue = deque(self.parent_ids(node_id))
+        while queue:
+            parent_id = queue.popleft()
+            if parent_id in seen:
+                continue
+            seen.add(parent_id)
+            yield parent_id
+            queue.extend(self._parent_list(parent_id))
+
+    def depth(self, node_id: str) -> int:
+        """Number of edges on the longest path between a node and the root."""
+        return self.depths([node_id])[node_id]
+
+    def depths(self, node_ids: Iterable[str]) -> dict[str, int]:
+        """
+        Get the depth (see depth()) of several nodes at once.
+
+        Each ancestor is only visited once, however many of the nodes share it.
+        A node is always deeper than each of its parents.
+
+        Returns:
+            Depths by node id, including those of the nodes' ancestors
+
+        Raises:
+            KeyError: If a node isn't in the tree
+        """
+        depths: dict[str, int] = {}
+        for node_id in node_ids:
+            self.get(node_id)
+            stack = [node_id]
+            while stack:
+                current = stack[-1]
+                if current in depths:
+                    stack.pop()
+                    continue
+                parent_ids = self._parent_list(current)
+                missing = [p for p in parent_ids if p not in depths]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                depths[current] = 1 + max((depths[p] for p in parent_ids), default=-1)
+                stack.pop()
+        return depths
+
+    def iter_subtree(self, node_id: str) -> Iterator[MbirdNode]:
+        """Yield a node and all its descendants in preorder, each once."""
+        stack = [self.get(node_id)]
+        seen: set[str] | None = set() if self._other_parents else None
+        while stack:
+            node = stack.pop()
+            if seen is not None:
+                if node.id in seen:
+                    continue
+                seen.add(node.id)
+            yield node
+            stack.extend(reversed(node.children))
+
+    def position(self, node_id: str, parent_id: str | None = None) -> int:
+        """
+        Get a node's position among its parent's children (0 for the root).
+
+        Args:
+            node_id: Id of the node
+            parent_id: Id of the parent, which is only needed for shared nodes
+
+        Raises:
+            KeyError: If the node isn't in the tree
+            ValueError: If parent_id isn't a parent of the node, or isn't given
+                for a shared node
+        """
+        with self._lock:
+            parent_id = self._check_parent(node_id, parent_id)
+            if parent_id is None:
+                return 0
+            return self._position(node_id, parent_id)
+
+    def digest(self, node_id: str) -> bytes:
+        """
+        Get the digest of a node's subtree (see mbird_data.hashing).
+
+        Only subtrees that changed since their digest was last computed are
+        visited again.
+        """
+        node = self.get(node_id)
+        with self._lock:
+            return subtree_digest(node, self._digests)
+
+    def snapshot(self, node_id: str | None = None) -> TreeSnapshot:
+        """
+        Freeze the current version of the tree, so that later edits copy it.
+
+        Args:
+            node_id: Id of the snapshot's root (the tree's root if None)
+
+        Raises:
+            KeyError: If there's no node with the given id
+        """
+        with self._lock:
+            node = self.root if node_id is None else self.get(node_id)
+            self._frozen = True
+            self._shared = True
+            self._owned.clear()
+            return TreeSnapshot(self.version, node)
+
+    def snapshot_digest(self, snapshot: TreeSnapshot) -> bytes | None:
+        """
+        Get the digest of a snapshot's root, if the tree hasn't changed since.
+
+        Returns:
+            The digest, or None if the tree changed since the snapshot was
+            taken (subtree_digest() of the snapshot's root computes it from
+            scratch instead)
+        """
+        with self._lock:
+            if self.version != snapshot.version:
+                return None
+            return self.digest(snapshot.root.id)
+
+    def attach(self, node: MbirdNode, parent_id: str, position: int | None) -> int:
+        """
+        Insert a subtree among a node's children, and index it.
+
+        Args:
+            node: Root of the subtree. Nodes in it that are already in the tree
+                (e.g. when putting back a removed subtree that shared them) must
+                be the same objects, and are shared.
+            parent_id: Id of the new parent
+            position: Position among the parent's children (appended if None)
+
+        Returns:
+            The position the subtree ended up at
+
+        Raises:
+            KeyError: If there's no node with id parent_id
+            ValueError: If any id in the subtree is already in the tree as a
+                different node
+        """
+        with self._lock:
+            self.get(parent_id)
+            self.add_subtree(node, parent_id)
+            parent = self._writable(parent_id)
+            position = _insert(parent, node, position)
+            self._positions.pop(parent_id, None)
+            return position
+
+    def link(self, node_id: str, parent_id: str, position: int | None) -> int:
+        """
+        Insert a node that's in the tree among another node's children too.
+
+        The node (with its subtree) is then shared by its parents.
+
+        Returns:
+            The position the node ended up at among parent_id's children
+
+        Raises:
+            KeyError: If either node isn't in the tree
+            ValueError: If the node is already a child of parent_id, or is
+                parent_id or one of its ancestors
+        """
+        with self._lock:
+            node = self.get(node_id)
+            self.get(parent_id)
+            if node_id == parent_id or node_id in self.ancestor_ids(parent_id):
+                raise ValueError(f"Cycle detected in tree involving node: {node_id}")
+            if parent_id in self._parent_list(node_id):
+                raise ValueError(f"Node {node_id} is already a child of {parent_id}")
+            self._other_parents.setdefault(node_id, []).append(parent_id)
+            self.invalidate(parent_id)
+            position = _insert(self._writable(parent_id), node, position)
+            self._positions.pop(parent_id, None)
+            return position
+
+    def detach(self, node_id: str, parent_id: str | None = None) -> list[str]:
+        """
+        Remove a subtree from its parent's children, and drop it from the index.
+
+        Nodes in the subtree that have another parent stay in the tree.
+
+        Args:
+            node_id: Id of the subtree's root
+            parent_id: Parent to remove it from, only needed for shared nodes
+
+        Returns:
+            Ids of the removed nodes, in preorder
+
+        Raises:
+            ValueError: If the node is the root, parent_id isn't a parent of the
+                node, or isn't given for a shared node
+        """
+        with self._lock:
+            parent_id = self._check_parent(node_id, parent_id)
+            if parent_id is None:
+                raise ValueError("Cannot detach the root node")
+            position = self._position(node_id, parent_id)
+            del self._writable(parent_id).children[position]
+            return self.remove_subtree(node_id, parent_id)
+
+    def move(
+        self,
+        node_id: str,
+        parent_id: str,
+        position: int | None,
+        old_parent_id: str | None = None,
+    ) -> int:
+        """
+        Move a subtree under a different parent (or within the same one).
+
+        The caller must make sure parent_id isn't in the moved subtree.
+
+        Args:
+            node_id: Id of the subtree's root
+            parent_id: Id of the new parent
+            position: Position among the new parent's children (appended if
+                None)
+            old_parent_id: Parent to move it from, only needed for shared nodes
+
+        Returns:
+            The position the subtree ended up at
+
+        Raises:
+            KeyError: If either node isn't in the tree
+            ValueError: If the node is the root, or old_parent_id isn't a parent
+                of the node (or isn't given for a shared node), or the node is
+                already a child of parent_id through another of its parents
+        """
+        with self._lock:
+            self.get(parent_id)
+            old_parent_id = self._check_parent(node_id, old_parent_id)
+            if old_parent_id is None:
+                raise ValueError("Cannot move the root node")
+            if parent_id != old_parent_id and parent_id in self._parent_list(node_id):
+                raise ValueError(f"Node {node_id} is already a child of {parent_id}")
+            node = self._nodes[node_id]
+            old_position = self._position(node_id, old_parent_id)
+            self.invalidate(old_parent_id)
+            del self._writable(old_parent_id).children[old_position]
+            self._positions.pop(old_parent_id, None)
+
+            self._replace_parent(node_id, old_parent_id, parent_id)
+            self.invalidate(parent_id)
+            position = _insert(self._writable(parent_id), node, position)
+            self._positions.pop(parent_id, None)
+            return position
+
+    def rename(self, old_id: str, new_id: str) -> None:
+        """
+        Change a node's id from old_id to new_id.
+
+        Raises:
+            KeyError: If there's no node with id old_id
+            ValueError: If new_id is already in the tree
+        """
+        with self._lock:
+            self.get(old_id)
+            if new_id in self._nodes:
+                raise ValueError(f"Duplicate node id: {new_id}")
+            self.invalidate(old_id)
+            node = self._writable(old_id)
+            parent_ids = self._parent_list(old_id)
+            node.id = new_id
+            del self._nodes[old_id]
+            self._nodes[new_id] = node
+            self._parents[new_id] = self._parents.pop(old_id)
+            if old_id in self._other_parents:
+                self._other_parents[new_id] = self._other_parents.pop(old_id)
+            for child in node.children:
+                self._replace_parent(child.id, old_id, new_id)
+            if self._shared:
+                self._owned.discard(old_id)
+                self._owned.add(new_id)
+            for parent_id in parent_ids:
+                self._positions.pop(parent_id, None)
+            positions = self._positions.pop(old_id, None)
+            if positions is not None:
+                self._positions[new_id] = positions
+
+    def set_stale(self, node_id: str, is_stale: bool) -> None:
+        """
+        Set a node's is_stale flag.
+
+        Raises:
+            KeyError: If the node isn't in the tree
+        """
+        with self._lock:
+            if self.get(node_id).is_stale == is_stale:
+                return
+            self.invalidate(node_id)
+            self._writable(node_id).is_stale = is_stale
+
+    def invalidate(self, node_id: str) -> None:
+        """Record that a node's id, flags or children changed."""
+        with self._lock:
+            if self._frozen:
+                self._frozen = False
+                self.version += 1
+            stack = [node_id]
+            while stack:
+                current = stack.pop()
+                if current in self._digests:
+                    del self._digests[current]
+                    stack.extend(self._parent_list(current))
+
+    def add_subtree(self, node: MbirdNode, parent_id: str | None) -> None:
+        """
+        Index a subtree that the caller attached under parent_id.
+
+        Nodes in the subtree that are already in the tree (as the same objects)
+        are shared with their other parents.
+
+        Raises:
+            ValueError: If any id in the subtree is already in the tree as a
+                different node, or sharing a node would make a cycle
+        """
+        with self._lock:
+            added: list[str] = []
+            # Nodes that were already in the tree, and their new parents
+            linked: list[tuple[str, str]] = []
+            stack: list[tuple[MbirdNode, str | None]] = [(node, parent_id)]
+            while stack:
+                current, current_parent = stack.pop()
+                existing = self._nodes.get(current.id)
+                if existing is None:
+                    self._nodes[current.id] = current
+                    self._parents[current.id] = current_parent
+                    added.append(current.id)
+                    # In preorder, so a node's first parent comes first
+                    stack.extend(
+                        (child, current.id) for child in reversed(current.children)
+                    )
+                    continue
+
+                error = None
+                if existing is not current or current_parent is None:
+                    error = f"Duplicate node id: {current.id}"
+                elif current_parent in self._parent_list(current.id):
+                    error = (
+                        f"Duplicate node id: {current.id} (twice under "
+                        f"{current_parent})"
+                    )
+                elif current.id in self.ancestor_ids(current_parent):
+                    error = f"Cycle detected in tree involving node: {current.id}"
+                if error is not None or current_parent is None:
+                    for node_id, linked_parent in linked:
+                        self._remove_parent(node_id, linked_parent)
+                    for node_id in added:
+                        del self._nodes[node_id]
+                        del self._parents[node_id]
+                    raise ValueError(error)
+                self._other_parents.setdefault(current.id, []).append(current_parent)
+                linked.append((current.id, current_parent))
+
+            if parent_id is not None:
+                self.invalidate(parent_id)
+                self._positions.pop(parent_id, None)
+
+    def remove_subtree(self, node_id: str, parent_id: str | None = None) -> list[str]:
+        """
+        Drop a subtree that the caller detached (from parent_id) from the index.
+
+        Nodes in the subtree that have another parent stay, with their own
+        subtrees.
+
+        Args:
+            node_id: Id of the subtree's root
+            parent_id: Parent it was detached from, only needed for shared nodes
+
+        Returns:
+            Ids of the removed nodes, in preorder
+        """
+        with self._lock:
+            parent_id = self._check_parent(node_id, parent_id)
+            if parent_id is not None:
+                self.invalidate(parent_id)
+                self._positions.pop(parent_id, None)
+                if self._remove_parent(node_id, parent_id):
+                    return []
+
+            removed = []
+            stack = [node_id]
+            while stack:
+                current = stack.pop()
+                removed.append(current)
+                for child in reversed(self._nodes[current].children):
+                    if not self._remove_parent(child.id, current):
+                        stack.append(child.id)
+            for removed_id in removed:
+                del self._nodes[removed_id]
+                del self._parents[removed_id]
+                self._digests.pop(removed_id, None)
+                self._owned.discard(removed_id)
+                self._positions.pop(removed_id, None)
+            return removed
+
+    def _parent_list(self, node_id: str) -> list[str]:
+        parent_id = self._parents[node_id]
+        if parent_id is None:
+            return []
+        other_parents = self._other_parents.get(node_id)
+        return [parent_id, *other_parents] if other_parents else [parent_id]
+
+    def _check_parent(self, node_id: str, parent_id: str | None) -> str | None:
+        """
+        Get the parent an occurrence of a node is under.
+
+        Returns:
+            parent_id, or the node's only parent if parent_id is None (None for
+            the root)
+
+        Raises:
+            KeyError: If the node isn't in the tree
+            ValueError: If parent_id isn't a parent of the node, or isn't given
+                for a shared node
+        """
+        first_parent_id = self.parent_id(node_id)
+        if parent_id is None:
+            if node_id in self._other_parents:
+                raise ValueError(
+                    f"Node {node_id} has several parents, so the parent must be given"
+                )
+            return first_parent_id
+        if parent_id != first_parent_id and parent_id not in self._other_parents.get(
+            node_id, ()
+        ):
+            raise ValueError(f"Node {node_id} is not a child of {parent_id}")
+        return parent_id
+
+    def _position(self, node_id: str, parent_id: str) -> int:
+        positions = self._positions.get(parent_id)
+        if positions is None:
+            children = self._nodes[parent_id].children
+            positions = {child.id: i for i, child in enumerate(children)}
+            self._positions[parent_id] = positions
+        return positions[node_id]
+
+    def _remove_parent(self, node_id: str, parent_id: str) -> bool:
+        """Forget one of a node's parents, returning whether it has others."""
+        other_parents = self._other_parents.get(node_id)
+        if not other_parents:
+            return False
+        if self._parents[node_id] == parent_id:
+            self._parents[node_id] = other_parents.pop(0)
+        else:
+            other_parents.remove(parent_id)
+        if not other_parents:
+            del self._other_parents[node_id]
+        return True
+
+    def _replace_parent(self, node_id: str, old_parent_id: str, parent_id: str) -> None:
+        if self._parents[node_id] == old_parent_id:
+            self._parents[node_id] = parent_id
+        else:
+            other_parents = self._other_parents[node_id]
+            other_parents[other_parents.index(old_parent_id)] = parent_id
+
+    def _writable(self, node_id: str) -> MbirdNode:
+        """
+        Get a node that can be changed in place.
+
+        Unless it was already copied since the last snapshot, the node is
+        copied, along with each of its ancestors that wasn't.
+        """
+        node = self._nodes[node_id]
+        if not self._shared or node_id in self._owned:
+            return node
+
+        # Depth-first through the parents, so every node comes after its parents
+        order: list[str] = []
+        visited: set[str] = set()
+        stack = [(node_id, False)]
+        while stack:
+            current, parents_done = stack.pop()
+            if parents_done:
+                order.append(current)
+                continue
+            if current in visited:
+                continue
+            visited.add(current)
+            stack.append((current, True))
+            stack.extend(
+                (parent_id, False)
+                for parent_id in self._parent_list(current)
+                if parent_id not in self._owned
+            )
+
+        # Copied from the top, so each copy goes into parents that are copies
+        for current in order:
+            original = self._nodes[current]
+            copy = construct_node(
+                original.id, list(original.children), original.is_stale
+            )
+            parent_ids = self._parent_list(current)
+            if not parent_ids:
+                self.root = copy
+            for parent_id in parent_ids:
+                self._nodes[parent_id].children[self._position(current, parent_id)] = (
+                    copy
+                )
+            self._nodes[current] = copy
+            self._owned.add(current)
+        return self._nodes[node_id]
+
+
+def _insert(parent: MbirdNode, node: MbirdNode, position: int | None) -> int:
+    """Insert node among parent's children, returning where it ended up."""
+    if position is None or position >= len(parent.children):
+        parent.children.append(node)
+        return len(parent.children) - 1
+    parent.children.insert(position, node)
+    return position
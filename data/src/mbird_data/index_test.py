@@ -0,0 +1,269 @@
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.hashing import subtree_digest
+from mbird_data.index import TreeIndex
+
+
+@pytest.fixture
+def tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "a1"}, {"id": "a2"}]},
+                {"id": "b"},
+            ],
+        }
+    )
+
+
+def test_lookup_parent_and_depth(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    assert len(index) == 5
+    assert index.get("a2").id == "a2"
+    assert index.parent_id("a2") == "a"
+    assert index.parent_id("root") is None
+    assert list(index.ancestor_ids("a2")) == ["a", "root"]
+    assert index.depth("a2") == 2
+    assert index.depth("root") == 0
+
+
+def test_get_missing_node_raises_key_error(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    with pytest.raises(KeyError, match="Node not found"):
+        index.get("missing")
+
+
+def test_duplicate_ids_raise_error():
+    tree = MbirdNode(id="root", children=[MbirdNode(id="dup"), MbirdNode(id="other")])
+    tree.children[1].children.append(MbirdNode(id="dup"))
+
+    with pytest.raises(ValueError, match="Duplicate node id: dup"):
+        TreeIndex(tree)
+
+
+def test_add_and_remove_subtree(tree: MbirdNode):
+    index = TreeIndex(tree)
+    new_node = MbirdNode(id="c", children=[MbirdNode(id="c1")])
+    tree.children.append(new_node)
+
+    index.add_subtree(new_node, "root")
+    assert index.parent_id("c1") == "c"
+    assert len(index) == 7
+
+    tree.children.remove(new_node)
+    assert index.remove_subtree("c") == ["c", "c1"]
+    assert "c1" not in index
+    assert len(index) == 5
+
+
+def test_failed_add_leaves_index_unchanged(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    with pytest.raises(ValueError, match="Duplicate node id: a1"):
+        index.add_subtree(MbirdNode(id="c", children=[MbirdNode(id="a1")]), "root")
+
+    assert "c" not in index
+    assert index.parent_id("a1") == "a"
+
+
+def test_digest_is_only_recomputed_on_the_changed_path(tree: MbirdNode):
+    index = TreeIndex(tree)
+    before = {node.id: index.digest(node.id) for node in list(index)}
+
+    index.get("a1").is_stale = False
+    index.invalidate("a1")
+
+    after = {node.id: index.digest(node.id) for node in list(index)}
+    assert {node_id for node_id in after if after[node_id] != before[node_id]} == {
+        "a1",
+        "a",
+        "root",
+    }
+    assert after["root"] == subtree_digest(tree)
+
+
+def test_edits_before_a_snapshot_change_the_tree_in_place(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    index.set_stale("a1", False)
+    index.attach(MbirdNode(id="c"), "root", None)
+
+    assert index.root is tree
+    assert tree.children[0].children[0].is_stale is False
+    assert [child.id for child in tree.children] == ["a", "b", "c"]
+
+
+def test_snapshot_is_unchanged_by_later_edits(tree: MbirdNode):
+    index = TreeIndex(tree)
+    snapshot = index.snapshot()
+    before = subtree_digest(snapshot.root)
+
+    index.set_stale("a1", False)
+    index.attach(MbirdNode(id="c"), "a", 0)
+    index.move("b", "a", None)
+    index.rename("a2", "a3")
+    index.detach("a1")
+
+    assert subtree_digest(snapshot.root) == before
+    assert snapshot.root is tree
+    assert index.root is not tree
+    assert [child.id for child in index.root.children] == ["a"]
+    assert [child.id for child in index.get("a").children] == ["c", "a3", "b"]
+    assert index.digest("root") == subtree_digest(index.root)
+
+
+def test_edits_only_copy_the_path_to_the_root(tree: MbirdNode):
+    index = TreeIndex(tree)
+    index.snapshot()
+
+    index.set_stale("a1", False)
+
+    assert index.root is not tree
+    assert index.get("a") is not tree.children[0]
+    assert index.get("a2") is tree.children[0].children[1]
+    assert index.get("b") is tree.children[1]
+
+    # Copies are changed in place until the next snapshot
+    copy = index.get("a")
+    index.set_stale("a2", False)
+    assert index.get("a") is copy
+
+
+def test_version_changes_with_the_first_edit_after_a_snapshot(tree: MbirdNode):
+    index = TreeIndex(tree)
+    snapshot = index.snapshot()
+    assert index.snapshot_digest(snapshot) == subtree_digest(tree)
+
+    index.set_stale("b", False)
+    index.set_stale("a", False)
+
+    assert index.version == snapshot.version + 1
+    assert index.snapshot_digest(snapshot) is None
+
+
+def test_subtree_snapshot(tree: MbirdNode):
+    index = TreeIndex(tree)
+    snapshot = index.snapshot("a")
+
+    index.detach("a2")
+
+    assert [child.id for child in snapshot.root.children] == ["a1", "a2"]
+    assert [child.id for child in index.get("a").children] == ["a1"]
+
+
+def test_detach_root_raises_error(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    with pytest.raises(ValueError, match="Cannot detach the root node"):
+        index.detach("root")
+
+
+def test_position_follows_edits(tree: MbirdNode):
+    index = TreeIndex(tree)
+    assert index.position("a2") == 1
+    assert index.position("root") == 0
+
+    index.attach(MbirdNode(id="c"), "a", 0)
+    index.rename("a1", "a0")
+
+    assert index.position("a2") == 2
+    assert index.position("a0") == 1
+
+
+@pytest.fixture
+def shared() -> MbirdNode:
+    # "s" is under both "a" and "b", and "b" under both "root" and "a"
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {
+                    "id": "a",
+                    "children": [
+                        {"id": "s", "children": [{"id": "s1"}]},
+                        {"id": "b", "children": [{"ref": "s"}]},
+                    ],
+                },
+                {"ref": "b"},
+            ],
+        }
+    )
+
+
+def test_shared_nodes_are_indexed_once(shared: MbirdNode):
+    index = TreeIndex(shared)
+
+    assert len(index) == 5
+    assert index.num_shared == 2
+    assert index.parent_ids("s") == ["a", "b"]
+    assert list(index.ancestor_ids("s")) == ["a", "b", "root"]
+    assert index.depth("s") == 3
+    assert index.depths(["s1", "b"]) == {"root": 0, "a": 1, "b": 2, "s": 3, "s1": 4}
+    assert [node.id for node in index.iter_subtree("a")] == ["a", "s", "s1", "b"]
+    assert index.position("s", "b") == 0
+    with pytest.raises(ValueError, match="several parents"):
+        index.position("s")
+
+
+def test_link_and_detach_one_occurrence(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    index.link("a", "b", None)
+    assert index.get("b").children == [index.get("a")]
+    assert index.num_shared == 1
+
+    assert index.detach("a", "root") == []
+    assert index.parent_ids("a") == ["b"]
+    assert [child.id for child in index.root.children] == ["b"]
+    assert index.digest("root") == subtree_digest(index.root)
+
+
+def test_link_rejects_cycles_and_repeats(tree: MbirdNode):
+    index = TreeIndex(tree)
+
+    with pytest.raises(ValueError, match="Cycle detected"):
+        index.link("a", "a1", None)
+    with pytest.raises(ValueError, match="already a child"):
+        index.link("a1", "a", None)
+
+
+def test_detach_keeps_nodes_shared_with_other_parents(shared: MbirdNode):
+    index = TreeIndex(shared)
+
+    assert index.detach("b", "a") == []
+    assert index.detach("a", "root") == ["a"]
+
+    assert index.parent_ids("s") == ["b"]
+    assert index.parent_ids("b") == ["root"]
+    assert index.num_shared == 0
+    assert index.digest("root") == subtree_digest(index.root)
+
+
+def test_shared_node_edit_after_snapshot_copies_every_parent(shared: MbirdNode):
+    index = TreeIndex(shared)
+    snapshot = index.snapshot()
+    before = subtree_digest(snapshot.root)
+
+    index.set_stale("s1", False)
+
+    s = index.get("s")
+    assert s is not shared.children[0].children[0]
+    assert index.get("a").children[0] is s
+    assert index.get("b").children[0] is s
+    assert index.root.children[1] is index.get("b")
+    assert subtree_digest(snapshot.root) == before
+    assert index.digest("root") == subtree_digest(index.root)
+
+
+def test_rename_shared_node(shared: MbirdNode):
+    index = TreeIndex(shared)
+
+    index.rename("s", "t")
+
+    assert index.parent_ids("t") == ["a", "b"]
+    assert index.parent_ids("s1") == ["t"]
+    assert index.position("t", "b") == 0
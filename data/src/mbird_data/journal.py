@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import BinaryIO
+
+from mbird_data.atomic import atomic_write
+from mbird_data.index import TreeIndex
+from mbird_data.models import MbirdNode
+from mbird_data.patch import TreePatch, apply_patch, decode_patch
+from mbird_data.staleness import StalenessEngine
+
+# The journal is a JSON-lines file. The first line records the digest of each
+# snapshot file it extends, e.g. {"snapshots": {"tree.json": "<sha256>"}}, and
+# every following line is one applied TreePatch. A journal whose digests don't
+# match the snapshot on disk predates that snapshot and is ignored.
+
+_READ_SIZE = 1024 * 1024
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of a file's contents, as hex."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def start_journal(path: Path, snapshots: dict[str, str]) -> None:
+    """
+    Replace the journal with an empty one that extends the given snapshots.
+
+    Args:
+        path: Journal file path
+        snapshots: Snapshot file name -> file_digest() of its contents
+    """
+    with atomic_write(path) as f:
+        f.write(json.dumps({"snapshots": snapshots}) + "\n")
+
+
+def append_journal(path: Path, patches: list[bytes]) -> None:
+    """Durably append applied patches, encoded by encode_patch(), to the journal."""
+    lines = b"".join(patch + b"\n" for patch in patches)
+    with path.open("r+b") as f:
+        # A crash mid-append can leave a partial last line, which readers skip
+        end = f.seek(0, os.SEEK_END)
+        complete = _complete_length(f, end)
+        if complete != end:
+            f.truncate(complete)
+            f.seek(complete)
+        try:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            # Don't leave some of the patches behind to be appended again
+            f.truncate(complete)
+            raise
+
+
+def read_journal(path: Path) -> tuple[dict[str, str], list[TreePatch]]:
+    """
+    Read a journal's snapshot digests and patches.
+
+    A partial last line (from a crash while appending) is ignored.
+
+    Raises:
+        ValueError: If the journal is malformed
+    """
+    with path.open("rb") as f:
+        data = f.read()
+
+    lines = data.split(b"\n")
+    # The last element is empty unless the final line was cut off
+    lines.pop()
+    if not lines:
+        raise ValueError(f"Journal has no header: {path}")
+
+    try:
+        header = json.loads(lines[0])
+        snapshots = header["snapshots"]
+        if not isinstance(snapshots, dict):
+            raise TypeError("snapshots must be an object")
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid journal header in {path}: {e}") from e
+
+    patches = [decode_patch(line) for line in lines[1:]]
+    return snapshots, patches
+
+
+def replay_journal(root: MbirdNode, patches: list[TreePatch]) -> None:
+    """Apply journaled patches to a freshly loaded tree, in order."""
+    engine = StalenessEngine(TreeIndex(root))
+    for patch in patches:
+        apply_patch(engine, patch)
+
+
+def _complete_length(f: BinaryIO, end: int) -> int:
+    """Length of the file up to and including its last newline."""
+    pos = end
+    while pos > 0:
+        start = max(0, pos - _READ_SIZE)
+        f.seek(start)
+        block = f.read(pos - start)
+        newline = block.rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        pos = start
+    return 0
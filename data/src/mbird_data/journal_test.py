@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.journal import (
+    append_journal,
+    read_journal,
+    replay_journal,
+    start_journal,
+)
+from mbird_data.patch import (
+    AddChild,
+    RenameNode,
+    SetFlags,
+    TreePatch,
+    encode_patch,
+)
+
+
+def test_appended_patches_are_read_back(tmp_path: Path):
+    path = tmp_path / "journal.jsonl"
+    patches = [
+        TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]),
+        TreePatch(ops=[RenameNode(node_id="a", new_id="b")]),
+    ]
+
+    start_journal(path, {"tree.json": "abc"})
+    append_journal(path, [encode_patch(patches[0])])
+    append_journal(path, [encode_patch(patches[1])])
+
+    assert read_journal(path) == ({"tree.json": "abc"}, patches)
+
+
+def test_patches_adding_deep_subtrees_are_read_back(tmp_path: Path):
+    path = tmp_path / "journal.jsonl"
+    chain: dict = {"id": "n999", "children": []}
+    for i in range(998, -1, -1):
+        chain = {"id": f"n{i}", "children": [chain]}
+    patches = [
+        TreePatch(ops=[AddChild(parent_id="root", node=chain)]),
+        TreePatch(ops=[AddChild(parent_id="root", node=MbirdNode.from_dict(chain))]),
+    ]
+
+    start_journal(path, {"tree.json": "abc"})
+    append_journal(path, [encode_patch(patch) for patch in patches])
+
+    _, read = read_journal(path)
+    assert [encode_patch(patch) for patch in read] == [
+        encode_patch(patch) for patch in patches
+    ]
+
+
+def test_partial_last_line_is_ignored_and_overwritten(tmp_path: Path):
+    path = tmp_path / "journal.jsonl"
+    patch = TreePatch(ops=[SetFlags(node_id="root", is_stale=False)])
+    start_journal(path, {})
+    append_journal(path, [encode_patch(patch)])
+    # Simulate a crash partway through an append
+    with path.open("ab") as f:
+        f.write(b'{"ops": [{"op": "rem')
+
+    assert read_journal(path) == ({}, [patch])
+
+    append_journal(path, [encode_patch(patch)])
+    assert read_journal(path) == ({}, [patch, patch])
+
+
+def test_journal_without_header_is_rejected(tmp_path: Path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text('{"ops": []}\n')
+
+    with pytest.raises(ValueError, match="Invalid journal header"):
+        read_journal(path)
+
+
+def test_replay_applies_patches_in_order():
+    root = MbirdNode(id="root", is_stale=False)
+
+    replay_journal(
+        root,
+        [
+            TreePatch(ops=[AddChild(parent_id="root", node={"id": "a"})]),
+            TreePatch(ops=[RenameNode(node_id="a", new_id="b")]),
+        ],
+    )
+
+    assert [child.id for child in root.children] == ["b"]
+    assert root.is_stale is True
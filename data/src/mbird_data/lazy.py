@@ -0,0 +1,243 @@
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+import mmap
+from pathlib import Path
+
+from mbird_data.binary import _parse, _read_sections
+from mbird_data.hashing import node_digest
+from mbird_data.models import MbirdNode, construct_node
+
+
+@dataclass
+class TreeSlice:
+    # Copy of a node and its descendants, down to a bounded depth
+    root: MbirdNode
+    # Ids of nodes in the slice whose children were left out
+    truncated: list[str] = field(default_factory=list)
+
+
+def slice_tree(node: MbirdNode, depth: int | None = None) -> TreeSlice:
+    """
+    Copy a node and its descendants down to depth levels below it.
+
+    A depth of 0 copies just the node itself; None copies the whole subtree,
+    where shared nodes stay shared (they're copied at every occurrence within
+    the depth otherwise).
+    """
+    result = TreeSlice(_shallow_copy(node))
+    # Copies of the nodes copied so far by id, when copying the whole subtree
+    copies = {node.id: result.root} if depth is None else None
+    stack = [(node, result.root, 0)]
+    while stack:
+        original, copy, level = stack.pop()
+        if not original.children:
+            continue
+        if depth is not None and level >= depth:
+            result.truncated.append(original.id)
+            continue
+        if copies is None:
+            copy.children = [_shallow_copy(child) for child in original.children]
+            stack.extend(
+                (child, child_copy, level + 1)
+                for child, child_copy in zip(
+                    original.children, copy.children, strict=True
+                )
+            )
+            continue
+
+        copy.children = []
+        for child in original.children:
+            child_copy = copies.get(child.id)
+            if child_copy is None:
+                child_copy = copies[child.id] = _shallow_copy(child)
+                stack.append((child, child_copy, level + 1))
+            copy.children.append(child_copy)
+    return result
+
+
+def _shallow_copy(node: MbirdNode) -> MbirdNode:
+    return construct_node(node.id, [], node.is_stale)
+
+
+class MappedTree:
+    """
+    A binary tree file mapped into memory and decoded one node at a time.
+
+    Opening the file only reads its header, so the cost of a slice depends on
+    how many nodes it contains rather than on the size of the tree. The file
+    must not be rewritten in place while it's mapped.
+    """
+
+    def __init__(self, path: str | Path):
+        """
+        Map a binary tree file.
+
+        Raises:
+            ValueError: If the file isn't a supported binary tree file
+        """
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        try:
+            self._sections = _read_sections(self._view, copy=False)
+        except Exception:
+            self.close()
+            raise
+        # Built on the first lookup by id
+        self._index: dict[str, int] | None = None
+        # Subtree digests by node index, kept once computed (the file never
+        # changes while it's mapped)
+        self._digests: dict[int, bytes] = {}
+
+    def __len__(self) -> int:
+        return self._sections.num_nodes
+
+    def num_nodes(self) -> int:
+        """Number of distinct nodes, counting shared nodes (and links) once."""
+        # The string table has each id once
+        return self._sections.num_strings
+
+    def close(self) -> None:
+        """Unmap the file; the tree can't be read afterwards."""
+        # Views into the map have to be released before it can be closed
+        for section in getattr(self, "_sections", ()):
+            if isinstance(section, memoryview):
+                section.release()
+        self._view.release()
+        self._mmap.close()
+
+    def node_id(self, index: int) -> str:
+        self._check_index(index)
+        sections = self._sections
+        ref = sections.refs[index]
+        if ref >= sections.num_strings:
+            raise ValueError("Corrupt id table in binary tree file")
+        start = sections.offsets[ref]
+        end = sections.offsets[ref + 1]
+        return bytes(sections.blob[start:end]).decode()
+
+    def is_stale(self, index: int) -> bool:
+        self._check_index(index)
+        return bool(self._sections.stale[index >> 3] & (1 << (index & 7)))
+
+    def is_link(self, index: int) -> bool:
+        """Whether a node is a link to the first occurrence of its id."""
+        self._check_index(index)
+        return bool(self._sections.links[index >> 3] & (1 << (index & 7)))
+
+    def target(self, index: int) -> int:
+        """Get the index of the node a link stands for (a node's own otherwise)."""
+        if not self.is_link(index):
+            return index
+        target = self.find(self.node_id(index))
+        # As TreeStore checks, which also rules out cycles
+        if self._sections.subtree_ends[target] > index:
+            raise ValueError("Corrupt links bitmap in binary tree file")
+        return target
+
+    def children(self, index: int) -> Iterator[int]:
+        """Yield the indices of a node's children, in order (links have none)."""
+        self._check_index(index)
+        subtree_ends = self._sections.subtree_ends
+        end = subtree_ends[index]
+        child = index + 1
+        while child < end:
+            child_end = subtree_ends[child]
+            if not child < child_end <= end:
+                raise ValueError("Corrupt subtree table in binary tree file")
+            yield child
+            child = child_end
+
+    def find(self, node_id: str) -> int:
+        """Get the index of a node by id, raising KeyError if it doesn't exist."""
+        if self._index is None:
+            sections = self._sections
+            offsets = sections.offsets
+            blob = bytes(sections.blob)
+            strings = [
+                blob[offsets[k] : offsets[k + 1]].decode()
+                for k in range(sections.num_strings)
+            ]
+            index: dict[str, int] = {}
+            for i, ref in enumerate(sections.refs):
+                index.setdefault(strings[ref], i)
+            self._index = index
+        try:
+            return self._index[node_id]
+        except KeyError:
+            raise KeyError(f"Node not found: {node_id}") from None
+
+    def digest(self, index: int) -> bytes:
+        """
+        Get the digest of a node's subtree (see mbird_data.hashing).
+
+        Only the nodes in the subtree are read, and their digests are kept for
+        later calls.
+        """
+        index = self.target(index)
+        digests = self._digests
+        if index not in digests:
+            self._hash_subtree(index)
+        return digests[index]
+
+    def _hash_subtree(self, index: int) -> None:
+        """Compute the digests in a node's subtree that aren't known yet."""
+        digests = self._digests
+        # Each node is visited again once its children's digests are known
+        stack: list[tuple[int, list[int] | None]] = [(index, None)]
+        while stack:
+            current, children = stack.pop()
+            if current in digests:
+                continue
+            if children is None:
+                children = [self.target(child) for child in self.children(current)]
+                stack.append((current, children))
+                stack.extend((child, None) for child in children)
+                continue
+            digests[current] = node_digest(
+                self.node_id(current),
+                self.is_stale(current),
+                [digests[child] for child in children],
+            )
+
+    def slice(self, index: int, depth: int | None = None) -> TreeSlice:
+        """
+        Materialize a node and its descendants down to depth levels below it.
+
+        A depth of 0 builds just the node itself; None builds the whole subtree,
+        where shared nodes stay shared (as with slice_tree()).
+        """
+        index = self.target(index)
+        result = TreeSlice(self._build(index))
+        # Nodes built so far by index, when building the whole subtree
+        built = {index: result.root} if depth is None else None
+        stack = [(index, result.root, 0)]
+        while stack:
+            current, node, level = stack.pop()
+            children = [self.target(child) for child in self.children(current)]
+            if not children:
+                continue
+            if depth is not None and level >= depth:
+                result.truncated.append(node.id)
+                continue
+            node.children = []
+            for child in children:
+                child_node = None if built is None else built.get(child)
+                if child_node is None:
+                    child_node = self._build(child)
+                    if built is not None:
+                        built[child] = child_node
+                    stack.append((child, child_node, level + 1))
+                node.children.append(child_node)
+        return result
+
+    def to_node(self) -> MbirdNode:
+        """Materialize the whole tree."""
+        return _parse(self._view).to_node()
+
+    def _build(self, index: int) -> MbirdNode:
+        return construct_node(self.node_id(index), [], self.is_stale(index))
+
+    def _check_index(self, index: int) -> None:
+        if not 0 <= index < self._sections.num_nodes:
+            raise IndexError(f"Node index out of range: {index}")
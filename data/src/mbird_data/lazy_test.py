@@ -0,0 +1,189 @@
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from mbird_data import MbirdData, MbirdNode
+from mbird_data import lazy as lazy_module
+from mbird_data.binary import write_binary
+from mbird_data.hashing import node_digest, subtree_digest
+from mbird_data.lazy import MappedTree, slice_tree
+
+
+@pytest.fixture
+def tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": False,
+                    "children": [{"id": "a1", "children": [{"id": "a1x"}]}],
+                },
+                {"id": "b", "is_stale": False},
+            ],
+        }
+    )
+
+
+@pytest.fixture
+def mapped(tree: MbirdNode, tmp_path: Path):
+    path = tmp_path / "tree.bin"
+    with path.open("wb") as f:
+        write_binary(tree, f)
+    mapped = MappedTree(path)
+    yield mapped
+    mapped.close()
+
+
+def test_mapped_tree_reads_nodes(mapped: MappedTree):
+    assert len(mapped) == 5
+    assert mapped.node_id(0) == "root"
+    assert [mapped.node_id(i) for i in mapped.children(0)] == ["a", "b"]
+    assert mapped.is_stale(mapped.find("a")) is False
+    assert mapped.is_stale(mapped.find("a1")) is True
+
+
+def test_mapped_tree_find_missing_id_raises(mapped: MappedTree):
+    with pytest.raises(KeyError, match="Node not found: missing"):
+        mapped.find("missing")
+
+
+def test_mapped_slice_is_cut_off_at_depth(mapped: MappedTree):
+    result = mapped.slice(0, depth=1)
+
+    assert result.root.model_dump() == {
+        "id": "root",
+        "is_stale": True,
+        "children": [
+            {"id": "a", "is_stale": False, "children": []},
+            {"id": "b", "is_stale": False, "children": []},
+        ],
+    }
+    assert result.truncated == ["a"]
+
+
+def test_mapped_slice_matches_slice_of_built_tree(mapped: MappedTree, tree: MbirdNode):
+    for depth in (0, 1, 2, None):
+        expected = slice_tree(tree.children[0], depth)
+        result = mapped.slice(mapped.find("a"), depth)
+
+        assert result.root.model_dump() == expected.root.model_dump()
+        assert result.truncated == expected.truncated
+
+
+def test_mapped_to_node_builds_whole_tree(mapped: MappedTree, tree: MbirdNode):
+    assert mapped.to_node().model_dump() == tree.model_dump()
+
+
+def test_lazy_load_materializes_only_when_root_is_used(tree: MbirdNode, tmp_path: Path):
+    mbird_dir = tmp_path / "lazy.mbird"
+    MbirdData(root=tree).save(mbird_dir, binary=True)
+
+    data = MbirdData.load(mbird_dir, lazy=True)
+    assert not data.is_materialized
+    assert data.subtree("a", depth=0).truncated == ["a"]
+    assert not data.is_materialized
+
+    assert data.root is not None
+    assert data.is_materialized
+    assert data.root.model_dump() == tree.model_dump()
+    assert data.subtree("a", depth=0).truncated == ["a"]
+
+
+def test_lazy_load_without_binary_file_loads_json(tree: MbirdNode, tmp_path: Path):
+    mbird_dir = tmp_path / "lazy.mbird"
+    MbirdData(root=tree).save(mbird_dir)
+
+    data = MbirdData.load(mbird_dir, lazy=True)
+
+    assert data.is_materialized
+    assert data.subtree().root.model_dump() == tree.model_dump()
+
+
+def test_truncated_binary_file_is_rejected(tree: MbirdNode, tmp_path: Path):
+    path = tmp_path / "tree.bin"
+    with path.open("wb") as f:
+        write_binary(tree, f)
+    path.write_bytes(path.read_bytes()[:40])
+
+    with pytest.raises(ValueError, match="Truncated"):
+        MappedTree(path)
+
+
+def test_mapped_digest_matches_built_tree(mapped: MappedTree, tree: MbirdNode):
+    assert mapped.digest(0) == subtree_digest(tree)
+    assert mapped.digest(mapped.find("a")) == subtree_digest(tree.children[0])
+
+
+def test_mapped_digest_only_hashes_the_subtree(
+    mapped: MappedTree, tree: MbirdNode, monkeypatch: pytest.MonkeyPatch
+):
+    hashed: list[str] = []
+
+    def counting_digest(node_id: str, *args: Any) -> bytes:
+        hashed.append(node_id)
+        return node_digest(node_id, *args)
+
+    monkeypatch.setattr(lazy_module, "node_digest", counting_digest)
+
+    assert mapped.digest(mapped.find("a")) == subtree_digest(tree.children[0])
+    assert sorted(hashed) == ["a", "a1", "a1x"]
+    # The subtree's digests are reused
+    assert mapped.digest(0) == subtree_digest(tree)
+    assert sorted(hashed) == ["a", "a1", "a1x", "b", "root"]
+
+
+def test_slice_keeps_shared_nodes_shared():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [{"id": "a", "children": [{"id": "s"}]}, {"ref": "s"}],
+        }
+    )
+
+    whole = slice_tree(root).root
+    cut = slice_tree(root, depth=1)
+
+    assert whole.children[1] is whole.children[0].children[0]
+    assert whole.model_dump() == root.model_dump()
+    assert cut.truncated == ["a"]
+    assert [child.id for child in cut.root.children] == ["a", "s"]
+
+
+def test_mapped_tree_follows_links(tmp_path: Path):
+    shared = MbirdNode(id="s", children=[MbirdNode(id="s1")])
+    root = MbirdNode(id="root", children=[MbirdNode(id="a", children=[shared]), shared])
+    path = tmp_path / "tree.bin"
+    with path.open("wb") as f:
+        write_binary(root, f)
+    mapped = MappedTree(path)
+
+    link = list(mapped.children(0))[1]
+    whole = mapped.slice(0).root
+    cut = mapped.slice(0, depth=1)
+
+    assert mapped.is_link(link)
+    assert mapped.target(link) == mapped.find("s")
+    assert len(mapped) == 5
+    assert mapped.num_nodes() == 4
+    assert whole.children[1] is whole.children[0].children[0]
+    assert whole.model_dump() == root.model_dump()
+    assert cut.truncated == ["s", "a"]
+    assert mapped.slice(link).root.model_dump() == shared.model_dump()
+    assert mapped.digest(link) == subtree_digest(shared)
+    assert mapped.digest(0) == subtree_digest(root)
+    mapped.close()
+
+
+def test_lazy_load_counts_shared_nodes_once(tmp_path: Path):
+    shared = MbirdNode(id="s")
+    root = MbirdNode(id="root", children=[shared, shared])
+    MbirdData(root=root).save(tmp_path / "project.mbird", binary=True)
+
+    lazy = MbirdData.load(tmp_path / "project.mbird", lazy=True)
+
+    assert lazy.num_nodes() == 2
+    assert not lazy.is_materialized
+    assert MbirdData(root=root).num_nodes() == 2
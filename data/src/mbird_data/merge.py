@@ -0,0 +1,312 @@
+"""
+Three-way merge of trees: two versions edited separately from a common base.
+
+Nodes are matched by id, as with diff_trees(). For each node's placement,
+children order and stale flag, the merged tree takes the version that changed
+it from the base. Where both versions changed it differently, the conflict is
+recorded and one version (ours, unless told otherwise) is taken.
+"""
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Literal, TypeVar
+
+from mbird_data.diff import TreeShape, order_changed
+from mbird_data.models import MbirdNode, construct_node, paused_gc
+
+Side = Literal["ours", "theirs"]
+
+_T = TypeVar("_T")
+
+_BOTH: tuple[Side, ...] = ("ours", "theirs")
+
+
+@dataclass
+class MergeConflict:
+    node_id: str
+    # "removed" (removed in one version and changed in the other), "moved"
+    # (under different parents in each), "reordered" (its children reordered
+    # differently in each) or "cycle" (the moves together would make a cycle)
+    kind: str
+    detail: str
+
+
+@dataclass
+class MergeResult:
+    tree: MbirdNode
+    conflicts: list[MergeConflict]
+
+
+def merge_trees(
+    base: MbirdNode, ours: MbirdNode, theirs: MbirdNode, prefer: Side = "ours"
+) -> MergeResult:
+    """
+    Merge two versions of a tree that were edited separately from a base.
+
+    Args:
+        base: The version both were edited from
+        ours: One edited version
+        theirs: The other edited version
+        prefer: Which version to take where they conflict
+
+    Returns:
+        The merged tree (built anew, sharing no nodes with the versions) and
+        the conflicts found
+
+    Raises:
+        ValueError: If the trees have different roots
+    """
+    shapes = TreeShape(base), TreeShape(ours), TreeShape(theirs)
+    with paused_gc():
+        return _Merger(*shapes, prefer).merge()
+
+
+class _Merger:
+    def __init__(
+        self, base: TreeShape, ours: TreeShape, theirs: TreeShape, prefer: Side
+    ):
+        if not base.root_id == ours.root_id == theirs.root_id:
+            raise ValueError(
+                "Trees have different roots: "
+                f"{base.root_id}, {ours.root_id} and {theirs.root_id}"
+            )
+        self.base = base
+        self.sides: dict[Side, TreeShape] = {"ours": ours, "theirs": theirs}
+        self.prefer: Side = prefer
+        self._ours = ours.nodes
+        self._theirs = theirs.nodes
+        self.conflicts: list[MergeConflict] = []
+        self._conflicted: set[tuple[str, str]] = set()
+        # Ids of the nodes in the merged tree
+        self.kept: dict[str, None] = {}
+        # Parents each kept node is placed under, and the version they're from
+        self.parents: dict[str, list[str]] = {}
+        self.source: dict[str, Side] = {}
+
+    def merge(self) -> MergeResult:
+        root_id = self.base.root_id
+        for node_id in self._all_ids():
+            if self._keeps(node_id):
+                self.kept[node_id] = None
+        for node_id in list(self.kept):
+            if node_id != root_id:
+                self._place(node_id)
+        for node_id in list(self.kept):
+            if node_id != root_id:
+                self._keep_a_parent(node_id)
+        while (cycle := self._find_cycle()) is not None:
+            self._break_cycle(cycle)
+
+        children: dict[str, set[str]] = {node_id: set() for node_id in self.kept}
+        for node_id, parent_ids in self.parents.items():
+            for parent_id in parent_ids:
+                if parent_id in self.kept:
+                    children[parent_id].add(node_id)
+        child_lists: dict[str, list[MbirdNode]] = {}
+        nodes = {}
+        for node_id in self.kept:
+            child_lists[node_id] = []
+            nodes[node_id] = construct_node(
+                node_id, child_lists[node_id], self._is_stale(node_id)
+            )
+        for node_id, child_ids in children.items():
+            if child_ids:
+                child_lists[node_id].extend(
+                    nodes[child_id] for child_id in self._order(node_id, child_ids)
+                )
+        return MergeResult(nodes[root_id], self.conflicts)
+
+    def _all_ids(self) -> dict[str, None]:
+        ids = dict.fromkeys(self.sides["ours"].nodes)
+        ids.update(dict.fromkeys(self.sides["theirs"].nodes))
+        return ids
+
+    def _keeps(self, node_id: str) -> bool:
+        present = self._present(node_id)
+        if len(present) == 2 or node_id not in self.base:
+            return True
+        # Removed in one version
+        keeper = present[0]
+        if not self._changed(node_id, keeper):
+            return False
+        self._conflict(
+            node_id,
+            "removed",
+            f"removed in {_other(keeper)} but changed in {keeper}",
+        )
+        return keeper == self.prefer
+
+    def _changed(self, node_id: str, side: Side) -> bool:
+        base, shape = self.base, self.sides[side]
+        return (
+            base.nodes[node_id].is_stale != shape.nodes[node_id].is_stale
+            or base.children[node_id] != shape.children[node_id]
+            or set(base.parents[node_id]) != set(shape.parents[node_id])
+        )
+
+    def _place(self, node_id: str) -> None:
+        present = self._present(node_id)
+        if len(present) == 1:
+            side = present[0]
+        else:
+            base_parents = self.base.parents.get(node_id)
+            side = self._pick(
+                node_id,
+                "moved",
+                None if base_parents is None else set(base_parents),
+                set(self.sides["ours"].parents[node_id]),
+                set(self.sides["theirs"].parents[node_id]),
+                lambda a, b: a is not None and a == b,
+            )
+        self.parents[node_id] = self.sides[side].parents[node_id]
+        self.source[node_id] = side
+
+    def _keep_a_parent(self, node_id: str) -> None:
+        """Put back removed parents that a kept node is left without."""
+        pending = [node_id]
+        while pending:
+            child_id = pending.pop()
+            parent_ids = self.parents[child_id]
+            if any(parent_id in self.kept for parent_id in parent_ids):
+                continue
+            # From the version the child was placed from, so it has the parent
+            parent_id = parent_ids[0]
+            side = self.source[child_id]
+            self._conflict(
+                parent_id,
+                "removed",
+                f"removed in {_other(side)} but {child_id} is under it in {side}",
+            )
+            self.kept[parent_id] = None
+            self._place(parent_id)
+            pending.append(parent_id)
+
+    def _find_cycle(self) -> list[str] | None:
+        """Find the ids of a cycle among the placements, if there's one."""
+        children: dict[str, list[str]] = {node_id: [] for node_id in self.kept}
+        for node_id, parent_ids in self.parents.items():
+            for parent_id in parent_ids:
+                if parent_id in self.kept:
+                    children[parent_id].append(node_id)
+        # Nodes whose subtrees were walked without finding a cycle
+        done: set[str] = set()
+        for start in (self.base.root_id, *self.kept):
+            if start in done:
+                continue
+            path = [start]
+            on_path = {start}
+            stack = [iter(children[start])]
+            while stack:
+                child_id = next(stack[-1], None)
+                if child_id is None:
+                    stack.pop()
+                    node_id = path.pop()
+                    on_path.discard(node_id)
+                    done.add(node_id)
+                    continue
+                if child_id in on_path:
+                    return path[path.index(child_id) :]
+                if child_id in done:
+                    continue
+                path.append(child_id)
+                on_path.add(child_id)
+                stack.append(iter(children[child_id]))
+        return None
+
+    def _break_cycle(self, cycle: list[str]) -> None:
+        """Place the cycle's nodes moved by the other version as preferred."""
+        preferred = self.sides[self.prefer]
+        for node_id in cycle:
+            if self.source[node_id] == self.prefer or node_id not in preferred:
+                continue
+            self._conflict(
+                node_id,
+                "cycle",
+                f"moving it as in {_other(self.prefer)} would make a cycle",
+            )
+            self.parents[node_id] = preferred.parents[node_id]
+            self.source[node_id] = self.prefer
+            self._keep_a_parent(node_id)
+
+    def _order(self, parent_id: str, child_ids: set[str]) -> list[str]:
+        """Order a node's merged children."""
+        lists = {
+            side: shape.children[parent_id]
+            for side, shape in self.sides.items()
+            if parent_id in shape
+        }
+        if len(lists) == 1:
+            (side,) = lists
+        else:
+            side = self._pick(
+                parent_id,
+                "reordered",
+                self.base.children.get(parent_id),
+                lists["ours"],
+                lists["theirs"],
+                lambda a, b: a is not None and not order_changed(a, b),
+            )
+        ordered = [child_id for child_id in lists[side] if child_id in child_ids]
+        placed = set(ordered)
+        # Children only in the other version go after the last of their previous
+        # siblings there that's placed (or first, if there's none)
+        after: dict[str | None, list[str]] = {}
+        for other_ids in lists.values():
+            previous = None
+            for child_id in other_ids:
+                if child_id in placed:
+                    previous = child_id
+                elif child_id in child_ids:
+                    after.setdefault(previous, []).append(child_id)
+        if not after:
+            return ordered
+        merged = after.get(None, [])
+        for child_id in ordered:
+            merged.append(child_id)
+            merged.extend(after.get(child_id, ()))
+        return merged
+
+    def _is_stale(self, node_id: str) -> bool:
+        present = self._present(node_id)
+        if len(present) == 1:
+            return self.sides[present[0]].nodes[node_id].is_stale
+        ours = self.sides["ours"].nodes[node_id].is_stale
+        theirs = self.sides["theirs"].nodes[node_id].is_stale
+        base = self.base.nodes.get(node_id)
+        if base is None:
+            return ours or theirs
+        return theirs if ours == base.is_stale else ours
+
+    def _present(self, node_id: str) -> tuple[Side, ...]:
+        in_ours = node_id in self._ours
+        in_theirs = node_id in self._theirs
+        if in_ours and in_theirs:
+            return _BOTH
+        return ("ours",) if in_ours else ("theirs",)
+
+    def _pick(
+        self,
+        node_id: str,
+        kind: str,
+        base: _T | None,
+        ours: _T,
+        theirs: _T,
+        same: Callable[[_T | None, _T], bool],
+    ) -> Side:
+        """Pick the version that changed something from the base."""
+        if same(base, ours):
+            return "theirs"
+        if same(base, theirs) or same(ours, theirs):
+            return "ours"
+        self._conflict(node_id, kind, f"{kind} differently in ours and theirs")
+        return self.prefer
+
+    def _conflict(self, node_id: str, kind: str, detail: str) -> None:
+        # Only the first conflict of each kind is kept for a node
+        if (node_id, kind) not in self._conflicted:
+            self._conflicted.add((node_id, kind))
+            self.conflicts.append(MergeConflict(node_id, kind, detail))
+
+
+def _other(side: Side) -> Side:
+    return "theirs" if side == "ours" else "ours"
@@ -0,0 +1,158 @@
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.diff import TreeShape, tree_patch
+from mbird_data.merge import MergeConflict, merge_trees
+
+TREE = {
+    "id": "root",
+    "is_stale": False,
+    "children": [
+        {
+            "id": "a",
+            "is_stale": False,
+            "children": [
+                {"id": "a1", "is_stale": False},
+                {"id": "a2", "is_stale": False},
+            ],
+        },
+        {"id": "b", "is_stale": False, "children": [{"id": "b1", "is_stale": False}]},
+        {"id": "c", "is_stale": False},
+    ],
+}
+
+
+def tree(children: dict[str, list[str]] | None = None, **stale: bool) -> MbirdNode:
+    """The test tree, with some nodes' children (by id) and flags replaced."""
+    root = MbirdNode.from_dict(TREE)
+    nodes = TreeShape(root).nodes
+    for node_id, child_ids in (children or {}).items():
+        nodes[node_id].children = [
+            nodes.get(child_id) or MbirdNode(id=child_id) for child_id in child_ids
+        ]
+    for node_id, is_stale in stale.items():
+        nodes[node_id].is_stale = is_stale
+    return root
+
+
+def children(root: MbirdNode) -> dict[str, list[str]]:
+    return TreeShape(root).children
+
+
+def test_merge_takes_the_changes_from_each_version():
+    ours = tree({"a": ["a1", "a2", "n"]}, a2=True)
+    theirs = tree({"root": ["c", "a", "b"], "b": [], "c": ["b1"]})
+
+    result = merge_trees(tree(), ours, theirs)
+
+    assert result.conflicts == []
+    assert children(result.tree) == {
+        "root": ["c", "a", "b"],
+        "c": ["b1"],
+        "b1": [],
+        "a": ["a1", "a2", "n"],
+        "a1": [],
+        "a2": [],
+        "n": [],
+        "b": [],
+    }
+    assert TreeShape(result.tree).nodes["a2"].is_stale
+
+
+def test_merge_with_an_unchanged_version_is_the_other_version():
+    theirs = tree({"root": ["b", "a"], "b": ["b1", "c"]}, a1=True)
+
+    result = merge_trees(tree(), tree(), theirs)
+
+    assert result.conflicts == []
+    assert children(result.tree) == children(theirs)
+    assert TreeShape(result.tree).nodes["a1"].is_stale
+
+
+def test_node_removed_in_one_version_and_changed_in_the_other():
+    ours = tree(b1=True)
+    theirs = tree({"b": []})
+
+    kept = merge_trees(tree(), ours, theirs)
+    removed = merge_trees(tree(), ours, theirs, prefer="theirs")
+
+    assert kept.conflicts == [
+        MergeConflict("b1", "removed", "removed in theirs but changed in ours")
+    ]
+    assert children(kept.tree)["b"] == ["b1"]
+    assert removed.conflicts == kept.conflicts
+    assert children(removed.tree)["b"] == []
+
+
+def test_removed_parent_is_put_back_for_nodes_added_under_it():
+    ours = tree({"c": ["n"]})
+    theirs = tree({"root": ["a", "b"]})
+
+    result = merge_trees(tree(), ours, theirs, prefer="theirs")
+
+    assert [conflict.node_id for conflict in result.conflicts] == ["c"]
+    assert children(result.tree)["c"] == ["n"]
+
+
+def test_node_moved_differently_in_each_version():
+    ours = tree({"b": [], "a": ["a1", "a2", "b1"]})
+    theirs = tree({"b": [], "c": ["b1"]})
+
+    result = merge_trees(tree(), ours, theirs)
+    preferring_theirs = merge_trees(tree(), ours, theirs, prefer="theirs")
+
+    assert [(c.node_id, c.kind) for c in result.conflicts] == [("b1", "moved")]
+    assert children(result.tree)["a"] == ["a1", "a2", "b1"]
+    assert children(preferring_theirs.tree)["c"] == ["b1"]
+
+
+def test_moves_that_would_make_a_cycle():
+    ours = tree({"root": ["b", "c"], "b": ["b1", "a"]})
+    theirs = tree({"root": ["a", "c"], "a": ["a1", "a2", "b"]})
+
+    result = merge_trees(tree(), ours, theirs)
+
+    assert [(c.node_id, c.kind) for c in result.conflicts] == [("b", "cycle")]
+    assert children(result.tree)["root"] == ["b", "c"]
+    assert children(result.tree)["b"] == ["b1", "a"]
+
+
+def test_children_order_combines_both_versions():
+    ours = tree({"a": ["a2", "a1", "n"]})
+    theirs = tree({"a": ["m", "a2", "a1"], "root": ["c", "b", "a"]})
+
+    result = merge_trees(tree(), ours, theirs)
+
+    # Both moved a2 first; m is first, as in theirs
+    assert result.conflicts == []
+    assert children(result.tree)["a"] == ["m", "a2", "a1", "n"]
+    assert children(result.tree)["root"] == ["c", "b", "a"]
+
+
+def test_children_reordered_differently_in_each_version():
+    ours = tree({"root": ["b", "a", "c"]})
+    theirs = tree({"root": ["a", "c", "b"]})
+
+    result = merge_trees(tree(), ours, theirs)
+
+    assert [(c.node_id, c.kind) for c in result.conflicts] == [("root", "reordered")]
+    assert children(result.tree)["root"] == ["b", "a", "c"]
+
+
+def test_merge_of_deep_new_subtrees():
+    chain = MbirdNode(id="n1999")
+    for i in range(1998, -1, -1):
+        chain = MbirdNode(id=f"n{i}", children=[chain])
+    ours = tree()
+    ours.children[2].children = [chain]
+
+    result = merge_trees(tree(), ours, tree({"a": ["a2"]}))
+
+    assert result.conflicts == []
+    assert len(TreeShape(result.tree).nodes) == 2006
+    assert len(tree_patch(tree(), result.tree).ops) == 2
+
+
+def test_merge_requires_the_same_root():
+    with pytest.raises(ValueError, match="different roots"):
+        merge_trees(tree(), tree(), MbirdNode(id="other"))
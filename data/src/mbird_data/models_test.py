@@ -0,0 +1,173 @@
+from typing import Any
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.models import construct_node, find_cycle
+
+
+def make_chain(depth: int) -> dict[str, Any]:
+    root: dict[str, Any] = {"id": "node0", "children": []}
+    node = root
+    for i in range(1, depth):
+        child: dict[str, Any] = {"id": f"node{i}", "children": []}
+        node["children"].append(child)
+        node = child
+    return root
+
+
+def test_from_dict_builds_nested_tree():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "child1", "is_stale": False},
+                {"id": "child2", "children": [{"id": "grandchild"}]},
+            ],
+        }
+    )
+
+    assert root.id == "root"
+    assert [child.id for child in root.children] == ["child1", "child2"]
+    assert root.children[0].is_stale is False
+    assert root.children[1].children[0].id == "grandchild"
+
+
+def test_from_dict_without_validation_builds_same_tree():
+    data = make_chain(100)
+    data["children"][0]["is_stale"] = False
+
+    trusted = MbirdNode.from_dict(data, validate=False)
+
+    assert trusted == MbirdNode.from_dict(data)
+    assert trusted.children[0].model_fields_set == {"id", "children", "is_stale"}
+
+
+def test_from_dict_without_validation_skips_checks():
+    data = make_chain(3)
+    data["children"][0]["children"].append({"id": "node0"})
+
+    root = MbirdNode.from_dict(data, validate=False)
+
+    assert find_cycle(root) == "node0"
+
+
+def test_constructed_node_behaves_like_validated_node():
+    node = construct_node("a", [], False)
+
+    assert node == MbirdNode(id="a", is_stale=False)
+    node.children = [construct_node("b", [], True)]
+    assert node.model_copy(update={"children": []}).children == []
+    assert node.model_dump() == {
+        "id": "a",
+        "children": [{"id": "b", "children": [], "is_stale": True}],
+        "is_stale": False,
+    }
+
+
+def test_from_dict_handles_trees_deeper_than_recursion_limit():
+    root = MbirdNode.from_dict(make_chain(5000))
+
+    depth = 1
+    node = root
+    while node.children:
+        node = node.children[0]
+        depth += 1
+    assert depth == 5000
+    assert node.id == "node4999"
+
+
+def test_from_dict_reports_cycle_node_id():
+    data = make_chain(1000)
+    data["children"][0]["children"][0]["children"].append({"id": "node1"})
+
+    with pytest.raises(ValueError, match="Cycle detected .* node: node1"):
+        MbirdNode.from_dict(data)
+
+
+def test_from_dict_with_invalid_node_raises_error():
+    with pytest.raises(ValueError):
+        MbirdNode.from_dict({"id": "root", "children": [{"children": []}]})
+
+
+def test_from_dict_with_non_list_children_raises_error():
+    with pytest.raises(ValueError, match="must be a list"):
+        MbirdNode.from_dict({"id": "root", "children": "oops"})
+
+
+def test_repeated_ids_in_separate_branches_are_not_a_cycle():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "shared"}]},
+                {"id": "b", "children": [{"id": "shared"}]},
+            ],
+        }
+    )
+
+    assert find_cycle(root) is None
+
+
+def test_constructing_from_existing_nodes_checks_for_cycles():
+    leaf = MbirdNode(id="node1")
+    middle = MbirdNode(id="node2", children=[leaf])
+
+    with pytest.raises(ValueError, match="Cycle detected .* node: node1"):
+        MbirdNode(id="node1", children=[middle])
+
+
+SHARED = {
+    "id": "root",
+    "children": [
+        {"id": "a", "children": [{"id": "s", "children": [{"id": "s1"}]}]},
+        {"id": "b", "children": [{"ref": "s"}]},
+        {"id": "c", "children": [{"id": "s", "children": [{"id": "s1"}]}]},
+    ],
+}
+
+
+@pytest.mark.parametrize("validate", [True, False])
+def test_from_dict_shares_referenced_nodes(validate: bool):
+    root = MbirdNode.from_dict(SHARED, validate=validate)
+
+    a, b, _ = root.children
+    assert b.children[0] is a.children[0]
+    assert [child.id for child in b.children[0].children] == ["s1"]
+
+
+def test_from_dict_shares_repeated_nodes():
+    root = MbirdNode.from_dict(SHARED)
+
+    a, _, c = root.children
+    assert c.children[0] is a.children[0]
+    assert c.children[0].children[0] is a.children[0].children[0]
+
+
+def test_from_dict_rejects_differing_occurrences():
+    data = {
+        "id": "root",
+        "children": [{"id": "s", "is_stale": False}, {"id": "s"}],
+    }
+
+    with pytest.raises(ValueError, match="differs"):
+        MbirdNode.from_dict(data)
+
+
+def test_from_dict_rejects_references_to_unknown_nodes():
+    # A reference can't point at one of its own ancestors
+    data = {"id": "root", "children": [{"id": "a", "children": [{"ref": "a"}]}]}
+
+    with pytest.raises(ValueError, match="unknown node: a"):
+        MbirdNode.from_dict(data)
+    with pytest.raises(ValueError, match="unknown node: b"):
+        MbirdNode.from_dict({"id": "root", "children": [{"ref": "b"}]}, False)
+
+
+def test_find_cycle_visits_shared_nodes_once():
+    # Each level shares its node twice, which expands to 2**40 paths
+    node = construct_node("n0", [], True)
+    for i in range(1, 40):
+        node = construct_node(f"n{i}", [node, node], True)
+
+    assert find_cycle(node) is None
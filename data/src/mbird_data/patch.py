@@ -0,0 +1,442 @@
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Annotated, Any, Literal
+
+from pydantic import BaseModel, Field, ValidationError
+from pydantic_core import PydanticSerializationError
+
+from mbird_data.index import TreeIndex
+from mbird_data.models import MbirdNode, construct_node
+from mbird_data.staleness import Propagation, StalenessEngine
+from mbird_data.streaming import dumps_json, loads_json
+
+
+class AddChild(BaseModel):
+    op: Literal["add"] = "add"
+    parent_id: str
+    # Plain data is built with MbirdNode.from_dict when applied; a built node
+    # (a removed subtree, when undoing) is copied, so that applying the patch
+    # doesn't change it
+    node: Annotated[dict[str, Any] | MbirdNode, Field(union_mode="left_to_right")]
+    # Position among the parent's children (appended if None)
+    position: int | None = Field(default=None, ge=0)
+
+
+class LinkNode(BaseModel):
+    # Puts a node that's in the tree under another parent too, sharing it
+    op: Literal["link"] = "link"
+    parent_id: str
+    node_id: str
+    position: int | None = Field(default=None, ge=0)
+
+
+class RemoveSubtree(BaseModel):
+    op: Literal["remove"] = "remove"
+    node_id: str
+    # Parent to remove it from, only needed for shared nodes. Its subtree's
+    # nodes stay in the tree as long as they have another parent.
+    parent_id: str | None = None
+
+
+class MoveSubtree(BaseModel):
+    op: Literal["move"] = "move"
+    node_id: str
+    new_parent_id: str
+    position: int | None = Field(default=None, ge=0)
+    # Parent to move it from, only needed for shared nodes
+    parent_id: str | None = None
+
+
+class RenameNode(BaseModel):
+    op: Literal["rename"] = "rename"
+    node_id: str
+    new_id: str
+
+
+class SetFlags(BaseModel):
+    op: Literal["set_flags"] = "set_flags"
+    node_id: str
+    is_stale: bool | None = None
+
+
+PatchOp = Annotated[
+    AddChild | LinkNode | RemoveSubtree | MoveSubtree | RenameNode | SetFlags,
+    Field(discriminator="op"),
+]
+
+
+class TreePatch(BaseModel):
+    ops: list[PatchOp]
+
+
+@dataclass
+class PatchDiff:
+    # Ids of the roots of added subtrees
+    added: list[str] = field(default_factory=list)
+    # Ids of nodes put under another parent
+    linked: list[str] = field(default_factory=list)
+    # Ids of every removed node
+    removed: list[str] = field(default_factory=list)
+    moved: list[str] = field(default_factory=list)
+    # Old id -> new id
+    renamed: dict[str, str] = field(default_factory=dict)
+    # New is_stale flag of every remaining node whose flag may have changed
+    stale: dict[str, bool] = field(default_factory=dict)
+
+
+def encode_patch(patch: TreePatch) -> bytes:
+    """
+    Encode a patch as compact JSON.
+
+    Patches that add subtrees deeper than pydantic's serializer allows (255
+    levels) are encoded by dumps_json() instead.
+    """
+    try:
+        return patch.__pydantic_serializer__.to_json(patch)
+    except PydanticSerializationError:
+        return dumps_json(patch).encode()
+
+
+def decode_patch(data: str | bytes) -> TreePatch:
+    """
+    Parse a patch encoded by encode_patch().
+
+    Raises:
+        ValueError: If it isn't a valid patch
+    """
+    try:
+        return TreePatch.model_validate_json(data)
+    except ValidationError as e:
+        # Pydantic's JSON parser gives up on deep subtrees too
+        if not any(error["type"] == "json_invalid" for error in e.errors()):
+            raise
+        return TreePatch.model_validate(loads_json(data))
+
+
+def apply_patch(
+    engine: StalenessEngine,
+    patch: TreePatch,
+    inverse: list[PatchOp] | None = None,
+) -> PatchDiff:
+    """
+    Apply a list of edit operations to the engine's tree.
+
+    Only the nodes an operation touches are validated (plus the path to the root
+    for moves), and staleness is propagated through the engine. Either every
+    operation is applied or, if one fails, none are.
+
+    Args:
+        engine: Engine tracking the tree's staleness
+        patch: Operations to apply, in order
+        inverse: If given, the operations that revert the patch (stale flags
+            included) are appended to it, once the whole patch was applied
+
+    Raises:
+        KeyError: If an operation refers to a node that doesn't exist
+        ValueError: If an operation would make the tree invalid
+    """
+    diff = PatchDiff()
+    touched: set[str] = set()
+    undo_stack: list[Callable[[], None]] = []
+    inverse_ops: list[list[PatchOp]] = []
+
+    try:
+        for op in patch.ops:
+            undo, op_inverse = _apply_op(engine, op, diff, touched)
+            undo_stack.append(undo)
+            inverse_ops.append(op_inverse)
+    except Exception:
+        for undo in reversed(undo_stack):
+            undo()
+        raise
+
+    if inverse is not None:
+        for op_inverse in reversed(inverse_ops):
+            inverse.extend(op_inverse)
+    diff.stale = {
+        node_id: engine.index.get(node_id).is_stale
+        for node_id in touched
+        if node_id in engine.index
+    }
+    return diff
+
+
+def _apply_op(
+    engine: StalenessEngine,
+    op: AddChild | LinkNode | RemoveSubtree | MoveSubtree | RenameNode | SetFlags,
+    diff: PatchDiff,
+    touched: set[str],
+) -> tuple[Callable[[], None], list[PatchOp]]:
+    """
+    Apply a single operation.
+
+    Returns:
+        A function that reverts it, and the operations that revert it
+    """
+    index = engine.index
+
+    if isinstance(op, AddChild):
+        index.get(op.parent_id)
+        node = (
+            _copy_subtree(op.node)
+            if isinstance(op.node, MbirdNode)
+            else MbirdNode.from_dict(op.node)
+        )
+        index.attach(node, op.parent_id, op.position)
+
+        marked = engine.mark_changed(node.id)
+        for descendant in list(index.iter_subtree(node.id)):
+            if descendant.is_stale:
+                marked += engine.mark_changed(descendant.id)
+        touched.update(marked)
+        diff.added.append(node.id)
+
+        def undo_add() -> None:
+            # Nodes the subtree shares with the rest of the tree stay
+            engine.forget(index.detach(node.id, op.parent_id))
+            engine.reset_stale([i for i in marked if i in index], False)
+
+        subtree_ids = {n.id for n in index.iter_subtree(node.id)}
+        inverse: list[PatchOp] = [
+            RemoveSubtree(node_id=node.id, parent_id=op.parent_id)
+        ]
+        inverse += _set_flags([i for i in marked if i not in subtree_ids], False)
+        return undo_add, inverse
+
+    if isinstance(op, LinkNode):
+        index.link(op.node_id, op.parent_id, op.position)
+        marked = engine.children_changed(op.parent_id)
+        # A node generated from its parents now has one more
+        marked += engine.parent_changed(op.node_id)
+        touched.update(marked)
+        diff.linked.append(op.node_id)
+
+        def undo_link() -> None:
+            engine.reset_stale(marked, False)
+            index.detach(op.node_id, op.parent_id)
+
+        inverse = [RemoveSubtree(node_id=op.node_id, parent_id=op.parent_id)]
+        inverse += _set_flags(marked, False)
+        return undo_link, inverse
+
+    if isinstance(op, RemoveSubtree):
+        parent_id = (
+            index.parent_id(op.node_id) if op.parent_id is None else op.parent_id
+        )
+        if parent_id is None:
+            raise ValueError("Cannot remove the root node")
+        position = index.position(op.node_id, op.parent_id)
+        # Detaching copies the parent, not the subtree, so it can be put back
+        node = index.get(op.node_id)
+        removed = index.detach(node.id, parent_id)
+        was_stale = engine.forget(removed)
+        marked = engine.children_changed(parent_id)
+        touched.update(marked)
+        diff.removed += removed
+
+        if not removed:
+            # Another parent still has the node, so this only unshared it
+            def undo_unlink() -> None:
+                engine.reset_stale(marked, False)
+                index.link(node.id, parent_id, position)
+
+            inverse = [
+                LinkNode(parent_id=parent_id, node_id=node.id, position=position)
+            ]
+            inverse += _set_flags(marked, False)
+            return undo_unlink, inverse
+
+        def undo_remove() -> None:
+            engine.reset_stale(marked, False)
+            index.attach(node, parent_id, position)
+            engine.reset_stale(was_stale, True)
+
+        inverse = _put_back(engine, node, removed, was_stale, parent_id, position)
+        inverse += _set_flags(marked, False)
+        return undo_remove, inverse
+
+    if isinstance(op, MoveSubtree):
+        old_parent_id = (
+            index.parent_id(op.node_id) if op.parent_id is None else op.parent_id
+        )
+        if old_parent_id is None:
+            raise ValueError("Cannot move the root node")
+        new_parent_id = index.get(op.new_parent_id).id
+        # The only way to create a cycle is moving a node under itself
+        if op.node_id == new_parent_id or op.node_id in index.ancestor_ids(
+            new_parent_id
+        ):
+            raise ValueError(f"Cycle detected in tree involving node: {op.node_id}")
+
+        old_position = index.position(op.node_id, op.parent_id)
+        index.move(op.node_id, new_parent_id, op.position, old_parent_id)
+
+        old_marked = engine.children_changed(old_parent_id)
+        new_marked = engine.children_changed(new_parent_id)
+        moved_marked = engine.parent_changed(op.node_id)
+        marked = old_marked + new_marked + moved_marked
+        touched.update(marked)
+        diff.moved.append(op.node_id)
+
+        def undo_move() -> None:
+            engine.reset_stale(marked, False)
+            index.move(op.node_id, old_parent_id, old_position, new_parent_id)
+
+        inverse = [
+            MoveSubtree(
+                node_id=op.node_id,
+                new_parent_id=old_parent_id,
+                position=old_position,
+                parent_id=new_parent_id,
+            )
+        ]
+        # The ancestors of both parents were marked, and either can end above
+        # the other
+        parents_marked = _deepest_first(index, old_marked, new_marked)
+        inverse += _set_flags(parents_marked + moved_marked, False)
+        return undo_move, inverse
+
+    if isinstance(op, RenameNode):
+        old_id = index.get(op.node_id).id
+        index.rename(old_id, op.new_id)
+        engine.rename(old_id, op.new_id)
+        diff.renamed[old_id] = op.new_id
+        if old_id in touched:
+            touched.discard(old_id)
+            touched.add(op.new_id)
+
+        def undo_rename() -> None:
+            index.rename(op.new_id, old_id)
+            engine.rename(op.new_id, old_id)
+
+        return undo_rename, [RenameNode(node_id=op.new_id, new_id=old_id)]
+
+    node_id = index.get(op.node_id).id
+    marked = []
+    if op.is_stale:
+        marked = engine.mark_changed(node_id)
+    elif op.is_stale is False and index.get(node_id).is_stale:
+        engine.mark_fresh(node_id)
+        marked = [node_id]
+    touched.update(marked)
+
+    def undo_set_flags() -> None:
+        # Every node in `marked` had the opposite flag before
+        engine.reset_stale(marked, not op.is_stale)
+
+    return undo_set_flags, _set_flags(marked, not op.is_stale)
+
+
+def _put_back(
+    engine: StalenessEngine,
+    node: MbirdNode,
+    removed: list[str],
+    was_stale: list[str],
+    parent_id: str,
+    position: int,
+) -> list[PatchOp]:
+    """
+    Operations that put back a removed subtree, and the flags of its nodes.
+
+    The removed nodes are added back as a copy, so later edits to the tree
+    don't change the operations. Nodes that are still in the tree (under
+    another parent), and removed nodes shared within the subtree, are left out
+    of the copy and linked back instead, so that the operations can be encoded
+    and applied again without building a node twice.
+
+    Args:
+        engine: Engine the subtree was removed from
+        node: Root of the removed subtree, as it was
+        removed: Ids of the removed nodes (see TreeIndex.detach())
+        was_stale: Ids of the removed nodes that were stale
+        parent_id: Parent the subtree was removed from
+        position: Position the subtree was removed from
+    """
+    index = engine.index
+    is_removed = set(removed)
+    copies = {node.id: construct_node(node.id, [], node.is_stale)}
+    links: list[PatchOp] = []
+    kept: list[str] = []
+    # Removed nodes in postorder, so each comes after the nodes below it
+    postorder: list[str] = []
+    stack = [(node, iter(enumerate(node.children)))]
+    while stack:
+        current, children = stack[-1]
+        step = next(children, None)
+        if step is None:
+            stack.pop()
+            postorder.append(current.id)
+            continue
+        child_position, child = step
+        if child.id in is_removed and child.id not in copies:
+            copy = construct_node(child.id, [], child.is_stale)
+            copies[current.id].children.append(copy)
+            copies[child.id] = copy
+            stack.append((child, iter(enumerate(child.children))))
+            continue
+        links.append(
+            LinkNode(parent_id=current.id, node_id=child.id, position=child_position)
+        )
+        if child.id not in is_removed:
+            kept.append(child.id)
+
+    inverse: list[PatchOp] = [
+        AddChild.model_construct(
+            op="add", parent_id=parent_id, node=copies[node.id], position=position
+        )
+    ]
+    inverse += links
+
+    # Adding the subtree back marks its root stale, and with DOWN propagation
+    # every node in it. Linking a node marks the new parent and its ancestors
+    # with UP propagation, and the node and its descendants with DOWN.
+    was_fresh = is_removed.difference(was_stale)
+    if engine.propagation is Propagation.UP:
+        if not links:
+            was_fresh &= {node.id}
+        return inverse + _set_flags([i for i in postorder if i in was_fresh], False)
+    fresh_kept = {
+        descendant.id
+        for kept_id in kept
+        for descendant in index.iter_subtree(kept_id)
+        if not descendant.is_stale
+    }
+    depths = index.depths(fresh_kept)
+    inverse += _set_flags([i for i in reversed(postorder) if i in was_fresh], False)
+    inverse += _set_flags(sorted(fresh_kept, key=depths.__getitem__), False)
+    return inverse
+
+
+def _copy_subtree(root: MbirdNode) -> MbirdNode:
+    """Copy a subtree, keeping the nodes it shares within itself shared."""
+    copies = {root.id: construct_node(root.id, [], root.is_stale)}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        children = copies[node.id].children
+        for child in node.children:
+            copy = copies.get(child.id)
+            if copy is None:
+                copy = construct_node(child.id, [], child.is_stale)
+                copies[child.id] = copy
+                stack.append(child)
+            children.append(copy)
+    return copies[root.id]
+
+
+def _set_flags(node_ids: list[str], is_stale: bool) -> list[PatchOp]:
+    """
+    Operations that set the nodes' flags, in order.
+
+    Nodes are only marked fresh once their dependencies are, so the nodes must
+    be in dependency order (as the engine marks them).
+    """
+    return [SetFlags(node_id=node_id, is_stale=is_stale) for node_id in node_ids]
+
+
+def _deepest_first(index: TreeIndex, *node_ids: list[str]) -> list[str]:
+    """Merge lists of node ids (dropping repeats), deepest nodes first."""
+    merged = list(dict.fromkeys(chain(*node_ids)))
+    depths = index.depths(merged)
+    return sorted(merged, key=depths.__getitem__, reverse=True)
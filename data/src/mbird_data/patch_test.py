@@ -0,0 +1,217 @@
+from contextlib import suppress
+from typing import Any
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.hashing import subtree_digest
+from mbird_data.index import TreeIndex
+from mbird_data.patch import TreePatch, apply_patch
+from mbird_data.staleness import StalenessEngine
+
+
+@pytest.fixture
+def engine() -> StalenessEngine:
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "is_stale": False,
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": False,
+                    "children": [{"id": "a1", "is_stale": False}],
+                },
+                {"id": "b", "is_stale": False},
+            ],
+        }
+    )
+    return StalenessEngine(TreeIndex(root))
+
+
+def patch(*ops: dict[str, Any]) -> TreePatch:
+    return TreePatch.model_validate({"ops": list(ops)})
+
+
+def test_add_child_inserts_subtree_and_marks_ancestors_stale(
+    engine: StalenessEngine,
+):
+    diff = apply_patch(
+        engine,
+        patch(
+            {
+                "op": "add",
+                "parent_id": "a",
+                "node": {"id": "new", "children": [{"id": "new_child"}]},
+                "position": 0,
+            }
+        ),
+    )
+
+    a = engine.index.get("a")
+    assert [child.id for child in a.children] == ["new", "a1"]
+    assert engine.index.parent_id("new_child") == "new"
+    assert diff.added == ["new"]
+    assert diff.stale == {
+        "new": True,
+        "new_child": True,
+        "a": True,
+        "root": True,
+    }
+    assert engine.index.get("b").is_stale is False
+
+
+def test_remove_subtree_drops_nodes_and_marks_parent_stale(
+    engine: StalenessEngine,
+):
+    diff = apply_patch(engine, patch({"op": "remove", "node_id": "a"}))
+
+    assert [child.id for child in engine.index.root.children] == ["b"]
+    assert "a1" not in engine.index
+    assert diff.removed == ["a", "a1"]
+    assert diff.stale == {"root": True}
+
+
+def test_move_subtree_updates_parents(engine: StalenessEngine):
+    diff = apply_patch(
+        engine, patch({"op": "move", "node_id": "a1", "new_parent_id": "b"})
+    )
+
+    assert engine.index.get("a").children == []
+    assert [child.id for child in engine.index.get("b").children] == ["a1"]
+    assert engine.index.parent_id("a1") == "b"
+    assert diff.moved == ["a1"]
+    assert diff.stale == {"a": True, "b": True, "root": True}
+
+
+def test_move_under_own_descendant_is_rejected(engine: StalenessEngine):
+    with pytest.raises(ValueError, match="Cycle detected .* node: a"):
+        apply_patch(
+            engine, patch({"op": "move", "node_id": "a", "new_parent_id": "a1"})
+        )
+
+    assert engine.index.parent_id("a") == "root"
+
+
+def test_rename_updates_index(engine: StalenessEngine):
+    diff = apply_patch(
+        engine, patch({"op": "rename", "node_id": "a", "new_id": "renamed"})
+    )
+
+    assert "a" not in engine.index
+    assert engine.index.parent_id("a1") == "renamed"
+    assert engine.index.root.children[0].id == "renamed"
+    assert diff.renamed == {"a": "renamed"}
+
+
+def test_rename_to_existing_id_is_rejected(engine: StalenessEngine):
+    with pytest.raises(ValueError, match="Duplicate node id: b"):
+        apply_patch(engine, patch({"op": "rename", "node_id": "a", "new_id": "b"}))
+
+
+def test_set_flags_marks_dependents_stale(engine: StalenessEngine):
+    diff = apply_patch(
+        engine, patch({"op": "set_flags", "node_id": "a1", "is_stale": True})
+    )
+
+    assert diff.stale == {"a1": True, "a": True, "root": True}
+
+    diff = apply_patch(
+        engine, patch({"op": "set_flags", "node_id": "a1", "is_stale": False})
+    )
+    assert diff.stale == {"a1": False}
+
+
+def test_set_fresh_with_stale_dependencies_is_rejected(engine: StalenessEngine):
+    engine.mark_changed("a1")
+
+    with pytest.raises(ValueError, match="stale dependencies"):
+        apply_patch(
+            engine, patch({"op": "set_flags", "node_id": "a", "is_stale": False})
+        )
+
+
+def test_failed_patch_rolls_back_earlier_operations(engine: StalenessEngine):
+    before = engine.index.root.model_dump()
+
+    with pytest.raises(KeyError):
+        apply_patch(
+            engine,
+            patch(
+                {"op": "add", "parent_id": "b", "node": {"id": "new"}},
+                {"op": "move", "node_id": "a1", "new_parent_id": "new"},
+                {"op": "rename", "node_id": "a", "new_id": "renamed"},
+                {"op": "remove", "node_id": "b"},
+                {"op": "remove", "node_id": "missing"},
+            ),
+        )
+
+    assert engine.index.root.model_dump() == before
+    assert len(engine.index) == 4
+    assert engine.index.parent_id("a1") == "a"
+    assert engine.stale_ids == frozenset()
+
+
+def test_removing_root_is_rejected(engine: StalenessEngine):
+    with pytest.raises(ValueError, match="Cannot remove the root"):
+        apply_patch(engine, patch({"op": "remove", "node_id": "root"}))
+
+
+@pytest.mark.parametrize(
+    "ops",
+    [
+        [{"op": "add", "parent_id": "a1", "node": {"id": "new"}}],
+        [{"op": "remove", "node_id": "a1"}],
+        [{"op": "move", "node_id": "a1", "new_parent_id": "b"}],
+        [{"op": "rename", "node_id": "a1", "new_id": "renamed"}],
+        [{"op": "set_flags", "node_id": "b", "is_stale": True}],
+        [
+            {"op": "add", "parent_id": "b", "node": {"id": "new"}},
+            {"op": "remove", "node_id": "missing"},
+        ],
+        [{"op": "link", "parent_id": "b", "node_id": "a1"}],
+        [
+            {"op": "link", "parent_id": "b", "node_id": "a1"},
+            {"op": "set_flags", "node_id": "a1", "is_stale": True},
+        ],
+    ],
+)
+def test_patched_tree_digest_matches_recomputed_digest(
+    engine: StalenessEngine, ops: list[dict[str, Any]]
+):
+    index = engine.index
+    index.digest("root")
+
+    with suppress(KeyError):
+        apply_patch(engine, patch(*ops))
+
+    assert index.digest("root") == subtree_digest(index.root)
+
+
+def test_link_shares_node_and_marks_both_parents_stale(engine: StalenessEngine):
+    diff = apply_patch(engine, patch({"op": "link", "parent_id": "b", "node_id": "a1"}))
+
+    index = engine.index
+    assert index.get("b").children[-1] is index.get("a").children[0]
+    assert index.parent_ids("a1") == ["a", "b"]
+    assert diff.linked == ["a1"]
+    assert diff.stale == {"b": True, "root": True}
+
+
+def test_shared_node_is_removed_from_one_parent_at_a_time(engine: StalenessEngine):
+    apply_patch(engine, patch({"op": "link", "parent_id": "b", "node_id": "a1"}))
+
+    with pytest.raises(ValueError, match="several parents"):
+        apply_patch(engine, patch({"op": "remove", "node_id": "a1"}))
+    diff = apply_patch(
+        engine, patch({"op": "remove", "node_id": "a1", "parent_id": "a"})
+    )
+
+    assert diff.removed == []
+    assert engine.index.parent_ids("a1") == ["b"]
+    assert engine.index.get("a").children == []
+
+
+def test_link_that_makes_a_cycle_is_rejected(engine: StalenessEngine):
+    with pytest.raises(ValueError, match="Cycle detected"):
+        apply_patch(engine, patch({"op": "link", "parent_id": "a1", "node_id": "a"}))
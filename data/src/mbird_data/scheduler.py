@@ -0,0 +1,254 @@
+import asyncio
+from collections import deque
+from collections.abc import Callable, Iterable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    BrokenExecutor,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Any
+
+from mbird_data.hashing import node_digest
+from mbird_data.models import MbirdNode
+from mbird_data.staleness import Propagation, StalenessEngine
+
+
+@dataclass
+class RegenerationResult:
+    # Ids of regenerated nodes (including skipped ones), in completion order
+    regenerated: list[str] = field(default_factory=list)
+    # Ids of nodes marked fresh without running the per-node work, since their
+    # subtree is the same as when they were last generated
+    skipped: list[str] = field(default_factory=list)
+    # Seconds spent in the per-node work, by node id
+    timings: dict[str, float] = field(default_factory=dict)
+    cancelled: bool = False
+
+
+class WorkPlan:
+    """
+    Dependency graph between the stale nodes of a tree.
+
+    A node is ready once every stale node it depends on has been regenerated.
+    """
+
+    def __init__(self, engine: StalenessEngine):
+        stale_ids = engine.stale_ids
+        self._pending = dict.fromkeys(stale_ids, 0)
+        self._dependents: dict[str, list[str]] = {}
+
+        for node_id in stale_ids:
+            # Shared nodes have an edge to each of their parents, so they're
+            # still only regenerated once
+            for parent_id in engine.index.parent_ids(node_id):
+                if parent_id not in stale_ids:
+                    continue
+                if engine.propagation is Propagation.UP:
+                    dependency, dependent = node_id, parent_id
+                else:
+                    dependency, dependent = parent_id, node_id
+                self._dependents.setdefault(dependency, []).append(dependent)
+                self._pending[dependent] += 1
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def ready(self) -> list[str]:
+        """Ids of nodes with no unfinished dependencies."""
+        return [node_id for node_id, count in self._pending.items() if count == 0]
+
+    def complete(self, node_id: str) -> list[str]:
+        """
+        Record that a node finished.
+
+        Returns:
+            Ids of nodes that became ready as a result
+        """
+        ready = []
+        for dependent in self._dependents.get(node_id, []):
+            self._pending[dependent] -= 1
+            if self._pending[dependent] == 0:
+                ready.append(dependent)
+        return ready
+
+
+def _fresh_digest(engine: StalenessEngine, node_id: str) -> bytes:
+    """Digest a node's subtree will have once the node is marked fresh."""
+    node = engine.index.get(node_id)
+    child_digests = [engine.index.digest(child.id) for child in node.children]
+    return node_digest(node.id, False, child_digests)
+
+
+def _timed_call(generate: Callable[[MbirdNode], Any], node: MbirdNode) -> float:
+    start = time.perf_counter()
+    generate(node)
+    return time.perf_counter() - start
+
+
+class RegenerationScheduler:
+    """
+    Regenerates stale nodes concurrently, dependencies first.
+
+    Independent nodes (e.g. sibling subtrees) run in parallel on a thread or
+    process pool. With a process pool, `generate` must be picklable and receives
+    a copy of the node without its children, so changes it makes to the node
+    aren't seen by the caller. The pool is started by the first run and kept
+    for later ones, until close().
+
+    When nodes are generated from their children (Propagation.UP), the scheduler
+    remembers each node's subtree digest when it was generated. A stale node
+    whose subtree has the same digest once its children are fresh again, e.g.
+    after a child was added and removed, is marked fresh without regenerating.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[MbirdNode], Any],
+        max_workers: int | None = None,
+        use_processes: bool = False,
+    ):
+        self.generate = generate
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self._cancel_event = threading.Event()
+        # Digest of each node's subtree when it was last generated, by node id
+        self._generated: dict[str, bytes] = {}
+        self._executor: Executor | None = None
+        self._executor_lock = threading.Lock()
+
+    def close(self) -> None:
+        """
+        Shut down the worker pool, waiting for running nodes to finish.
+
+        Nodes that haven't started are dropped. A later run starts a new pool.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def cancel(self) -> None:
+        """
+        Stop starting new nodes in the current run.
+
+        Nodes already running finish, and everything not yet regenerated stays
+        stale.
+        """
+        self._cancel_event.set()
+
+    def run(
+        self,
+        engine: StalenessEngine,
+        progress: Callable[[str], None] | None = None,
+    ) -> RegenerationResult:
+        """
+        Regenerate every stale node tracked by the engine.
+
+        Args:
+            engine: Engine tracking the stale nodes
+            progress: Called with each node's id once it's fresh, from the
+                thread running the regeneration
+        """
+        self._cancel_event = cancel_event = threading.Event()
+        result = RegenerationResult()
+        plan = WorkPlan(engine)
+        if not plan:
+            return result
+
+        executor = self._get_executor()
+        running: dict[Future[float], str] = {}
+        error: BaseException | None = None
+        reuse = engine.propagation is Propagation.UP
+
+        def submit(node_ids: Iterable[str]) -> None:
+            queue = deque(node_ids)
+            while queue:
+                node_id = queue.popleft()
+                generated = self._generated.get(node_id) if reuse else None
+                if generated is not None and generated == _fresh_digest(
+                    engine, node_id
+                ):
+                    engine.mark_fresh(node_id)
+                    result.regenerated.append(node_id)
+                    result.skipped.append(node_id)
+                    if progress is not None:
+                        progress(node_id)
+                    if not cancel_event.is_set():
+                        queue.extend(plan.complete(node_id))
+                    continue
+
+                node = engine.index.get(node_id)
+                if self.use_processes:
+                    node = node.model_copy(update={"children": []})
+                future = executor.submit(_timed_call, self.generate, node)
+                running[future] = node_id
+
+        try:
+            submit(plan.ready())
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node_id = running.pop(future)
+                    if future.cancelled():
+                        continue
+                    try:
+                        seconds = future.result()
+                    except BaseException as e:
+                        error = error or e
+                        continue
+
+                    engine.mark_fresh(node_id)
+                    if reuse:
+                        self._generated[node_id] = engine.index.digest(node_id)
+                    result.regenerated.append(node_id)
+                    result.timings[node_id] = seconds
+                    if progress is not None:
+                        progress(node_id)
+                    if error is None and not cancel_event.is_set():
+                        submit(plan.complete(node_id))
+
+                if error is not None or cancel_event.is_set():
+                    # Drop queued nodes that haven't started yet
+                    for future in running:
+                        future.cancel()
+        except BrokenExecutor:
+            self._drop_executor(executor)
+            raise
+
+        if isinstance(error, BrokenExecutor):
+            self._drop_executor(executor)
+        if error is not None:
+            raise error
+        result.cancelled = len(result.regenerated) < len(plan)
+        return result
+
+    def _get_executor(self) -> Executor:
+        with self._executor_lock:
+            if self._executor is None:
+                if self.use_processes:
+                    self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def _drop_executor(self, executor: Executor) -> None:
+        """Stop using a pool that broke, e.g. because a worker process died."""
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    async def run_async(
+        self,
+        engine: StalenessEngine,
+        progress: Callable[[str], None] | None = None,
+    ) -> RegenerationResult:
+        """Run regeneration in a worker thread, without blocking the event loop."""
+        return await asyncio.to_thread(self.run, engine, progress)
@@ -0,0 +1,214 @@
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import time
+from typing import Any
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data import scheduler as scheduler_module
+from mbird_data.index import TreeIndex
+from mbird_data.scheduler import RegenerationScheduler
+from mbird_data.staleness import Propagation, StalenessEngine
+
+
+def make_engine(propagation: Propagation = Propagation.UP) -> StalenessEngine:
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "a1"}, {"id": "a2"}]},
+                {"id": "b", "children": [{"id": "b1"}]},
+            ],
+        }
+    )
+    return StalenessEngine(TreeIndex(root), propagation=propagation)
+
+
+def process_safe_generate(node: MbirdNode) -> None:
+    time.sleep(0.001)
+
+
+def test_children_finish_before_parents():
+    engine = make_engine()
+    finished: list[str] = []
+    lock = threading.Lock()
+
+    def generate(node: MbirdNode) -> None:
+        with lock:
+            assert all(child.id in finished for child in node.children)
+            finished.append(node.id)
+
+    result = RegenerationScheduler(generate, max_workers=4).run(engine)
+
+    assert set(result.regenerated) == {"root", "a", "a1", "a2", "b", "b1"}
+    assert result.regenerated[-1] == "root"
+    assert set(result.timings) == set(result.regenerated)
+    assert result.cancelled is False
+    assert engine.stale_ids == frozenset()
+
+
+def test_down_propagation_runs_parents_first():
+    engine = make_engine(Propagation.DOWN)
+    engine.regenerate()
+    engine.mark_changed("a")
+    order: list[str] = []
+
+    result = RegenerationScheduler(lambda node: order.append(node.id)).run(engine)
+
+    assert order[0] == "a"
+    assert set(result.regenerated) == {"a", "a1", "a2"}
+
+
+def test_independent_subtrees_run_concurrently():
+    engine = make_engine()
+    barrier = threading.Barrier(3, timeout=5)
+
+    def generate(node: MbirdNode) -> None:
+        # All three leaves must be running at the same time to pass the barrier
+        if not node.children:
+            barrier.wait()
+
+    result = RegenerationScheduler(generate, max_workers=4).run(engine)
+
+    assert len(result.regenerated) == 6
+
+
+def test_process_pool_regenerates_all_nodes():
+    engine = make_engine()
+    scheduler = RegenerationScheduler(
+        process_safe_generate, max_workers=2, use_processes=True
+    )
+
+    result = scheduler.run(engine)
+    scheduler.close()
+
+    assert result.regenerated[-1] == "root"
+    assert len(result.regenerated) == 6
+    assert engine.stale_ids == frozenset()
+
+
+def test_process_pool_is_kept_until_closed(monkeypatch: pytest.MonkeyPatch):
+    pools: list[ProcessPoolExecutor] = []
+
+    class RecordingPool(ProcessPoolExecutor):
+        def __init__(self, *args: Any, **kwargs: Any):
+            super().__init__(*args, **kwargs)
+            pools.append(self)
+
+    monkeypatch.setattr(scheduler_module, "ProcessPoolExecutor", RecordingPool)
+    scheduler = RegenerationScheduler(
+        process_safe_generate, max_workers=2, use_processes=True
+    )
+
+    scheduler.run(make_engine(Propagation.DOWN))
+    scheduler.run(make_engine(Propagation.DOWN))
+    assert len(pools) == 1
+
+    scheduler.close()
+    with pytest.raises(RuntimeError):
+        pools[0].submit(process_safe_generate, MbirdNode(id="a"))
+    # A later run starts a new pool
+    result = scheduler.run(make_engine(Propagation.DOWN))
+    scheduler.close()
+    assert len(pools) == 2
+    assert len(result.regenerated) == 6
+
+
+def test_cancel_leaves_remaining_nodes_stale():
+    engine = make_engine()
+
+    def generate(node: MbirdNode) -> None:
+        scheduler.cancel()
+
+    scheduler = RegenerationScheduler(generate, max_workers=1)
+    result = scheduler.run(engine)
+
+    assert result.cancelled is True
+    assert len(result.regenerated) < 6
+    assert "root" in engine.stale_ids
+
+
+def test_failed_node_stops_scheduling_and_raises():
+    engine = make_engine()
+
+    def generate(node: MbirdNode) -> None:
+        if node.id == "a1":
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        RegenerationScheduler(generate, max_workers=1).run(engine)
+
+    assert {"a1", "a", "root"} <= engine.stale_ids
+
+
+def test_nothing_stale_returns_empty_result():
+    engine = make_engine()
+    engine.regenerate()
+
+    result = RegenerationScheduler(process_safe_generate).run(engine)
+
+    assert result.regenerated == []
+    assert result.cancelled is False
+
+
+def test_unchanged_subtrees_are_not_generated_again():
+    engine = make_engine()
+    calls: list[str] = []
+    scheduler = RegenerationScheduler(lambda node: calls.append(node.id))
+    scheduler.run(engine)
+    calls.clear()
+
+    # Added and removed again before regenerating: "a" is stale but unchanged
+    engine.index.add_subtree(MbirdNode(id="tmp"), "a")
+    engine.children_changed("a")
+    engine.forget(engine.index.remove_subtree("tmp"))
+    # Marked stale without changing
+    engine.mark_changed("a1")
+    # Actually changed
+    b2 = MbirdNode(id="b2")
+    engine.index.get("b").children.append(b2)
+    engine.index.add_subtree(b2, "b")
+    engine.mark_changed("b2")
+
+    result = scheduler.run(engine)
+
+    assert sorted(calls) == ["b", "b2", "root"]
+    assert sorted(result.skipped) == ["a", "a1"]
+    assert set(result.regenerated) == {"a", "a1", "b", "b2", "root"}
+    assert engine.stale_ids == frozenset()
+
+
+def test_progress_reports_each_fresh_node():
+    engine = make_engine()
+    reported: list[str] = []
+
+    result = RegenerationScheduler(lambda node: None).run(engine, reported.append)
+
+    assert reported == result.regenerated
+
+
+def test_shared_node_runs_once_before_every_parent():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "s", "children": [{"id": "s1"}]}]},
+                {"id": "b", "children": [{"ref": "s"}]},
+                {"id": "c", "children": [{"ref": "b"}]},
+            ],
+        }
+    )
+    engine = StalenessEngine(TreeIndex(root))
+    finished: list[str] = []
+    lock = threading.Lock()
+
+    def generate(node: MbirdNode) -> None:
+        with lock:
+            assert all(child.id in finished for child in node.children)
+            finished.append(node.id)
+
+    RegenerationScheduler(generate, max_workers=4).run(engine)
+
+    assert sorted(finished) == ["a", "b", "c", "root", "s", "s1"]
+    assert not engine.stale_ids
@@ -0,0 +1,217 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+
+from mbird_data.index import TreeIndex
+from mbird_data.patch import PatchDiff
+
+# Length of the substrings of ids that are indexed. Shorter queries scan every
+# id instead.
+GRAM_LENGTH = 3
+# Ids added (or removed) at once past which the sorted ids are rebuilt, rather
+# than updated one by one
+SORTED_INSERTS = 64
+
+
+@dataclass
+class SearchHit:
+    id: str
+    # Ids from the root down to the node, through each node's first parent
+    path: list[str]
+    is_stale: bool
+
+
+@dataclass
+class SearchPage:
+    hits: list[SearchHit]
+    # Number of nodes that match, on every page
+    total: int
+
+
+def _grams(key: str) -> set[str]:
+    return {key[i : i + GRAM_LENGTH] for i in range(len(key) - GRAM_LENGTH + 1)}
+
+
+class NodeSearch:
+    """
+    Lookup of the nodes of an indexed tree by (part of) their id.
+
+    Ids are matched ignoring case, by prefix (with a sorted list of the ids) or
+    by substring (with the ids' trigrams). Results can be filtered by stale
+    flag, depth and subtree, which are read from the tree when searching, so
+    only changes to ids (see update()) need to be passed on.
+    """
+
+    def __init__(self, index: TreeIndex):
+        self.index = index
+        # (lowercased id, id), sorted
+        self._keys = sorted((node.id.lower(), node.id) for node in index)
+        self._ids = {node_id for _, node_id in self._keys}
+        # Ids containing each trigram of the lowercased ids
+        grams: defaultdict[str, list[str]] = defaultdict(list)
+        for key, node_id in self._keys:
+            for i in range(len(key) - GRAM_LENGTH + 1):
+                grams[key[i : i + GRAM_LENGTH]].append(node_id)
+        self._grams = {gram: set(node_ids) for gram, node_ids in grams.items()}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, node_id: object) -> bool:
+        return node_id in self._ids
+
+    def update(self, diff: PatchDiff) -> None:
+        """
+        Catch up with the changes to the tree's ids that a patch made.
+
+        Nodes that are no longer in the tree are dropped, and those that are new
+        (including the descendants of added nodes) are added.
+        """
+        self._remove([*diff.renamed, *diff.removed])
+
+        added = [node_id for node_id in diff.renamed.values() if node_id in self.index]
+        for root_id in diff.added:
+            # It may have been renamed later in the same patch
+            seen = set()
+            while root_id not in self.index and root_id in diff.renamed:
+                if root_id in seen:
+                    break
+                seen.add(root_id)
+                root_id = diff.renamed[root_id]
+            if root_id not in self.index:
+                continue
+            added += [node.id for node in self.index.iter_subtree(root_id)]
+        self._add(added)
+
+    def search(
+        self,
+        query: str = "",
+        prefix: bool = False,
+        is_stale: bool | None = None,
+        min_depth: int | None = None,
+        max_depth: int | None = None,
+        under: str | None = None,
+        offset: int = 0,
+        limit: int = 50,
+    ) -> SearchPage:
+        """
+        Find the nodes whose id matches a query, ordered by id.
+
+        Args:
+            query: Text the ids contain (ignoring case), or everything if empty
+            prefix: Only match ids that start with the query
+            is_stale: Only match nodes with this stale flag
+            min_depth: Only match nodes at least this deep (see
+                TreeIndex.depth())
+            max_depth: Only match nodes at most this deep
+            under: Only match this node and its descendants
+            offset: Number of matches to skip
+            limit: Number of matches to return
+
+        Returns:
+            A page of matches, and how many there are in all
+
+        Raises:
+            KeyError: If `under` isn't in the tree
+        """
+        node_ids: Iterable[str] = self._matching(query.lower(), prefix)
+
+        if under is not None:
+            subtree = {node.id for node in self.index.iter_subtree(under)}
+            node_ids = (node_id for node_id in node_ids if node_id in subtree)
+        if is_stale is not None:
+            node_ids = (
+                node_id
+                for node_id in node_ids
+                if self.index.get(node_id).is_stale == is_stale
+            )
+        matches = list(node_ids)
+        if min_depth is not None or max_depth is not None:
+            depths = self.index.depths(matches)
+            if min_depth is not None:
+                matches = [i for i in matches if depths[i] >= min_depth]
+            if max_depth is not None:
+                matches = [i for i in matches if depths[i] <= max_depth]
+
+        hits = [
+            SearchHit(
+                id=node_id,
+                path=self.path(node_id),
+                is_stale=self.index.get(node_id).is_stale,
+            )
+            for node_id in matches[offset : offset + limit]
+        ]
+        return SearchPage(hits=hits, total=len(matches))
+
+    def path(self, node_id: str) -> list[str]:
+        """
+        Ids from the root down to a node, through each node's first parent.
+
+        Raises:
+            KeyError: If the node isn't in the tree
+        """
+        path = [self.index.get(node_id).id]
+        parent_id = self.index.parent_id(node_id)
+        while parent_id is not None:
+            path.append(parent_id)
+            parent_id = self.index.parent_id(parent_id)
+        path.reverse()
+        return path
+
+    def _matching(self, query: str, prefix: bool) -> list[str]:
+        """Ids matching a lowercased query, in order."""
+        if not query:
+            return [node_id for _, node_id in self._keys]
+        if prefix:
+            return list(self._prefixed(query))
+        if len(query) < GRAM_LENGTH:
+            return [node_id for key, node_id in self._keys if query in key]
+
+        # Ids with every trigram of the query, starting from the rarest
+        postings = sorted(
+            (self._grams.get(gram, set()) for gram in _grams(query)), key=len
+        )
+        candidates = postings[0].intersection(*postings[1:])
+        keys = sorted((node_id.lower(), node_id) for node_id in candidates)
+        return [node_id for key, node_id in keys if query in key]
+
+    def _prefixed(self, query: str) -> Iterator[str]:
+        keys = self._keys
+        for position in range(bisect_left(keys, (query,)), len(keys)):
+            key, node_id = keys[position]
+            if not key.startswith(query):
+                return
+            yield node_id
+
+    def _add(self, node_ids: list[str]) -> None:
+        new_ids = [
+            node_id for node_id in dict.fromkeys(node_ids) if node_id not in self
+        ]
+        new_keys = [(node_id.lower(), node_id) for node_id in new_ids]
+        if len(new_keys) > SORTED_INSERTS:
+            # Sorting the mostly sorted list is cheaper than shifting it for each
+            self._keys += new_keys
+            self._keys.sort()
+        else:
+            for new_key in new_keys:
+                insort(self._keys, new_key)
+        self._ids.update(new_ids)
+        for key, node_id in new_keys:
+            for gram in _grams(key):
+                self._grams.setdefault(gram, set()).add(node_id)
+
+    def _remove(self, node_ids: list[str]) -> None:
+        old_ids = {node_id for node_id in node_ids if node_id in self}
+        if len(old_ids) > SORTED_INSERTS:
+            self._keys = [key for key in self._keys if key[1] not in old_ids]
+        else:
+            for node_id in old_ids:
+                del self._keys[bisect_left(self._keys, (node_id.lower(), node_id))]
+        self._ids -= old_ids
+        for node_id in old_ids:
+            for gram in _grams(node_id.lower()):
+                ids = self._grams[gram]
+                ids.discard(node_id)
+                if not ids:
+                    del self._grams[gram]
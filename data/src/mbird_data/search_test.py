@@ -0,0 +1,133 @@
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.index import TreeIndex
+from mbird_data.patch import (
+    AddChild,
+    MoveSubtree,
+    RemoveSubtree,
+    RenameNode,
+    TreePatch,
+    apply_patch,
+)
+from mbird_data.search import SORTED_INSERTS, NodeSearch
+from mbird_data.staleness import StalenessEngine
+
+
+@pytest.fixture
+def engine() -> StalenessEngine:
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "is_stale": False,
+            "children": [
+                {
+                    "id": "Drums",
+                    "is_stale": False,
+                    "children": [
+                        {"id": "kick", "is_stale": False},
+                        {"id": "snare", "is_stale": True},
+                    ],
+                },
+                {
+                    "id": "bass",
+                    "is_stale": False,
+                    "children": [{"id": "bassline", "is_stale": False}],
+                },
+            ],
+        }
+    )
+    return StalenessEngine(TreeIndex(root))
+
+
+def ids(search: NodeSearch, **kwargs) -> list[str]:
+    return [hit.id for hit in search.search(**kwargs).hits]
+
+
+def test_search_matches_substrings_ignoring_case(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+
+    assert ids(search, query="ass") == ["bass", "bassline"]
+    assert ids(search, query="DRU") == ["Drums"]
+    # Shorter than a trigram
+    assert ids(search, query="k") == ["kick"]
+    assert ids(search, query="nope") == []
+    assert len(ids(search)) == 6
+
+
+def test_search_matches_prefixes(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+
+    assert ids(search, query="bass", prefix=True) == ["bass", "bassline"]
+    assert ids(search, query="ass", prefix=True) == []
+    assert ids(search, query="d", prefix=True) == ["Drums"]
+
+
+def test_search_returns_paths(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+
+    [hit] = search.search(query="snare").hits
+
+    assert hit.path == ["root", "Drums", "snare"]
+    assert hit.is_stale
+
+
+def test_search_filters(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+
+    # snare and the nodes generated from it
+    assert ids(search, is_stale=True) == ["Drums", "root", "snare"]
+    assert ids(search, is_stale=False) == ["bass", "bassline", "kick"]
+    assert ids(search, min_depth=2) == ["bassline", "kick", "snare"]
+    assert ids(search, max_depth=1) == ["bass", "Drums", "root"]
+    assert ids(search, under="Drums") == ["Drums", "kick", "snare"]
+    assert ids(search, query="s", under="bass", max_depth=1) == ["bass"]
+    with pytest.raises(KeyError):
+        search.search(under="missing")
+
+
+def test_search_pages(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+
+    page = search.search(offset=2, limit=2)
+
+    assert [hit.id for hit in page.hits] == ["Drums", "kick"]
+    assert page.total == 6
+
+
+def test_update_follows_patches(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+    patch = TreePatch(
+        ops=[
+            AddChild(
+                parent_id="root",
+                node={"id": "keys", "children": [{"id": "organ"}]},
+            ),
+            RenameNode(node_id="keys", new_id="synths"),
+            RemoveSubtree(node_id="bass"),
+            MoveSubtree(node_id="kick", new_parent_id="synths"),
+        ]
+    )
+
+    search.update(apply_patch(engine, patch))
+
+    assert ids(search) == ["Drums", "kick", "organ", "root", "snare", "synths"]
+    assert ids(search, query="keys") == []
+    assert ids(search, query="syn") == ["synths"]
+    assert search.search(query="kick").hits[0].path == ["root", "synths", "kick"]
+
+
+def test_update_adds_and_removes_many_nodes(engine: StalenessEngine):
+    search = NodeSearch(engine.index)
+    count = SORTED_INSERTS * 2
+    node = {"id": "many", "children": [{"id": f"n{i:03}"} for i in range(count)]}
+
+    search.update(
+        apply_patch(engine, TreePatch(ops=[AddChild(parent_id="root", node=node)]))
+    )
+    assert search.search(query="n0", prefix=True).total == 100
+    assert len(search) == 6 + 1 + count
+
+    search.update(apply_patch(engine, TreePatch(ops=[RemoveSubtree(node_id="many")])))
+    assert search.search(query="n0", prefix=True).total == 0
+    assert ids(search) == ["bass", "bassline", "Drums", "kick", "root", "snare"]
@@ -0,0 +1,155 @@
+from collections.abc import Callable
+from enum import Enum
+
+from mbird_data.index import TreeIndex
+from mbird_data.models import MbirdNode
+
+
+class Propagation(str, Enum):
+    """Which nodes depend on a node, and so go stale when it changes."""
+
+    # A node is generated from its children: changes make ancestors stale
+    UP = "up"
+    # A node is generated from its parent: changes make descendants stale
+    DOWN = "down"
+
+
+class StalenessEngine:
+    """
+    Tracks which nodes are stale so regeneration only visits those.
+
+    The set of stale nodes is kept closed under propagation: whenever a node is
+    stale, every node that depends on it is too. Marking a node therefore stops
+    as soon as it reaches an already-stale node, and regenerating costs
+    O(stale nodes) rather than O(tree).
+    """
+
+    def __init__(self, index: TreeIndex, propagation: Propagation = Propagation.UP):
+        self.index = index
+        self.propagation = propagation
+        self._stale: set[str] = set()
+
+        # Nodes loaded as stale make their dependents stale too
+        for node in list(index):
+            if node.is_stale:
+                self.mark_changed(node.id)
+
+    @property
+    def stale_ids(self) -> frozenset[str]:
+        return frozenset(self._stale)
+
+    def mark_changed(self, node_id: str) -> list[str]:
+        """
+        Mark a node and every node that depends on it as stale.
+
+        Returns:
+            Ids of the nodes that weren't stale before, dependencies first
+        """
+        self.index.get(node_id)
+        up = self.propagation is Propagation.UP
+        marked = []
+        stack = [node_id]
+        while stack:
+            current_id = stack.pop()
+            if current_id in self._stale:
+                continue
+            self._mark_stale(current_id)
+            marked.append(current_id)
+            if up:
+                stack.extend(self.index.parent_ids(current_id))
+            else:
+                stack.extend(child.id for child in self.index.get(current_id).children)
+
+        # Walking a tree reaches dependencies first, but a shared node can be
+        # reached before a node it depends on
+        if self.index.num_shared and len(marked) > 1:
+            depths = self.index.depths(marked)
+            marked.sort(key=depths.__getitem__, reverse=up)
+        return marked
+
+    def children_changed(self, node_id: str) -> list[str]:
+        """Record that children were attached to or detached from a node."""
+        if self.propagation is Propagation.UP:
+            return self.mark_changed(node_id)
+        return []
+
+    def parent_changed(self, node_id: str) -> list[str]:
+        """Record that a node was moved under a different parent."""
+        if self.propagation is Propagation.DOWN:
+            return self.mark_changed(node_id)
+        return []
+
+    def has_stale_dependencies(self, node_id: str) -> bool:
+        if self.propagation is Propagation.UP:
+            return any(
+                child.id in self._stale for child in self.index.get(node_id).children
+            )
+        return any(
+            parent_id in self._stale for parent_id in self.index.parent_ids(node_id)
+        )
+
+    def forget(self, node_ids: list[str]) -> list[str]:
+        """
+        Stop tracking nodes that were removed from the tree.
+
+        Returns:
+            Ids of the forgotten nodes that were stale
+        """
+        was_stale = [node_id for node_id in node_ids if node_id in self._stale]
+        self._stale.difference_update(was_stale)
+        return was_stale
+
+    def rename(self, old_id: str, new_id: str) -> None:
+        """Carry a node's staleness over to its new id."""
+        if old_id in self._stale:
+            self._stale.discard(old_id)
+            self._stale.add(new_id)
+
+    def reset_stale(self, node_ids: list[str], is_stale: bool) -> None:
+        """Set flags directly, without propagating (for undoing changes)."""
+        for node_id in node_ids:
+            self.index.set_stale(node_id, is_stale)
+            if is_stale:
+                self._stale.add(node_id)
+            else:
+                self._stale.discard(node_id)
+
+    def regenerate(
+        self, generate: Callable[[MbirdNode], None] | None = None
+    ) -> list[str]:
+        """
+        Regenerate only the stale nodes, dependencies first.
+
+        Args:
+            generate: Optional per-node work, called before the node is
+                marked fresh
+
+        Returns:
+            Ids of the regenerated nodes, in the order they were processed
+        """
+        # Dependencies of a node are deeper (UP) or shallower (DOWN) than it
+        deepest_first = self.propagation is Propagation.UP
+        depths = self.index.depths(self._stale)
+        order = sorted(self._stale, key=depths.__getitem__, reverse=deepest_first)
+
+        for node_id in order:
+            if generate is not None:
+                generate(self.index.get(node_id))
+            self.mark_fresh(node_id)
+        return order
+
+    def mark_fresh(self, node_id: str) -> None:
+        """
+        Record that a node has been regenerated.
+
+        Raises:
+            ValueError: If a node it depends on is still stale
+        """
+        if self.has_stale_dependencies(node_id):
+            raise ValueError(f"Node has stale dependencies: {node_id}")
+        self.index.set_stale(node_id, False)
+        self._stale.discard(node_id)
+
+    def _mark_stale(self, node_id: str) -> None:
+        self.index.set_stale(node_id, True)
+        self._stale.add(node_id)
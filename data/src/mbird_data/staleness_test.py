@@ -0,0 +1,124 @@
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.index import TreeIndex
+from mbird_data.staleness import Propagation, StalenessEngine
+
+
+@pytest.fixture
+def tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "is_stale": False,
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": False,
+                    "children": [
+                        {"id": "a1", "is_stale": False},
+                        {"id": "a2", "is_stale": False},
+                    ],
+                },
+                {"id": "b", "is_stale": False},
+            ],
+        }
+    )
+
+
+def test_change_marks_node_and_ancestors_stale(tree: MbirdNode):
+    index = TreeIndex(tree)
+    engine = StalenessEngine(index)
+
+    engine.mark_changed("a1")
+
+    assert engine.stale_ids == {"a1", "a", "root"}
+    assert index.get("a1").is_stale is True
+    assert index.get("root").is_stale is True
+    assert index.get("a2").is_stale is False
+
+
+def test_down_propagation_marks_descendants_stale(tree: MbirdNode):
+    engine = StalenessEngine(TreeIndex(tree), propagation=Propagation.DOWN)
+
+    engine.mark_changed("a")
+
+    assert engine.stale_ids == {"a", "a1", "a2"}
+
+
+def test_initially_stale_nodes_propagate(tree: MbirdNode):
+    tree.children[1].is_stale = True
+
+    engine = StalenessEngine(TreeIndex(tree))
+
+    assert engine.stale_ids == {"b", "root"}
+    assert tree.is_stale is True
+
+
+def test_regenerate_visits_only_stale_nodes_dependencies_first(tree: MbirdNode):
+    engine = StalenessEngine(TreeIndex(tree))
+    engine.mark_changed("a2")
+    visited: list[str] = []
+
+    regenerated = engine.regenerate(lambda node: visited.append(node.id))
+
+    assert regenerated == ["a2", "a", "root"]
+    assert visited == regenerated
+    assert engine.stale_ids == frozenset()
+    assert tree.is_stale is False
+    assert engine.regenerate() == []
+
+
+def test_regenerate_down_processes_parents_first(tree: MbirdNode):
+    engine = StalenessEngine(TreeIndex(tree), propagation=Propagation.DOWN)
+    engine.mark_changed("a")
+
+    regenerated = engine.regenerate()
+
+    assert regenerated[0] == "a"
+    assert set(regenerated) == {"a", "a1", "a2"}
+
+
+def test_failed_generate_leaves_remaining_nodes_stale(tree: MbirdNode):
+    engine = StalenessEngine(TreeIndex(tree))
+    engine.mark_changed("a1")
+
+    def generate(node: MbirdNode) -> None:
+        if node.id == "a":
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        engine.regenerate(generate)
+
+    assert engine.stale_ids == {"a", "root"}
+    assert tree.children[0].children[0].is_stale is False
+
+
+def test_shared_node_marks_every_parent_and_regenerates_once():
+    # "s" is under both "a" and "b"
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "is_stale": False,
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": False,
+                    "children": [{"id": "s", "is_stale": False}],
+                },
+                {"id": "b", "is_stale": False, "children": [{"ref": "s"}]},
+            ],
+        }
+    )
+    engine = StalenessEngine(TreeIndex(root))
+
+    marked = engine.mark_changed("s")
+    assert marked[0] == "s"
+    assert marked[-1] == "root"
+    assert set(marked) == {"s", "a", "b", "root"}
+
+    generated: list[str] = []
+    engine.regenerate(lambda node: generated.append(node.id))
+    assert generated[0] == "s"
+    assert generated[-1] == "root"
+    assert sorted(generated) == sorted(marked)
@@ -0,0 +1,255 @@
+from array import array
+from collections.abc import Iterator
+
+from mbird_data.models import MbirdNode, construct_node, paused_gc
+
+NO_PARENT = -1
+
+
+class TreeStore:
+    """
+    Compact, index-backed copy of an MbirdNode tree.
+
+    Nodes are numbered in preorder and their data lives in flat arrays instead of
+    one pydantic object per node. Because of the preorder numbering, the subtree
+    of node i is the contiguous index range [i, subtree_end(i)).
+
+    The structure is immutable once built; only the is_stale flags can change.
+    A shared node is stored with its subtree once, at its first occurrence; later
+    occurrences are links, leaves that stand for it (see is_link()). Shared
+    nodes are looked up by their first occurrence, and to_node() shares them
+    again.
+
+    Stores are a serialization format, not what MbirdData keeps its tree in:
+    the binary tree file is read and written through one, and to_store() makes
+    one on demand. MbirdData's tree stays MbirdNode objects, since TreeIndex
+    edits them copy-on-write. Only lazily loaded trees skip building them, by
+    reading the binary file in place (see MappedTree). So an open, edited tree
+    still costs one pydantic object per node in memory and garbage collection;
+    stores don't reduce that.
+    """
+
+    def __init__(
+        self,
+        ids: list[str],
+        parents: array,
+        stale: bytearray,
+        links: bytearray | None = None,
+    ):
+        """
+        Build a store from preorder-numbered nodes.
+
+        Args:
+            ids: Node ids in preorder
+            parents: Parent index of each node (NO_PARENT for the root)
+            stale: Packed is_stale bitset, one bit per node
+            links: Packed bitset of the nodes that are links, one bit per node
+                (none are if None)
+
+        Raises:
+            ValueError: If the arrays don't describe a preorder-numbered tree,
+                or a link doesn't stand for a node whose subtree is before it
+        """
+        num_nodes = len(ids)
+        if num_nodes == 0:
+            raise ValueError("Tree must have a root node")
+        if len(parents) != num_nodes:
+            raise ValueError("ids and parents must have the same length")
+        if len(stale) != (num_nodes + 7) // 8:
+            raise ValueError("stale bitset does not match the number of nodes")
+        if links is None:
+            links = bytearray(len(stale))
+        elif len(links) != len(stale):
+            raise ValueError("links bitset does not match the number of nodes")
+
+        # In preorder, each node's parent is on the path to the node before it
+        path: list[int] = []
+        for i, parent in enumerate(parents):
+            while path and path[-1] != parent:
+                path.pop()
+            if (i == 0 and parent != NO_PARENT) or (i > 0 and not path):
+                raise ValueError(f"Nodes are not numbered in preorder at index {i}")
+            path.append(i)
+
+        self._ids = ids
+        self._parents = parents
+        self._stale = stale
+        self._links = links
+
+        self._index: dict[str, int] = {}
+        for i, node_id in enumerate(ids):
+            if not links[i >> 3] & (1 << (i & 7)):
+                self._index.setdefault(node_id, i)
+
+        # Children of node i are _children[_child_offsets[i]:_child_offsets[i + 1]]
+        counts = array("q", bytes(8 * (num_nodes + 1)))
+        for i in range(1, num_nodes):
+            counts[parents[i] + 1] += 1
+        for i in range(num_nodes):
+            counts[i + 1] += counts[i]
+        self._child_offsets = counts
+        self._children = array("q", bytes(8 * max(num_nodes - 1, 0)))
+        fill = array("q", counts)
+        for i in range(1, num_nodes):
+            parent = parents[i]
+            self._children[fill[parent]] = i
+            fill[parent] += 1
+
+        # Preorder numbering puts every subtree after its root, so one backwards
+        # pass is enough to find where each subtree ends
+        self._subtree_ends = array("q", range(1, num_nodes + 1))
+        for i in range(num_nodes - 1, 0, -1):
+            parent = parents[i]
+            if self._subtree_ends[i] > self._subtree_ends[parent]:
+                self._subtree_ends[parent] = self._subtree_ends[i]
+
+        if any(links):
+            self._check_links()
+
+    @classmethod
+    def from_node(cls, root: MbirdNode) -> "TreeStore":
+        """
+        Flatten a node tree into a store.
+
+        Nodes are matched by id, so each shared node's subtree is walked once.
+        """
+        ids: list[str] = []
+        parents = array("q")
+        stale_flags: list[bool] = []
+        link_indices: list[int] = []
+        seen: set[str] = set()
+
+        stack: list[tuple[MbirdNode, int]] = [(root, NO_PARENT)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(ids)
+            ids.append(node.id)
+            parents.append(parent)
+            stale_flags.append(node.is_stale)
+            if node.id in seen:
+                link_indices.append(index)
+                continue
+            seen.add(node.id)
+            stack.extend((child, index) for child in reversed(node.children))
+
+        stale = bytearray((len(ids) + 7) // 8)
+        for i, is_stale in enumerate(stale_flags):
+            if is_stale:
+                stale[i >> 3] |= 1 << (i & 7)
+        links = bytearray(len(stale))
+        for i in link_indices:
+            links[i >> 3] |= 1 << (i & 7)
+
+        return cls(ids, parents, stale, links)
+
+    def to_node(self) -> MbirdNode:
+        """
+        Rebuild the nested node tree (without re-running validation).
+
+        Every occurrence of an id is rebuilt as the same node.
+        """
+        # Built from the last index down, so node i is nodes[last - i]
+        nodes: list[MbirdNode] = []
+        built: dict[str, MbirdNode] = {}
+        # Children lists and positions of links, which are filled in once the
+        # nodes they stand for (before them) are built
+        unlinked: list[tuple[list[MbirdNode], int, str]] = []
+        last = len(self) - 1
+        ids = self._ids
+        offsets = self._child_offsets
+        stale = self._stale
+        links = self._links
+        with paused_gc():
+            # Children always have higher indices than their parents
+            for i in range(last, -1, -1):
+                node = built.get(ids[i])
+                if node is None:
+                    children: list[MbirdNode] = []
+                    for child in self._children[offsets[i] : offsets[i + 1]]:
+                        if links[child >> 3] & (1 << (child & 7)):
+                            unlinked.append((children, len(children), ids[child]))
+                        children.append(nodes[last - child])
+                    node = construct_node(
+                        ids[i], children, bool(stale[i >> 3] & (1 << (i & 7)))
+                    )
+                    if not links[i >> 3] & (1 << (i & 7)):
+                        built[ids[i]] = node
+                nodes.append(node)
+            for children, position, node_id in unlinked:
+                children[position] = built[node_id]
+        return nodes[-1]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, node_id: object) -> bool:
+        return node_id in self._index
+
+    def find(self, node_id: str) -> int:
+        """Get the index of a node by id, raising KeyError if it doesn't exist."""
+        try:
+            return self._index[node_id]
+        except KeyError:
+            raise KeyError(f"Node not found: {node_id}") from None
+
+    def node_id(self, index: int) -> str:
+        return self._ids[index]
+
+    def parent(self, index: int) -> int | None:
+        """Get the parent index of a node, or None for the root."""
+        parent = self._parents[index]
+        return None if parent == NO_PARENT else parent
+
+    def children(self, index: int) -> array:
+        return self._children[
+            self._child_offsets[index] : self._child_offsets[index + 1]
+        ]
+
+    def ancestors(self, index: int) -> Iterator[int]:
+        """Yield the indices of a node's ancestors, nearest first."""
+        parent = self._parents[index]
+        while parent != NO_PARENT:
+            yield parent
+            parent = self._parents[parent]
+
+    def subtree_end(self, index: int) -> int:
+        return self._subtree_ends[index]
+
+    def subtree(self, index: int) -> range:
+        """Get the indices of a node and all its descendants, in preorder."""
+        return range(index, self._subtree_ends[index])
+
+    def is_link(self, index: int) -> bool:
+        """Whether a node is a link to the first occurrence of its id."""
+        self._check_index(index)
+        return bool(self._links[index >> 3] & (1 << (index & 7)))
+
+    def is_stale(self, index: int) -> bool:
+        self._check_index(index)
+        return bool(self._stale[index >> 3] & (1 << (index & 7)))
+
+    def set_stale(self, index: int, is_stale: bool) -> None:
+        self._check_index(index)
+        if is_stale:
+            self._stale[index >> 3] |= 1 << (index & 7)
+        else:
+            self._stale[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def _check_index(self, index: int) -> None:
+        # The bitset is padded to whole bytes, so it can't catch this itself
+        if not 0 <= index < len(self._ids):
+            raise IndexError(f"Node index out of range: {index}")
+
+    def _check_links(self) -> None:
+        # A link can only stand for a node whose whole subtree comes before it.
+        # Every edge then leads to a node that ends earlier in postorder, so the
+        # links can't make a cycle.
+        ends = self._subtree_ends
+        for i in range(len(self._ids)):
+            if not self.is_link(i):
+                continue
+            target = self._index.get(self._ids[i])
+            if target is None or ends[target] > i:
+                raise ValueError(f"Link at index {i} comes before its node's subtree")
+            if ends[i] != i + 1:
+                raise ValueError(f"Link at index {i} has children")
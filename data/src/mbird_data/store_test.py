@@ -0,0 +1,190 @@
+from array import array
+
+import pytest
+
+from mbird_data import MbirdData, MbirdNode, TreeStore
+from mbird_data.hashing import subtree_digest
+
+
+@pytest.fixture
+def tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {
+                    "id": "a",
+                    "is_stale": False,
+                    "children": [{"id": "a1"}, {"id": "a2", "is_stale": False}],
+                },
+                {"id": "b", "children": [{"id": "b1"}]},
+            ],
+        }
+    )
+
+
+def test_nodes_are_numbered_in_preorder(tree: MbirdNode):
+    store = TreeStore.from_node(tree)
+
+    assert len(store) == 6
+    assert [store.node_id(i) for i in range(len(store))] == [
+        "root",
+        "a",
+        "a1",
+        "a2",
+        "b",
+        "b1",
+    ]
+
+
+def test_find_returns_index_and_raises_for_missing_id(tree: MbirdNode):
+    store = TreeStore.from_node(tree)
+
+    assert store.find("b") == 4
+    assert "b1" in store
+    assert "missing" not in store
+    with pytest.raises(KeyError, match="Node not found"):
+        store.find("missing")
+
+
+def test_parent_children_and_ancestor_queries(tree: MbirdNode):
+    store = TreeStore.from_node(tree)
+    a2 = store.find("a2")
+
+    assert store.parent(0) is None
+    assert store.parent(a2) == store.find("a")
+    assert [store.node_id(i) for i in store.children(0)] == ["a", "b"]
+    assert list(store.children(a2)) == []
+    assert [store.node_id(i) for i in store.ancestors(a2)] == ["a", "root"]
+
+
+def test_subtree_is_contiguous_range(tree: MbirdNode):
+    store = TreeStore.from_node(tree)
+
+    assert [store.node_id(i) for i in store.subtree(store.find("a"))] == [
+        "a",
+        "a1",
+        "a2",
+    ]
+    assert list(store.subtree(store.find("b1"))) == [5]
+    assert store.subtree(0) == range(6)
+
+
+def test_stale_bits_round_trip(tree: MbirdNode):
+    store = TreeStore.from_node(tree)
+
+    assert store.is_stale(store.find("root")) is True
+    assert store.is_stale(store.find("a")) is False
+
+    store.set_stale(store.find("a"), True)
+    store.set_stale(store.find("b1"), False)
+    assert store.is_stale(store.find("a")) is True
+    assert store.is_stale(store.find("b1")) is False
+    assert store.is_stale(store.find("a2")) is False
+
+    with pytest.raises(IndexError):
+        store.is_stale(len(store))
+
+
+def test_to_node_rebuilds_equal_tree(tree: MbirdNode):
+    rebuilt = TreeStore.from_node(tree).to_node()
+
+    assert rebuilt.model_dump() == tree.model_dump()
+
+
+def test_large_tree_round_trips():
+    nodes = [MbirdNode(id=f"node{i}", is_stale=i % 3 == 0) for i in range(1000)]
+    for i in range(999, 0, -1):
+        nodes[(i - 1) // 3].children.insert(0, nodes[i])
+    root = nodes[0]
+
+    store = TreeStore.from_node(root)
+
+    assert len(store) == 1000
+    assert store.to_node().model_dump() == root.model_dump()
+
+
+def test_mbird_data_converts_to_and_from_store(tree: MbirdNode):
+    store = MbirdData(root=tree).to_store()
+    data = MbirdData.from_store(store)
+
+    assert data.root is not None
+    assert data.root.model_dump() == tree.model_dump()
+
+
+def test_to_store_without_root_raises_error():
+    with pytest.raises(ValueError, match="No root node loaded"):
+        MbirdData().to_store()
+
+
+@pytest.mark.parametrize(
+    "parents",
+    [
+        [0, 0, 0],  # root has a parent
+        [-1, 0, -1],  # second root
+        [-1, 2, 0],  # parent after child
+        [-1, 0, 1, 0, 2],  # parent no longer on the current path
+    ],
+)
+def test_non_preorder_parents_are_rejected(parents: list[int]):
+    ids = [f"n{i}" for i in range(len(parents))]
+
+    with pytest.raises(ValueError, match="not numbered in preorder"):
+        TreeStore(ids, array("q", parents), bytearray(1))
+
+
+def test_to_node_shares_repeated_nodes():
+    root = MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "children": [{"id": "s", "children": [{"id": "s1"}]}]},
+                {"ref": "s"},
+            ],
+        }
+    )
+
+    store = TreeStore.from_node(root)
+    rebuilt = store.to_node()
+
+    # The second occurrence of s is a link, without its subtree
+    assert len(store) == 5
+    assert store.find("s") == 2
+    assert store.is_link(4)
+    assert not store.is_link(2)
+    assert list(store.children(4)) == []
+    assert rebuilt.children[1] is rebuilt.children[0].children[0]
+    assert rebuilt.model_dump() == root.model_dump()
+
+
+def test_shared_nodes_are_stored_once():
+    # Each level's two nodes share both children
+    level = [MbirdNode(id="leaf0"), MbirdNode(id="leaf1")]
+    for depth in range(20):
+        level = [MbirdNode(id=f"n{depth}-{i}", children=level) for i in range(2)]
+    root = MbirdNode(id="root", children=level)
+
+    store = TreeStore.from_node(root)
+    rebuilt = store.to_node()
+
+    assert len(store) == 1 + 2 + 20 * 4
+    assert rebuilt.children[0].children[0] is rebuilt.children[1].children[0]
+    assert subtree_digest(rebuilt) == subtree_digest(root)
+
+
+@pytest.mark.parametrize(
+    "ids,parents,link",
+    [
+        # Before its node
+        (["root", "s", "a", "s"], [-1, 0, 0, 2], 1),
+        # Inside its node's subtree, which would make a cycle
+        (["root", "a", "a"], [-1, 0, 1], 2),
+        # With children
+        (["root", "s", "s", "c"], [-1, 0, 0, 2], 2),
+        # With no node
+        (["root", "s"], [-1, 0], 1),
+    ],
+)
+def test_invalid_links_are_rejected(ids: list[str], parents: list[int], link: int):
+    with pytest.raises(ValueError, match="Link at index"):
+        TreeStore(ids, array("q", parents), bytearray(1), bytearray([1 << link]))
@@ -0,0 +1,523 @@
+from collections.abc import Iterator
+import json
+from json.decoder import scanstring  # type: ignore[attr-defined]
+from json.encoder import encode_basestring_ascii  # type: ignore[attr-defined]
+import re
+from typing import Any, TextIO
+
+from pydantic import BaseModel
+from pydantic_core import PydanticSerializationError
+
+from mbird_data.models import (
+    MbirdNode,
+    _build_shallow,
+    _ref_id,
+    _resolve_ref,
+    _share_node,
+    check_acyclic,
+    construct_node,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+# Scalars and punctuation; strings are handed to the C string scanner
+_TOKEN = re.compile(
+    r"[ \t\n\r]*(?:([{}\[\]:,])|(\")|"
+    r"(-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null))"
+)
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Fast paths for nodes laid out the way iter_json writes them: the start of a
+# node up to its children array, and the end of the array up to the node's end
+_NODE_HEAD = re.compile(
+    r'[ \t\n\r]*\{[ \t\n\r]*"id"[ \t\n\r]*:[ \t\n\r]*"([^"\\\x00-\x1f]*)"'
+    r'[ \t\n\r]*,[ \t\n\r]*"children"[ \t\n\r]*:[ \t\n\r]*\['
+)
+_NODE_TAIL = re.compile(
+    r'[ \t\n\r]*\][ \t\n\r]*,[ \t\n\r]*"is_stale"[ \t\n\r]*:[ \t\n\r]*'
+    r"(true|false)[ \t\n\r]*\}"
+)
+# Characters iter_json() adds around each node's id without indentation
+_COMPACT_NODE_SIZE = 48
+_LITERALS: dict[str, Any] = {"true": True, "false": False, "null": None}
+
+
+def iter_json(
+    root: MbirdNode, indent: int | None = None, chunk_size: int = CHUNK_SIZE
+) -> Iterator[str]:
+    """
+    Encode a tree as JSON text, yielding it in chunks as the tree is walked.
+
+    The output matches json.dumps(root.model_dump(), indent=indent) (with
+    compact separators when indent is None), but the whole document is never
+    held in memory. Shared nodes (one node object under several parents) are
+    the exception: they're written in full the first time, and as {"ref": id}
+    at every other occurrence.
+    """
+    if indent is None:
+        yield from _iter_compact(root, chunk_size)
+        return
+    colon = ": "
+
+    def newline(level: int) -> str:
+        return "\n" + " " * (indent * level)
+
+    parts: list[str] = []
+    size = 0
+    # Nodes written so far, by identity
+    written: set[int] = set()
+    # Strings to emit and (node, level) pairs still to expand, in reverse order
+    stack: list[str | tuple[MbirdNode, int]] = [(root, 0)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            size += len(item)
+            if size >= chunk_size:
+                yield "".join(parts)
+                parts.clear()
+                size = 0
+            continue
+
+        node, level = item
+        if id(node) in written:
+            stack.append(
+                f"{{{newline(level + 1)}"
+                f'"ref"{colon}{json.dumps(node.id)}{newline(level)}}}'
+            )
+            continue
+        written.add(id(node))
+        inner = newline(level + 1)
+        tail: list[str | tuple[MbirdNode, int]] = [
+            f',{inner}"is_stale"{colon}{"true" if node.is_stale else "false"}'
+            f"{newline(level)}}}"
+        ]
+        if node.children:
+            child_indent = newline(level + 2)
+            tail.append(f"{newline(level + 1)}]")
+            for i in range(len(node.children) - 1, -1, -1):
+                tail.append((node.children[i], level + 2))
+                tail.append(child_indent if i == 0 else "," + child_indent)
+            tail.append("[")
+        else:
+            tail.append("[]")
+        tail.append(
+            f'{{{inner}"id"{colon}{json.dumps(node.id)},{inner}"children"{colon}'
+        )
+        stack.extend(tail)
+
+    if parts:
+        yield "".join(parts)
+
+
+def _iter_compact(root: MbirdNode, chunk_size: int) -> Iterator[str]:
+    """iter_json() without indentation, which is much simpler and faster."""
+    parts: list[str] = []
+    append = parts.append
+    # Roughly: each node adds its id and up to _COMPACT_NODE_SIZE characters,
+    # besides the strings taken from the stack
+    size = 0
+    # Nodes written so far, by identity
+    written: set[int] = set()
+    # Strings to emit and nodes still to expand, in reverse order
+    stack: list[str | MbirdNode] = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            append(item)
+            size += len(item)
+        elif id(item) in written:
+            append('{"ref":')
+            append(encode_basestring_ascii(item.id))
+            append("}")
+            size += len(item.id) + _COMPACT_NODE_SIZE
+        else:
+            written.add(id(item))
+            append('{"id":')
+            append(encode_basestring_ascii(item.id))
+            tail = ',"is_stale":true}' if item.is_stale else ',"is_stale":false}'
+            children = item.children
+            if children:
+                append(',"children":[')
+                stack.append("]" + tail)
+                for i in range(len(children) - 1, 0, -1):
+                    stack.append(children[i])
+                    stack.append(",")
+                stack.append(children[0])
+            else:
+                append(',"children":[]')
+                append(tail)
+            size += len(item.id) + _COMPACT_NODE_SIZE
+
+        if size >= chunk_size:
+            yield "".join(parts)
+            parts.clear()
+            size = 0
+
+    if parts:
+        yield "".join(parts)
+
+
+def encode_json(root: MbirdNode, shared: bool = False) -> bytes:
+    """
+    Encode a tree as compact JSON all at once, as fast as possible.
+
+    Trees up to pydantic's serialization depth limit (255 levels) are encoded by
+    its compiled serializer, which leaves non-ASCII characters unescaped. Deeper
+    ones are encoded like iter_json().
+
+    Args:
+        root: Root of the tree
+        shared: Whether the tree may have shared nodes (see TreeIndex.num_shared),
+            which are then written once, like iter_json() does. Otherwise they
+            would be written in full at every occurrence.
+    """
+    if shared:
+        return "".join(_iter_compact(root, CHUNK_SIZE)).encode()
+    try:
+        return MbirdNode.__pydantic_serializer__.to_json(root)
+    except PydanticSerializationError:
+        return "".join(_iter_compact(root, CHUNK_SIZE)).encode()
+
+
+class _Literal(str):
+    """Text that dumps_json() writes as is, rather than as a JSON string."""
+
+
+def dumps_json(value: Any) -> str:
+    """
+    Encode data as compact JSON, however deeply it nests.
+
+    json.dumps() and pydantic's serializers recurse, so they fail on deep data,
+    such as a patch adding a deep subtree. Trees (MbirdNode values) are
+    encoded as iter_json() does, and other pydantic models as dicts of their
+    fields.
+    """
+    parts: list[str] = []
+    stack: list[Any] = [value]
+    while stack:
+        item = stack.pop()
+        if type(item) is _Literal:
+            parts.append(item)
+        elif isinstance(item, MbirdNode):
+            parts.extend(_iter_compact(item, CHUNK_SIZE))
+        elif isinstance(item, (dict, BaseModel)):
+            items = list(item.items() if isinstance(item, dict) else item)
+            if not items:
+                parts.append("{}")
+                continue
+            stack.append(_Literal("}"))
+            for i in range(len(items) - 1, -1, -1):
+                key, field = items[i]
+                stack.append(field)
+                prefix = "{" if i == 0 else ","
+                stack.append(_Literal(f"{prefix}{encode_basestring_ascii(key)}:"))
+        elif isinstance(item, (list, tuple)):
+            if not item:
+                parts.append("[]")
+                continue
+            stack.append(_Literal("]"))
+            for i in range(len(item) - 1, -1, -1):
+                stack.append(item[i])
+                stack.append(_Literal("[" if i == 0 else ","))
+        else:
+            parts.append(json.dumps(item))
+    return "".join(parts)
+
+
+def loads_json(text: str | bytes) -> Any:
+    """
+    Parse JSON text, however deeply it nests (json.loads() recurses).
+
+    Raises:
+        ValueError: If the text isn't valid JSON
+    """
+    if isinstance(text, bytes):
+        text = text.decode()
+    # Objects and arrays still being parsed, with each object's current key
+    containers: list[dict | list] = []
+    keys: list[str] = []
+    results: list[Any] = []
+    pos = 0
+    # What the next token may be: "value", "key", "colon" or "comma"
+    expect = "value"
+
+    def error(message: str) -> ValueError:
+        return ValueError(f"Invalid JSON at offset {pos}: {message}")
+
+    while True:
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            if _WHITESPACE.fullmatch(text, pos) and not containers and results:
+                return results[0]
+            raise error("unexpected character or end")
+        punct, quote, scalar = match.groups()
+        pos = match.end()
+        value: Any
+
+        if quote:
+            value, pos = scanstring(text, pos)
+            if expect == "key":
+                keys[-1] = value
+                expect = "colon"
+                continue
+            if expect != "value":
+                raise error("unexpected string")
+        elif scalar:
+            if expect != "value":
+                raise error(f"unexpected {scalar!r}")
+            value = _LITERALS[scalar] if scalar in _LITERALS else json.loads(scalar)
+        elif punct in ("{", "["):
+            if expect != "value":
+                raise error(f"unexpected {punct!r}")
+            containers.append({} if punct == "{" else [])
+            keys.append("")
+            expect = "key" if punct == "{" else "value"
+            continue
+        elif punct in ("}", "]"):
+            top = containers[-1] if containers else None
+            is_object = punct == "}"
+            if top is None or is_object != isinstance(top, dict):
+                raise error(f"unexpected {punct!r}")
+            # Closing is allowed after a value, or straight after the opening
+            opened = "key" if is_object else "value"
+            if expect != "comma" and (expect != opened or top):
+                raise error(f"unexpected {punct!r}")
+            containers.pop()
+            keys.pop()
+            value = top
+        elif punct == ":":
+            if expect != "colon":
+                raise error("unexpected ':'")
+            expect = "value"
+            continue
+        else:
+            if expect != "comma" or not containers:
+                raise error("unexpected ','")
+            expect = "key" if isinstance(containers[-1], dict) else "value"
+            continue
+
+        if not containers:
+            if results:
+                raise error("unexpected value after the end")
+            results.append(value)
+        elif isinstance(containers[-1], dict):
+            containers[-1][keys[-1]] = value
+        else:
+            containers[-1].append(value)
+        expect = "comma"
+
+
+def write_json(root: MbirdNode, fp: TextIO, indent: int | None = 2) -> None:
+    """Write a tree as JSON to an open text file, without building it in memory."""
+    for chunk in iter_json(root, indent=indent):
+        fp.write(chunk)
+
+
+class _Container:
+    """An object or array that is still being parsed."""
+
+    __slots__ = ("value", "key", "is_node", "holds_nodes")
+
+    def __init__(self, value: dict | list, is_node: bool, holds_nodes: bool):
+        self.value = value
+        self.key: str | None = None
+        # Objects that are tree nodes, and the "children" arrays of those objects
+        self.is_node = is_node
+        self.holds_nodes = holds_nodes
+
+
+def read_json(
+    fp: TextIO, chunk_size: int = CHUNK_SIZE, validate: bool = True
+) -> MbirdNode:
+    """
+    Parse a tree from an open JSON text file, building nodes as they complete.
+
+    The file is read in chunks and each node object is turned into an MbirdNode
+    as soon as it closes, so neither the full text nor a full dict tree is held
+    in memory. Parsing is iterative, so any depth is supported. Repeated ids are
+    read as shared nodes, as MbirdNode.from_dict() does.
+
+    Args:
+        fp: File to read
+        chunk_size: Characters read at a time
+        validate: Validate the nodes and check the tree is acyclic. Only skip
+            this for files this package wrote (see MbirdNode.from_dict).
+
+    Raises:
+        ValueError: If the file isn't valid JSON or (when validating) doesn't
+            describe a valid tree
+    """
+    build_node = _build_node if validate else _construct_node
+    # Built nodes by id, so that references and repeated occurrences share them
+    built: dict[str, MbirdNode] = {}
+
+    def finish(fields: dict[str, Any]) -> MbirdNode:
+        """Build a node object that just closed, or resolve a reference."""
+        ref_id = _ref_id(fields)
+        if ref_id is not None:
+            return _resolve_ref(built, ref_id)
+        node = build_node(fields)
+        if validate:
+            return _share_node(built, node)
+        built.setdefault(node.id, node)
+        return node
+
+    buf = ""
+    pos = 0
+    offset = 0  # position of buf[0] within the file, for error messages
+    eof = False
+
+    def fill() -> bool:
+        """Read more text into the buffer, returning False at end of file."""
+        nonlocal buf, pos, offset, eof
+        if eof:
+            return False
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        offset += pos
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def error(message: str) -> ValueError:
+        return ValueError(f"Invalid tree JSON at offset {offset + pos}: {message}")
+
+    stack: list[_Container] = []
+    results: list[Any] = []
+    # What the next token may be: "value", "key", "colon" or "comma"
+    expect = "value"
+
+    while True:
+        top = stack[-1] if stack else None
+        value: Any
+
+        if expect == "value" and (top is None or top.holds_nodes):
+            head = _NODE_HEAD.match(buf, pos)
+            if head is not None:
+                pos = head.end()
+                node_container = _Container({"id": head.group(1)}, True, False)
+                node_container.key = "children"
+                stack.append(node_container)
+                stack.append(_Container([], False, True))
+                continue
+
+        tail = None
+        if top is not None and top.holds_nodes and (expect == "comma" or not top.value):
+            tail = _NODE_TAIL.match(buf, pos)
+        if tail is not None:
+            pos = tail.end()
+            children = stack.pop().value
+            fields = stack.pop().value
+            assert isinstance(fields, dict)
+            fields["children"] = children
+            fields["is_stale"] = tail.group(1) == "true"
+            value = finish(fields)
+        else:
+            match = _TOKEN.match(buf, pos)
+            # A token (or trailing whitespace) may continue in the next chunk
+            if (match is None or match.end() == len(buf)) and fill():
+                continue
+            if match is None:
+                if _WHITESPACE.fullmatch(buf, pos):
+                    break
+                raise error("unexpected character")
+
+            punct, quote, scalar = match.groups()
+            pos = match.end()
+
+            if quote:
+                while True:
+                    try:
+                        text, pos = scanstring(buf, pos)
+                        break
+                    except json.JSONDecodeError as e:
+                        if not fill():
+                            raise error("unterminated string") from e
+                if expect == "key":
+                    stack[-1].key = text
+                    expect = "colon"
+                    continue
+                if expect != "value":
+                    raise error("unexpected string")
+                value = text
+            elif scalar:
+                if expect != "value":
+                    raise error(f"unexpected {scalar!r}")
+                if scalar in _LITERALS:
+                    value = _LITERALS[scalar]
+                else:
+                    value = json.loads(scalar)
+            elif punct in ("{", "["):
+                if expect != "value":
+                    raise error(f"unexpected {punct!r}")
+                if punct == "{":
+                    is_node = top is None or top.holds_nodes
+                    stack.append(_Container({}, is_node, False))
+                    expect = "key"
+                else:
+                    holds_nodes = (
+                        top is not None and top.is_node and top.key == "children"
+                    )
+                    stack.append(_Container([], False, holds_nodes))
+                continue
+            elif punct in ("}", "]"):
+                is_object = punct == "}"
+                if top is None or is_object != isinstance(top.value, dict):
+                    raise error(f"unexpected {punct!r}")
+                # Closing is allowed after a value, or straight after the opening
+                opened = "key" if is_object else "value"
+                if expect != "comma" and (expect != opened or top.value):
+                    raise error(f"unexpected {punct!r}")
+                stack.pop()
+                value = top.value
+                if top.is_node:
+                    value = finish(value)
+            elif punct == ":":
+                if expect != "colon":
+                    raise error("unexpected ':'")
+                expect = "value"
+                continue
+            else:
+                if expect != "comma" or top is None:
+                    raise error("unexpected ','")
+                expect = "key" if isinstance(top.value, dict) else "value"
+                continue
+
+        if not stack:
+            results.append(value)
+        elif isinstance(stack[-1].value, dict):
+            stack[-1].value[stack[-1].key] = value
+        else:
+            stack[-1].value.append(value)
+        expect = "comma"
+
+    if stack or not results:
+        raise error("unexpected end of file")
+    root = results[0]
+    if not isinstance(root, MbirdNode):
+        raise ValueError("Tree JSON must be an object")
+
+    if validate:
+        check_acyclic(root)
+    return root
+
+
+def _construct_node(fields: dict[str, Any]) -> MbirdNode:
+    """Build a node from a parsed object as it is, without validating it."""
+    return construct_node(
+        fields["id"], fields.get("children", []), fields.get("is_stale", True)
+    )
+
+
+def _build_node(fields: dict[str, Any]) -> MbirdNode:
+    """Build a node from a parsed object whose children are already nodes."""
+    node, children = _build_shallow(MbirdNode, fields)
+    if not isinstance(children, list):
+        raise ValueError(f"Children of node {node.id} must be a list")
+    for child in children:
+        if not isinstance(child, MbirdNode):
+            raise ValueError(f"Children of node {node.id} must be objects")
+    node.children = children
+    return node
@@ -0,0 +1,193 @@
+import io
+import json
+
+import pytest
+
+from mbird_data import MbirdNode
+from mbird_data.patch import AddChild, TreePatch
+from mbird_data.streaming import (
+    dumps_json,
+    encode_json,
+    iter_json,
+    loads_json,
+    read_json,
+)
+
+
+@pytest.fixture
+def tree() -> MbirdNode:
+    return MbirdNode.from_dict(
+        {
+            "id": "root",
+            "children": [
+                {"id": "a", "is_stale": False, "children": [{"id": "a1"}]},
+                {"id": 'quoted "b" \\ é'},
+            ],
+        }
+    )
+
+
+def make_chain(depth: int) -> MbirdNode:
+    data: dict = {"id": f"node{depth - 1}", "children": []}
+    for i in range(depth - 2, -1, -1):
+        data = {"id": f"node{i}", "children": [data]}
+    return MbirdNode.from_dict(data)
+
+
+def test_iter_json_matches_json_dumps(tree: MbirdNode):
+    pretty = "".join(iter_json(tree, indent=2))
+    compact = "".join(iter_json(tree))
+
+    assert pretty == json.dumps(tree.model_dump(), indent=2)
+    assert compact == json.dumps(tree.model_dump(), separators=(",", ":"))
+
+
+def test_iter_json_yields_bounded_chunks():
+    root = MbirdNode(id="root", children=[MbirdNode(id=f"n{i}") for i in range(500)])
+
+    chunks = list(iter_json(root, chunk_size=256))
+
+    assert len(chunks) > 1
+    assert all(len(chunk) < 512 for chunk in chunks)
+    assert "".join(chunks) == json.dumps(root.model_dump(), separators=(",", ":"))
+
+
+def test_iter_json_yields_bounded_chunks_of_deep_trees():
+    chunks = list(iter_json(make_chain(500), chunk_size=256))
+
+    assert len(chunks) > 1
+    assert all(len(chunk) < 512 for chunk in chunks)
+
+
+@pytest.mark.parametrize("depth", [10, 1000])
+def test_encode_json_matches_iter_json(tree: MbirdNode, depth: int):
+    assert json.loads(encode_json(tree)) == json.loads("".join(iter_json(tree)))
+    # Deeper than pydantic's serializer goes
+    chain = make_chain(depth)
+    assert encode_json(chain) == "".join(iter_json(chain)).encode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+def test_read_json_round_trips(tree: MbirdNode, chunk_size: int):
+    text = "".join(iter_json(tree, indent=2))
+
+    parsed = read_json(io.StringIO(text), chunk_size=chunk_size)
+
+    assert parsed.model_dump() == tree.model_dump()
+
+
+def test_read_json_accepts_other_json_layouts(tree: MbirdNode):
+    data = tree.model_dump()
+    data["extra"] = {"nested": [1, 2.5, None, {"id": 3}]}
+    text = json.dumps(data, indent=4, sort_keys=True)
+
+    parsed = read_json(io.StringIO(text), chunk_size=5)
+
+    assert parsed.model_dump() == tree.model_dump()
+
+
+def test_read_json_handles_deep_trees():
+    root = make_chain(5000)
+    text = "".join(iter_json(root))
+
+    parsed = read_json(io.StringIO(text))
+
+    assert "".join(iter_json(parsed)) == text
+
+
+def test_read_json_without_validation_builds_same_tree(tree: MbirdNode):
+    text = "".join(iter_json(tree, indent=2))
+
+    assert read_json(io.StringIO(text), validate=False) == tree
+
+
+def test_read_json_detects_cycles():
+    text = '{"id": "a", "children": [{"id": "b", "children": [{"id": "a"}]}]}'
+
+    with pytest.raises(ValueError, match="Cycle detected .* node: a"):
+        read_json(io.StringIO(text))
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        '{"id": "root", "children": [}',
+        '{"id": "root",}',
+        '{"id": "root"} {"id": "other"}',
+        '{"id": "root", "children": [1]}',
+        '{"id": "root", "children": "oops"}',
+        '{"id": "root", "children": [{"children": []}]}',
+        '{"id": "unterminated',
+        "[]",
+    ],
+)
+def test_read_json_rejects_invalid_input(text: str):
+    with pytest.raises(ValueError):
+        read_json(io.StringIO(text))
+
+
+def make_shared() -> MbirdNode:
+    shared = MbirdNode.from_dict({"id": "s", "children": [{"id": "s1"}]})
+    return MbirdNode(id="root", children=[MbirdNode(id="a", children=[shared]), shared])
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_shared_nodes_are_written_once(indent: int | None):
+    root = make_shared()
+
+    text = "".join(iter_json(root, indent=indent))
+    decoded = json.loads(text)
+
+    assert text.count('"s1"') == 1
+    assert decoded["children"][1] == {"ref": "s"}
+    read = read_json(io.StringIO(text), chunk_size=7)
+    assert read.children[1] is read.children[0].children[0]
+    assert read.model_dump() == root.model_dump()
+
+
+def test_encode_json_writes_shared_nodes_once_when_asked():
+    root = make_shared()
+
+    assert encode_json(root).count(b'"s1"') == 2
+    assert encode_json(root, shared=True) == "".join(iter_json(root)).encode()
+
+
+def test_read_json_shares_repeated_nodes():
+    root = make_shared()
+
+    read = read_json(io.StringIO(encode_json(root).decode()))
+
+    assert read.children[1] is read.children[0].children[0]
+
+
+@pytest.mark.parametrize(
+    "value", [None, 1.5, 'quoted "é"', [], {}, {"a": [1, True, {"b": []}]}]
+)
+def test_dumps_and_loads_json_match_json_module(value: object):
+    text = dumps_json(value)
+
+    assert text == json.dumps(value, separators=(",", ":"))
+    assert loads_json(text) == value
+
+
+def test_dumps_and_loads_json_handle_deep_patches():
+    root = make_chain(5000)
+    patch = TreePatch(
+        ops=[
+            AddChild(parent_id="a", node=root),
+            AddChild(parent_id="b", node=json.loads(encode_json(make_chain(100)))),
+        ]
+    )
+
+    text = dumps_json(patch)
+    parsed = TreePatch.model_validate(loads_json(text))
+
+    assert text.startswith('{"ops":[{"op":"add","parent_id":"a","node":{"id":')
+    assert dumps_json(parsed) == text
+
+
+@pytest.mark.parametrize("text", ["", "[1,]", '{"a" 1}', "[1] 2", "{]", '"open'])
+def test_loads_json_rejects_invalid_input(text: str):
+    with pytest.raises(ValueError):
+        loads_json(text)